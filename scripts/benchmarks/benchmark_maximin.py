@@ -0,0 +1,67 @@
+"""
+Benchmark the maximin baseline of dcnv.preprocess computed with torch max
+pooling against the numba monotonic-deque filters used on the CPU.
+
+    python scripts/benchmarks/benchmark_maximin.py --ncells 2000 --nframes 54000 --fs 30
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.nn.functional import conv1d, max_pool1d, pad
+
+from suite2p.extraction.dcnv import preprocess
+
+
+def maximin_max_pool(F, win_baseline, sig_baseline, fs, batch_size=100):
+    """ maximin baseline with torch max pooling on the CPU (previous implementation) """
+    win = int(win_baseline * fs)
+    win += 1 if win % 2 == 0 else 0
+    Flow = np.zeros(F.shape, "float32")
+    gwid = int(np.round(sig_baseline * 3))
+    gaussian = torch.exp(-torch.arange(-gwid, gwid + 1, 1)**2 / (2 * sig_baseline**2))
+    gaussian /= gaussian.sum()
+    for nstart in range(0, F.shape[0], batch_size):
+        data = torch.from_numpy(F[nstart : nstart + batch_size]).float()
+        data = pad(data, (gwid, gwid), "replicate")
+        data = conv1d(data.unsqueeze(1), gaussian.unsqueeze(0).unsqueeze(0), padding=0)
+        data = pad(data, (win // 2, win // 2), "replicate")
+        data = -max_pool1d(-data, kernel_size=win, stride=1, padding=0)
+        data = pad(data, (win // 2, win // 2), "replicate")
+        data = max_pool1d(data, kernel_size=win, stride=1, padding=0)
+        Flow[nstart : nstart + batch_size] = data.squeeze().numpy()
+    return F - Flow
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="maximin baseline benchmark")
+    parser.add_argument("--ncells", type=int, default=2000)
+    parser.add_argument("--nframes", type=int, default=54000)
+    parser.add_argument("--fs", type=float, default=30.)
+    parser.add_argument("--win_baseline", type=float, default=60.)
+    parser.add_argument("--sig_baseline", type=float, default=10.)
+    parser.add_argument("--batch_size", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    F = rng.standard_normal((args.ncells, args.nframes), dtype="float32")
+    F += np.sin(np.linspace(0, 20, args.nframes, dtype="float32"))
+
+    print(f"traces: {F.shape}, window: {args.win_baseline} s at {args.fs} Hz "
+          f"({int(args.win_baseline * args.fs)} frames)")
+    # compile the numba kernels
+    preprocess(F[:2, :1000].copy(), "maximin", args.win_baseline, args.sig_baseline, args.fs,
+               device=torch.device("cpu"))
+    t0 = time.time()
+    ref = maximin_max_pool(F, args.win_baseline, args.sig_baseline, args.fs,
+                           batch_size=args.batch_size)
+    t_pool = time.time() - t0
+    t0 = time.time()
+    out = preprocess(F, "maximin", args.win_baseline, args.sig_baseline, args.fs,
+                     batch_size=args.batch_size, device=torch.device("cpu"))
+    t_deque = time.time() - t0
+    print(f"{'method':<24}{'time (s)':>10}")
+    print(f"{'torch max_pool1d':<24}{t_pool:>10.2f}")
+    print(f"{'numba deque':<24}{t_deque:>10.2f}")
+    print(f"identical output: {np.array_equal(out, ref)}")
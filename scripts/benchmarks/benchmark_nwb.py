@@ -0,0 +1,143 @@
+"""
+Benchmark the NWB export (io.save_nwb) with streamed, chunked traces,
+columnar pixel masks and parallel plane loading against the previous
+writer, which added the ROIs one at a time and wrote uncompressed traces
+held in memory. Reports the export time and the file size.
+
+On the test data (downloaded by the tests to data/test_outputs):
+
+    python scripts/benchmarks/benchmark_nwb.py --save_folder data/test_outputs/2plane2chan1500/suite2p
+
+On synthetic plane folders:
+
+    python scripts/benchmarks/benchmark_nwb.py --nplanes 4 --ncells 2000 --nframes 20000
+"""
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from natsort import natsorted
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.ophys import Fluorescence, ImageSegmentation, OpticalChannel, RoiResponseSeries
+
+from suite2p import default_settings
+from suite2p.io.nwb import save_nwb, NWB_TRACES
+
+
+def save_nwb_per_roi(save_folder):
+    """ previous writer: ROIs added one at a time, uncompressed in-memory traces
+    (the acquisition series and background images are omitted) """
+    plane_folders = natsorted([f.path for f in os.scandir(save_folder)
+                               if f.is_dir() and f.name[:5] == "plane"])
+    multiplane = len(plane_folders) > 1
+    nwbfile = NWBFile(session_description="suite2p_proc", identifier="benchmark",
+                      session_start_time=datetime.datetime.now().astimezone())
+    device = nwbfile.create_device(name="Microscope")
+    imaging_plane = nwbfile.create_imaging_plane(
+        name="ImagingPlane", optical_channel=OpticalChannel(
+            name="OpticalChannel", description="an optical channel", emission_lambda=500.0),
+        imaging_rate=10., description="standard", device=device, excitation_lambda=600.0,
+        indicator="GCaMP", location="V1")
+    img_seg = ImageSegmentation()
+    ps = img_seg.create_plane_segmentation(name="PlaneSegmentation",
+                                           description="suite2p output",
+                                           imaging_plane=imaging_plane)
+    ophys_module = nwbfile.create_processing_module(name="ophys", description="ophys")
+    ophys_module.add(img_seg)
+    ncells, iscell = [], []
+    for iplane, folder in enumerate(plane_folders):
+        stat = np.load(os.path.join(folder, "stat.npy"), allow_pickle=True)
+        for s in stat:
+            if multiplane:
+                ps.add_roi(voxel_mask=np.array([s["ypix"], s["xpix"],
+                                                iplane * np.ones(len(s["ypix"])), s["lam"]]).T)
+            else:
+                ps.add_roi(pixel_mask=np.array([s["ypix"], s["xpix"], s["lam"]]).T)
+        ncells.append(len(stat))
+        iscell.append(np.load(os.path.join(folder, "iscell.npy")))
+    ps.add_column("iscell", "two columns - iscell & probcell", np.concatenate(iscell))
+    starts = np.cumsum([0] + ncells)
+    regions = [ps.create_roi_table_region(region=list(range(starts[i], starts[i + 1])),
+                                          description=f"ROIs for plane{i}")
+               for i in range(len(plane_folders))]
+    for fstr, nstr in NWB_TRACES.items():
+        fl = Fluorescence(name=nstr)
+        ophys_module.add(fl)
+        for iplane, folder in enumerate(plane_folders):
+            fl.add_roi_response_series(roi_response_series=RoiResponseSeries(
+                name=f"plane{iplane}", data=np.load(os.path.join(folder, fstr)).T,
+                rois=regions[iplane], unit="lumens", rate=10.))
+    with NWBHDF5IO(os.path.join(save_folder, "ophys.nwb"), "w") as fio:
+        fio.write(nwbfile)
+
+
+def make_plane_folders(save_folder, nplanes, ncells, nframes, Ly=512, Lx=512, npix=100):
+    """ synthetic plane folders with random ROIs and smooth (compressible) traces """
+    rng = np.random.default_rng(0)
+    for iplane in range(nplanes):
+        folder = os.path.join(save_folder, f"plane{iplane}")
+        os.makedirs(folder)
+        stat = []
+        for n in range(ncells):
+            y0, x0 = rng.integers(0, [Ly - 12, Lx - 12])
+            ypix, xpix = np.unravel_index(rng.choice(144, npix, replace=False), (12, 12))
+            stat.append({"ypix": ypix + y0, "xpix": xpix + x0,
+                         "lam": rng.random(npix).astype("float32"), "npix": npix,
+                         "med": [y0 + 6, x0 + 6]})
+        np.save(os.path.join(folder, "stat.npy"), np.array(stat, dtype=object))
+        for fstr in NWB_TRACES:
+            spikes = (rng.random((ncells, nframes)) < 0.01).astype("float32")
+            traces = np.cumsum(spikes, axis=1) * 0.1
+            traces -= np.floor(traces)
+            np.save(os.path.join(folder, fstr), traces.astype("float32"))
+        np.save(os.path.join(folder, "iscell.npy"), rng.random((ncells, 2)))
+        np.save(os.path.join(folder, "db.npy"), {
+            "Ly": Ly, "Lx": Lx, "nframes": nframes, "nchannels": 1, "nplanes": nplanes,
+            "data_path": [save_folder]})
+        np.save(os.path.join(folder, "settings.npy"), default_settings())
+        np.save(os.path.join(folder, "reg_outputs.npy"), {
+            "meanImg": rng.random((Ly, Lx)), "yrange": [0, Ly], "xrange": [0, Lx]})
+        np.save(os.path.join(folder, "detect_outputs.npy"), {
+            "Vcorr": rng.random((Ly, Lx)), "max_proj": rng.random((Ly, Lx))})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NWB export benchmark")
+    parser.add_argument("--save_folder", type=str, default="",
+                        help="suite2p folder with plane folders (copied before exporting)")
+    parser.add_argument("--nplanes", type=int, default=4)
+    parser.add_argument("--ncells", type=int, default=2000)
+    parser.add_argument("--nframes", type=int, default=20000)
+    parser.add_argument("--n_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = os.path.join(tmp, "suite2p")
+        if args.save_folder:
+            shutil.copytree(args.save_folder, folder,
+                            ignore=shutil.ignore_patterns("*.bin", "combined", "ophys.nwb"))
+        else:
+            make_plane_folders(folder, args.nplanes, args.ncells, args.nframes)
+        print(f"exporting {folder} ({len(list(Path(folder).glob('plane*')))} planes)")
+
+        writers = {
+            "per-ROI, uncompressed": lambda: save_nwb_per_roi(folder),
+            "streamed, uncompressed": lambda: save_nwb(folder, compression=None,
+                                                       n_workers=args.n_workers),
+            "streamed, gzip 4": lambda: save_nwb(folder, n_workers=args.n_workers),
+        }
+        print(f"{'writer':<26}{'time (s)':>10}{'size (MB)':>12}")
+        for name, writer in writers.items():
+            t0 = time.time()
+            writer()
+            t = time.time() - t0
+            size = os.path.getsize(os.path.join(folder, "ophys.nwb")) / 2**20
+            print(f"{name:<26}{t:>10.2f}{size:>12.1f}")
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,67 @@
+"""
+Benchmark the randomized SVD backend against the full decompositions used in
+sourcery.getSVDdata and denoise.pca_denoise, on a synthetic low-rank movie.
+
+    python scripts/benchmarks/benchmark_svd.py --nframes 2000 --Ly 256 --Lx 256 --device cuda
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+from suite2p.detection.denoise import pca_denoise
+from suite2p.detection.sourcery import getSVDdata
+
+
+def synthetic_movie(nframes, Ly, Lx, rank=20, noise=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    mov = rng.standard_normal((nframes, rank), dtype="float32") @ \
+        rng.standard_normal((rank, Ly * Lx), dtype="float32")
+    mov += noise * rng.standard_normal((nframes, Ly * Lx), dtype="float32")
+    return mov.reshape(nframes, Ly, Lx)
+
+
+def run(fun, *args, **kwargs):
+    tracemalloc.start()
+    t0 = time.time()
+    out = fun(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    runtime = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return out, runtime, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="randomized SVD benchmark")
+    parser.add_argument("--nframes", type=int, default=2000)
+    parser.add_argument("--Ly", type=int, default=256)
+    parser.add_argument("--Lx", type=int, default=256)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    mov = synthetic_movie(args.nframes, args.Ly, args.Lx)
+    diameter = np.array([12., 12.])
+
+    print(f"movie: {mov.shape}, device: {device}")
+    print(f"{'function':<24}{'method':<12}{'time (s)':>10}{'peak host MB':>14}{'rel. err':>10}")
+    ref = None
+    for method in ["full", "randomized"]:
+        out, runtime, peak = run(pca_denoise, mov.copy(), block_size=[64, 64],
+                                 n_comps_frac=0.5, svd_method=method, device=device)
+        ref = out if ref is None else ref
+        err = np.linalg.norm(out - ref) / np.linalg.norm(ref)
+        print(f"{'pca_denoise':<24}{method:<12}{runtime:>10.2f}{peak:>14.1f}{err:>10.2e}")
+
+    ref = None
+    for method in ["full", "randomized"]:
+        (U, u), runtime, peak = run(getSVDdata, mov.copy(), diameter,
+                                    svd_method=method, device=device)
+        # compare the subspace spanned by the top 20 temporal components
+        ref = u[:, :20] if ref is None else ref
+        err = 1 - np.abs(np.linalg.svd(ref.T @ u[:, :20])[1]).min()
+        print(f"{'sourcery.getSVDdata':<24}{method:<12}{runtime:>10.2f}{peak:>14.1f}{err:>10.2e}")
@@ -1,10 +1,12 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
-import argparse, os, platform
+import argparse, os, platform, traceback
 import numpy as np
 from suite2p import default_settings, default_db, version
-from suite2p.run_s2p import logger_setup, run_plane, run_s2p, get_save_folder
+from suite2p.run_s2p import logger_setup, run_plane, run_s2p, append_s2p, get_save_folder
+from suite2p.io.jobs import write_status
+from suite2p.io.store import convert_results
 import logging
 
 def add_args(parser: argparse.ArgumentParser):
@@ -15,6 +17,12 @@ def add_args(parser: argparse.ArgumentParser):
                         help="run single plane db/settings")
     parser.add_argument("--settings", default=[], type=str, help="options")
     parser.add_argument("--db", default=[], type=str, help="options")
+    parser.add_argument("--status", default=None, type=str,
+                        help="status file the state of the run is written to (see io.jobs).")
+    parser.add_argument("--append", action="store_true",
+                        help="append new files in data_path to the processed planes.")
+    parser.add_argument("--convert_results", default=None, type=str,
+                        help="add the columnar results store to existing result folders.")
     parser.add_argument("--version", action="store_true", help="print version number.")
     parser.add_argument("--verbose", action="store_true", help="print more info during processing.")
     return parser
@@ -38,17 +46,28 @@ def main():
         add_args(argparse.ArgumentParser(description="Suite2p settings/db paths")))
     if args.version:
         print("suite2p v{}".format(version))
+    elif args.convert_results:
+        logger_setup()
+        convert_results(args.convert_results)
     elif args.settings and args.db:
         if args.verbose:
             save_folder = db['save_path'] if args.single_plane else get_save_folder(db)
             logger_setup(save_folder)
         try:
+            if args.status:
+                write_status(args.status, "running")
             if args.single_plane:
                 run_plane(db=db, settings=settings, db_path=args.db)
+            elif args.append:
+                append_s2p(db=db, settings=settings)
             else:
                 run_s2p(db=db, settings=settings)
+            if args.status:
+                write_status(args.status, "done")
         except Exception as e:
             logging.exception(f'fatal error in {"run_plane" if args.single_plane else "run_s2p"}:')
+            if args.status:
+                write_status(args.status, "failed", traceback.format_exc())
             raise
 
     else:
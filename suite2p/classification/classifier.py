@@ -1,12 +1,57 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+import os
+import hashlib
 import numpy as np
 from scipy.ndimage import gaussian_filter
+from scipy.special import expit
 from sklearn.linear_model import LogisticRegression
 import logging
 logger = logging.getLogger(__name__)
 
+from ..detection.roitable import ROITable
+
+# classifier files loaded in this process, by path and modification time
+_MODEL_CACHE = {}
+# fitted grid, p and logistic coefficients, by training data digest and keys
+_FIT_CACHE = {}
+
+
+def _load_model(classfile):
+    """ load a classifier file, reusing the loaded dictionary while the file is unchanged """
+    key = (os.path.abspath(classfile), os.stat(classfile).st_mtime_ns)
+    if key not in _MODEL_CACHE:
+        _MODEL_CACHE.clear()
+        _MODEL_CACHE[key] = np.load(classfile, allow_pickle=True).item()
+    return _MODEL_CACHE[key]
+
+
+def feature_table(stat, keys):
+    """
+    Table of the classifier features of each ROI.
+
+    Parameters
+    ----------
+    stat : numpy.ndarray, list of dict or ROITable
+        ROI statistics containing the keys.
+    keys : list of str
+        Keys of ROI stat used as features.
+
+    Returns
+    -------
+    features : numpy.ndarray
+        Features of shape (n_rois, n_keys), float64.
+    """
+    if isinstance(stat, ROITable):
+        return np.stack([np.asarray(stat.columns[k], np.float64) for k in keys],
+                        axis=1).reshape(len(stat), len(keys))
+    features = np.zeros((len(stat), len(keys)), np.float64)
+    for n, k in enumerate(keys):
+        features[:, n] = np.fromiter((s[k] for s in stat), np.float64, count=len(stat))
+    return features
+
+
 class Classifier:
     """
     ROI classifier model that uses a weighted, non-parametric, naive Bayes classifier.
@@ -40,19 +85,19 @@ class Classifier:
             Keys of ROI stat to use to classify.
         """
         try:
-            model = np.load(classfile, allow_pickle=True).item()
+            model = _load_model(classfile)
             if keys is None:
-                self.keys = model["keys"]
+                self.keys = list(model["keys"])
                 self.stats = model["stats"]
             else:
-                model["keys"] = np.array(model["keys"])
-                ikey = np.isin(model["keys"], keys)
-                self.keys = model["keys"][ikey].tolist()
+                model_keys = np.array(model["keys"])
+                ikey = np.isin(model_keys, keys)
+                self.keys = model_keys[ikey].tolist()
                 self.stats = model["stats"][:, ikey]
             self.iscell = model["iscell"]
             self.loaded = True
             self.classfile = classfile
-            self._fit()
+            self._load_fit(model.get("fits", {}))
         except (ValueError, KeyError, OSError, RuntimeError, TypeError, NameError):
             print("ERROR: incorrect classifier file")
             self.loaded = False
@@ -92,10 +137,8 @@ class Classifier:
         y_pred : numpy.ndarray
             Predicted probability of each ROI being a cell, shape (n_rois,).
         """
-        test_stats = np.array([stat[j][k] for j in range(len(stat)) for k in self.keys
-                              ]).reshape(len(stat), -1)
-        logp = self._get_logp(test_stats)
-        y_pred = self.model.predict_proba(logp)[:, 1]
+        logp = self._get_logp(feature_table(stat, self.keys))
+        y_pred = expit(logp @ self.coef + self.intercept)
         return y_pred
 
     def save(self, filename):
@@ -110,7 +153,8 @@ class Classifier:
         np.save(filename, {
             "stats": self.stats,
             "iscell": self.iscell,
-            "keys": self.keys
+            "keys": self.keys,
+            "fits": {tuple(self.keys): self._fit_params()},
         })
 
     def _get_logp(self, stats):
@@ -127,17 +171,50 @@ class Classifier:
         logp : numpy.ndarray
             Log probability array of shape (n_cells, n_keys).
         """
+        stats = np.clip(stats, self.grid[0], self.grid[-1])
+        stats = np.where(np.isnan(stats), self.grid[0], stats)
         logp = np.zeros(stats.shape)
         for n in range(stats.shape[1]):
-            x = stats[:, n]
-            x[x < self.grid[0, n]] = self.grid[0, n]
-            x[x > self.grid[-1, n]] = self.grid[-1, n]
-            x[np.isnan(x)] = self.grid[0, n]
-            ibin = np.digitize(x, self.grid[:, n], right=True) - 1
+            ibin = np.searchsorted(self.grid[:, n], stats[:, n], side="left") - 1
             logp[:, n] = np.log(self.p[ibin, n] + 1e-6) - np.log(1 - self.p[ibin, n] +
                                                                  1e-6)
         return logp
 
+    def _digest(self):
+        """ digest of the training data and keys of the classifier """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr(self.keys).encode())
+        for X in [self.stats, self.iscell]:
+            X = np.ascontiguousarray(X)
+            h.update(str((X.dtype, X.shape)).encode())
+            h.update(X.tobytes())
+        return h.hexdigest()
+
+    def _fit_params(self):
+        """ fitted grid, p and logistic coefficients, with the digest of the training data """
+        return {"digest": self._digest(), "grid": self.grid, "p": self.p,
+                "coef": self.coef, "intercept": self.intercept}
+
+    def _load_fit(self, fits):
+        """
+        Use the fit saved in the classifier file or cached in this process, or fit the classifier.
+
+        Parameters
+        ----------
+        fits : dict
+            Saved fits of the classifier file, by tuple of keys.
+        """
+        digest = self._digest()
+        fit = fits.get(tuple(self.keys), None)
+        if fit is None or fit.get("digest", None) != digest:
+            fit = _FIT_CACHE.get(digest, None)
+        if fit is None:
+            self._fit()
+            _FIT_CACHE[digest] = self._fit_params()
+        else:
+            self.grid, self.p = fit["grid"], fit["p"]
+            self.coef, self.intercept = fit["coef"], fit["intercept"]
+
     def _fit(self):
         """
         Fit weighted, non-parametric naive Bayes classifier using self.stats, self.keys, and self.iscell.
@@ -151,13 +228,17 @@ class Classifier:
         isort = np.argsort(self.stats, axis=0)
         ix = np.linspace(0, ncells - 1, nodes).astype("int32")
         grid = ssort[ix, :]
-        p = np.zeros((nodes - 1, nstats))
-        for j in range(nodes - 1):
-            for k in range(nstats):
-                p[j, k] = np.mean(self.iscell[isort[ix[j]:ix[j + 1], k]])
+        # fraction of cells between consecutive grid nodes, from cumulative sums
+        ncum = np.zeros((ncells + 1, nstats))
+        ncum[1:] = np.cumsum(self.iscell[isort], axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            p = (ncum[ix[1:]] - ncum[ix[:-1]]) / np.diff(ix)[:, np.newaxis]
+        # round to the precision of the mean of iscell
+        p = p.astype(np.mean(self.iscell[:1]).dtype).astype(np.float64)
         p = gaussian_filter(p, (2., 0))
         self.grid = grid
         self.p = p
         logp = self._get_logp(self.stats)
         self.model = LogisticRegression(C=100., solver="liblinear")
         self.model.fit(logp, self.iscell)
+        self.coef, self.intercept = self.model.coef_[0], self.model.intercept_[0]
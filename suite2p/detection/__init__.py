@@ -3,3 +3,4 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 """
 from .detect import detection_wrapper, bin_movie
 from .stats import roi_stats, assign_overlaps
+from .roitable import ROITable
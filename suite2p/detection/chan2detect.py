@@ -135,22 +135,17 @@ def intensity_ratio(mimg2, stats, chan2_threshold=0.65, inner_neuropil_radius=2,
     cell_masks0 = [
         masks.create_cell_mask(stat, Ly=Ly, Lx=Lx, allow_overlap=True) for stat in stats
     ]
-    neuropil_ipix = masks.create_neuropil_masks(
+    neuropil_masks = masks.create_neuropil_mask_matrix(
         ypixs=[stat["ypix"] for stat in stats],
         xpixs=[stat["xpix"] for stat in stats],
         cell_pix=cell_pix,
         inner_neuropil_radius=inner_neuropil_radius,
         min_neuropil_pixels=min_neuropil_pixels
     )
-    cell_masks = np.zeros((len(stats), Ly * Lx), np.float32)
-    neuropil_masks = np.zeros((len(stats), Ly * Lx), np.float32)
-    for cell_mask, cell_mask0, neuropil_mask, neuropil_mask0 in zip(
-            cell_masks, cell_masks0, neuropil_masks, neuropil_ipix):
-        cell_mask[cell_mask0[0]] = cell_mask0[1]
-        neuropil_mask[neuropil_mask0.astype(np.int64)] = 1. / len(neuropil_mask0)
-
-    inpix = cell_masks @ mimg2.flatten()
-    extpix = neuropil_masks @ mimg2.flatten()
+    mimg2 = mimg2.flatten().astype(np.float32)
+    inpix = np.array([mimg2[ipix] @ lam for ipix, lam in cell_masks0], np.float32)
+    npix_neu = np.asarray(neuropil_masks.sum(axis=1)).flatten()
+    extpix = (neuropil_masks @ mimg2) / np.maximum(1, npix_neu)
     inpix = np.maximum(1e-3, inpix)
     redprob = inpix / (inpix + extpix)
     redcell = redprob > chan2_threshold
@@ -3,14 +3,17 @@ Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer a
 """
 import numpy as np
 import time
+import torch
 from sklearn.decomposition import PCA
-import logging 
+import logging
 logger = logging.getLogger(__name__)
 
 from ..registration.nonrigid import make_blocks, spatial_taper
+from .svd import randomized_svd, svd_device
 
 
-def pca_denoise(mov, block_size, n_comps_frac):
+def pca_denoise(mov, block_size, n_comps_frac, svd_method="full", batch_size=100,
+                device=torch.device("cuda")):
     """
     Denoise a movie using block-wise PCA reconstruction.
 
@@ -28,6 +31,13 @@ def pca_denoise(mov, block_size, n_comps_frac):
     n_comps_frac : float
         Fraction of the smaller block dimension used to set the number
         of PCA components (number of PCs n_comps = min(Lyb, Lxb) * n_comps_frac).
+    svd_method : str, optional (default "full")
+        "full" fits a sklearn PCA per block, "randomized" decomposes all
+        blocks at once with a batched randomized SVD on device.
+    batch_size : int, optional (default 100)
+        Number of frames per batch for the randomized SVD.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for the randomized SVD.
 
     Returns
     -------
@@ -45,23 +55,88 @@ def pca_denoise(mov, block_size, n_comps_frac):
     Lyb, Lxb = block_size
     n_comps = int(min(min(Lyb * Lxb, nframes), min(Lyb, Lxb) * n_comps_frac))
     maskMul = spatial_taper(Lyb // 4, Lyb, Lxb).numpy()
-    norm = np.zeros((Ly, Lx), np.float32)
-    reconstruction = np.zeros_like(mov)
-    block_re = np.zeros((nblocks, nframes, Lyb * Lxb))
-    for i in range(nblocks):
-        block = mov[:, yblock[i][0]:yblock[i][-1],
-                    xblock[i][0]:xblock[i][-1]].reshape(-1, Lyb * Lxb)
-        model = PCA(n_components=n_comps, random_state=0).fit(block)
-        block_re[i] = (block @ model.components_.T) @ model.components_
-        norm[yblock[i][0]:yblock[i][-1], xblock[i][0]:xblock[i][-1]] += maskMul
-
-    block_re = block_re.reshape(nblocks, nframes, Lyb, Lxb)
-    block_re *= maskMul
-    for i in range(nblocks):
-        reconstruction[:, yblock[i][0]:yblock[i][-1],
-                       xblock[i][0]:xblock[i][-1]] += block_re[i]
-    reconstruction /= norm
+    if svd_method == "randomized":
+        reconstruction = _pca_denoise_blocks(mov, yblock, xblock, n_comps, maskMul,
+                                             batch_size=batch_size, device=device)
+    else:
+        norm = np.zeros((Ly, Lx), np.float32)
+        reconstruction = np.zeros_like(mov)
+        block_re = np.zeros((nblocks, nframes, Lyb * Lxb))
+        for i in range(nblocks):
+            block = mov[:, yblock[i][0]:yblock[i][-1],
+                        xblock[i][0]:xblock[i][-1]].reshape(-1, Lyb * Lxb)
+            model = PCA(n_components=n_comps, random_state=0).fit(block)
+            block_re[i] = (block @ model.components_.T) @ model.components_
+            norm[yblock[i][0]:yblock[i][-1], xblock[i][0]:xblock[i][-1]] += maskMul
+
+        block_re = block_re.reshape(nblocks, nframes, Lyb, Lxb)
+        block_re *= maskMul
+        for i in range(nblocks):
+            reconstruction[:, yblock[i][0]:yblock[i][-1],
+                           xblock[i][0]:xblock[i][-1]] += block_re[i]
+        reconstruction /= norm
     logger.info("Binned movie denoised (for cell detection only) in %0.2f sec." %
           (time.time() - t0))
     reconstruction += mov_mean
     return reconstruction
+
+
+def _pca_denoise_blocks(mov, yblock, xblock, n_comps, maskMul, batch_size=100,
+                        device=torch.device("cuda")):
+    """
+    Reconstruct a mean-subtracted movie from the top PCs of all blocks at once.
+
+    The blocks are decomposed together with a batched randomized SVD that
+    streams over frames, and the tapered block reconstructions are accumulated
+    directly into the output movie, so no per-block copy of the movie is made.
+
+    Parameters
+    ----------
+    mov : numpy.ndarray
+        Mean-subtracted movie of shape (nframes, Ly, Lx).
+    yblock : list of numpy.ndarray
+        Y start and end of each block, from make_blocks.
+    xblock : list of numpy.ndarray
+        X start and end of each block, from make_blocks.
+    n_comps : int
+        Number of principal components kept per block.
+    maskMul : numpy.ndarray
+        Spatial taper of shape (Lyb, Lxb) used to blend the blocks.
+    batch_size : int, optional (default 100)
+        Number of frames per batch.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    reconstruction : numpy.ndarray
+        Denoised movie of shape (nframes, Ly, Lx), float32.
+    """
+    device = svd_device(device)
+    nframes, Ly, Lx = mov.shape
+    nblocks = len(yblock)
+    Lyb, Lxb = maskMul.shape
+    slices = [(slice(yb[0], yb[-1]), slice(xb[0], xb[-1])) for yb, xb in zip(yblock, xblock)]
+
+    def get_rows(tstart, tend):
+        data = torch.from_numpy(mov[tstart : tend]).to(device, dtype=torch.float32)
+        blocks = torch.stack([data[:, ys, xs] for ys, xs in slices])
+        return blocks.reshape(nblocks, tend - tstart, Lyb * Lxb)
+
+    Vh = randomized_svd(get_rows, nframes, Lyb * Lxb, n_comps, n_batch=nblocks,
+                        batch_size=batch_size, device=device)[2]
+
+    maskMul = torch.from_numpy(maskMul.astype("float32")).to(device)
+    norm = torch.zeros((Ly, Lx), dtype=torch.float32, device=device)
+    for ys, xs in slices:
+        norm[ys, xs] += maskMul
+    reconstruction = np.zeros((nframes, Ly, Lx), "float32")
+    for tstart in range(0, nframes, batch_size):
+        tend = min(tstart + batch_size, nframes)
+        block_re = (get_rows(tstart, tend) @ Vh.transpose(-2, -1)) @ Vh
+        block_re = block_re.reshape(nblocks, tend - tstart, Lyb, Lxb) * maskMul
+        re = torch.zeros((tend - tstart, Ly, Lx), dtype=torch.float32, device=device)
+        for i, (ys, xs) in enumerate(slices):
+            re[:, ys, xs] += block_re[i]
+        reconstruction[tstart : tend] = (re / norm).cpu().numpy()
+    return reconstruction
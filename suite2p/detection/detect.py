@@ -68,17 +68,17 @@ def bin_movie(f_reg, bin_size, yrange=None, xrange=None, badframes=None, nbins=5
     for n in trange(n_batches, mininterval=10, file=tqdm_out):
         tstart = tstarts[n]
         tend = min(tstart + batch_size, n_frames)
-        data = f_reg[tstart : tend]
-        
+        # read only the valid region
+        if yrange is not None and xrange is not None:
+            data = f_reg[tstart : tend, slice(*yrange), slice(*xrange)]
+        else:
+            data = f_reg[tstart : tend]
+
         # exclude badframes
         good_indices = good_frames[tstart : tend]
         if good_indices.mean() > 0.5:
             data = data[good_indices]
 
-        # crop to valid region
-        if yrange is not None and xrange is not None:
-            data = data[:, slice(*yrange), slice(*xrange)]
-
         # bin in time
         if data.shape[0] > bin_size:
             # Downsample by binning via reshaping and taking mean of each bin
@@ -145,7 +145,7 @@ def detection_wrapper(f_reg, diameter=[12., 12.], tau=1., fs=30, meanImg_chan2=N
     settings : dict, optional
         Detection settings dictionary.
     device : torch.device, optional (default torch.device("cuda"))
-        Torch device for cellpose-based detection.
+        Torch device for cellpose-based detection and the randomized SVD.
 
     Returns
     -------
@@ -185,7 +185,8 @@ def detection_wrapper(f_reg, diameter=[12., 12.], tau=1., fs=30, meanImg_chan2=N
     if settings.get("denoise", False):
         mov = pca_denoise(
             mov, block_size=settings["block_size"],
-            n_comps_frac=0.5)
+            n_comps_frac=0.5, svd_method=settings.get("svd_method", "full"),
+            device=device)
 
     meanImg = mov.mean(axis=0) 
 
@@ -215,6 +216,8 @@ def detection_wrapper(f_reg, diameter=[12., 12.], tau=1., fs=30, meanImg_chan2=N
         else:
             new_settings, stat = sourcery.sourcery(mov=mov, sdmov=sdmov, diameter=diameter,
                                               threshold_scaling=settings["threshold_scaling"],
+                                              svd_method=settings.get("svd_method", "full"),
+                                              device=device,
                                               **settings["sourcery_settings"])
     logger.info("Detected %d ROIs, %0.2f sec" % (len(stat), time.time() - t0))
     stat = np.array(stat)
@@ -0,0 +1,229 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# keys of the legacy stat dictionaries with one value per ROI pixel
+PIXEL_KEYS = ["overlap", "soma_crop"]
+
+
+class ROITable:
+    """
+    Columnar storage of ROIs.
+
+    The pixels of all ROIs are concatenated into flat ypix / xpix / lam
+    arrays, and the pixels of ROI k are ypix[offsets[k] : offsets[k+1]].
+    Other per-pixel keys (e.g. "overlap", "soma_crop") are stored as flat
+    arrays in `pixel_columns`, and per-ROI keys (e.g. "npix", "med") as
+    arrays with one row per ROI in `columns`. Keys whose values are not
+    numeric (or whose shapes differ across ROIs) are kept as object arrays.
+
+    Parameters
+    ----------
+    ypix : numpy.ndarray
+        Y-coordinates of the pixels of all ROIs, shape (npix_total,).
+    xpix : numpy.ndarray
+        X-coordinates of the pixels of all ROIs, shape (npix_total,).
+    lam : numpy.ndarray
+        Pixel weights of all ROIs, shape (npix_total,).
+    offsets : numpy.ndarray
+        Start of each ROI in the flat pixel arrays, shape (n_rois + 1,).
+    pixel_columns : dict, optional
+        Flat per-pixel arrays of shape (npix_total,).
+    columns : dict, optional
+        Per-ROI arrays of shape (n_rois, ...).
+    list_columns : set, optional
+        Keys of `columns` stored as lists in the legacy stat format.
+    """
+
+    def __init__(self, ypix, xpix, lam, offsets, pixel_columns=None, columns=None,
+                 list_columns=None):
+        self.ypix = np.asarray(ypix)
+        self.xpix = np.asarray(xpix)
+        self.lam = np.asarray(lam)
+        self.offsets = np.asarray(offsets, dtype="int64")
+        self.pixel_columns = {} if pixel_columns is None else dict(pixel_columns)
+        self.columns = {} if columns is None else dict(columns)
+        self.list_columns = set() if list_columns is None else set(list_columns)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def npix(self):
+        """ number of pixels in each ROI """
+        return np.diff(self.offsets)
+
+    @property
+    def roi_index(self):
+        """ index of the ROI of each pixel in the flat pixel arrays """
+        return np.repeat(np.arange(len(self), dtype="int64"), self.npix)
+
+    def pixel_slice(self, k):
+        """ slice of ROI k in the flat pixel arrays """
+        return slice(self.offsets[k], self.offsets[k + 1])
+
+    def ipix(self, Lx):
+        """ flattened (y * Lx + x) pixel indices of all ROIs """
+        return self.ypix.astype("int64") * Lx + self.xpix
+
+    def keys(self):
+        return (["ypix", "xpix", "lam"] + list(self.pixel_columns.keys()) +
+                list(self.columns.keys()))
+
+    def __getitem__(self, index):
+        """ subset of the ROIs selected by an integer array, boolean mask or slice """
+        iroi = np.arange(len(self))[index]
+        if np.isscalar(iroi):
+            iroi = np.array([iroi])
+        npix = self.npix[iroi]
+        offsets = np.zeros(len(iroi) + 1, "int64")
+        offsets[1:] = np.cumsum(npix)
+        # indices of the pixels of the selected ROIs in the flat arrays
+        ip = (np.repeat(self.offsets[iroi] - offsets[:-1], npix) +
+              np.arange(offsets[-1], dtype="int64"))
+        return ROITable(self.ypix[ip], self.xpix[ip], self.lam[ip], offsets,
+                        pixel_columns={k: v[ip] for k, v in self.pixel_columns.items()},
+                        columns={k: v[iroi] for k, v in self.columns.items()},
+                        list_columns=self.list_columns)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Concatenate ROITables, e.g. of several planes.
+
+        Per-pixel columns are kept if all tables have them. Per-ROI columns
+        missing in some tables (or with different shapes) become object
+        columns, with None for the missing values.
+
+        Parameters
+        ----------
+        tables : list of ROITable
+            Tables to concatenate.
+
+        Returns
+        -------
+        table : ROITable
+            Table with the ROIs of all tables, in order.
+        """
+        tables = list(tables)
+        if len(tables) == 0:
+            return cls(np.zeros(0, "int64"), np.zeros(0, "int64"), np.zeros(0, "float32"),
+                       np.zeros(1, "int64"))
+        offsets = np.zeros(sum(len(t) for t in tables) + 1, "int64")
+        offsets[1:] = np.cumsum(np.concatenate([t.npix for t in tables]))
+        cat = lambda key: np.concatenate([getattr(t, key) for t in tables])
+        pixel_columns = {key: np.concatenate([t.pixel_columns[key] for t in tables])
+                         for key in tables[0].pixel_columns
+                         if all(key in t.pixel_columns for t in tables)}
+        keys = []
+        for t in tables:
+            keys += [key for key in t.columns if key not in keys]
+        columns = {}
+        for key in keys:
+            values = [t.columns.get(key, None) for t in tables]
+            if all(v is not None and v.dtype != object and v.shape[1:] == values[0].shape[1:]
+                   for v in values):
+                columns[key] = np.concatenate(values)
+            else:
+                column = np.empty(len(offsets) - 1, dtype=object)
+                i0 = 0
+                for t, v in zip(tables, values):
+                    for k in range(len(t)):
+                        column[i0 + k] = None if v is None else v[k]
+                    i0 += len(t)
+                columns[key] = column
+        list_columns = set().union(*[t.list_columns for t in tables])
+        return cls(cat("ypix"), cat("xpix"), cat("lam"), offsets, pixel_columns, columns,
+                   list_columns)
+
+    @classmethod
+    def from_stat(cls, stat):
+        """
+        Build an ROITable from a legacy array of ROI dictionaries.
+
+        Parameters
+        ----------
+        stat : numpy.ndarray or list of dict
+            ROI statistics dictionaries, each containing at least "ypix",
+            "xpix" and "lam".
+
+        Returns
+        -------
+        table : ROITable
+            Columnar representation of `stat`.
+        """
+        stat = list(stat)
+        n_rois = len(stat)
+        npix = np.array([len(s["ypix"]) for s in stat], dtype="int64")
+        offsets = np.zeros(n_rois + 1, "int64")
+        offsets[1:] = np.cumsum(npix)
+
+        def concat(key, dtype):
+            if n_rois == 0:
+                return np.zeros(0, dtype)
+            return np.concatenate([np.asarray(s[key]).ravel() for s in stat])
+
+        ypix, xpix, lam = concat("ypix", "int64"), concat("xpix", "int64"), concat("lam", "float32")
+
+        keys = []
+        for s in stat:
+            for key in s:
+                if key not in keys and key not in ["ypix", "xpix", "lam"]:
+                    keys.append(key)
+
+        pixel_columns, columns, list_columns = {}, {}, set()
+        for key in keys:
+            values = [s.get(key, None) for s in stat]
+            if key in PIXEL_KEYS and all(v is not None and np.size(v) == n
+                                         for v, n in zip(values, npix)):
+                pixel_columns[key] = concat(key, "bool")
+                continue
+            column = None
+            if all(v is not None for v in values):
+                try:
+                    column = np.array(values)
+                except ValueError:
+                    column = None
+                if column is not None and (column.dtype == object or
+                                           column.shape[:1] != (n_rois,)):
+                    column = None
+                if column is not None and all(isinstance(v, list) for v in values):
+                    list_columns.add(key)
+            if column is None:
+                column = np.empty(n_rois, dtype=object)
+                column[:] = values
+            columns[key] = column
+        return cls(ypix, xpix, lam, offsets, pixel_columns, columns, list_columns)
+
+    def to_stat(self):
+        """
+        Convert the table to the legacy array of ROI dictionaries.
+
+        Returns
+        -------
+        stat : numpy.ndarray
+            Object array of ROI statistics dictionaries (as saved in stat.npy).
+            Missing values (None) of object columns are omitted.
+        """
+        stat = np.empty(len(self), dtype=object)
+        for k in range(len(self)):
+            ps = self.pixel_slice(k)
+            # np.array (not .copy) so that memory-mapped columns give plain arrays
+            s = {"ypix": np.array(self.ypix[ps]), "xpix": np.array(self.xpix[ps]),
+                 "lam": np.array(self.lam[ps])}
+            for key, column in self.pixel_columns.items():
+                s[key] = np.array(column[ps])
+            for key, column in self.columns.items():
+                value = column[k]
+                if column.dtype == object and value is None:
+                    continue
+                if key in self.list_columns:
+                    value = list(value)
+                elif isinstance(value, np.ndarray):
+                    value = np.array(value)
+                s[key] = value
+            stat[k] = s
+        return stat
@@ -6,19 +6,26 @@ import time
 
 from tqdm import trange
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
 from scipy.ndimage import filters, gaussian_filter
+import torch
 import logging 
 logger = logging.getLogger(__name__)
 
 from .utils import circleMask
+from .svd import randomized_svd, svd_device
 
 
-def getSVDdata(mov: np.ndarray, diameter):
+def getSVDdata(mov: np.ndarray, diameter, svd_method="full", batch_size=500,
+               device=torch.device("cuda")):
     """
     Compute SVD spatial components from temporally binned movie data.
 
     Smooths each frame with a 2D Gaussian filter, computes the temporal covariance
     matrix, and returns the top SVD spatial components reshaped as images.
+    With svd_method="randomized", the decomposition is instead computed with a
+    randomized SVD on the torch device, streaming over frames.
 
     Parameters
     ----------
@@ -26,6 +33,13 @@ def getSVDdata(mov: np.ndarray, diameter):
         Temporally binned movie of shape (nbins, Ly, Lx).
     diameter : float or list of float
         Cell diameter used to set the Gaussian smoothing sigma (sigma = diameter / 10).
+    svd_method : str, optional (default "full")
+        "full" for the SVD of the covariance matrix with numpy, "randomized"
+        for the streaming randomized SVD on device.
+    batch_size : int, optional (default 500)
+        Number of frames per batch for the randomized SVD.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for the randomized SVD.
 
     Returns
     -------
@@ -42,6 +56,20 @@ def getSVDdata(mov: np.ndarray, diameter):
 
     # compute noise variance across frames
     mov = np.reshape(mov, (-1, Lyc * Lxc))
+    if svd_method == "randomized":
+        device = svd_device(device)
+        get_rows = lambda tstart, tend: torch.from_numpy(
+            mov[tstart : tend]).to(device, dtype=torch.float32).unsqueeze(0)
+        nsvd_for_roi = min(nbins, int(nbins / 2))
+        u, s, vh = randomized_svd(get_rows, nbins, Lyc * Lxc, nsvd_for_roi,
+                                  batch_size=batch_size, device=device)
+        # u.T @ mov = s * vh
+        U = (s[0].unsqueeze(1) * vh[0]).cpu().numpy()
+        u = u[0].cpu().numpy()
+        U = np.reshape(U, (-1, Lyc, Lxc))
+        U = np.transpose(U, (1, 2, 0)).copy()
+        return U, u
+
     # compute covariance of binned frames
     cov = mov @ mov.transpose() / mov.shape[1]
     cov = cov.astype("float32")
@@ -445,8 +473,91 @@ def iter_extend(ypix, xpix, Ucell, code, refine=-1, change_codes=False):
     return ypix, xpix, lam, ix, code
 
 
+def roi_footprints(ypix, xpix, lam, Ly, Lx):
+    """
+    Create the sparse matrix of ROI footprints.
+
+    Parameters
+    ----------
+    ypix : list of numpy.ndarray
+        Y-coordinates of the pixels of each ROI.
+    xpix : list of numpy.ndarray
+        X-coordinates of the pixels of each ROI.
+    lam : list of numpy.ndarray
+        Pixel weights of each ROI.
+    Ly : int
+        Height of the image in pixels.
+    Lx : int
+        Width of the image in pixels.
+
+    Returns
+    -------
+    L : scipy.sparse.csc_matrix
+        Footprint matrix of shape (Ly * Lx, ncells), float32, with the weights
+        of ROI n at its flattened pixel indices in column n.
+    """
+    ncells = len(ypix)
+    if ncells == 0:
+        return sparse.csc_matrix((Ly * Lx, 0), dtype=np.float32)
+    npix = np.array([len(yp) for yp in ypix])
+    ipix = np.ravel_multi_index((np.concatenate(ypix).astype(np.int64),
+                                 np.concatenate(xpix).astype(np.int64)), (Ly, Lx))
+    iroi = np.repeat(np.arange(ncells), npix)
+    L = sparse.csc_matrix((np.concatenate(lam).astype(np.float32), (ipix, iroi)),
+                          shape=(Ly * Lx, ncells))
+    return L
+
+
+def solve_codes(LtL, LtS, StS, LtU, StU, reg=1e-3):
+    """
+    Jointly regress the SVD components onto the ROI footprints and neuropil basis.
+
+    Solves the regularized normal equations
+    [[LtL, LtS], [LtS.T, StS]] + reg * I @ [codes; neu] = [LtU; StU]
+    with a sparse factorization of the ROI Gram matrix LtL and a dense
+    Schur complement for the (small) neuropil block, so the cost scales with
+    the number of overlapping ROI pairs instead of cubically with ncells.
+
+    Parameters
+    ----------
+    LtL : scipy.sparse.spmatrix
+        Gram matrix of the ROI footprints, shape (ncells, ncells).
+    LtS : numpy.ndarray
+        Footprint / neuropil basis products, shape (ncells, nbasis).
+    StS : numpy.ndarray
+        Gram matrix of the neuropil basis, shape (nbasis, nbasis).
+    LtU : numpy.ndarray
+        Footprint / SVD component products, shape (ncells, nsvd).
+    StU : numpy.ndarray
+        Neuropil basis / SVD component products, shape (nbasis, nsvd).
+    reg : float, optional (default 1e-3)
+        Ridge regularization added to the diagonal.
+
+    Returns
+    -------
+    codes : numpy.ndarray
+        ROI codes, shape (ncells, nsvd), float32.
+    neu : numpy.ndarray
+        Neuropil codes, shape (nbasis, nsvd), float32.
+    """
+    ncells, nbasis = LtS.shape
+    D = StS.astype(np.float64) + reg * np.eye(nbasis)
+    if ncells == 0:
+        neu = np.linalg.solve(D, StU.astype(np.float64))
+        return np.zeros((0, StU.shape[1]), np.float32), neu.astype("float32")
+    C = LtS.astype(np.float64)
+    G = splu((LtL.astype(np.float64) + reg * sparse.eye(ncells)).tocsc())
+    GiC = G.solve(C)
+    GiU = G.solve(LtU.astype(np.float64))
+    # Schur complement of the ROI block
+    neu = np.linalg.solve(D - C.T @ GiC, StU.astype(np.float64) - C.T @ GiU)
+    codes = GiU - GiC @ neu
+    return codes.astype("float32"), neu.astype("float32")
+
+
 def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
-             connected=True, max_iterations=20, smooth_masks=False):
+             connected=True, max_iterations=20, smooth_masks=False,
+             svd_method="full", device=torch.device("cuda")):
     """
     Detect ROIs using the Sourcery algorithm (SVD-based iterative detection).
 
@@ -473,6 +584,11 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
         Maximum number of detection and refinement iterations.
     smooth_masks : bool, optional (default False)
         If True, spatially smooth frames before SVD projection during refinement.
+    svd_method : str, optional (default "full")
+        Method for computing the SVD of the movie, "full" or "randomized"
+        (see getSVDdata).
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for the randomized SVD.
 
     Returns
     -------
@@ -489,7 +605,8 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
     change_codes = True
     t0 = time.time()
     
-    U, u = getSVDdata(mov=mov, diameter=diameter)  # get SVD components
+    U, u = getSVDdata(mov=mov, diameter=diameter, svd_method=svd_method,
+                      device=device)  # get SVD components
     S, StU, StS = getStU(diameter, U)
     Ly, Lx, nsvd = U.shape
     d0 = diameter
@@ -501,10 +618,12 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
     codes = np.zeros((0, nsvd), np.float32)
     LtU = np.zeros((0, nsvd), np.float32)
     LtS = np.zeros((0, nbasis), np.float32)
-    L = np.zeros((Ly, Lx, 0), np.float32)
+    L = roi_footprints([], [], [], Ly, Lx)
+    LtL = sparse.csc_matrix((0, 0), dtype=np.float32)
+    S2 = S.reshape((-1, nbasis))
     # regress maps onto basis functions and subtract neuropil contribution
     neu = np.linalg.solve(StS, StU).astype("float32")
-    Ucell = U - (S.reshape((-1, nbasis)) @ neu).reshape(U.shape)
+    Ucell = U - (S2 @ neu).reshape(U.shape)
 
     it = 0
     ncells = 0
@@ -533,6 +652,7 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
 
             # add extra ROIs here
             n = ncells
+            new_codes = []
             while n < ncells + 200:
                 ind = np.argmax(V)
                 i, j = np.unravel_index(ind, V.shape)
@@ -540,11 +660,11 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
                     break
                 yp, xp, la, ix, code = iter_extend(i, j, Ucell, us[i, j, :],
                                                    change_codes=change_codes)
-                codes = np.append(codes, np.expand_dims(code, axis=0), axis=0)
+                new_codes.append(code.astype("float32"))
                 ypix.append(yp)
                 xpix.append(xp)
                 lam.append(la)
-                Ucell[ypix[n], xpix[n], :] -= np.outer(lam[n], codes[n, :])
+                Ucell[ypix[n], xpix[n], :] -= np.outer(lam[n], new_codes[-1])
 
                 yp, xp = extendROI(yp, xp, Ly, Lx, int(np.mean(d0)))
                 V[yp, xp] = 0
@@ -552,28 +672,21 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
             newcells = len(ypix) - ncells
             if it == 0:
                 Nfirst = newcells
-            L = np.append(L, np.zeros((Ly, Lx, newcells), "float32"), axis=-1)
-            LtU = np.append(LtU, np.zeros((newcells, nsvd), "float32"), axis=0)
-            LtS = np.append(LtS, np.zeros((newcells, nbasis), "float32"), axis=0)
-            for n in range(ncells, len(ypix)):
-                L[ypix[n], xpix[n], n] = lam[n]
-                LtU[n, :] = lam[n] @ U[ypix[n], xpix[n], :]
-                LtS[n, :] = lam[n] @ S[ypix[n], xpix[n], :]
+            if newcells > 0:
+                codes = np.concatenate((codes, np.stack(new_codes)), axis=0)
+                # append footprints of new ROIs and update Gram matrix incrementally
+                Lnew = roi_footprints(ypix[ncells:], xpix[ncells:], lam[ncells:], Ly, Lx)
+                LtLnew = (L.T @ Lnew).tocsc()
+                LtL = sparse.bmat([[LtL, LtLnew], [LtLnew.T, Lnew.T @ Lnew]], format="csc")
+                L = sparse.hstack((L, Lnew), format="csc")
+                LtU = np.concatenate((LtU, Lnew.T @ U.reshape((-1, nsvd))), axis=0)
+                LtS = np.concatenate((LtS, Lnew.T @ S2), axis=0)
             ncells += newcells
 
             # regression with neuropil
-            LtL = L.reshape((-1, ncells)).transpose() @ L.reshape((-1, ncells))
-            cellcode = np.concatenate((LtL, LtS), axis=1)
-            neucode = np.concatenate((LtS.transpose(), StS), axis=1)
-            codes = np.concatenate((cellcode, neucode), axis=0)
-            Ucode = np.concatenate((LtU, StU), axis=0)
-            codes = np.linalg.solve(codes + 1e-3 * np.eye((codes.shape[0])),
-                                    Ucode).astype("float32")
-            neu = codes[ncells:, :]
-            codes = codes[:ncells, :]
-
-        Ucell = U - (S.reshape((-1, nbasis)) @ neu + L.reshape(
-            (-1, ncells)) @ codes).reshape(U.shape)
+            codes, neu = solve_codes(LtL, LtS, StS, LtU, StU)
+
+        Ucell = U - (S2 @ neu + L @ codes).reshape(U.shape)
         # reestimate masks
         n, k = 0, 0
         while n < len(ypix):
@@ -589,14 +702,11 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
             n += 1
         codes = codes[:n, :]
         ncells = len(ypix)
-        L = np.zeros((Ly, Lx, ncells), "float32")
-        LtU = np.zeros((ncells, nsvd), "float32")
-        LtS = np.zeros((ncells, nbasis), "float32")
-        for n in range(ncells):
-            L[ypix[n], xpix[n], n] = lam[n]
-            if refine < 0:
-                LtU[n, :] = lam[n] @ U[ypix[n], xpix[n], :]
-                LtS[n, :] = lam[n] @ S[ypix[n], xpix[n], :]
+        L = roi_footprints(ypix, xpix, lam, Ly, Lx)
+        LtL = (L.T @ L).tocsc()
+        if refine < 0:
+            LtU = L.T @ U.reshape((-1, nsvd))
+            LtS = L.T @ S2
         err = (Ucell**2).mean()
         t1 = time.time() - t0
         logger.info(f"iter {it},\tROIs: {ncells},\terr: {err:0.4f}, \ttime: {t1:0.2f} sec")
@@ -616,7 +726,7 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
             lam = [stat[n]["lam"] for n in range(len(stat))]
             ncells = len(ypix)
         if refine > 0:
-            Ucell = Ucell + (S.reshape((-1, nbasis)) @ neu).reshape(U.shape)
+            Ucell = Ucell + (S2 @ neu).reshape(U.shape)
         if refine < 0 and (newcells < Nfirst / 10 or it == max_iterations - 1):
             refine = 3
             U = getSVDproj(mov, u, diameter, smooth_masks)
@@ -627,7 +737,7 @@ def sourcery(mov: np.ndarray, sdmov, diameter, threshold_scaling=1.0,
             #StU = np.reshape(S, (Lyc*Lxc,-1)).transpose() @ np.reshape(Ucell, (Lyc*Lxc, -1))
             neu = np.linalg.solve(StS, StU).astype("float32")
         refine -= 1
-    Ucell = U - (S.reshape((-1, nbasis)) @ neu).reshape(U.shape)
+    Ucell = U - (S2 @ neu).reshape(U.shape)
 
     sdmov = np.reshape(sdmov, (Ly, Lx))
     stat = [{
@@ -5,7 +5,10 @@ import numpy as np
 import logging 
 logger = logging.getLogger(__name__)
 
+from numba import njit, prange
+
 from .utils import circleMask
+from .roitable import ROITable
 
 def median_pix(ypix, xpix):
     """
@@ -132,6 +135,178 @@ def soma_crop(ypix, xpix, lam, med):
         crop = np.ones(ypix.size, "bool")
     return crop
     
+@njit(parallel=True, cache=True)
+def _roi_shape_stats(ypix, xpix, lam, offsets, med, has_med, do_soma_crop,
+                     compute_radius, d0, dists_disk, imed, soma_crop, npix_soma,
+                     mrs, mrs0, compact, radius, aspect_ratio):
+    """
+    Compute median pixel, soma crop, compactness and aspect ratio of all ROIs.
+
+    Numba version of the per-ROI loop over median_pix, soma_crop and fitMVGaus
+    (with thres=2), parallelized over ROIs with prange. Outputs are filled
+    in place.
+
+    Parameters
+    ----------
+    ypix, xpix : numpy.ndarray
+        Flat pixel coordinates of all ROIs (float64), shape (npix_total,).
+    lam : numpy.ndarray
+        Flat pixel weights of all ROIs (float64), shape (npix_total,).
+    offsets : numpy.ndarray
+        Start of each ROI in the flat arrays, shape (n_rois + 1,).
+    med : numpy.ndarray
+        Given ROI centers, shape (n_rois, 2), used where has_med is True.
+    has_med : numpy.ndarray
+        Whether each ROI already has a center, shape (n_rois,).
+    do_soma_crop : bool
+        Whether to crop dendritic pixels.
+    compute_radius : numpy.ndarray
+        Whether to fit radius and aspect ratio for each ROI, shape (n_rois,).
+    d0 : numpy.ndarray
+        Cell diameter [dy, dx].
+    dists_disk : numpy.ndarray
+        Sorted normalized distances of the pixels in a disk.
+    imed : numpy.ndarray
+        Output index (within the ROI) of the median pixel, shape (n_rois,).
+    soma_crop : numpy.ndarray
+        Output flat soma crop of all ROIs, shape (npix_total,).
+    npix_soma, mrs, mrs0, compact, radius, aspect_ratio : numpy.ndarray
+        Outputs, shape (n_rois,).
+    """
+    n_rois = len(offsets) - 1
+    for k in prange(n_rois):
+        p0, p1 = offsets[k], offsets[k + 1]
+        n = p1 - p0
+        if n == 0:
+            continue
+        y, x, l = ypix[p0:p1], xpix[p0:p1], lam[p0:p1]
+
+        # pixel closest to the median of the pixels
+        if has_med[k]:
+            ymed, xmed = med[k, 0], med[k, 1]
+        else:
+            ym, xm = np.median(y), np.median(x)
+            ib, dbest = 0, np.inf
+            for i in range(n):
+                d = (x[i] - xm)**2 + (y[i] - ym)**2
+                if d < dbest:
+                    ib, dbest = i, d
+            imed[k] = ib
+            ymed, xmed = y[ib], x[ib]
+
+        # crop dendritic pixels: area as a function of radius from histogram of distances
+        crop = soma_crop[p0:p1]
+        crop[:] = True
+        if do_soma_crop and n > 10:
+            dists = ((y - ymed)**2 + (x - xmed)**2)**0.5
+            nr = int(np.ceil(dists.max()))
+            if nr > 1:
+                area = np.zeros(nr)
+                for i in range(n):
+                    ir = int(np.floor(dists[i])) + 1
+                    if ir < nr:
+                        area[ir] += l[i]
+                area = np.cumsum(area)
+                darea = area[1:] - area[:-1]
+                rad = nr - 1
+                threshold = darea.max() / 3
+                ida = -1
+                for i in range(nr - 1):
+                    if darea[i] > threshold:
+                        ida = i
+                        break
+                if ida >= 0:
+                    for i in range(ida, nr - 1):
+                        if darea[i] < threshold:
+                            rad = i
+                            break
+                ncrop = 0
+                for i in range(n):
+                    crop[i] = dists[i] < rad
+                    ncrop += crop[i]
+                if ncrop == 0:
+                    crop[:] = True
+        yc, xc, lc = y[crop], x[crop], l[crop]
+        nc = len(yc)
+        npix_soma[k] = nc
+
+        # compactness of ROI
+        ym, xm = np.median(yc), np.median(xc)
+        dists = (((yc - ym) / d0[0])**2 + ((xc - xm) / d0[1])**2)**0.5
+        mrs[k] = dists.mean()
+        mrs0[k] = dists_disk[:nc].mean()
+        compact[k] = max(1.0, mrs[k] / (1e-10 + mrs0[k]))
+
+        # aspect ratio from the eigenvalues of the weighted covariance
+        if compute_radius[k]:
+            ipos = lc > 0
+            yg, xg, lg = yc[ipos] / d0[0], xc[ipos] / d0[1], lc[ipos]
+            lg = lg / lg.sum()
+            muy, mux = (lg * yg).sum(), (lg * xg).sum()
+            cyy = (lg * (yg - muy)**2).sum()
+            cxx = (lg * (xg - mux)**2).sum()
+            cyx = (lg * (yg - muy) * (xg - mux)).sum()
+            disc = (((cyy - cxx) / 2)**2 + cyx**2)**0.5
+            r0 = 2 * max(0., (cyy + cxx) / 2 + disc)**0.5
+            r1 = 2 * max(0., (cyy + cxx) / 2 - disc)**0.5
+            radius[k] = r0 * (d0[0] + d0[1]) / 2
+            aspect_ratio[k] = 2 * r0 / (.01 + r0 + r1)
+
+
+def _unique_pixels(ipix, offsets, npix_image):
+    """ mask of the first occurrence of each pixel within each ROI """
+    npix = np.diff(offsets)
+    roi_pix = np.repeat(np.arange(len(npix), dtype="int64"), npix) * npix_image + ipix
+    unique = np.zeros(len(ipix), "bool")
+    unique[np.unique(roi_pix, return_index=True)[1]] = True
+    return unique
+
+
+@njit(cache=True)
+def _remove_overlaps(ipix, unique, offsets, npix_image, max_overlap):
+    """
+    Remove ROIs with too many overlapping pixels, in reversed order.
+
+    Parameters
+    ----------
+    ipix : numpy.ndarray
+        Flat (y * Lx + x) pixel indices of all ROIs, shape (npix_total,).
+    unique : numpy.ndarray
+        First occurrence of each pixel within its ROI, shape (npix_total,);
+        repeated pixels of an ROI are counted once in the overlap image.
+    offsets : numpy.ndarray
+        Start of each ROI in `ipix`, shape (n_rois + 1,).
+    npix_image : int
+        Number of pixels in the image (Ly * Lx).
+    max_overlap : float
+        Maximum allowed fraction of overlapping pixels.
+
+    Returns
+    -------
+    keep_rois : numpy.ndarray
+        Boolean array of ROIs kept, shape (n_rois,).
+    overlap : numpy.ndarray
+        Number of kept ROIs in each image pixel, shape (npix_image,).
+    """
+    n_rois = len(offsets) - 1
+    overlap = np.zeros(npix_image, np.int64)
+    for i in range(len(ipix)):
+        overlap[ipix[i]] += unique[i]
+    keep_rois = np.zeros(n_rois, np.bool_)
+    # remove overlapping ROIs in reversed order, because highest variance ROIs are first
+    for k in range(n_rois - 1, -1, -1):
+        p0, p1 = offsets[k], offsets[k + 1]
+        if p1 > p0:
+            noverlap = 0
+            for i in range(p0, p1):
+                noverlap += overlap[ipix[i]] > 1
+            keep_rois[k] = noverlap / (p1 - p0) <= max_overlap
+        if not keep_rois[k]:
+            for i in range(p0, p1):
+                overlap[ipix[i]] -= unique[i]
+    return keep_rois, overlap
+
+
 def roi_stats(stats, Ly: int, Lx: int, diameter=[12., 12.], max_overlap=0.75,
               do_soma_crop=True, npix_norm_min=-1, npix_norm_max=np.inf,
               median=False):
@@ -141,13 +316,14 @@ def roi_stats(stats, Ly: int, Lx: int, diameter=[12., 12.], max_overlap=0.75,
     For each ROI, computes the median center, soma crop, compactness, and aspect
     ratio from a 2D Gaussian fit. Normalizes pixel counts across ROIs, removes
     ROIs outside the normalized pixel range, and optionally removes ROIs with
-    excessive overlap.
+    excessive overlap. The ROIs are converted to an ROITable and all statistics
+    are computed on its flat pixel arrays.
 
     Parameters
     ----------
-    stats : numpy.ndarray
+    stats : numpy.ndarray or ROITable
         Array of dictionaries, each containing "ypix", "xpix", and "lam" for
-        one detected ROI.
+        one detected ROI, or an ROITable.
     Ly : int
         Height of the image in pixels.
     Lx : int
@@ -170,91 +346,98 @@ def roi_stats(stats, Ly: int, Lx: int, diameter=[12., 12.], max_overlap=0.75,
 
     Returns
     -------
-    stats : numpy.ndarray
-        Updated array of ROI statistics dictionaries with added keys "med",
-        "npix", "soma_crop", "npix_soma", "mrs", "mrs0", "compact", "radius",
-        "aspect_ratio", "footprint", "npix_norm", "npix_norm_no_crop", and
-        "overlap".
+    stats : numpy.ndarray or ROITable
+        Updated ROI statistics with added keys "med", "npix", "soma_crop",
+        "npix_soma", "mrs", "mrs0", "compact", "radius", "aspect_ratio",
+        "footprint", "npix_norm", "npix_norm_no_crop", and "overlap", in the
+        same format as the input (array of dictionaries or ROITable).
     """
-   
+    return_table = isinstance(stats, ROITable)
+    table = stats if return_table else ROITable.from_stat(stats)
+    n_rois = len(table)
+    columns = table.columns
+
     # approx size of masks for ROI aspect ratio estimation
-    dy, dx = diameter[0], diameter[1]
-    d0 = np.array([float(dy), float(dx)])
-    
-    dy, dx = np.meshgrid(np.arange(-d0[0]*3, d0[0]*3 + 1) / d0[0], 
+    d0 = np.array([float(diameter[0]), float(diameter[1])])
+    dy, dx = np.meshgrid(np.arange(-d0[0]*3, d0[0]*3 + 1) / d0[0],
                          np.arange(-d0[1]*3, d0[1]*3 + 1) / d0[1], indexing="ij")
     rs = (dy**2 + dx**2)**0.5
     dists_disk = np.sort(rs.flatten())
 
-    for k, stat in enumerate(stats):
-        ypix, xpix, lam = stat["ypix"].copy(), stat["xpix"].copy(), stat["lam"].copy()
-        med = stat.get("med", median_pix(ypix, xpix)) # median of pixels
-        stat["med"], stat["npix"] = med, ypix.size
-        
-        # crop dendritic pixels out for computing compactness and aspect ratio
-        if do_soma_crop:
-            crop = soma_crop(ypix, xpix, lam, med)
-            stat["soma_crop"] = crop
-            ypix, xpix, lam = ypix[crop], xpix[crop], lam[crop]
+    # ROIs with a center or radius already computed (e.g. by cellpose) keep them
+    has_med = np.zeros(n_rois, "bool")
+    med = np.zeros((n_rois, 2), "float64")
+    if "med" in columns:
+        has_med = np.array([m is not None for m in columns["med"]], "bool")
+        if has_med.any():
+            med[has_med] = np.array([m for m in columns["med"][has_med]], "float64")
+    compute_radius = np.ones(n_rois, "bool")
+    if "radius" in columns:
+        compute_radius = np.array([r is None for r in columns["radius"]], "bool")
+
+    imed = np.zeros(n_rois, "int64")
+    soma_crop = np.ones(len(table.ypix), "bool")
+    npix_soma = np.zeros(n_rois, "int64")
+    mrs, mrs0, compact = np.zeros((3, n_rois))
+    radius, aspect_ratio = np.full((2, n_rois), np.nan)
+    _roi_shape_stats(table.ypix.astype("float64"), table.xpix.astype("float64"),
+                     table.lam.astype("float64"), table.offsets, med, has_med,
+                     bool(do_soma_crop), compute_radius, d0, dists_disk, imed,
+                     soma_crop, npix_soma, mrs, mrs0, compact, radius, aspect_ratio)
+
+    if not has_med.all():
+        imed += table.offsets[:-1]
+        ypix_med, xpix_med = table.ypix[imed], table.xpix[imed]
+        if "med" not in columns:
+            columns["med"] = np.stack((ypix_med, xpix_med), axis=1)
+            table.list_columns.add("med")
         else:
-            stat["soma_crop"] = np.ones(ypix.size, "bool")
-        stat["npix_soma"] = stat["soma_crop"].sum()  
-        
-        # compute compactness of ROI
-        med = np.median(ypix), np.median(xpix)
-        dists = (((ypix - med[0]) / d0[0])**2 + ((xpix - med[1]) / d0[1])**2)**0.5
-        stat["mrs"], stat["mrs0"] = dists.mean(), dists_disk[:ypix.size].mean()
-        stat["compact"] = max(1.0, stat["mrs"] / (1e-10 + stat["mrs0"]))
-        
-        # compute aspect ratio
-        if "radius" not in stat:
-            radii = fitMVGaus(ypix, xpix, lam, dy=d0[0], dx=d0[1], thres=2)[2]
-            stat["radius"] = radii[0] * d0.mean()
-            stat["aspect_ratio"] = 2 * radii[0] / (.01 + radii[0] + radii[1])
-        stat["footprint"] = stat.get("footprint", 0)
+            for k in np.nonzero(~has_med)[0]:
+                columns["med"][k] = [ypix_med[k], xpix_med[k]]
+    table.pixel_columns["soma_crop"] = soma_crop
+    columns["npix"] = table.npix
+    columns["npix_soma"] = npix_soma
+    columns["mrs"], columns["mrs0"], columns["compact"] = mrs, mrs0, compact
+    if compute_radius.all():
+        columns["radius"], columns["aspect_ratio"] = radius, aspect_ratio
+    else:
+        for key, values in zip(["radius", "aspect_ratio"], [radius, aspect_ratio]):
+            column = columns.get(key, np.full(n_rois, None, dtype=object)).astype(object)
+            column[compute_radius] = values[compute_radius]
+            columns[key] = column
+    if "footprint" not in columns:
+        columns["footprint"] = np.zeros(n_rois, "int64")
+    elif columns["footprint"].dtype == object:
+        columns["footprint"] = np.array([0 if f is None else f for f in columns["footprint"]])
 
     ### compute npix_norm (normalized npix) for each ROI
-    npix_soma = np.array([stat["npix_soma"] for stat in stats], dtype="float32")
-    npix = np.array([stat["npix"] for stat in stats], dtype="float32")
+    npix_soma = npix_soma.astype("float32")
+    npix = table.npix.astype("float32")
     # use median if cellpose, otherwise use best neurons to determine normalizer
     norm_npix = np.median(npix_soma) if median else np.median(npix_soma[:100])
     npix_soma /= norm_npix + 1e-10
     norm_npix = np.median(npix) if median else np.median(npix[:100])
     npix /= norm_npix + 1e-10
-    
+
     keep_rois = (npix_norm_min <= npix_soma) * (npix_soma <= npix_norm_max)
-    stats = stats[keep_rois]
-    npix_soma, npix = npix_soma[keep_rois], npix[keep_rois]
+    columns["npix_norm"], columns["npix_norm_no_crop"] = npix_soma, npix
     nremove = (~keep_rois).sum()
     if nremove > 0:
+        table = table[keep_rois]
         logger.info(f"Removed {nremove} ROIs with npix_norm < {npix_norm_min:.2f} or npix_norm > {npix_norm_max:.2f}")
 
-    for stat, npix_soma0, npix0 in zip(stats, npix_soma, npix):
-        stat["npix_norm"] = npix_soma0
-        stat["npix_norm_no_crop"] = npix0       
-    
     if max_overlap is not None and max_overlap < 1.0:
-        overlap = np.zeros((Ly, Lx), "int")
-        for stat in stats:
-            overlap[stat["ypix"], stat["xpix"]] += 1
-        
-        keep_rois = np.zeros(len(stats), "bool")
-        # remove overlapping ROIs in reversed order, because highest variance ROIs are first
-        for k, stat in enumerate(stats[::-1]): 
-            keep_roi = (overlap[stat["ypix"], stat["xpix"]] > 1).mean() <= max_overlap
-            keep_rois[k] = keep_roi
-            if not keep_roi:
-                overlap[stat["ypix"], stat["xpix"]] -= 1
-        keep_rois = keep_rois[::-1]
-        stats = stats[keep_rois]
-        
-        for stat in stats:
-            stat["overlap"] = (overlap[stat["ypix"], stat["xpix"]] > 1).astype("bool")
+        ipix = table.ipix(Lx)
+        unique = _unique_pixels(ipix, table.offsets, Ly * Lx)
+        keep_rois, overlap = _remove_overlaps(ipix, unique, table.offsets, Ly * Lx,
+                                              float(max_overlap))
+        table.pixel_columns["overlap"] = overlap[ipix] > 1
+        table = table[keep_rois]
 
         nremove = (~keep_rois).sum()
         logger.info(f"Removed {nremove} ROIs with overlap > {max_overlap}")
 
-    return stats
+    return table if return_table else table.to_stat()
 
 def assign_overlaps(stats, Ly, Lx):
     """
@@ -265,8 +448,9 @@ def assign_overlaps(stats, Ly, Lx):
 
     Parameters
     ----------
-    stats : numpy.ndarray
-        Array of ROI statistics dictionaries, each containing "ypix" and "xpix".
+    stats : numpy.ndarray or ROITable
+        Array of ROI statistics dictionaries, each containing "ypix" and "xpix",
+        or an ROITable.
     Ly : int
         Height of the image in pixels.
     Lx : int
@@ -274,12 +458,16 @@ def assign_overlaps(stats, Ly, Lx):
 
     Returns
     -------
-    stats : numpy.ndarray
-        Updated array with "overlap" key added to each ROI dictionary.
+    stats : numpy.ndarray or ROITable
+        Updated ROIs with "overlap" key added to each ROI.
     """
-    overlap = np.zeros((Ly, Lx), "int")
-    for stat in stats:
-        overlap[stat["ypix"], stat["xpix"]] += 1
-    for stat in stats:
-        stat["overlap"] = (overlap[stat["ypix"], stat["xpix"]] > 1).astype("bool")
+    table = stats if isinstance(stats, ROITable) else ROITable.from_stat(stats)
+    ipix = table.ipix(Lx)
+    unique = _unique_pixels(ipix, table.offsets, Ly * Lx)
+    overlap = np.bincount(ipix[unique], minlength=Ly * Lx)[ipix] > 1
+    if isinstance(stats, ROITable):
+        stats.pixel_columns["overlap"] = overlap
+        return stats
+    for k, stat in enumerate(stats):
+        stat["overlap"] = overlap[table.pixel_slice(k)]
     return stats
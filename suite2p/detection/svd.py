@@ -0,0 +1,150 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import numpy as np
+import torch
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _stream_matmul(get_rows, n_rows, W, batch_size):
+    """
+    Compute X @ W by streaming over row batches of X.
+
+    Parameters
+    ----------
+    get_rows : callable
+        Function get_rows(tstart, tend) returning a float32 tensor of shape
+        (n_batch, tend - tstart, n_cols) with rows tstart:tend of X.
+    n_rows : int
+        Number of rows of X.
+    W : torch.Tensor
+        Matrix of shape (n_batch, n_cols, l).
+    batch_size : int
+        Number of rows of X read per batch.
+
+    Returns
+    -------
+    Y : torch.Tensor
+        Product X @ W, shape (n_batch, n_rows, l).
+    """
+    Y = torch.zeros((W.shape[0], n_rows, W.shape[-1]), dtype=torch.float32,
+                    device=W.device)
+    for tstart in range(0, n_rows, batch_size):
+        tend = min(tstart + batch_size, n_rows)
+        Y[:, tstart : tend] = get_rows(tstart, tend) @ W
+    return Y
+
+
+def _stream_rmatmul(get_rows, n_rows, Q, batch_size):
+    """
+    Compute X.T @ Q by streaming over row batches of X.
+
+    Parameters
+    ----------
+    get_rows : callable
+        Function get_rows(tstart, tend) returning a float32 tensor of shape
+        (n_batch, tend - tstart, n_cols) with rows tstart:tend of X.
+    n_rows : int
+        Number of rows of X.
+    Q : torch.Tensor
+        Matrix of shape (n_batch, n_rows, l).
+    batch_size : int
+        Number of rows of X read per batch.
+
+    Returns
+    -------
+    Z : torch.Tensor
+        Product X.T @ Q, shape (n_batch, n_cols, l).
+    """
+    Z = None
+    for tstart in range(0, n_rows, batch_size):
+        tend = min(tstart + batch_size, n_rows)
+        Zb = get_rows(tstart, tend).transpose(-2, -1) @ Q[:, tstart : tend]
+        Z = Zb if Z is None else Z + Zb
+    return Z
+
+
+def randomized_svd(get_rows, n_rows, n_cols, n_components, n_batch=1,
+                   n_oversamples=10, n_iter=4, batch_size=500, seed=0,
+                   device=torch.device("cuda")):
+    """
+    Batched randomized SVD (Halko, Martinsson & Tropp, 2011) streamed over rows.
+
+    Computes the top singular triplets of n_batch matrices X of shape
+    (n_rows, n_cols) at once. X is never held in memory in full: its rows
+    (frames) are fetched in batches with get_rows, so that memory is bounded
+    by the sketch size and batch_size. All computations are float32 on device.
+
+    Parameters
+    ----------
+    get_rows : callable
+        Function get_rows(tstart, tend) returning a float32 tensor on device
+        of shape (n_batch, tend - tstart, n_cols) with rows tstart:tend of X.
+    n_rows : int
+        Number of rows (frames) of X.
+    n_cols : int
+        Number of columns (pixels) of X.
+    n_components : int
+        Number of singular values and vectors to return.
+    n_batch : int, optional (default 1)
+        Number of matrices decomposed together.
+    n_oversamples : int, optional (default 10)
+        Additional random vectors used to sample the range of X.
+    n_iter : int, optional (default 4)
+        Number of power iterations.
+    batch_size : int, optional (default 500)
+        Number of rows of X read per batch.
+    seed : int, optional (default 0)
+        Seed of the random test matrix.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    U : torch.Tensor
+        Left singular vectors, shape (n_batch, n_rows, n_components).
+    S : torch.Tensor
+        Singular values in descending order, shape (n_batch, n_components).
+    Vh : torch.Tensor
+        Right singular vectors, shape (n_batch, n_components, n_cols).
+    """
+    n_components = min(n_components, n_rows, n_cols)
+    l = min(n_components + n_oversamples, n_rows, n_cols)
+    batch_size = int(max(1, batch_size))
+
+    # random test matrix generated on CPU to be reproducible across devices
+    generator = torch.Generator().manual_seed(seed)
+    W = torch.randn((n_batch, n_cols, l), generator=generator).to(device)
+
+    Q = _stream_matmul(get_rows, n_rows, W, batch_size)
+    Q = torch.linalg.qr(Q).Q
+    for i in range(n_iter):
+        Z = torch.linalg.qr(_stream_rmatmul(get_rows, n_rows, Q, batch_size)).Q
+        Q = torch.linalg.qr(_stream_matmul(get_rows, n_rows, Z, batch_size)).Q
+
+    # project X onto the sampled range and decompose the small matrix
+    B = _stream_rmatmul(get_rows, n_rows, Q, batch_size).transpose(-2, -1)
+    Ub, S, Vh = torch.linalg.svd(B, full_matrices=False)
+    U = Q @ Ub
+    return U[..., :n_components], S[..., :n_components], Vh[..., :n_components, :]
+
+
+def svd_device(device):
+    """
+    Return the device used for the randomized SVD (MPS does not support QR).
+
+    Parameters
+    ----------
+    device : torch.device
+        Requested torch device.
+
+    Returns
+    -------
+    device : torch.device
+        Device on which the randomized SVD is computed.
+    """
+    # torch.linalg.qr is not implemented for MPS tensors, so the randomized SVD runs on the CPU
+    if device.type == "mps":
+        return torch.device("cpu")
+    return device
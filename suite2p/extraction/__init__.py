@@ -2,5 +2,6 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 from .dcnv import preprocess, oasis, baseline_maximin
-from .extract import extraction_wrapper
-from .masks import create_cell_mask, create_neuropil_masks, create_cell_pix
\ No newline at end of file
+from .extract import extraction_wrapper, reextract_changed_rois, extract_rois, update_traces, MASK_SETTINGS
+from .masks import create_cell_mask, create_neuropil_masks, create_neuropil_mask_matrix, create_cell_pix, create_mask_matrices
+from .traces import trace_statistics, deconvolve_traces
@@ -93,11 +93,109 @@ def oasis_matrix(F, v, w, t, l, s, tau, fs):
         oasis_trace(F[n], v[n], w[n], t[n], l[n], s[n], tau, fs)
 
 
-def oasis(F, batch_size, tau, fs):
+@njit(["float64[:], float64[:], int64, float32, float32"], cache=True)
+def decay_tables(decay, decay2, NT, tau, fs):
+    """
+    Fill the lookup tables of the decay of pools of length 0 to NT.
+
+    Parameters
+    ----------
+    decay : numpy.ndarray
+        Output exp(g * k) for k = 0, ..., NT, shape (NT + 1,).
+    decay2 : numpy.ndarray
+        Output exp(2 * g * k) for k = 0, ..., NT, shape (NT + 1,).
+    NT : int
+        Number of frames.
+    tau : float
+        Timescale of the indicator decay in seconds.
+    fs : float
+        Sampling rate per plane in Hz.
+    """
+    g = -1. / (tau * fs)
+    for k in range(NT + 1):
+        decay[k] = np.exp(g * k)
+        decay2[k] = np.exp(2 * g * k)
+
+
+@njit([
+    "float32[:], float32[:], float32[:], int32[:], int32[:], float32[:], float64[:], float64[:]"
+], cache=True)
+def oasis_trace_lut(F, v, w, t, l, s, decay, decay2):
+    """
+    Spike deconvolution on a single neuron using OASIS with decay lookup tables.
+
+    Same as oasis_trace, with the pool decays read from the tables filled
+    by decay_tables instead of recomputed at each merge.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        Fluorescence trace, shape (n_frames,).
+    v, w : numpy.ndarray
+        Pool values and weights buffers, shape (n_frames,).
+    t, l : numpy.ndarray
+        Pool start times and lengths buffers, shape (n_frames,).
+    s : numpy.ndarray
+        Output spike trace, shape (n_frames,). Overwritten.
+    decay, decay2 : numpy.ndarray
+        Decay lookup tables, shape (n_frames + 1,).
+    """
+    NT = F.shape[0]
+    it = 0
+    ip = 0
+
+    while it < NT:
+        v[ip], w[ip], t[ip], l[ip] = F[it], 1, it, 1
+        while ip > 0:
+            f1 = decay[l[ip - 1]]
+            if v[ip - 1] * f1 > v[ip]:
+                # violation of the constraint means merging pools
+                wnew = w[ip - 1] + w[ip] * decay2[l[ip - 1]]
+                v[ip - 1] = (v[ip - 1] * w[ip - 1] + v[ip] * w[ip] * f1) / wnew
+                w[ip - 1] = wnew
+                l[ip - 1] = l[ip - 1] + l[ip]
+                ip -= 1
+            else:
+                break
+        it += 1
+        ip += 1
+
+    s[:] = 0
+    for i in range(1, ip):
+        s[t[i]] = v[i] - v[i - 1] * decay[l[i - 1]]
+
+
+@njit([
+    "float32[:,:], float32[:,:], float32[:,:], int32[:,:], int32[:,:], float32[:,:], float64[:], float64[:]"
+], parallel=True, cache=True)
+def oasis_matrix_lut(F, v, w, t, l, s, decay, decay2):
+    """
+    Spike deconvolution on many neurons with decay lookup tables, parallelized with prange.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        Fluorescence traces, shape (n_neurons, n_frames).
+    v, w, t, l : numpy.ndarray
+        Pool buffers, shape (n_neurons, n_frames) (see oasis_trace_lut).
+    s : numpy.ndarray
+        Output spike traces, shape (n_neurons, n_frames). Overwritten.
+    decay, decay2 : numpy.ndarray
+        Decay lookup tables, shape (n_frames + 1,).
+    """
+    for n in prange(F.shape[0]):
+        oasis_trace_lut(F[n], v[n], w[n], t[n], l[n], s[n], decay, decay2)
+
+
+def oasis(F, batch_size, tau, fs, out=None):
     """
     Compute non-negative deconvolution with no sparsity constraints.
 
-    Uses OASIS algorithm (Friedrich, Zhou & Paninski, 2017).
+    Uses OASIS algorithm (Friedrich, Zhou & Paninski, 2017). The neurons are
+    deconvolved in batches that share one preallocated workspace and one
+    table of pool decays, and the spikes of each batch are written directly
+    into `out`, so with memory-mapped F and out (e.g. from
+    numpy.lib.format.open_memmap) the memory used is bounded by the batch size.
 
     Parameters
     ----------
@@ -110,29 +208,35 @@ def oasis(F, batch_size, tau, fs):
         Timescale of the indicator decay in seconds.
     fs : float
         Sampling rate per plane in Hz.
+    out : numpy.ndarray, optional (default None)
+        Float32 array of shape (n_neurons, n_frames) to write the deconvolved
+        fluorescence into. If None, a new array is allocated.
 
     Returns
     -------
     S : numpy.ndarray
-        Deconvolved fluorescence, shape (n_neurons, n_frames).
+        Deconvolved fluorescence, shape (n_neurons, n_frames) (`out` if given).
     """
 
     NN, NT = F.shape
-    F = F.astype(np.float32)
-    S = np.zeros((NN, NT), dtype=np.float32)
+    S = np.zeros((NN, NT), dtype=np.float32) if out is None else out
+    batch_size = int(max(1, min(batch_size, NN)))
     n_batches = int(np.ceil(NN / batch_size))
+    decay, decay2 = np.zeros(NT + 1, np.float64), np.zeros(NT + 1, np.float64)
+    decay_tables(decay, decay2, NT, tau, fs)
+    v = np.zeros((batch_size, NT), dtype=np.float32)
+    w = np.zeros((batch_size, NT), dtype=np.float32)
+    t = np.zeros((batch_size, NT), dtype=np.int32)
+    l = np.zeros((batch_size, NT), dtype=np.int32)
+    s = np.zeros((batch_size, NT), dtype=np.float32)
     logger.info(f"Deconvolving {NN} neurons in {n_batches} batches")
     tqdm_out = TqdmToLogger(logger, level=logging.INFO)
     for n in trange(n_batches, file=tqdm_out):
         i = n * batch_size
-        f = F[i:i + batch_size]
-        v = np.zeros((f.shape[0], NT), dtype=np.float32)
-        w = np.zeros((f.shape[0], NT), dtype=np.float32)
-        t = np.zeros((f.shape[0], NT), dtype=np.int64)
-        l = np.zeros((f.shape[0], NT), dtype=np.float32)
-        s = np.zeros((f.shape[0], NT), dtype=np.float32)
-        oasis_matrix(f, v, w, t, l, s, tau, fs)
-        S[i:i + batch_size] = s
+        f = np.ascontiguousarray(F[i:i + batch_size], dtype=np.float32)
+        nb = f.shape[0]
+        oasis_matrix_lut(f, v[:nb], w[:nb], t[:nb], l[:nb], s[:nb], decay, decay2)
+        S[i:i + nb] = s[:nb]
     return S
 
 def preprocess(F, baseline, win_baseline, sig_baseline,
@@ -193,7 +297,8 @@ def baseline_maximin(F, win_baseline, sig_baseline,
     Compute maximin baseline using GPU-accelerated max/min pooling.
 
     Smooths traces with a Gaussian filter, then applies a rolling minimum
-    followed by a rolling maximum to estimate the baseline.
+    followed by a rolling maximum to estimate the baseline. On the CPU the
+    rolling filters are computed with sliding_maximin instead of max pooling.
 
     Parameters
     ----------
@@ -233,6 +338,11 @@ def baseline_maximin(F, win_baseline, sig_baseline,
         data = pad(data, (gwid, gwid), 'replicate')
         data = conv1d(data.unsqueeze(1), gaussian.unsqueeze(0).unsqueeze(0), padding=0)
 
+        if device.type == "cpu":
+            # O(n_frames) sliding min and max, parallel over neurons
+            sliding_maximin(data[:, 0].numpy(), Flow[nstart : nend], win // 2)
+            continue
+
         data = pad(data, (win//2, win//2), 'replicate')
         data = -max_pool1d(-data, kernel_size=win, stride=1, padding= 0)
 
@@ -244,3 +354,49 @@ def baseline_maximin(F, win_baseline, sig_baseline,
     F = F - Flow
 
     return F 
+
+
+@njit(cache=True)
+def _sliding_extremum(x, out, queue, h, is_max):
+    """ out[i] = extremum of x[max(i - h, 0) : i + h + 1] using the index deque queue """
+    n_frames = x.shape[0]
+    head, tail, j = 0, 0, 0
+    for i in range(n_frames):
+        # push the samples entering the window, dropping the ones they dominate
+        while j < n_frames and j <= i + h:
+            while tail > head and ((x[queue[tail - 1]] <= x[j]) if is_max
+                                   else (x[queue[tail - 1]] >= x[j])):
+                tail -= 1
+            queue[tail] = j
+            tail += 1
+            j += 1
+        # pop the samples leaving the window
+        while queue[head] < i - h:
+            head += 1
+        out[i] = x[queue[head]]
+
+
+@njit(["void(float32[:,:], float32[:,:], int64)"], parallel=True, cache=True)
+def sliding_maximin(F, Flow, h):
+    """
+    Rolling minimum followed by rolling maximum with monotonic deques.
+
+    Each filter takes the extremum over the window [i - h, i + h] clamped to
+    the trace (equivalent to replicate padding), in O(n_frames) time per
+    neuron independently of the window size.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        Smoothed fluorescence traces, shape (n_neurons, n_frames).
+    Flow : numpy.ndarray
+        Output baseline, shape (n_neurons, n_frames). Modified in place.
+    h : int
+        Half-width of the window in frames.
+    """
+    n_neurons, n_frames = F.shape
+    for n in prange(n_neurons):
+        fmin = np.empty(n_frames, np.float32)
+        queue = np.empty(n_frames, np.int64)
+        _sliding_extremum(F[n], fmin, queue, h, False)
+        _sliding_extremum(fmin, Flow[n], queue, h, True)
@@ -7,16 +7,22 @@ import time
 from tqdm import trange
 import numpy as np
 import torch
-from scipy import stats
+from scipy import stats, sparse
 
 import logging 
 logger = logging.getLogger(__name__)
 
 
-from .masks import create_masks
+from .masks import (create_mask_matrices, mask_matrix, create_cell_mask_matrix,
+                    create_cell_pix, create_neuropil_masks, create_neuropil_mask_matrix)
+from .dcnv import preprocess, oasis
 from .. import default_settings
 from ..logger import TqdmToLogger
 
+# extraction settings used to create the masks (keyword arguments of create_mask_matrices)
+MASK_SETTINGS = ["lam_percentile", "allow_overlap", "neuropil_extract",
+                 "inner_neuropil_radius", "min_neuropil_pixels", "circular_neuropil"]
+
 def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500, 
                     device = torch.device("cuda")):
     """
@@ -29,12 +35,15 @@ def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500,
     ----------
     f_in : numpy.ndarray or BinaryFile
         Registered frames, shape (n_frames, Ly, Lx).
-    cell_masks : list of tuple
-        Each element is a tuple (pixel_indices, weights) for one ROI, where
-        pixel_indices are flattened and weights are normalized to sum to 1.
-    neuropil_masks : list of numpy.ndarray
-        Each element is an array of flattened pixel indices for the neuropil
-        mask of one ROI.
+    cell_masks : scipy.sparse.csc_matrix or list of tuple
+        Matrix of shape (Ly * Lx, n_rois) of normalized pixel weights (see
+        create_mask_matrices), or list with a tuple (pixel_indices, weights)
+        for each ROI, where pixel_indices are flattened and weights are
+        normalized to sum to 1.
+    neuropil_masks : scipy.sparse.csc_matrix or list of numpy.ndarray or None
+        Binary matrix of shape (Ly * Lx, n_rois), or list with an array of
+        flattened pixel indices for the neuropil mask of each ROI. If None,
+        Fneu is zero.
     batch_size : int, optional (default 500)
         Number of frames processed per batch.
     device : torch.device, optional (default torch.device("cuda"))
@@ -47,36 +56,74 @@ def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500,
     Fneu : numpy.ndarray
         Neuropil fluorescence traces, shape (n_rois, n_frames).
     """
-    n_frames, Ly, Lx = f_in.shape
-    t0 = time.time()
+    Fs, Fneus = extract_traces_multichannel([f_in], cell_masks, neuropil_masks,
+                                            batch_size=batch_size, device=device)
+    return Fs[0], Fneus[0]
+
+
+def extract_traces_multichannel(f_ins, cell_masks, neuropil_masks, batch_size=500,
+                                device=torch.device("cuda")):
+    """
+    Extract fluorescence traces from several channels in a single pass.
+
+    The frames of all channels are read together in each batch and multiplied
+    by one stacked [cell, neuropil] mask matrix, so each batch takes a single
+    sparse matmul. Only the bounding box of the mask pixels is read from
+    each frame.
+
+    Parameters
+    ----------
+    f_ins : list of numpy.ndarray or BinaryFile
+        Registered frames of each channel, each of shape (n_frames, Ly, Lx).
+    cell_masks : scipy.sparse.csc_matrix or list of tuple
+        Cell masks, see extract_traces.
+    neuropil_masks : scipy.sparse.csc_matrix or list of numpy.ndarray or None
+        Neuropil masks, see extract_traces.
+    batch_size : int, optional (default 500)
+        Number of frames processed per batch.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    Fs : list of numpy.ndarray
+        ROI fluorescence traces of each channel, shape (n_rois, n_frames).
+    Fneus : list of numpy.ndarray
+        Neuropil fluorescence traces of each channel, shape (n_rois, n_frames).
+    """
+    n_frames, Ly, Lx = f_ins[0].shape
+    nchannels = len(f_ins)
     batch_size = min(batch_size, 1000)
-    ncells = len(cell_masks)
 
     # Check if mps and force to be on the CPU so that extraction can be run
     # TODO: Once, sparse_coo_tensor works on sparseMPS backend, we should remove this check
     if device.type == 'mps':
         device = torch.device('cpu')
 
-    npix_neuropil = torch.Tensor([len(nm) for nm in neuropil_masks]).to(device)
-    # create coo tensor of neuropil and cell masks 
-    ccol_indices = [m for nm in neuropil_masks for m in nm]
-    row_indices = [k for k in range(len(neuropil_masks)) for m in neuropil_masks[k]]
-    inds = torch.Tensor([ccol_indices, row_indices]).to(device)
-    # convert to csc (tried creating csc directly but it was slow)
-    nmasks = torch.sparse_coo_tensor(inds, torch.ones(len(row_indices), device=device), 
-                                     size=(Ly*Lx, ncells))
-    nmasks = nmasks.to_sparse_csc()
-
-    ccol_indices = [m for cm in cell_masks for m in cm[0]]
-    row_indices = [k for k in range(len(cell_masks)) for m in cell_masks[k][0]]
-    cell_lam = torch.Tensor([l for cm in cell_masks for l in cm[1]]).to(device)
-    inds = torch.Tensor([ccol_indices, row_indices]).to(device)
-    cmasks = torch.sparse_coo_tensor(inds, cell_lam, 
-                                     size=(Ly*Lx, ncells))
-    cmasks = cmasks.to_sparse_csc()
-
-    F = np.zeros((ncells, n_frames), np.float32)
-    Fneu = np.zeros((ncells, n_frames), np.float32)
+    if not sparse.issparse(cell_masks):
+        cell_masks = mask_matrix([cm[0] for cm in cell_masks], Ly, Lx,
+                                 weights=[cm[1] for cm in cell_masks])
+    if neuropil_masks is not None and not sparse.issparse(neuropil_masks):
+        neuropil_masks = mask_matrix(neuropil_masks, Ly, Lx)
+    ncells = cell_masks.shape[1]
+    if neuropil_masks is not None:
+        npix_neuropil = torch.from_numpy(np.diff(neuropil_masks.tocsc().indptr).astype("float32")).to(device)
+        masks = sparse.hstack((cell_masks, neuropil_masks), format="csc")
+    else:
+        masks = cell_masks.tocsc()
+
+    # read only the rows and columns of the frames covered by the masks
+    yrange, xrange = _bounding_box(masks.indices, Lx)
+    crop = (yrange[1] - yrange[0], xrange[1] - xrange[0]) != (Ly, Lx)
+    if crop:
+        Ly, Lx, Lx0 = yrange[1] - yrange[0], xrange[1] - xrange[0], Lx
+        indices = (masks.indices // Lx0 - yrange[0]) * Lx + masks.indices % Lx0 - xrange[0]
+        masks = sparse.csc_matrix((masks.data, indices, masks.indptr),
+                                  shape=(Ly * Lx, masks.shape[1]))
+    masks = _to_torch_csc(masks, device)
+
+    Fs = [np.zeros((ncells, n_frames), np.float32) for f_in in f_ins]
+    Fneus = [np.zeros((ncells, n_frames), np.float32) for f_in in f_ins]
 
     batch_size = int(batch_size)
 
@@ -85,16 +132,39 @@ def extract_traces(f_in, cell_masks, neuropil_masks, batch_size=500,
     tqdm_out = TqdmToLogger(logger, level=logging.INFO)
     for n in trange(n_batches, mininterval=10, file=tqdm_out):
         tstart, tend = n * batch_size, min((n+1) * batch_size, n_frames)
-        data = torch.from_numpy(f_in[tstart : tend]).to(device)
-        data = data.reshape(-1, Ly*Lx).float()
-        
-        Fneu_batch = (data @ nmasks) / npix_neuropil
-        Fneu[:, tstart : tend] = Fneu_batch.T.cpu().numpy()
-        
-        F_batch = data @ cmasks 
-        F[:, tstart : tend] = F_batch.T.cpu().numpy()
-        
-    return F, Fneu
+        frames = [np.ascontiguousarray(f_in[tstart : tend, yrange[0] : yrange[1],
+                                            xrange[0] : xrange[1]])
+                  if crop else f_in[tstart : tend] for f_in in f_ins]
+        data = torch.cat([torch.from_numpy(frames0).to(device).reshape(-1, Ly*Lx)
+                          for frames0 in frames]).float()
+
+        traces = data @ masks
+        if neuropil_masks is not None:
+            traces[:, ncells:] /= npix_neuropil
+        traces = traces.T.cpu().numpy().reshape(-1, nchannels, tend - tstart)
+        for ich in range(nchannels):
+            Fs[ich][:, tstart : tend] = traces[:ncells, ich]
+            if neuropil_masks is not None:
+                Fneus[ich][:, tstart : tend] = traces[ncells:, ich]
+
+    return Fs, Fneus
+
+
+def _bounding_box(ipix, Lx):
+    """ y and x ranges of the bounding box of flattened pixel indices ipix """
+    if ipix.size == 0:
+        return [0, 1], [0, 1]
+    ypix, xpix = ipix // Lx, ipix % Lx
+    return [int(ypix.min()), int(ypix.max()) + 1], [int(xpix.min()), int(xpix.max()) + 1]
+
+
+def _to_torch_csc(masks, device):
+    """ convert a scipy CSC matrix to a torch sparse CSC tensor with int64 indices """
+    return torch.sparse_csc_tensor(torch.from_numpy(masks.indptr.astype("int64")),
+                                   torch.from_numpy(masks.indices.astype("int64")),
+                                   torch.from_numpy(masks.data.astype("float32")),
+                                   size=masks.shape, check_invariants=False).to(device)
+
 
 def extraction_wrapper(stat, f_reg, f_reg_chan2=None, cell_masks=None,
                        neuropil_masks=None, settings=default_settings()["extraction"],
@@ -114,9 +184,10 @@ def extraction_wrapper(stat, f_reg, f_reg_chan2=None, cell_masks=None,
         Registered functional frames, shape (n_frames, Ly, Lx).
     f_reg_chan2 : numpy.ndarray or BinaryFile, optional (default None)
         Registered anatomical channel frames, shape (n_frames, Ly, Lx).
-    cell_masks : list of tuple, optional (default None)
-        Pre-computed cell masks. If None, masks are created from stat.
-    neuropil_masks : list of numpy.ndarray, optional (default None)
+    cell_masks : scipy.sparse.csc_matrix or list of tuple, optional (default None)
+        Pre-computed cell masks (see extract_traces). If None, masks are
+        created from stat with create_mask_matrices.
+    neuropil_masks : scipy.sparse.csc_matrix or list of numpy.ndarray, optional (default None)
         Pre-computed neuropil masks. If None, masks are created from stat.
     settings : dict
         Extraction settings dictionary.
@@ -140,31 +211,233 @@ def extraction_wrapper(stat, f_reg, f_reg_chan2=None, cell_masks=None,
     batch_size = settings["batch_size"]
     if cell_masks is None:
         t10 = time.time()
-        cell_masks, neuropil_masks0 = create_masks(stat, Ly, Lx, 
-                                                   lam_percentile=settings["lam_percentile"], 
-                                                allow_overlap=settings["allow_overlap"], 
-                                                neuropil_extract=settings["neuropil_extract"], 
-                                                inner_neuropil_radius=settings["inner_neuropil_radius"],
-                                                min_neuropil_pixels=settings["min_neuropil_pixels"], 
-                                                circular_neuropil=settings["circular_neuropil"])
+        cell_masks, neuropil_masks0 = create_mask_matrices(stat, Ly, Lx,
+                                                **{key: settings[key] for key in MASK_SETTINGS})
         if neuropil_masks is None:
             neuropil_masks = neuropil_masks0
         logger.info("Masks created, %0.2f sec." % (time.time() - t10))
 
     t0 = time.time()
-    ncells = len(cell_masks)
-    logger.info("functional channel:")
-    F, Fneu = extract_traces(f_reg, cell_masks, neuropil_masks, 
-                             batch_size=batch_size, device=device)
-    if f_reg_chan2 is not None:
-        logger.info("anatomical channel:")
-        F_chan2, Fneu_chan2 = extract_traces(f_reg_chan2, cell_masks, neuropil_masks,
-                                             batch_size=batch_size, device=device)
-    else:
-        F_chan2, Fneu_chan2 = None, None
+    ncells = cell_masks.shape[1] if sparse.issparse(cell_masks) else len(cell_masks)
+    f_ins = [f_reg] if f_reg_chan2 is None else [f_reg, f_reg_chan2]
+    logger.info("functional and anatomical channels:" if f_reg_chan2 is not None
+                else "functional channel:")
+    Fs, Fneus = extract_traces_multichannel(f_ins, cell_masks, neuropil_masks,
+                                            batch_size=batch_size, device=device)
+    F, Fneu = Fs[0], Fneus[0]
+    F_chan2, Fneu_chan2 = (Fs[1], Fneus[1]) if f_reg_chan2 is not None else (None, None)
 
     logger.info("Extracted fluorescence from %d ROIs in %d frames, %0.2f sec." %
           (ncells, n_frames, time.time() - t0))
 
     
     return F, Fneu, F_chan2, Fneu_chan2
+
+
+def reextract_changed_rois(stat, f_reg, keep_rois, cell_masks, neuropil_masks, F, Fneu,
+                           f_reg_chan2=None, F_chan2=None, Fneu_chan2=None,
+                           settings=default_settings()["extraction"],
+                           device=torch.device("cuda")):
+    """
+    Update traces after removing ROIs, re-extracting only the ROIs whose masks changed.
+
+    After removing ROIs (e.g. with low SNR) and recomputing the overlapping
+    pixels with assign_overlaps, the masks of the remaining ROIs are recreated
+    and compared with their previous masks. Only the ROIs with a changed cell
+    or neuropil mask are extracted again, in a single pass over the channels.
+
+    Parameters
+    ----------
+    stat : numpy.ndarray
+        Remaining ROIs, stat_prev[keep_rois] with updated "overlap".
+    f_reg : numpy.ndarray or BinaryFile
+        Registered functional frames, shape (n_frames, Ly, Lx).
+    keep_rois : numpy.ndarray
+        Boolean array of the previous ROIs that are kept, shape (n_rois_prev,).
+    cell_masks : scipy.sparse.csc_matrix
+        Previous cell masks, shape (Ly * Lx, n_rois_prev).
+    neuropil_masks : scipy.sparse.csc_matrix or None
+        Previous neuropil masks, shape (Ly * Lx, n_rois_prev).
+    F, Fneu : numpy.ndarray
+        Previous traces of the functional channel, shape (n_rois_prev, n_frames).
+    f_reg_chan2 : numpy.ndarray or BinaryFile, optional (default None)
+        Registered anatomical channel frames, shape (n_frames, Ly, Lx).
+    F_chan2, Fneu_chan2 : numpy.ndarray, optional (default None)
+        Previous traces of the anatomical channel.
+    settings : dict
+        Extraction settings dictionary.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    F, Fneu, F_chan2, Fneu_chan2 : numpy.ndarray
+        Traces of the remaining ROIs, shape (n_rois, n_frames) (F_chan2 and
+        Fneu_chan2 are None without anatomical channel).
+    cell_masks, neuropil_masks : scipy.sparse.csc_matrix
+        Masks of the remaining ROIs.
+    """
+    Ly, Lx = f_reg.shape[-2:]
+    cell_masks0 = cell_masks[:, keep_rois]
+    neuropil_masks0 = neuropil_masks[:, keep_rois] if neuropil_masks is not None else None
+    cell_masks, neuropil_masks = create_mask_matrices(
+        stat, Ly, Lx, **{key: settings[key] for key in MASK_SETTINGS})
+    changed = _changed_columns(cell_masks, cell_masks0)
+    if neuropil_masks is not None:
+        changed |= _changed_columns(neuropil_masks, neuropil_masks0)
+
+    outputs = [F, Fneu]
+    f_ins = [f_reg]
+    if f_reg_chan2 is not None:
+        outputs += [F_chan2, Fneu_chan2]
+        f_ins += [f_reg_chan2]
+    outputs = [X[keep_rois] for X in outputs]
+    logger.info(f"Re-extracting {changed.sum()} of {len(stat)} ROIs with changed masks")
+    if changed.sum() > 0:
+        Fs, Fneus = extract_traces_multichannel(
+            f_ins, cell_masks[:, changed],
+            neuropil_masks[:, changed] if neuropil_masks is not None else None,
+            batch_size=settings["batch_size"], device=device)
+        for ich in range(len(f_ins)):
+            outputs[2 * ich][changed] = Fs[ich]
+            outputs[2 * ich + 1][changed] = Fneus[ich]
+    if f_reg_chan2 is None:
+        outputs += [None, None]
+    return (*outputs, cell_masks, neuropil_masks)
+
+
+def _changed_columns(masks, masks0):
+    """ boolean array of the columns that differ between two sparse matrices """
+    diff = (masks - masks0).tocsc()
+    diff.eliminate_zeros()
+    return np.diff(diff.indptr) > 0
+
+
+def extract_rois(stat, irois, f_reg, f_reg_chan2=None,
+                 settings=default_settings()["extraction"], device=torch.device("cuda")):
+    """
+    Extract the traces of a subset of ROIs, reading only their bounding box.
+
+    The cell masks of the ROIs irois and their neuropil masks (excluding the
+    cell pixels of all ROIs in stat) are created as in extraction_wrapper.
+    The frames are then read in batches restricted to the bounding box of
+    these masks (see extract_traces_multichannel), for all channels at once.
+
+    Parameters
+    ----------
+    stat : numpy.ndarray
+        Array of all ROI statistics dictionaries, each containing "ypix",
+        "xpix", "lam", "radius", and "overlap".
+    irois : numpy.ndarray
+        Indices in stat of the ROIs to extract.
+    f_reg : numpy.ndarray or BinaryFile
+        Registered functional frames, shape (n_frames, Ly, Lx).
+    f_reg_chan2 : numpy.ndarray or BinaryFile, optional (default None)
+        Registered anatomical channel frames, shape (n_frames, Ly, Lx).
+    settings : dict
+        Extraction settings dictionary.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    F, Fneu : numpy.ndarray
+        Traces of the ROIs for the functional channel, shape (len(irois), n_frames).
+    F_chan2, Fneu_chan2 : numpy.ndarray or None
+        Traces of the ROIs for the anatomical channel, or None if f_reg_chan2
+        is not provided.
+    """
+    t0 = time.time()
+    n_frames, Ly, Lx = f_reg.shape
+    irois = np.asarray(irois, "int64")
+    cell_masks = create_cell_mask_matrix([stat[n] for n in irois], Ly, Lx,
+                                         allow_overlap=settings["allow_overlap"])
+    neuropil_masks = None
+    if settings["neuropil_extract"]:
+        cell_pix = create_cell_pix(stat, Ly=Ly, Lx=Lx, lam_percentile=settings["lam_percentile"])
+        ypixs, xpixs = [stat[n]["ypix"] for n in irois], [stat[n]["xpix"] for n in irois]
+        if settings["circular_neuropil"]:
+            neuropil_masks = mask_matrix(
+                create_neuropil_masks(ypixs, xpixs, cell_pix,
+                                      inner_neuropil_radius=settings["inner_neuropil_radius"],
+                                      min_neuropil_pixels=settings["min_neuropil_pixels"],
+                                      circular=True), Ly, Lx)
+        else:
+            neuropil_masks = create_neuropil_mask_matrix(
+                ypixs, xpixs, cell_pix, inner_neuropil_radius=settings["inner_neuropil_radius"],
+                min_neuropil_pixels=settings["min_neuropil_pixels"]).T.tocsc()
+
+    f_ins = [f_reg] if f_reg_chan2 is None else [f_reg, f_reg_chan2]
+    Fs, Fneus = extract_traces_multichannel(f_ins, cell_masks, neuropil_masks,
+                                            batch_size=settings["batch_size"], device=device)
+    logger.info("Extracted fluorescence from %d ROIs in %d frames, %0.2f sec." %
+                (len(irois), n_frames, time.time() - t0))
+    if f_reg_chan2 is None:
+        return Fs[0], Fneus[0], None, None
+    return Fs[0], Fneus[0], Fs[1], Fneus[1]
+
+
+def update_traces(save_path, stat, irois, f_reg, f_reg_chan2=None, iremove=None,
+                  settings=default_settings(), device=torch.device("cuda")):
+    """
+    Update the saved traces of added or edited ROIs.
+
+    Rows iremove are first deleted from the saved traces, and rows are
+    appended for ROIs added at the end of stat. The traces of the ROIs irois
+    are then extracted with extract_rois and deconvolved, and only their rows
+    of F.npy, Fneu.npy and spks.npy (and F_chan2.npy, Fneu_chan2.npy with an
+    anatomical channel) are updated. Without removed or added ROIs the files
+    are updated in place.
+
+    Parameters
+    ----------
+    save_path : str
+        Folder with the outputs of the plane (F.npy, Fneu.npy, spks.npy).
+    stat : numpy.ndarray
+        Array of all ROI statistics dictionaries after the edit.
+    irois : numpy.ndarray
+        Indices in stat of the added or edited ROIs.
+    f_reg : numpy.ndarray or BinaryFile
+        Registered functional frames, shape (n_frames, Ly, Lx).
+    f_reg_chan2 : numpy.ndarray or BinaryFile, optional (default None)
+        Registered anatomical channel frames, shape (n_frames, Ly, Lx).
+    iremove : numpy.ndarray, optional (default None)
+        Indices of the rows of the saved traces of removed ROIs.
+    settings : dict
+        Suite2p settings dictionary (uses "extraction", "dcnv_preprocess",
+        "tau" and "fs").
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    F, Fneu, spks : numpy.ndarray
+        Updated traces of the ROIs irois, shape (len(irois), n_frames).
+    """
+    irois = np.asarray(irois, "int64")
+    F, Fneu, F_chan2, Fneu_chan2 = extract_rois(stat, irois, f_reg, f_reg_chan2=f_reg_chan2,
+                                                settings=settings["extraction"], device=device)
+    dF = F - settings["extraction"]["neuropil_coefficient"] * Fneu
+    dF = preprocess(F=dF, fs=settings["fs"], batch_size=settings["extraction"]["batch_size"],
+                    device=device, **settings["dcnv_preprocess"])
+    spks = oasis(F=dF, batch_size=settings["extraction"]["batch_size"], tau=settings["tau"],
+                 fs=settings["fs"])
+
+    outputs = {"F.npy": F, "Fneu.npy": Fneu, "spks.npy": spks}
+    if f_reg_chan2 is not None:
+        outputs.update({"F_chan2.npy": F_chan2, "Fneu_chan2.npy": Fneu_chan2})
+    for fname, X in outputs.items():
+        fpath = os.path.join(save_path, fname)
+        X0 = np.load(fpath, mmap_mode="r")
+        if (iremove is None or len(iremove) == 0) and X0.shape[0] == len(stat):
+            X0 = np.load(fpath, mmap_mode="r+")
+            X0[irois] = X
+            X0.flush()
+        else:
+            X0 = np.delete(X0, iremove, axis=0) if iremove is not None else np.array(X0)
+            X0 = np.concatenate((X0, np.zeros((len(stat) - X0.shape[0], X0.shape[1]),
+                                              X0.dtype)), axis=0)
+            X0[irois] = X
+            np.save(fpath, X0)
+        del X0
+    return F, Fneu, spks
@@ -1,12 +1,21 @@
 """
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
+from collections import OrderedDict
 from itertools import count
 import numpy as np
-from scipy.ndimage import percentile_filter
+from numba import njit, prange
+from scipy import sparse
 
 from ..detection.sparsedetect import extendROI
-from .. import default_settings
+from .. import default_settings, stage_cache
+
+# sparse mask matrices of the most recent ROI sets, see create_mask_matrices
+# (shared with the callers, which must not modify them)
+_MASK_CACHE = OrderedDict()
+_MASK_CACHE_SIZE = 2
+# keys of the stat of each ROI that the masks depend on
+_MASK_KEYS = ["ypix", "xpix", "lam", "overlap", "radius"]
 
 
 def create_masks(stats, Ly, Lx, lam_percentile=50., 
@@ -66,6 +75,148 @@ def create_masks(stats, Ly, Lx, lam_percentile=50.,
     return cell_masks, neuropil_masks
 
 
+def create_mask_matrices(stats, Ly, Lx, lam_percentile=50., allow_overlap=False,
+                         neuropil_extract=True, inner_neuropil_radius=2,
+                         min_neuropil_pixels=350, circular_neuropil=False):
+    """
+    Create cell and neuropil masks for all ROIs as sparse matrices.
+
+    Same masks as create_masks, as CSC matrices built by array concatenation
+    rather than from per-pixel Python lists. Results are cached on the content of the ROIs and
+    the mask settings, so that repeated extractions with the same ROIs
+    (e.g. of the anatomical channel) reuse them. Cached matrices are returned
+    as is, so they must not be modified in place.
+
+    Parameters
+    ----------
+    stats : list of dict
+        List of ROI statistics dictionaries, each containing "ypix", "xpix",
+        "lam", "radius", and "overlap".
+    Ly : int
+        Height of the image in pixels.
+    Lx : int
+        Width of the image in pixels.
+    lam_percentile, allow_overlap, neuropil_extract, inner_neuropil_radius, min_neuropil_pixels, circular_neuropil
+        Mask settings, see create_masks.
+
+    Returns
+    -------
+    cell_masks : scipy.sparse.csc_matrix
+        Matrix of shape (Ly * Lx, n_rois), column k holds the normalized
+        weights of the pixels of ROI k.
+    neuropil_masks : scipy.sparse.csc_matrix or None
+        Binary matrix of shape (Ly * Lx, n_rois), column k is the neuropil
+        mask of ROI k. None if neuropil_extract is False.
+    """
+    mask_settings = (Ly, Lx, lam_percentile, allow_overlap, neuropil_extract,
+                     inner_neuropil_radius, min_neuropil_pixels, circular_neuropil)
+    key = stage_cache.stage_hash(mask_settings, [{k: stat[k] for k in _MASK_KEYS if k in stat}
+                                                 for stat in stats])
+    if key in _MASK_CACHE:
+        _MASK_CACHE.move_to_end(key)
+        return _MASK_CACHE[key]
+
+    cell_masks = create_cell_mask_matrix(stats, Ly, Lx, allow_overlap=allow_overlap)
+    neuropil_masks = None
+    if neuropil_extract:
+        cell_pix = create_cell_pix(stats, Ly=Ly, Lx=Lx, lam_percentile=lam_percentile)
+        ypixs, xpixs = [stat["ypix"] for stat in stats], [stat["xpix"] for stat in stats]
+        if circular_neuropil:
+            neuropil_masks = mask_matrix(
+                create_neuropil_masks(ypixs, xpixs, cell_pix,
+                                      inner_neuropil_radius=inner_neuropil_radius,
+                                      min_neuropil_pixels=min_neuropil_pixels,
+                                      circular=True), Ly, Lx)
+        else:
+            neuropil_masks = create_neuropil_mask_matrix(
+                ypixs, xpixs, cell_pix, inner_neuropil_radius=inner_neuropil_radius,
+                min_neuropil_pixels=min_neuropil_pixels).T.tocsc()
+
+    _MASK_CACHE[key] = cell_masks, neuropil_masks
+    while len(_MASK_CACHE) > _MASK_CACHE_SIZE:
+        _MASK_CACHE.popitem(last=False)
+    return cell_masks, neuropil_masks
+
+
+def mask_matrix(ipixs, Ly, Lx, weights=None):
+    """
+    Stack masks given as flattened pixel indices into a sparse matrix.
+
+    Parameters
+    ----------
+    ipixs : list of numpy.ndarray
+        Flattened pixel indices of each mask.
+    Ly : int
+        Height of the image in pixels.
+    Lx : int
+        Width of the image in pixels.
+    weights : list of numpy.ndarray, optional (default None)
+        Weight of each pixel of each mask. If None, weights are 1.
+
+    Returns
+    -------
+    masks : scipy.sparse.csc_matrix
+        Float32 matrix of shape (Ly * Lx, n_masks). Repeated pixels of a
+        mask are summed.
+    """
+    npix = np.array([len(ipix) for ipix in ipixs], "int64")
+    indptr = np.zeros(len(npix) + 1, "int64")
+    indptr[1:] = np.cumsum(npix)
+    indices = (np.concatenate(ipixs).astype("int64") if indptr[-1] > 0
+               else np.zeros(0, "int64"))
+    if weights is None:
+        data = np.ones(indptr[-1], "float32")
+    else:
+        data = (np.concatenate(weights).astype("float32") if indptr[-1] > 0
+                else np.zeros(0, "float32"))
+    masks = sparse.csc_matrix((data, indices, indptr), shape=(Ly * Lx, len(npix)))
+    masks.sum_duplicates()
+    return masks
+
+
+def create_cell_mask_matrix(stats, Ly, Lx, allow_overlap=False):
+    """
+    Create the cell masks of all ROIs as a sparse matrix.
+
+    Same masks as create_cell_mask, with the weights of each ROI normalized
+    to sum to 1.
+
+    Parameters
+    ----------
+    stats : list of dict
+        List of ROI statistics dictionaries containing "ypix", "xpix", "lam",
+        and "overlap".
+    Ly : int
+        Height of the image in pixels.
+    Lx : int
+        Width of the image in pixels.
+    allow_overlap : bool, optional (default False)
+        If True, include overlapping pixels in the cell masks.
+
+    Returns
+    -------
+    cell_masks : scipy.sparse.csc_matrix
+        Float32 matrix of shape (Ly * Lx, n_rois).
+    """
+    if len(stats) == 0:
+        return mask_matrix([], Ly, Lx)
+    ypix = np.concatenate([stat["ypix"] for stat in stats]).astype("int64")
+    xpix = np.concatenate([stat["xpix"] for stat in stats]).astype("int64")
+    lam = np.concatenate([stat["lam"] for stat in stats]).astype("float32")
+    iroi = np.repeat(np.arange(len(stats)), [len(stat["ypix"]) for stat in stats])
+    if not allow_overlap:
+        keep = ~np.concatenate([stat["overlap"] for stat in stats]).astype("bool")
+        ypix, xpix, lam, iroi = ypix[keep], xpix[keep], lam[keep], iroi[keep]
+    lam_sum = np.bincount(iroi, weights=lam, minlength=len(stats))
+    lam = (lam / lam_sum[iroi]).astype("float32")
+    npix = np.bincount(iroi, minlength=len(stats))
+    indptr = np.zeros(len(stats) + 1, "int64")
+    indptr[1:] = np.cumsum(npix)
+    cell_masks = sparse.csc_matrix((lam, ypix * Lx + xpix, indptr), shape=(Ly * Lx, len(stats)))
+    cell_masks.sum_duplicates()
+    return cell_masks
+
+
 def create_cell_pix(stats, Ly, Lx, lam_percentile = 50.0):
     """
     Create a binary image indicating which pixels contain a cell.
@@ -101,15 +252,62 @@ def create_cell_pix(stats, Ly, Lx, lam_percentile = 50.0):
         lammap[ypix, xpix] = np.maximum(lammap[ypix, xpix], lam)
     radius = np.median(radii)
     if lam_percentile > 0.0:
-        filt = percentile_filter(lammap, percentile=lam_percentile,
-                                 size=int(radius * 5))
-        cell_pix = ~np.logical_or(lammap < filt, lammap == 0)
+        # percentile filter of lammap, only evaluated at the pixels with lammap > 0
+        size = int(radius * 5)
+        rank = size**2 - 1 if lam_percentile == 100.0 else int(size**2 * lam_percentile / 100.0)
+        ypix, xpix = np.nonzero(lammap)
+        cell_pix = np.zeros((Ly, Lx), "bool")
+        cell_pix[ypix, xpix] = _above_percentile_pixels(lammap, ypix, xpix, size, rank)
     else:
         cell_pix = lammap > 0.0
 
     return cell_pix
 
 
+@njit(parallel=True, cache=True)
+def _above_percentile_pixels(img, ypix, xpix, size, rank):
+    """
+    Compare pixels of an image to the percentile filter of the image.
+
+    Equivalent to img[ypix, xpix] >= scipy.ndimage.percentile_filter(img)[ypix, xpix]
+    (mode "reflect", square window of width `size`), computed by counting
+    the window values below each pixel rather than sorting the window.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        Image of shape (Ly, Lx).
+    ypix : numpy.ndarray
+        Y-coordinates of the pixels at which the filter is evaluated.
+    xpix : numpy.ndarray
+        X-coordinates of the pixels at which the filter is evaluated.
+    size : int
+        Width of the square window.
+    rank : int
+        Rank of the percentile in the sorted window values.
+
+    Returns
+    -------
+    above : numpy.ndarray
+        Boolean array of shape (len(ypix),), True where the pixel value is at
+        least the percentile of its window.
+    """
+    Ly, Lx = img.shape
+    above = np.zeros(len(ypix), np.bool_)
+    for i in prange(len(ypix)):
+        v = img[ypix[i], xpix[i]]
+        nbelow = 0
+        for dy in range(size):
+            y = (ypix[i] + dy - size // 2) % (2 * Ly)
+            y = y if y < Ly else 2 * Ly - 1 - y
+            for dx in range(size):
+                x = (xpix[i] + dx - size // 2) % (2 * Lx)
+                x = x if x < Lx else 2 * Lx - 1 - x
+                nbelow += img[y, x] <= v
+        above[i] = nbelow > rank
+    return above
+
+
 def create_cell_mask(stat, Ly, Lx, allow_overlap = False):
     """
     Create the cell mask for a single ROI.
@@ -141,6 +339,181 @@ def create_cell_mask(stat, Ly, Lx, allow_overlap = False):
     return cell_mask, lam_normed
 
 
+@njit(cache=True)
+def _neuropil_ring(ypix, xpix, Ly, Lx, radius):
+    """
+    Pixels within a 4-connected distance `radius` of an ROI (as extendROI).
+
+    Returns the bounding box [y0, y1] x [x0, x1] of the extended ROI and a
+    local boolean image of shape (y1 - y0 + 1, x1 - x0 + 1) of its pixels.
+    """
+    y0, y1 = max(0, ypix.min() - radius), min(Ly - 1, ypix.max() + radius)
+    x0, x1 = max(0, xpix.min() - radius), min(Lx - 1, xpix.max() + radius)
+    ring = np.zeros((y1 - y0 + 1, x1 - x0 + 1), np.bool_)
+    for i in range(len(ypix)):
+        for dy in range(-radius, radius + 1):
+            y = ypix[i] + dy - y0
+            if y < 0 or y > y1 - y0:
+                continue
+            for dx in range(abs(dy) - radius, radius - abs(dy) + 1):
+                x = xpix[i] + dx - x0
+                if x >= 0 and x <= x1 - x0:
+                    ring[y, x] = True
+    return y0, y1, x0, x1, ring
+
+
+@njit(parallel=True, cache=True)
+def _neuropil_boxes(ypix, xpix, offsets, valid, inner_neuropil_radius,
+                    min_neuropil_pixels, extend_by, max_extend):
+    """
+    Size the rectangular neuropil surround of each ROI.
+
+    The number of valid (non-cell) pixels in a box is computed from the
+    integral image of `valid`, so the number of times the box is extended
+    by `extend_by` pixels is found by bisection instead of by growing the box.
+
+    Returns
+    -------
+    boxes : numpy.ndarray
+        Neuropil box [y0, y1, x0, x1] (inclusive) of each ROI, shape (n_rois, 4).
+    nring : numpy.ndarray
+        Number of valid pixels in the ring of each ROI, shape (n_rois,).
+    npix : numpy.ndarray
+        Number of pixels in each neuropil mask, shape (n_rois,).
+    """
+    Ly, Lx = valid.shape
+    n_rois = len(offsets) - 1
+    integral = np.zeros((Ly + 1, Lx + 1), np.int64)
+    for y in range(Ly):
+        for x in range(Lx):
+            integral[y + 1, x + 1] = (integral[y, x + 1] + integral[y + 1, x] -
+                                      integral[y, x] + valid[y, x])
+    boxes = np.zeros((n_rois, 4), np.int64)
+    nring = np.zeros(n_rois, np.int64)
+    npix = np.zeros(n_rois, np.int64)
+    for k in prange(n_rois):
+        p0, p1 = offsets[k], offsets[k + 1]
+        if p1 == p0:
+            continue
+        y0, y1, x0, x1, ring = _neuropil_ring(ypix[p0:p1], xpix[p0:p1], Ly, Lx,
+                                              inner_neuropil_radius)
+        nr = 0
+        if inner_neuropil_radius > 0:
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    nr += ring[y - y0, x - x0] and valid[y, x]
+        else:
+            # without extension the pixels of the ROI are counted as given
+            for i in range(p0, p1):
+                nr += valid[ypix[i], xpix[i]]
+        nring[k] = nr
+        boxes[k] = y0, y1, x0, x1
+        if min_neuropil_pixels < 0:
+            continue
+        # smallest number of extensions with enough neuropil pixels
+        jmin, jmax = 1, max_extend
+        while jmin < jmax:
+            j = (jmin + jmax) // 2
+            by0, by1 = max(0, y0 - extend_by * j), min(Ly - 1, y1 + extend_by * j)
+            bx0, bx1 = max(0, x0 - extend_by * j), min(Lx - 1, x1 + extend_by * j)
+            nvalid = (integral[by1 + 1, bx1 + 1] - integral[by0, bx1 + 1] -
+                      integral[by1 + 1, bx0] + integral[by0, bx0])
+            if nvalid - nr > min_neuropil_pixels:
+                jmax = j
+            else:
+                jmin = j + 1
+        by0, by1 = max(0, y0 - extend_by * jmin), min(Ly - 1, y1 + extend_by * jmin)
+        bx0, bx1 = max(0, x0 - extend_by * jmin), min(Lx - 1, x1 + extend_by * jmin)
+        boxes[k] = by0, by1, bx0, bx1
+        nvalid = (integral[by1 + 1, bx1 + 1] - integral[by0, bx1 + 1] -
+                  integral[by1 + 1, bx0] + integral[by0, bx0])
+        # valid pixels of the ring (counted once each) are excluded from the mask
+        nring_unique = 0
+        for y in range(y0, y1 + 1):
+            for x in range(x0, x1 + 1):
+                nring_unique += ring[y - y0, x - x0] and valid[y, x]
+        npix[k] = nvalid - nring_unique
+    return boxes, nring, npix
+
+
+@njit(parallel=True, cache=True)
+def _neuropil_indices(ypix, xpix, offsets, valid, inner_neuropil_radius, boxes,
+                      indptr):
+    """
+    Fill the CSR column indices of the neuropil masks from their boxes.
+
+    The pixels of each mask are the valid pixels of its box, excluding the
+    ring around the ROI, in raster order.
+    """
+    Ly, Lx = valid.shape
+    indices = np.zeros(indptr[-1], np.int64)
+    for k in prange(len(offsets) - 1):
+        p0, p1 = offsets[k], offsets[k + 1]
+        if indptr[k + 1] == indptr[k]:
+            continue
+        y0, y1, x0, x1, ring = _neuropil_ring(ypix[p0:p1], xpix[p0:p1], Ly, Lx,
+                                              inner_neuropil_radius)
+        by0, by1, bx0, bx1 = boxes[k]
+        i = indptr[k]
+        for y in range(by0, by1 + 1):
+            for x in range(bx0, bx1 + 1):
+                if not valid[y, x]:
+                    continue
+                if y >= y0 and y <= y1 and x >= x0 and x <= x1 and ring[y - y0, x - x0]:
+                    continue
+                indices[i] = y * Lx + x
+                i += 1
+    return indices
+
+
+def create_neuropil_mask_matrix(ypixs, xpixs, cell_pix, inner_neuropil_radius=2,
+                                min_neuropil_pixels=350):
+    """
+    Create rectangular surround neuropil masks for all ROIs as a sparse matrix.
+
+    Batched version of create_neuropil_masks (with circular=False), with
+    identical masks: each surround box is sized directly from the integral
+    image of the non-cell pixels.
+
+    Parameters
+    ----------
+    ypixs : list of numpy.ndarray
+        Y-coordinates of the pixels for each ROI.
+    xpixs : list of numpy.ndarray
+        X-coordinates of the pixels for each ROI.
+    cell_pix : numpy.ndarray
+        Binary array of shape (Ly, Lx), True where a cell pixel exists.
+        These pixels are excluded from neuropil masks.
+    inner_neuropil_radius : int, optional (default 2)
+        Number of pixels to extend around each ROI as an exclusion zone.
+    min_neuropil_pixels : int, optional (default 350)
+        Minimum number of pixels in each neuropil mask.
+
+    Returns
+    -------
+    neuropil_masks : scipy.sparse.csr_matrix
+        Binary matrix of shape (n_rois, Ly * Lx), row k is the neuropil mask
+        of ROI k with flattened pixel indices as columns.
+    """
+    Ly, Lx = cell_pix.shape
+    assert len(xpixs) == len(ypixs)
+    npix = np.array([len(ypix) for ypix in ypixs], "int64")
+    offsets = np.zeros(len(npix) + 1, "int64")
+    offsets[1:] = np.cumsum(npix)
+    ypix = np.concatenate(ypixs).astype("int64") if len(ypixs) > 0 else np.zeros(0, "int64")
+    xpix = np.concatenate(xpixs).astype("int64") if len(xpixs) > 0 else np.zeros(0, "int64")
+    valid = cell_pix < .5
+    radius = int(inner_neuropil_radius)
+
+    boxes, nring, npix_neu = _neuropil_boxes(ypix, xpix, offsets, valid, radius,
+                                             min_neuropil_pixels, 5, 100)
+    indptr = np.zeros(len(npix) + 1, "int64")
+    indptr[1:] = np.cumsum(npix_neu)
+    indices = _neuropil_indices(ypix, xpix, offsets, valid, radius, boxes, indptr)
+    return sparse.csr_matrix((np.ones(len(indices), "float32"), indices, indptr),
+                             shape=(len(npix), Ly * Lx))
+
+
 def create_neuropil_masks(ypixs, xpixs, cell_pix, inner_neuropil_radius=2,
                           min_neuropil_pixels=350, circular=False):
     """
@@ -169,6 +542,12 @@ def create_neuropil_masks(ypixs, xpixs, cell_pix, inner_neuropil_radius=2,
         Each element is an array of flattened pixel indices for the neuropil
         mask of one ROI.
     """
+    if not circular:
+        neuropil_masks = create_neuropil_mask_matrix(
+            ypixs, xpixs, cell_pix, inner_neuropil_radius=inner_neuropil_radius,
+            min_neuropil_pixels=min_neuropil_pixels)
+        return np.split(neuropil_masks.indices, neuropil_masks.indptr[1:-1])
+
     valid_pixels = lambda cell_pix, ypix, xpix: cell_pix[ypix, xpix] < .5
     extend_by = 5
 
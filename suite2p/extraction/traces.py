@@ -0,0 +1,136 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import numpy as np
+import torch
+from scipy.ndimage import gaussian_filter
+from scipy.stats import skew
+import logging
+logger = logging.getLogger(__name__)
+
+from .dcnv import preprocess, oasis
+from ..parameters import default_settings
+
+# number of float32 traces held in memory per ROI of a chunk: F, Fneu, dF,
+# the baseline and smoothing buffers of preprocess, and the OASIS buffers
+TRACES_PER_ROI = 10
+
+
+def chunk_size(n_frames, memory_budget, batch_size=1):
+    """
+    Number of ROIs processed at once to stay within a memory budget.
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of frames of the traces.
+    memory_budget : float
+        Memory in GB for the traces of a chunk.
+    batch_size : int, optional (default 1)
+        The chunk size is a multiple of batch_size (at least batch_size), so
+        that the batches within a chunk are the same as without chunking.
+
+    Returns
+    -------
+    nchunk : int
+        Number of ROIs per chunk.
+    """
+    nchunk = int(memory_budget * 2**30 // (TRACES_PER_ROI * 4 * max(1, n_frames)))
+    return int(max(batch_size, nchunk // batch_size * batch_size))
+
+
+def trace_statistics(F, Fneu, neuropil_coefficient=0.7, memory_budget=4.):
+    """
+    SNR, skewness and standard deviation of neuropil-subtracted traces, in chunks of ROIs.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        ROI fluorescence traces, shape (n_rois, n_frames), e.g. memory-mapped from F.npy.
+    Fneu : numpy.ndarray
+        Neuropil fluorescence traces, shape (n_rois, n_frames).
+    neuropil_coefficient : float, optional (default 0.7)
+        Coefficient for neuropil subtraction.
+    memory_budget : float, optional (default 4.)
+        Memory in GB for the traces of a chunk.
+
+    Returns
+    -------
+    snr : numpy.ndarray
+        1 - 0.5 * var(diff(dF)) / var(dF) for each ROI, shape (n_rois,).
+    sk : numpy.ndarray
+        Skewness of dF for each ROI, shape (n_rois,).
+    sd : numpy.ndarray
+        Standard deviation of dF for each ROI, shape (n_rois,).
+    """
+    n_rois, n_frames = F.shape
+    nchunk = chunk_size(n_frames, memory_budget)
+    snr, sk, sd = [], [], []
+    for i in range(0, max(n_rois, 1), nchunk):
+        dF = np.asarray(F[i : i + nchunk]) - neuropil_coefficient * np.asarray(Fneu[i : i + nchunk])
+        snr.append(1 - 0.5 * np.diff(dF, axis=1).var(axis=1) / dF.var(axis=1))
+        sk.append(skew(dF, axis=1))
+        sd.append(np.std(dF, axis=1))
+    return np.concatenate(snr), np.concatenate(sk), np.concatenate(sd)
+
+
+def deconvolve_traces(F, Fneu, spks, tau, fs, neuropil_coefficient=0.7, batch_size=500,
+                      dcnv_settings=default_settings()["dcnv_preprocess"], memory_budget=4.,
+                      device=torch.device("cuda")):
+    """
+    Neuropil subtraction, baseline correction and OASIS deconvolution in chunks of ROIs.
+
+    Gives the same spikes as running preprocess and oasis on all traces at
+    once, while holding only one chunk of traces in memory: F and Fneu can be
+    memory-mapped from F.npy and Fneu.npy, and spks from spks.npy.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        ROI fluorescence traces, shape (n_rois, n_frames).
+    Fneu : numpy.ndarray
+        Neuropil fluorescence traces, shape (n_rois, n_frames).
+    spks : numpy.ndarray
+        Float32 output of the deconvolved traces, shape (n_rois, n_frames).
+        Modified in place.
+    tau : float
+        Timescale of the indicator decay in seconds.
+    fs : float
+        Sampling rate per plane in Hz.
+    neuropil_coefficient : float, optional (default 0.7)
+        Coefficient for neuropil subtraction.
+    batch_size : int, optional (default 500)
+        Number of ROIs per batch of preprocess and oasis.
+    dcnv_settings : dict, optional
+        Baseline settings passed to preprocess ("baseline", "win_baseline",
+        "sig_baseline", "prctile_baseline").
+    memory_budget : float, optional (default 4.)
+        Memory in GB for the traces of a chunk.
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    spks : numpy.ndarray
+        Deconvolved traces, shape (n_rois, n_frames).
+    """
+    n_rois, n_frames = F.shape
+    nchunk = chunk_size(n_frames, memory_budget, batch_size=batch_size)
+    dcnv_settings = dict(dcnv_settings)
+    chunks = range(0, n_rois, nchunk)
+    logger.info(f"Deconvolving {n_rois} ROIs in {len(chunks)} chunks of up to {nchunk} ROIs")
+    get_dF = lambda i: (np.asarray(F[i : i + nchunk]) -
+                        neuropil_coefficient * np.asarray(Fneu[i : i + nchunk]))
+    if dcnv_settings["baseline"] == "constant":
+        # the constant baseline is the minimum over all smoothed traces
+        Flow = min(gaussian_filter(get_dF(i), [0., dcnv_settings["sig_baseline"]]).min()
+                   for i in chunks)
+    for i in chunks:
+        dF = get_dF(i)
+        if dcnv_settings["baseline"] == "constant":
+            dF -= Flow
+        else:
+            dF = preprocess(F=dF, fs=fs, batch_size=batch_size, device=device,
+                            **dcnv_settings)
+        oasis(F=dF, batch_size=batch_size, tau=tau, fs=fs, out=spks[i : i + nchunk])
+    return spks
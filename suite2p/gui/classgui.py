@@ -363,5 +363,3 @@ def class_masks(parent):
     col = masks.istat_transform(istat, parent.ops_plot['colormap'])
     parent.colors['cols'][c] = col
     parent.colors['istat'][c] = istat.flatten()
-
-    masks.rgb_masks(parent, col, c)
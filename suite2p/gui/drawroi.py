@@ -14,8 +14,11 @@ from scipy import stats
 from scipy.ndimage import rotate
 
 from . import io
-from ..extraction import masks
-from ..detection.stats import roi_stats
+from .. import default_settings
+from ..detection.stats import roi_stats, assign_overlaps
+from ..extraction.extract import extract_rois
+from ..io import BinaryFile, store
+from ..run_s2p import _assign_torch_device
 from ..extraction import preprocess
 from ..extraction.dcnv import oasis
 
@@ -35,26 +38,24 @@ def masks_and_traces(settings, stat_manual, stat_orig):
     for n in range(len(stat_orig)):
         stat_all.append(stat_orig[n])
 
-    stat_all = roi_stats(stat_all, settings["Ly"], settings["Lx"], aspect=settings.get("aspect", None),
-                         diameter=settings["diameter"])
-    cell_masks = [
-        masks.create_cell_mask(stat, Ly=settings["Ly"], Lx=settings["Lx"],
-                               allow_overlap=settings["allow_overlap"]) for stat in stat_all
-    ]
-    cell_pix = masks.create_cell_pix(stat_all, Ly=settings["Ly"], Lx=settings["Lx"])
+    stat_all = roi_stats(np.array(stat_all), settings["Ly"], settings["Lx"],
+                         diameter=settings["diameter"], max_overlap=None)
+    stat_all = assign_overlaps(stat_all, settings["Ly"], settings["Lx"])
     manual_roi_stats = stat_all[:len(stat_manual)]
-    manual_cell_masks = cell_masks[:len(stat_manual)]
-    manual_neuropil_masks = masks.create_neuropil_masks(
-        ypixs=[stat["ypix"] for stat in manual_roi_stats],
-        xpixs=[stat["xpix"] for stat in manual_roi_stats],
-        cell_pix=cell_pix,
-        inner_neuropil_radius=settings["inner_neuropil_radius"],
-        min_neuropil_pixels=settings["min_neuropil_pixels"],
-    )
-    print("Masks made in %0.2f sec." % (time.time() - t0))
-
-    F, Fneu, F_chan2, Fneu_chan2 = extract_traces_from_masks(settings, manual_cell_masks,
-                                                             manual_neuropil_masks)
+
+    # extract only the manual ROIs, reading the bounding box of their masks
+    extraction_settings = default_settings()["extraction"]
+    extraction_settings.update({key: settings[key] for key in extraction_settings
+                                if key in settings})
+    f_reg = BinaryFile(settings["Ly"], settings["Lx"], settings["reg_file"])
+    f_reg_chan2 = None
+    if os.path.isfile(settings.get("reg_file_chan2", "")):
+        f_reg_chan2 = BinaryFile(settings["Ly"], settings["Lx"], settings["reg_file_chan2"])
+    device = _assign_torch_device(settings.get("torch_device", "cuda"))
+    F, Fneu, F_chan2, Fneu_chan2 = extract_rois(stat_all, np.arange(len(stat_manual)),
+                                                f_reg, f_reg_chan2=f_reg_chan2,
+                                                settings=extraction_settings, device=device)
+    print("Masks made and traces extracted in %0.2f sec." % (time.time() - t0))
 
     # compute activity statistics for classifier
     npix = np.array([stat_orig[n]["npix"] for n in range(len(stat_orig))
@@ -251,6 +252,8 @@ class ROIDraw(QMainWindow):
         for n in range(len(self.parent.stat)):
             stat_all.append(self.parent.stat[n])
         np.save(os.path.join(self.parent.basename, "stat.npy"), stat_all)
+        if os.path.exists(os.path.join(self.parent.basename, store.ROI_FOLDER)):
+            store.save_rois(self.parent.basename, stat_all)
         iscell_prob = np.concatenate(
             (self.parent.iscell[:, np.newaxis], self.parent.probcell[:, np.newaxis]),
             axis=1)
@@ -265,9 +268,9 @@ class ROIDraw(QMainWindow):
         Spks = np.concatenate(
             (self.Spks, self.parent.Spks), axis=0
         )  # For now convert spikes to 0 for the new ROIS and then fix it later
-        np.save(os.path.join(self.parent.basename, "F.npy"), Fcell)
-        np.save(os.path.join(self.parent.basename, "Fneu.npy"), Fneu)
-        np.save(os.path.join(self.parent.basename, "spks.npy"), Spks)
+        io.save_traces(os.path.join(self.parent.basename, "F.npy"), Fcell)
+        io.save_traces(os.path.join(self.parent.basename, "Fneu.npy"), Fneu)
+        io.save_traces(os.path.join(self.parent.basename, "spks.npy"), Spks)
 
         if "reg_file_chan2" in self.parent.ops:
             F_chan2 = np.load(os.path.join(self.parent.basename, "F_chan2.npy"))
@@ -0,0 +1,235 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ..io import BinaryFile
+
+# downsampling factors of the pyramid levels of a binary
+PYRAMID_FACTORS = (2, 4)
+
+
+def pyramid_filename(filename, factor):
+    """ file of the pyramid level of the binary filename downsampled by factor """
+    root, ext = os.path.splitext(filename)
+    return f"{root}_ds{factor}{ext}"
+
+
+def downsample(frames, factor):
+    """ mean over blocks of factor x factor pixels of frames (n_frames, Ly, Lx),
+    the pixels at the edges that do not fill a block are cropped """
+    nframes, Ly, Lx = frames.shape
+    Lyd, Lxd = Ly // factor, Lx // factor
+    frames = frames[:, :Lyd * factor, :Lxd * factor].reshape(nframes, Lyd, factor, Lxd,
+                                                             factor)
+    return frames.mean(axis=(2, 4), dtype=np.float32).astype(np.int16)
+
+
+def pyramid_ready(filename, n_frames, Ly, Lx, factor):
+    """ whether the pyramid level of filename is built and newer than filename """
+    fname = pyramid_filename(filename, factor)
+    if not os.path.isfile(fname):
+        return False
+    nbytes = 2 * n_frames * (Ly // factor) * (Lx // factor)
+    return (os.path.getsize(fname) == nbytes and
+            os.path.getmtime(fname) >= os.path.getmtime(filename))
+
+
+def build_pyramid(f, factors=PYRAMID_FACTORS, batch_size=500, stop=None):
+    """
+    Write the pyramid levels of a binary that are not built yet.
+
+    The frames of f are read once, in batches of frames, and downsampled for
+    each level. Each level is written to a temporary file which replaces the
+    level file once it is complete.
+
+    Parameters
+    ----------
+    f : BinaryFile
+        Binary to downsample.
+    factors : tuple of int, optional (default PYRAMID_FACTORS)
+        Downsampling factors of the levels.
+    batch_size : int, optional (default 500)
+        Number of frames read at once.
+    stop : threading.Event, optional
+        Stops the build (without writing the levels) when set.
+
+    Returns
+    -------
+    factors : list of int
+        Factors of the levels of f that are built.
+    """
+    n_frames, Ly, Lx = f.shape
+    factors = [factor for factor in factors if Ly >= factor and Lx >= factor]
+    todo = [factor for factor in factors
+            if not pyramid_ready(f.filename, n_frames, Ly, Lx, factor)]
+    if len(todo) == 0:
+        return factors
+    tmp_files = [pyramid_filename(f.filename, factor) + ".tmp" for factor in todo]
+    for tmp_file in tmp_files:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    f_levels = [BinaryFile(Ly // factor, Lx // factor, tmp_file, n_frames=n_frames,
+                           write=True) for factor, tmp_file in zip(todo, tmp_files)]
+    done = False
+    try:
+        for i0 in range(0, n_frames, batch_size):
+            if stop is not None and stop.is_set():
+                break
+            frames = np.asarray(f[i0:i0 + batch_size])
+            for factor, f_level in zip(todo, f_levels):
+                f_level[i0:i0 + frames.shape[0]] = downsample(frames, factor)
+        else:
+            done = True
+    finally:
+        for f_level in f_levels:
+            f_level.file.flush()
+            f_level.close()
+        for factor, tmp_file in zip(todo, tmp_files):
+            if done:
+                os.replace(tmp_file, pyramid_filename(f.filename, factor))
+            else:
+                os.remove(tmp_file)
+    return factors if done else [factor for factor in factors if factor not in todo]
+
+
+class FrameCache:
+    """
+    LRU cache of the frames of binaries, with a background thread that reads
+    ahead in the playback direction and one that builds their pyramid levels.
+
+    Parameters
+    ----------
+    sources : dict
+        BinaryFile (or array of frames) of each source, e.g. {("reg", 0): f}.
+    max_bytes : int, optional (default 2**29)
+        Maximum size of the cached frames, the least recently used frames
+        are dropped above it.
+    n_ahead : int, optional (default 50)
+        Number of frames read ahead of the current frame.
+    batch_size : int, optional (default 10)
+        Number of frames read at once by the read-ahead thread.
+    """
+
+    def __init__(self, sources, max_bytes=2**29, n_ahead=50, batch_size=10):
+        # frames of each source per pyramid level (1 is the source)
+        self.levels = {key: {1: source} for key, source in sources.items()}
+        self.max_bytes = max_bytes
+        self.n_ahead = n_ahead
+        self.batch_size = batch_size
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Condition()
+        self.request = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+        self.pyramid_thread = None
+
+    def build_pyramids(self, factors=PYRAMID_FACTORS):
+        """ build the pyramid levels of the sources that are BinaryFiles in the
+        background, each level is used once it is built """
+        sources = [(key, levels[1]) for key, levels in self.levels.items()
+                   if isinstance(levels[1], BinaryFile)]
+        self.pyramid_thread = threading.Thread(target=self._build_pyramids,
+                                               args=(sources, factors), daemon=True)
+        self.pyramid_thread.start()
+
+    def _build_pyramids(self, sources, factors):
+        for key, f in sources:
+            try:
+                built = build_pyramid(f, factors, stop=self.stop)
+            except OSError as e:
+                print("could not build the downsampled copies of %s: %s" % (f.filename, e))
+                continue
+            for factor in built:
+                f_level = BinaryFile(f.Ly // factor, f.Lx // factor,
+                                     pyramid_filename(f.filename, factor))
+                with self.lock:
+                    self.levels[key][factor] = f_level
+            if self.stop.is_set():
+                return
+
+    def level(self, keys, factor):
+        """ largest pyramid level, at most factor, that is built for all sources keys """
+        with self.lock:
+            return min(max(level for level in self.levels[key] if level <= factor)
+                       for key in keys)
+
+    def _store(self, key, factor, i, frame):
+        with self.lock:
+            if (key, factor, i) not in self.frames:
+                self.frames[(key, factor, i)] = frame
+                self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes and len(self.frames) > 1:
+                self.nbytes -= self.frames.popitem(last=False)[1].nbytes
+
+    def get(self, key, i, factor=1):
+        """ frame i of source key at pyramid level factor (which must be built) """
+        with self.lock:
+            frame = self.frames.get((key, factor, i), None)
+            if frame is not None:
+                self.frames.move_to_end((key, factor, i))
+                return frame
+            source = self.levels[key][factor]
+        frame = np.array(source[i])
+        self._store(key, factor, i, frame)
+        return frame
+
+    def read_ahead(self, keys, i, step=1, factor=1):
+        """ read the n_ahead frames i + step, i + 2 * step, ... of the sources keys
+        at pyramid level factor in the background (replaces the previous request) """
+        with self.lock:
+            self.request = (list(keys), i, step, factor)
+            self.lock.notify()
+
+    def _read_ahead(self):
+        while True:
+            with self.lock:
+                while self.request is None and not self.stop.is_set():
+                    self.lock.wait()
+                if self.stop.is_set():
+                    return
+                keys, i, step, factor = self.request
+                self.request = None
+                sources = [self.levels[key][factor] for key in keys]
+            for key, source in zip(keys, sources):
+                n_frames = source.shape[0]
+                frame_nbytes = np.prod(source.shape[1:]) * np.dtype(source.dtype).itemsize
+                n_ahead = min(self.n_ahead, n_frames - 1,
+                              self.max_bytes // (2 * len(keys) * frame_nbytes))
+                inds = (i + step * np.arange(1, n_ahead + 1)) % n_frames
+                with self.lock:
+                    inds = [j for j in inds if (key, factor, j) not in self.frames]
+                for j0 in range(0, len(inds), self.batch_size):
+                    # stop for a new request (e.g. the user jumped to another frame)
+                    if self.request is not None or self.stop.is_set():
+                        break
+                    batch = np.sort(inds[j0:j0 + self.batch_size])
+                    if batch[-1] - batch[0] == len(batch) - 1:
+                        frames = np.array(source[batch[0]:batch[-1] + 1])
+                    else:
+                        frames = np.stack([np.array(source[j]) for j in batch])
+                    for j, frame in zip(batch, frames):
+                        self._store(key, factor, int(j), frame)
+                if self.request is not None:
+                    break
+
+    def close(self):
+        """ stop the background threads and close the pyramid levels """
+        self.stop.set()
+        with self.lock:
+            self.lock.notify()
+        self.thread.join()
+        if self.pyramid_thread is not None:
+            self.pyramid_thread.join()
+        for levels in self.levels.values():
+            for factor, f_level in levels.items():
+                if factor > 1:
+                    f_level.close()
+        self.frames.clear()
+        self.nbytes = 0
@@ -86,8 +86,8 @@ class MainWindow(QMainWindow):
             "saturation": [0, 255],
             "colormap": "hsv"
         }
-        self.rois = {"iROI": 0, "Sroi": 0, "Lam": 0, "LamMean": 0, "LamNorm": 0}
-        self.colors = {"RGB": 0, "cols": 0, "colorbar": []}
+        self.rois = {"P": None, "iROI": 0, "Sroi": 0, "Lam": 0, "LamMean": 0, "LamNorm": 0}
+        self.colors = {"cols": 0, "colorbar": []}
 
         # --------- MAIN WIDGET LAYOUT ---------------------
         cwidget = QWidget()
@@ -209,6 +209,8 @@ class MainWindow(QMainWindow):
 
     def roi_text(self, state):
         if QtCore.Qt.CheckState(state) == QtCore.Qt.Checked:
+            if len(self.roi_text_labels) == 0:
+                masks.make_roi_text_labels(self)
             for n in range(len(self.roi_text_labels)):
                 if self.iscell[n] == 1:
                     self.p1.addItem(self.roi_text_labels[n])
@@ -437,21 +439,14 @@ class MainWindow(QMainWindow):
         if self.loaded:
             # activity used for correlations
             self.bin = max(1, int(self.binedit.text()))
-            nb = int(np.floor(float(self.Fcell.shape[1]) / float(self.bin)))
-            if i == 0:
-                f = self.Fcell
-            elif i == 1:
-                f = self.Fneu
-            elif i == 2:
-                f = self.Fcell - 0.7 * self.Fneu
+            # binned activity computed while loading the folder
+            Fbin_loaded = getattr(self, "Fbin_loaded", None)
+            self.Fbin_loaded = None
+            if Fbin_loaded is not None and Fbin_loaded[:2] == (i, self.bin):
+                self.Fbin, self.Fstd = Fbin_loaded[2:]
             else:
-                f = self.Spks
-            ncells = len(self.stat)
-            self.Fbin = f[:, :nb * self.bin].reshape(
-                (ncells, nb, self.bin)).mean(axis=2)
-
-            self.Fbin -= self.Fbin.mean(axis=1)[:, np.newaxis]
-            self.Fstd = (self.Fbin**2).mean(axis=1)**0.5
+                self.Fbin, self.Fstd = traces.binned_activity(
+                    self.Fcell, self.Fneu, self.Spks, i, self.bin)
             self.trange = np.arange(0, self.Fcell.shape[1])
             # if in behavior-view, recompute
             if self.ops_plot["color"] == 8:
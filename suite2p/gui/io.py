@@ -5,7 +5,7 @@ import os, time
 import numpy as np
 import scipy.io
 from scipy.ndimage import gaussian_filter1d
-from qtpy import QtGui
+from qtpy import QtGui, QtCore
 from qtpy.QtWidgets import QFileDialog, QMessageBox
 
 from . import utils, masks, views, graphics, traces, classgui
@@ -17,7 +17,7 @@ def export_fig(parent):
     parent.win.scene().showExportDialog()
 
 
-def make_masks_and_enable_buttons(parent):
+def make_masks_and_enable_buttons(parent, layers=None):
     parent.checkBox.setChecked(True)
     parent.ops_plot["color"] = 0
     parent.ops_plot["view"] = 0
@@ -46,20 +46,7 @@ def make_masks_and_enable_buttons(parent):
         parent.ops["chan2_thres"] = 0.6
     parent.chan2prob = parent.ops["chan2_thres"]
     parent.chan2edit.setText(str(parent.chan2prob))
-    # add boundaries to stat for ROI overlays
     ncells = len(parent.stat)
-    for n in range(0, ncells):
-        ypix = parent.stat[n]["ypix"].flatten()
-        xpix = parent.stat[n]["xpix"].flatten()
-        yext, xext = utils.boundary(ypix, xpix)
-        parent.stat[n]["yext"] = yext
-        parent.stat[n]["xext"] = xext
-        ycirc, xcirc = utils.circle(parent.stat[n]["med"], parent.stat[n]["radius"])
-        goodi = ((ycirc >= 0) & (xcirc >= 0) & (ycirc < parent.ops["Ly"]) &
-                 (xcirc < parent.ops["Lx"]))
-        parent.stat[n]["ycirc"] = ycirc[goodi]
-        parent.stat[n]["xcirc"] = xcirc[goodi]
-        parent.stat[n]["inmerge"] = 0
     # enable buttons
     enable_views_and_classifier(parent)
     # make views
@@ -80,7 +67,7 @@ def make_masks_and_enable_buttons(parent):
     parent.colormat = masks.draw_colorbar()
     masks.plot_colorbar(parent)
     tic = time.time()
-    masks.init_masks(parent)
+    masks.init_masks(parent, layers)
     M = masks.draw_masks(parent)
     masks.plot_masks(parent, M)
     print(f"time to draw and plot masks: {time.time() - tic : .4f} sec")
@@ -171,7 +158,7 @@ def load_dialog(parent):
     dlg_kwargs = {
         "parent": parent,
         "caption": "Open stat.npy",
-        "filter": "stat.npy",
+        "filter": "suite2p results (stat.npy metadata.json)",
     }
     name = QFileDialog.getOpenFileName(**dlg_kwargs)
     parent.fname = name[0]
@@ -196,21 +183,83 @@ def load_dialog_folder(parent):
     parent.fname = name
     load_folder(parent)
 
+
+class LoadWorker(QtCore.QThread):
+    """ loads a results folder in a background thread
+
+    load_fn(*args) returns the outputs of load_files (with memory-mapped traces),
+    then the values needed to display them are computed with prepare_procs.
+    ops_loaded is emitted first so that the images are shown while the ROIs and
+    traces are prepared.
+    """
+    ops_loaded = QtCore.Signal(object)
+    loaded = QtCore.Signal(object, object)
+    failed = QtCore.Signal(str)
+
+    def __init__(self, load_fn, *args):
+        super(LoadWorker, self).__init__()
+        self.load_fn = load_fn
+        self.args = args
+
+    def run(self):
+        try:
+            procs = self.load_fn(*self.args)
+            if procs is None:
+                self.failed.emit("Incorrect files, choose another?")
+                return
+            self.ops_loaded.emit(procs[1])
+            self.loaded.emit(procs, prepare_procs(procs))
+        except Exception as e:
+            self.failed.emit("ERROR loading files: %s" % e)
+
+
+def load_in_background(parent, basename, load_fn, *args, on_failed=print):
+    """ load the outputs of load_fn(*args) into the GUI with a LoadWorker """
+    worker = getattr(parent, "load_worker", None)
+    if worker is not None and worker.isRunning():
+        print("already loading a folder, wait for it to finish")
+        return
+    parent.loaded = False
+    parent.setWindowTitle("loading %s ..." % parent.fname)
+    worker = LoadWorker(load_fn, *args)
+    worker.ops_loaded.connect(lambda ops: show_images(parent, ops))
+    worker.loaded.connect(lambda procs, prep: load_to_GUI(parent, basename, procs, prep))
+    worker.failed.connect(on_failed)
+    # keep a reference to the thread while it runs
+    parent.load_worker = worker
+    worker.start()
+
+
+def show_images(parent, ops):
+    """ show the mean image of the folder being loaded """
+    parent.ops = ops
+    views.init_views(parent)
+    parent.color1.hide()
+    parent.color2.hide()
+    parent.view1.setImage(parent.views[1], levels=parent.ops_plot["saturation"])
+    parent.view2.setImage(parent.views[1], levels=parent.ops_plot["saturation"])
+    parent.p1.setXRange(0, parent.ops["Lx"])
+    parent.p1.setYRange(0, parent.ops["Ly"])
+    parent.p2.setXRange(0, parent.ops["Lx"])
+    parent.p2.setYRange(0, parent.ops["Ly"])
+    parent.show()
+
+
+def read_nwb_procs(name):
+    procs = list(io.read_nwb(name))
+    if procs[1]["nchannels"] == 2:
+        hasred = True
+    else:
+        hasred = False
+    procs.append(hasred)
+    return procs
+
+
 def load_NWB(parent):
     name = parent.fname
     print(name)
-    try:
-        procs = list(io.read_nwb(name))
-        if procs[1]["nchannels"] == 2:
-            hasred = True
-        else:
-            hasred = False
-        procs.append(hasred)
-        load_to_GUI(parent, os.path.split(name)[0], procs)
-
-        parent.loaded = True
-    except Exception as e:
-        print("ERROR with NWB: %s" % e)
+    load_in_background(parent, os.path.split(name)[0], read_nwb_procs, name,
+                       on_failed=lambda e: print("ERROR with NWB: %s" % e))
 
 
 def load_folder(parent):
@@ -222,26 +271,54 @@ def load_folder(parent):
     stat_found = False
     if len(plane_folders) > 0:
         stat_found = all(
-            [os.path.isfile(os.path.join(f, "stat.npy")) for f in plane_folders])
+            [os.path.isfile(os.path.join(f, "stat.npy")) or io.store.has_store(f)
+             for f in plane_folders])
     if not stat_found:
         print("No processed planeX folders in folder")
         return
 
-    # create a combined folder to hold iscell and redcell
+    fpath = os.path.join(save_folder, "combined")
+    if combined_up_to_date(save_folder, plane_folders):
+        # memory-map the traces of the saved combined view
+        load_in_background(parent, fpath, load_files, os.path.join(fpath, "stat.npy"))
+    else:
+        # create a combined folder to hold iscell and redcell
+        load_in_background(parent, fpath, load_combined, save_folder)
+    print(parent.fname)
+
+
+def combined_up_to_date(save_folder, plane_folders):
+    """ whether the combined folder of save_folder was saved after the outputs of its planes """
+    fpath = os.path.join(save_folder, "combined")
+    files = [os.path.join(fpath, f"{key}.npy") for key in ["F", "Fneu", "spks", "iscell"]]
+    if not (all(os.path.isfile(f) for f in files) and
+            (os.path.isfile(os.path.join(fpath, "stat.npy")) or io.store.has_store(fpath))):
+        return False
+    saved = min(os.path.getmtime(f) for f in files)
+    names = ["stat.npy", "F.npy", "Fneu.npy", "spks.npy", "iscell.npy", "redcell.npy",
+             io.store.METADATA_FILE]
+    return all(os.path.getmtime(os.path.join(f, name)) <= saved
+               for f in plane_folders for name in names
+               if os.path.isfile(os.path.join(f, name)))
+
+
+def load_combined(save_folder):
     output = io.combined(save_folder, save=False)
     output = list(output)
     output[1] = {**output[1], **output[2]}  # combine db and settings
     del output[2]
-    parent.basename = os.path.join(parent.fname, "combined")
-    load_to_GUI(parent, parent.basename, output)
-    parent.loaded = True
-    print(parent.fname)
+    return output
 
 
 def load_files(name):
-    """ give stat.npy path and load all needed files for suite2p """
+    """ give stat.npy (or metadata.json) path and load all needed files for suite2p """
+    # use the columnar results store of the folder if it is up to date
+    columnar = io.store.has_store(os.path.split(name)[0])
     try:
-        stat = np.load(name, allow_pickle=True)
+        if columnar:
+            stat = io.store.load_rois(os.path.split(name)[0]).to_stat()
+        else:
+            stat = np.load(name, allow_pickle=True)
         ypix = stat[0]["ypix"]
     except (ValueError, KeyError, OSError, RuntimeError, TypeError, NameError):
         print("ERROR: this is not a stat.npy file :( "
@@ -251,25 +328,32 @@ def load_files(name):
     if stat is not None:
         basename, fname = os.path.split(name)
         goodfolder = True
+        # traces are memory-mapped, rows are read when they are plotted
         try:
-            Fcell = np.load(basename + "/F.npy")
-            Fneu = np.load(basename + "/Fneu.npy")
+            Fcell = np.load(basename + "/F.npy", mmap_mode="r")
+            Fneu = np.load(basename + "/Fneu.npy", mmap_mode="r")
         except (ValueError, OSError, RuntimeError, TypeError, NameError):
             print("ERROR: there are no fluorescence traces in this folder "
                   "(F.npy/Fneu.npy)")
             goodfolder = False
         try:
-            Spks = np.load(basename + "/spks.npy")
+            Spks = np.load(basename + "/spks.npy", mmap_mode="r")
         except (ValueError, OSError, RuntimeError, TypeError, NameError):
             print("there are no spike deconvolved traces in this folder "
                   "(spks.npy)")
             goodfolder = False
         noops = True
-        try:
-            ops = np.load(os.path.join(basename, "ops.npy"), allow_pickle=True).item()
+        if columnar:
+            metadata = io.store.load_metadata(basename, mmap_mode=None)
+            ops = {**metadata["db"], **metadata["settings"], **metadata["reg_outputs"],
+                   **metadata["detect_outputs"]}
             noops = False
-        except:
-            noops = True
+        else:
+            try:
+                ops = np.load(os.path.join(basename, "ops.npy"), allow_pickle=True).item()
+                noops = False
+            except:
+                noops = True
         if noops:
             try:
                 settings = np.load(basename + "/settings.npy", allow_pickle=True).item()
@@ -322,17 +406,30 @@ def load_proc(parent):
     name = parent.fname
     print(name)
     basename, fname = os.path.split(name)
-    output = load_files(name)
-    if output is not None:
-        load_to_GUI(parent, basename, output)
-        parent.loaded = True
-    else:
-        Text = "Incorrect files, choose another?"
-        load_again(parent, Text)
+    load_in_background(parent, basename, load_files, name,
+                       on_failed=lambda Text: load_again(parent, Text))
 
 
-def load_to_GUI(parent, basename, procs):
+def prepare_procs(procs):
+    """ values computed from the loaded files before they are displayed: the snr
+    of the ROIs (if not in stat), the mask layers and the default binned activity """
+    stat, ops, Fcell, Fneu, Spks, iscell = procs[:6]
+    if iscell.ndim == 2:
+        iscell = iscell[:, 0]
+    prep = {}
+    if len(stat) > 0 and "snr" not in stat[0]:
+        prep["snr"] = traces.trace_snr(Fcell, Fneu)
+    prep["layers"] = masks.roi_layers(stat, iscell.astype("bool"), ops["Ly"], ops["Lx"])
+    # activity used for correlations, F - 0.7 * Fneu binned in 0.5s
+    bin = max(1, int(ops["tau"] * ops["fs"] / 2))
+    prep["Fbin"] = (2, bin, *traces.binned_activity(Fcell, Fneu, Spks, 2, bin))
+    return prep
+
+
+def load_to_GUI(parent, basename, procs, prep=None):
     stat, ops, Fcell, Fneu, Spks, iscell, probcell, redcell, probredcell, hasred = procs
+    if prep is None:
+        prep = prepare_procs(procs)
     parent.basename = basename
     parent.stat = stat
     parent.ops = ops
@@ -358,15 +455,12 @@ def load_to_GUI(parent, basename, procs):
     for n in range(len(parent.stat)):
         if parent.hasred:
             parent.stat[n]["chan2_prob"] = parent.probredcell[n]
-        if "snr" not in parent.stat[0]:
-            dF = Fcell.copy() - 0.7 * Fneu
-            snr = 1 - 0.5 * np.diff(dF, axis=1).var(axis=1) / dF.var(axis=1)        
-            del dF
-            for n in range(len(parent.stat)):
-                parent.stat[n]["snr"] = snr[n]
+        if "snr" in prep:
+            parent.stat[n]["snr"] = prep["snr"][n]
         parent.stat[n]["inmerge"] = 0
     parent.stat = np.array(parent.stat)
-    make_masks_and_enable_buttons(parent)
+    parent.Fbin_loaded = prep["Fbin"]
+    make_masks_and_enable_buttons(parent, prep["layers"])
     parent.ichosen = 0
     parent.imerge = [0]
     for n in range(len(parent.stat)):
@@ -482,12 +576,22 @@ def save_mat(parent):
         })
 
 
+def save_traces(filename, traces):
+    """ save traces to filename through a temporary file, so that the traces
+    memory-mapped from filename stay valid while they are written """
+    with open(filename + ".tmp", "wb") as f:
+        np.save(f, traces)
+    os.replace(filename + ".tmp", filename)
+
+
 def save_merge(parent):
     print("saving to NPY")
     np.save(os.path.join(parent.basename, "settings.npy"), parent.ops)
     np.save(os.path.join(parent.basename, "stat.npy"), parent.stat)
-    np.save(os.path.join(parent.basename, "F.npy"), parent.Fcell)
-    np.save(os.path.join(parent.basename, "Fneu.npy"), parent.Fneu)
+    if os.path.exists(os.path.join(parent.basename, io.store.ROI_FOLDER)):
+        io.store.save_rois(parent.basename, parent.stat)
+    save_traces(os.path.join(parent.basename, "F.npy"), parent.Fcell)
+    save_traces(os.path.join(parent.basename, "Fneu.npy"), parent.Fneu)
     if parent.hasred:
         np.save(os.path.join(parent.basename, "F_chan2.npy"), parent.F_chan2)
         np.save(os.path.join(parent.basename, "Fneu_chan2.npy"), parent.Fneu_chan2)
@@ -496,7 +600,7 @@ def save_merge(parent):
             np.concatenate((np.expand_dims(
                 parent.redcell, axis=1), np.expand_dims(parent.probredcell, axis=1)),
                            axis=1))
-    np.save(os.path.join(parent.basename, "spks.npy"), parent.Spks)
+    save_traces(os.path.join(parent.basename, "spks.npy"), parent.Spks)
     iscell = np.concatenate(
         (parent.iscell[:, np.newaxis], parent.probcell[:, np.newaxis]), axis=1)
     np.save(os.path.join(parent.basename, "iscell.npy"), iscell)
@@ -5,12 +5,13 @@ from pathlib import Path
 import matplotlib.cm
 import numpy as np
 import pyqtgraph as pg
+from scipy import sparse
 from qtpy import QtGui, QtCore
 from qtpy.QtWidgets import QPushButton, QButtonGroup, QLabel, QComboBox, QLineEdit
 from matplotlib.colors import hsv_to_rgb
 
 import suite2p.gui.merge
-from . import io
+from . import io, utils
 
 
 def make_buttons(parent, b0):
@@ -91,7 +92,6 @@ def cmap_change(parent):
         for c in range(1, istat.shape[0]):
             parent.colors["cols"][c] = istat_transform(istat[c],
                                                        parent.ops_plot["colormap"])
-            rgb_masks(parent, parent.colors["cols"][c], c)
         parent.colormat = draw_colorbar(parent.ops_plot["colormap"])
         parent.update_plot()
 
@@ -127,8 +127,7 @@ def make_colors(parent):
             istat = np.zeros((ncells, 1))
             if b < len(parent.color_names) - 2:
                 if names in parent.stat[0]:
-                    for n in range(0, ncells):
-                        istat[n] = parent.stat[n][names]
+                    istat[:, 0] = [parent.stat[n][names] for n in range(ncells)]
                 istat1 = np.percentile(istat, 2)
                 istat99 = np.percentile(istat, 98)
                 parent.colors["colorbar"].append(
@@ -206,64 +205,161 @@ def make_colorbar(parent, b0):
     ]
 
 
-def init_masks(parent):
+def roi_matrix(stat, Ly, Lx):
     """
-    creates RGB masks using stat and puts them in M0 or M1 depending on
-    whether or not iscell is True for a given ROI
+    sparse ROI to pixel matrix, (ncells, Ly * Lx), with the weights of the
+    pixels of each ROI normalized to sum to 1 (empty rows for ROIs with a
+    "ypix" of None)
+    """
+    ncells = len(stat)
+    npix = np.array([0 if stat[n]["ypix"] is None else stat[n]["ypix"].size
+                     for n in range(ncells)], np.int64)
+    iroi = np.nonzero(npix)[0]
+    if iroi.size > 0:
+        ypix = np.concatenate([stat[n]["ypix"].ravel() for n in iroi]).astype(np.int64)
+        xpix = np.concatenate([stat[n]["xpix"].ravel() for n in iroi]).astype(np.int64)
+        lam = np.concatenate([stat[n]["lam"].ravel() for n in iroi]).astype(np.float32)
+    else:
+        ypix, xpix = np.zeros(0, np.int64), np.zeros(0, np.int64)
+        lam = np.zeros(0, np.float32)
+    rows = np.repeat(np.arange(ncells), npix)
+    lam_sum = np.bincount(rows, weights=lam, minlength=ncells)
+    lam /= lam_sum[rows].astype(np.float32)
+    return sparse.csr_matrix((lam, (rows, ypix * Lx + xpix)), shape=(ncells, Ly * Lx))
+
+
+def roi_layers(stat, iscell, Ly, Lx, nlayers=3, P=None):
+    """
+    overlap layers of the ROIs in the cell (0) and not-cell (1) views, built
+    from the ROI to pixel matrix with array operations over all ROIs at once
+
+    the ROI with the smallest index is on top (layer 0) at each pixel, ROIs
+    with a "ypix" of None and ROIs merged into another ROI are not drawn
+
     args:
-        settings: mean_image, Vcorr
-        stat: xpix,ypix,xext,yext
+        stat: ypix, xpix, lam (imerge)
         iscell: vector with True if ROI is cell
-        settings_plot: plotROI, view, color, randcols
+        Ly, Lx: size of the views
+        P: output of roi_matrix if already computed
     outputs:
-        M0: ROIs that are True in iscell
-        M1: ROIs that are False in iscell
-
+        layers: dict with
+            P: ROI to pixel matrix (see roi_matrix)
+            iROI: ROI index per view, layer and pixel (-1 if no ROI), (2, nlayers, Ly, Lx)
+            Lam: normalized weight of the ROI per view, layer and pixel
+            Sroi: True where a view has an ROI, (2, Ly, Lx)
+            LamMean: mean weight of the top ROIs over all pixels
+            shown: True for the ROIs that are drawn
     """
-    stat = parent.stat
-    iscell = parent.iscell
-    cols = parent.colors["cols"]
     ncells = len(stat)
-    Ly = parent.Ly
-    Lx = parent.Lx
-    parent.rois["Sroi"] = np.zeros((2, Ly, Lx), "bool")
-    LamAll = np.zeros((Ly, Lx), np.float32)
+    iscell = np.asarray(iscell).astype("bool")
+    if P is None:
+        P = roi_matrix(stat, Ly, Lx)
+    # ignore merged cells
+    shown = np.diff(P.indptr) > 0
+    for n in np.arange(ncells - 1, -1, -1, int):
+        if shown[n] and "imerge" in stat[n]:
+            for k in stat[n]["imerge"]:
+                shown[k] = False
+                print(f"ROI {k} in merged ROI")
+    n_pix = np.repeat(np.arange(ncells), np.diff(P.indptr))
+    sel = shown[n_pix]
+    n_pix, ipix, lam = n_pix[sel], P.indices[sel].astype(np.int64), P.data[sel]
+    view = (1 - iscell[n_pix]).astype(np.int64)
+
+    # sort pixels by view, position and ROI index, then the rank of an ROI at a
+    # pixel is its position in the run of the pixel
+    key = view * Ly * Lx + ipix
+    isort = np.argsort(key * max(1, ncells) + n_pix, kind="stable")
+    key = key[isort]
+    first = np.ones(key.size, "bool")
+    first[1:] = key[1:] != key[:-1]
+    istart = np.maximum.accumulate(np.where(first, np.arange(key.size), 0))
+    rank = np.arange(key.size) - istart
+
+    layers = {"P": P}
+    layers["iROI"] = -1 * np.ones((2, nlayers, Ly * Lx), np.int32)
+    layers["Lam"] = np.zeros((2, nlayers, Ly * Lx), np.float32)
+    inl = isort[rank < nlayers]
+    layers["iROI"][view[inl], rank[rank < nlayers], ipix[inl]] = n_pix[inl]
+    layers["Lam"][view[inl], rank[rank < nlayers], ipix[inl]] = lam[inl]
+    layers["iROI"] = layers["iROI"].reshape(2, nlayers, Ly, Lx)
+    layers["Lam"] = layers["Lam"].reshape(2, nlayers, Ly, Lx)
+    layers["Sroi"] = layers["iROI"][:, 0] > -1
+
+    # weight of the top ROI over both views
+    LamAll = np.zeros(Ly * Lx, np.float32)
+    itop = np.argsort(ipix * max(1, ncells) + n_pix, kind="stable")
+    first = np.ones(itop.size, "bool")
+    first[1:] = ipix[itop][1:] != ipix[itop][:-1]
+    LamAll[ipix[itop[first]]] = lam[itop[first]]
+    layers["LamMean"] = LamAll[LamAll > 1e-10].mean()
+    layers["shown"] = shown
+    return layers
+
+
+def init_masks(parent, layers=None):
+    """
+    creates the label images of the ROIs, with the ROIs that are True in
+    iscell in view 0 and the others in view 1, from which the masks are
+    rendered by draw_masks
+    args:
+        stat: xpix,ypix,lam
+        iscell: vector with True if ROI is cell
+        layers: output of roi_layers if already computed (e.g. while loading)
+    outputs:
+        parent.rois: P (ROI to pixel matrix), iROI, Lam, Sroi, LamNorm
+
+    """
+    if layers is None:
+        layers = roi_layers(parent.stat, parent.iscell, parent.Ly, parent.Lx,
+                            P=roi_pixel_matrix(parent, build=False))
+    parent.rois["P"] = layers["P"]
+    parent.rois["Sroi"] = layers["Sroi"]
     # these have 3 layers
-    parent.rois["Lam"] = np.zeros((2, 3, Ly, Lx), np.float32)
-    parent.rois["iROI"] = -1 * np.ones((2, 3, Ly, Lx), np.int32)
+    parent.rois["Lam"] = layers["Lam"]
+    parent.rois["iROI"] = layers["iROI"]
+    parent.rois["shown"] = layers["shown"]
 
     if parent.checkBoxN.isChecked():
         parent.checkBoxN.setChecked(False)
+    # text labels are made when they are first shown
+    parent.roi_text_labels = []
 
-    # ignore merged cells
-    iignore = np.zeros(ncells, "bool")
+    parent.rois["LamMean"] = layers["LamMean"]
+    parent.rois["LamNorm"] = np.maximum(
+        0, np.minimum(1, 0.75 * parent.rois["Lam"][:, 0] / parent.rois["LamMean"]))
+
+
+def roi_pixel_matrix(parent, build=True):
+    """ ROI to pixel matrix of the GUI, with rows added for the ROIs added since it
+    was made (e.g. merged ROIs); None if there is none and build is False """
+    P = parent.rois.get("P", None)
+    if P is None or P.shape[1] != parent.Ly * parent.Lx or P.shape[0] > len(parent.stat):
+        if not build:
+            return None
+        P = roi_matrix(parent.stat, parent.Ly, parent.Lx)
+    elif P.shape[0] < len(parent.stat):
+        P = sparse.vstack((P, roi_matrix(parent.stat[P.shape[0]:], parent.Ly,
+                                         parent.Lx))).tocsr()
+    parent.rois["P"] = P
+    return P
+
+
+def roi_pixels(parent, n):
+    """ linear indices and normalized weights of the pixels of ROI n """
+    P = roi_pixel_matrix(parent)
+    return (P.indices[P.indptr[n]:P.indptr[n + 1]],
+            P.data[P.indptr[n]:P.indptr[n + 1]])
+
+
+def make_roi_text_labels(parent):
+    """ text items with the index of each ROI, placed at its center """
+    shown = parent.rois["shown"]
     parent.roi_text_labels = []
-    for n in np.arange(ncells - 1, -1, -1, int):
-        ypix = stat[n]["ypix"]
-        if ypix is not None and not iignore[n]:
-            if "imerge" in stat[n]:
-                for k in stat[n]["imerge"]:
-                    iignore[k] = True
-                    print(f"ROI {k} in merged ROI")
-            xpix = stat[n]["xpix"]
-            lam = stat[n]["lam"]
-            lam = lam / lam.sum()
-            i = int(1 - iscell[n])
-            # add cell on top
-            parent.rois["iROI"][i, 2, ypix, xpix] = parent.rois["iROI"][i, 1, ypix,
-                                                                        xpix]
-            parent.rois["iROI"][i, 1, ypix, xpix] = parent.rois["iROI"][i, 0, ypix,
-                                                                        xpix]
-            parent.rois["iROI"][i, 0, ypix, xpix] = n
-
-            # add weighting to all layers
-            parent.rois["Lam"][i, 2, ypix, xpix] = parent.rois["Lam"][i, 1, ypix, xpix]
-            parent.rois["Lam"][i, 1, ypix, xpix] = parent.rois["Lam"][i, 0, ypix, xpix]
-            parent.rois["Lam"][i, 0, ypix, xpix] = lam
-            parent.rois["Sroi"][i, ypix, xpix] = 1
-            LamAll[ypix, xpix] = lam
-            med = stat[n]["med"]
+    for n in range(len(parent.stat)):
+        if n >= shown.size or shown[n]:
             cell_str = str(n)
+            med = parent.stat[n]["med"]
         else:
             cell_str = ""
             med = (0, 0)
@@ -271,76 +367,70 @@ def init_masks(parent):
         txt.setPos(med[1], med[0])
         txt.setFont(QtGui.QFont("Times", 8, weight=QtGui.QFont.Bold))
         parent.roi_text_labels.append(txt)
-    parent.roi_text_labels = parent.roi_text_labels[::-1]
 
-    parent.rois["LamMean"] = LamAll[LamAll > 1e-10].mean()
-    parent.rois["LamNorm"] = np.maximum(
-        0, np.minimum(1, 0.75 * parent.rois["Lam"][:, 0] / parent.rois["LamMean"]))
-    parent.colors["RGB"] = np.zeros((2, cols.shape[0], Ly, Lx, 4), np.uint8)
 
-    for c in range(0, cols.shape[0]):
-        rgb_masks(parent, cols[c], c)
+def roi_circle(parent, n):
+    """ pixels of the circle around ROI n inside the view, computed when first drawn """
+    if "ycirc" not in parent.stat[n]:
+        ycirc, xcirc = utils.circle(parent.stat[n]["med"], parent.stat[n]["radius"])
+        goodi = ((ycirc >= 0) & (xcirc >= 0) & (ycirc < parent.ops["Ly"]) &
+                 (xcirc < parent.ops["Lx"]))
+        parent.stat[n]["ycirc"] = ycirc[goodi]
+        parent.stat[n]["xcirc"] = xcirc[goodi]
+    return parent.stat[n]["ycirc"], parent.stat[n]["xcirc"]
 
 
-def rgb_masks(parent, col, c):
-    for i in range(2):
-        #S = np.expand_dims(parent.rois["Sroi"][i],axis=2)
-        H = col[parent.rois["iROI"][i, 0], :]
-        #H = np.expand_dims(H,axis=2)
-        #hsv = np.concatenate((H,S,S),axis=2)
-        #rgb = (hsv_to_rgb(hsv)*255).astype(np.uint8)
-        parent.colors["RGB"][i, c, :, :, :3] = H
+def color_lut(parent, color):
+    """ lookup table from ROI index to RGBA color packed in uint32 (alpha 0),
+    with black for no ROI (-1) """
+    lut = np.zeros((parent.colors["cols"].shape[1] + 1, 4), np.uint8)
+    lut[:-1, :3] = parent.colors["cols"][color]
+    return lut.view(np.uint32)[:, 0]
 
 
 def draw_masks(parent):  #settings, stat, settings_plot, iscell, ichosen):
     """
 
-    creates RGB masks using stat and puts them in M0 or M1 depending on
-    whether or not iscell is True for a given ROI
+    renders the RGBA masks of the ROIs from the label images, with a single
+    gather of the colors of the top ROI at each pixel through the lookup table
+    of the current color
     args:
-        settings: mean_image, Vcorr
-        stat: xpix,ypix
+        rois: iROI, LamNorm
         iscell: vector with True if ROI is cell
-        settings_plot: plotROI, view, color, randcols
+        settings_plot: view, color, opacity
     outputs:
         M0: ROIs that are True in iscell
         M1: ROIs that are False in iscell
 
     """
-    ncells = parent.iscell.shape[0]
-    plotROI = parent.ops_plot["ROIs_on"]
     view = parent.ops_plot["view"]
     color = parent.ops_plot["color"]
     opacity = parent.ops_plot["opacity"]
+    lut = color_lut(parent, color)
 
     wplot = int(1 - parent.iscell[parent.ichosen])
-    # reset transparency
+    M = []
     for i in range(2):
-        parent.colors["RGB"][i, color, :, :,
-                             3] = (opacity[view == 0] * parent.rois["Sroi"][i] *
-                                   parent.rois["LamNorm"][i]).astype(np.uint8)
-    M = [
-        np.array(parent.colors["RGB"][0, color]),
-        np.array(parent.colors["RGB"][1, color])
-    ]
-
-    if view == 0:
-        for n in parent.imerge:
-            ypix = parent.stat[n]["ypix"].flatten()
-            xpix = parent.stat[n]["xpix"].flatten()
+        Mi = np.take(lut, parent.rois["iROI"][i, 0]).view(np.uint8).reshape(
+            parent.Ly, parent.Lx, 4)
+        np.multiply(parent.rois["LamNorm"][i], opacity[view == 0], out=Mi[:, :, 3],
+                    casting="unsafe")
+        M.append(Mi)
+
+    if len(parent.imerge) > 0:
+        ipix = np.concatenate([roi_pixels(parent, n)[0] for n in parent.imerge])
+        ypix, xpix = ipix // parent.Lx, ipix % parent.Lx
+        if view == 0:
             v = (parent.rois["iROI"][wplot][:, ypix, xpix] > -1).sum(axis=0) - 1
             v = 1 - v / 3
             M[wplot] = make_chosen_ROI(M[wplot], ypix, xpix, v)
-    else:
-        for n in parent.imerge:
-            ycirc = parent.stat[n]["ycirc"]
-            xcirc = parent.stat[n]["xcirc"]
-            ypix = parent.stat[n]["ypix"].flatten()
-            xpix = parent.stat[n]["xpix"].flatten()
+        else:
             M[wplot][ypix, xpix, 3] = 0
-            col = parent.colors["cols"][color, n]
-            sat = 1
-            M[wplot] = make_chosen_circle(M[wplot], ycirc, xcirc, col, sat)
+            for n in parent.imerge:
+                ycirc, xcirc = roi_circle(parent, n)
+                col = parent.colors["cols"][color, n]
+                sat = 1
+                M[wplot] = make_chosen_circle(M[wplot], ycirc, xcirc, col, sat)
 
     return M[0], M[1]
 
@@ -363,7 +453,6 @@ def chan2_masks(parent):
     col[parent.redcell] = 0
     col = col.flatten()
     parent.colors["cols"][c] = hsv2rgb(col)
-    rgb_masks(parent, parent.colors["cols"][c], c)
 
 
 def custom_masks(parent):
@@ -384,8 +473,6 @@ def custom_masks(parent):
     parent.colors["cols"][c] = col
     parent.colors["istat"][c] = istat.flatten()
 
-    rgb_masks(parent, col, c)
-
 
 def rastermap_masks(parent):
     c = 9
@@ -400,8 +487,6 @@ def rastermap_masks(parent):
     parent.colors["cols"][c] = col
     parent.colors["istat"][c] = istat.flatten()
 
-    rgb_masks(parent, col, c)
-
 
 def beh_masks(parent):
     c = 8
@@ -425,7 +510,6 @@ def beh_masks(parent):
     parent.colors["colorbar"][c] = [
         istat_min, (istat_max - istat_min) / 2 + istat_min, istat_max
     ]
-    rgb_masks(parent, col, c)
 
 
 def corr_masks(parent):
@@ -446,17 +530,14 @@ def corr_masks(parent):
     parent.colors["cols"][c] = col
     parent.colors["istat"][c] = istat.flatten()
 
-    rgb_masks(parent, col, c)
-
 
 def flip_for_class(parent, iscell):
-    ncells = iscell.size
-    if (iscell == parent.iscell).sum() < 100:
-        for n in range(ncells):
-            if iscell[n] != parent.iscell[n]:
-                parent.iscell[n] = iscell[n]
-                parent.ichosen = n
-                flip_roi(parent)
+    iflip = np.nonzero(iscell != parent.iscell)[0]
+    if iflip.size < 100:
+        for n in iflip:
+            parent.iscell[n] = iscell[n]
+            parent.ichosen = n
+            flip_roi(parent)
     else:
         parent.iscell = iscell
         init_masks(parent)
@@ -484,81 +565,60 @@ def plot_masks(parent, M):
 
 def remove_roi(parent, n, i0):
     """
-    removes roi n from view i0
+    removes roi n from view i0, the ROIs under it at its pixels move up a layer
     """
-    ypix = parent.stat[n]["ypix"]
-    xpix = parent.stat[n]["xpix"]
-    # cell indices
-    ipix = np.array((parent.rois["iROI"][i0, 0, :, :] == n).nonzero()).astype(np.int32)
-    ipix1 = np.array((parent.rois["iROI"][i0, 1, :, :] == n).nonzero()).astype(np.int32)
-    ipix2 = np.array((parent.rois["iROI"][i0, 2, :, :] == n).nonzero()).astype(np.int32)
-    # get rid of cell and push up overlaps on main views
-    parent.rois["Lam"][i0, 0, ipix[0, :],
-                       ipix[1, :]] = parent.rois["Lam"][i0, 1, ipix[0, :], ipix[1, :]]
-    parent.rois["Lam"][i0, 1, ipix[0, :], ipix[1, :]] = 0
-    parent.rois["Lam"][i0, 1, ipix1[0, :],
-                       ipix1[1, :]] = parent.rois["Lam"][i0, 2, ipix1[0, :],
-                                                         ipix1[1, :]]
-    parent.rois["Lam"][i0, 2, ipix1[0, :], ipix1[1, :]] = 0
-    parent.rois["Lam"][i0, 2, ipix2[0, :], ipix2[1, :]] = 0
-    parent.rois["iROI"][i0, 0, ipix[0, :],
-                        ipix[1, :]] = parent.rois["iROI"][i0, 1, ipix[0, :], ipix[1, :]]
-    parent.rois["iROI"][i0, 1, ipix[0, :], ipix[1, :]] = -1
-    parent.rois["iROI"][i0, 1, ipix1[0, :],
-                        ipix1[1, :]] = parent.rois["iROI"][i0, 2, ipix1[0, :],
-                                                           ipix1[1, :]]
-    parent.rois["iROI"][i0, 2, ipix1[0, :], ipix1[1, :]] = -1
-    parent.rois["iROI"][i0, 2, ipix2[0, :], ipix2[1, :]] = -1
-
-    # remove +/- 1 ROI exists
-    parent.rois["Sroi"][i0, ypix, xpix] = parent.rois["iROI"][i0, 0, ypix, xpix] > 0
-
-    parent.rois["LamNorm"][i0, ypix, xpix] = np.maximum(
-        0,
-        np.minimum(
-            1, 0.75 * parent.rois["Lam"][i0, 0, ypix, xpix] / parent.rois["LamMean"]))
+    ipix, lam = roi_pixels(parent, n)
+    nlayers = parent.rois["iROI"].shape[1]
+    iROI = parent.rois["iROI"][i0].reshape(nlayers, -1)
+    Lam = parent.rois["Lam"][i0].reshape(nlayers, -1)
+    # move the layers of roi n to the bottom and clear them
+    keep = iROI[:, ipix] != n
+    isort = np.argsort(~keep, axis=0, kind="stable")
+    keep = np.take_along_axis(keep, isort, axis=0)
+    iroi = np.take_along_axis(iROI[:, ipix], isort, axis=0)
+    iroi[~keep] = -1
+    lam = np.take_along_axis(Lam[:, ipix], isort, axis=0)
+    lam[~keep] = 0
+    iROI[:, ipix] = iroi
+    Lam[:, ipix] = lam
+    update_masks(parent, ipix)
 
 
 def add_roi(parent, n, i):
     """
-    add roi n to view i
+    add roi n to view i on top, the ROIs under it at its pixels move down a layer
+    """
+    ipix, lam = roi_pixels(parent, n)
+    nlayers = parent.rois["iROI"].shape[1]
+    iROI = parent.rois["iROI"][i].reshape(nlayers, -1)
+    Lam = parent.rois["Lam"][i].reshape(nlayers, -1)
+    iROI[1:, ipix] = iROI[:-1, ipix]
+    iROI[0, ipix] = n
+    Lam[1:, ipix] = Lam[:-1, ipix]
+    Lam[0, ipix] = lam
+    update_masks(parent, ipix)
+
+
+def update_masks(parent, ipix):
     """
-    ypix = parent.stat[n]["ypix"]
-    xpix = parent.stat[n]["xpix"]
-    lam = parent.stat[n]["lam"]
-    parent.rois["iROI"][i, 2, ypix, xpix] = parent.rois["iROI"][i, 1, ypix, xpix]
-    parent.rois["iROI"][i, 1, ypix, xpix] = parent.rois["iROI"][i, 0, ypix, xpix]
-    parent.rois["iROI"][i, 0, ypix, xpix] = n
-    parent.rois["Lam"][i, 2, ypix, xpix] = parent.rois["Lam"][i, 1, ypix, xpix]
-    parent.rois["Lam"][i, 1, ypix, xpix] = parent.rois["Lam"][i, 0, ypix, xpix]
-    parent.rois["Lam"][i, 0, ypix, xpix] = lam  #/ lam.sum()
-
-    # set whether or not an ROI + weighting of pixels
-    parent.rois["Sroi"][i, ypix, xpix] = 1
+    set whether or not an ROI + weighting of pixels at pixels ipix after rois are
+    added/removed
+    """
+    Lx = parent.Lx
+    ypix, xpix = ipix // Lx, ipix % Lx
+    parent.rois["Sroi"][:, ypix, xpix] = parent.rois["iROI"][:, 0, ypix, xpix] > -1
     parent.rois["LamNorm"][:, ypix, xpix] = np.maximum(
         0,
         np.minimum(1, 0.75 * parent.rois["Lam"][:, 0, ypix, xpix] /
                    parent.rois["LamMean"]))
 
 
-def redraw_masks(parent, ypix, xpix):
-    """
-    redraw masks after roi added/removed
-    """
-    for c in range(parent.colors["cols"].shape[0]):
-        for i in range(2):
-            col = parent.colors["cols"][c]
-            rgb = col[parent.rois["iROI"][i, 0, ypix, xpix], :]
-            parent.colors["RGB"][i, c, ypix, xpix, :3] = rgb
-
-
 def flip_roi(parent):
     """
     flips roi to other plot
     there are 3 levels of overlap so this may be buggy if more than 3 cells are on
     top of each other
     """
-    cols = parent.ops_plot["color"]
     n = parent.ichosen
     i = int(1 - parent.iscell[n])
     i0 = 1 - i
@@ -574,10 +634,6 @@ def flip_roi(parent):
     remove_roi(parent, n, i0)
     # add cell to other side (on top) and push down overlaps
     add_roi(parent, n, i)
-    # redraw colors
-    ypix = parent.stat[n]["ypix"]
-    xpix = parent.stat[n]["xpix"]
-    redraw_masks(parent, ypix, xpix)
 
 
 def draw_colorbar(colormap="hsv"):
@@ -186,7 +186,6 @@ def merge_activity_masks(parent):
         parent.stat[n]["inmerge"] = len(parent.stat) - 1
         masks.remove_roi(parent, n, i0)
     masks.add_roi(parent, len(parent.stat) - 1, i0)
-    masks.redraw_masks(parent, ypix, xpix)
 
 
 class MergeWindow(QDialog):
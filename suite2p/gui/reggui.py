@@ -16,6 +16,7 @@ from tifffile import imread
 import json
 
 from . import masks, views, graphics, traces, classgui, utils
+from .frame_cache import FrameCache, PYRAMID_FACTORS
 from .. import registration
 from ..io.save import compute_dydx
 from ..io import BinaryFile
@@ -169,6 +170,8 @@ class BinaryPlayer(QMainWindow):
         self.updateTimer = QtCore.QTimer()
         self.updateTimer.timeout.connect(self.next_frame)
         self.cframe = 0
+        self.last_frame = 0
+        self.cache = None
         self.loaded = False
         self.Floaded = False
         self.raw_on = False
@@ -249,31 +252,38 @@ class BinaryPlayer(QMainWindow):
         if self.cframe > self.nframes - 1:
             self.cframe = 0
             
-        self.img = np.zeros((self.LY, self.LX), dtype=np.int16)
-        for n in range(len(self.reg_loc)):
-            img = self.reg_file[n][self.cframe]
-            if self.wred and self.red_on:
-                imgred = self.reg_file_red[n][self.cframe]
-                img =  np.stack((img, imgred, np.zeros(img.shape, dtype=img.dtype)), axis=-1)
-            self.img[self.dy[n]:self.dy[n] + self.Ly[n],
-                     self.dx[n]:self.dx[n] + self.Lx[n]] = img    
-            self.imain.setImage(self.img, levels=self.srange)
-        
-            if self.wraw and self.raw_on:
-                if n==0:
-                    self.imgraw = np.zeros((self.LY, self.LX), dtype=np.int16)
-                img = self.raw_file[n][self.cframe]
-                if self.wraw_red and self.red_on:
-                    imgred = self.raw_file_red[n][self.cframe]
-                    img =  np.stack((img, imgred, np.zeros(img.shape, dtype=img.dtype)), axis=-1)
-                self.imgraw[self.dy[n]:self.dy[n] + self.Ly[n],
-                        self.dx[n]:self.dx[n] + self.Lx[n]] = img
-                self.iside.setImage(self.imgraw, levels=self.srange)
-    
+        # direction of playback / arrow keys, to read the next frames ahead
+        step = (self.cframe - self.last_frame + self.nframes // 2) % self.nframes - self.nframes // 2
+        if step == 0 or abs(step) > self.frameDelta:
+            step = 1
+        self.last_frame = self.cframe
+
+        keys = [("reg", n) for n in range(len(self.reg_loc))]
+        if self.wred and self.red_on:
+            keys += [("red", n) for n in range(len(self.reg_loc))]
+        level = self.cache.level(keys, self.zoom_factor())
+        self.img = self.compose_frame("reg", "red", self.wred, level)
+        self.imain.setImage(self.img, levels=self.srange)
+        self.imain.setTransform(QtGui.QTransform.fromScale(level, level))
+
+        if self.wraw and self.raw_on:
+            raw_keys = [("raw", n) for n in range(len(self.reg_loc))]
+            if self.wraw_red and self.red_on:
+                raw_keys += [("raw_red", n) for n in range(len(self.reg_loc))]
+            raw_level = self.cache.level(raw_keys, self.zoom_factor())
+            self.imgraw = self.compose_frame("raw", "raw_red", self.wraw_red, raw_level)
+            self.iside.setImage(self.imgraw, levels=self.srange)
+            self.iside.setTransform(QtGui.QTransform.fromScale(raw_level, raw_level))
+            keys += raw_keys
+            level = min(level, raw_level)
+
         if self.zloaded and self.z_on:
             if hasattr(self, "zmax"):
                 self.Zedit.setText(str(self.zmax[self.cframe]))
             self.iside.setImage(self.zstack[int(self.Zedit.text())], levels=self.zrange)
+            self.iside.setTransform(QtGui.QTransform())
+
+        self.cache.read_ahead(keys, self.cframe, step, level)
         
         if self.maskbox.isChecked():
            #imgmin = self.img.min()
@@ -295,6 +305,31 @@ class BinaryPlayer(QMainWindow):
                                   [self.zmax[self.cframe], self.zmax[self.cframe]],
                                   size=10, brush=pg.mkBrush(255, 0, 0))
 
+    def zoom_factor(self):
+        """ largest pyramid factor that is not larger than the number of binary
+        pixels per screen pixel of the main view """
+        try:
+            px = min(self.vmain.viewPixelSize())
+        except TypeError:
+            # view not shown yet
+            px = 1
+        return max([1] + [factor for factor in PYRAMID_FACTORS if factor <= px])
+
+    def compose_frame(self, name, name_red, wred, level):
+        """ current frame of the planes of binaries name (and name_red in green)
+        tiled at their positions, at pyramid level level """
+        LY, LX = -(-self.LY // level), -(-self.LX // level)
+        red = wred and self.red_on
+        img = np.zeros((LY, LX, 3) if red else (LY, LX), dtype=np.int16)
+        for n in range(len(self.reg_loc)):
+            frame = self.cache.get((name, n), self.cframe, level)
+            if red:
+                frame = np.stack((frame, self.cache.get((name_red, n), self.cframe, level),
+                                  np.zeros(frame.shape, dtype=frame.dtype)), axis=-1)
+            dy, dx = self.dy[n] // level, self.dx[n] // level
+            img[dy:dy + frame.shape[0], dx:dx + frame.shape[1]] = frame
+        return img
+
     def make_masks(self):
         ncells = len(self.stat)
         np.random.seed(seed=0)
@@ -391,7 +426,6 @@ class BinaryPlayer(QMainWindow):
                                      "data.bin"))
                 print(reg_file, os.path.isfile(reg_file))
                 self.reg_loc.append(reg_file)
-                self.reg_file.append(open(self.reg_loc[-1], "rb"))
                 self.Ly.append(settings["Ly"])
                 self.Lx.append(settings["Lx"])
                 self.dy.append(dy[ipl])
@@ -399,6 +433,7 @@ class BinaryPlayer(QMainWindow):
                 self.LY = np.maximum(self.LY, self.Ly[-1] + self.dy[-1])
                 self.LX = np.maximum(self.LX, self.Lx[-1] + self.dx[-1])
                 good = True
+            self.open_binaries()
             self.Floaded = False
 
         except Exception as e:
@@ -486,6 +521,8 @@ class BinaryPlayer(QMainWindow):
             
     def open_binaries(self):
         print(self.reg_loc)
+        if self.cache is not None:
+            self.cache.close()
         self.reg_file = [BinaryFile(Ly, Lx, fname, write=False) 
                             for Ly, Lx, fname in zip(self.Ly, self.Lx, self.reg_loc)]
         if self.wraw:
@@ -497,7 +534,18 @@ class BinaryPlayer(QMainWindow):
             if self.wraw_red:
                 self.raw_file_red = [BinaryFile(Ly, Lx, fname, write=False) 
                             for Ly, Lx, fname in zip(self.Ly, self.Lx, self.raw_loc_red)]
-            
+        sources = {("reg", n): f for n, f in enumerate(self.reg_file)}
+        if self.wraw:
+            sources.update({("raw", n): f for n, f in enumerate(self.raw_file)})
+        if self.wred:
+            sources.update({("red", n): f for n, f in enumerate(self.reg_file_red)})
+            if self.wraw_red:
+                sources.update({("raw_red", n): f for n, f in enumerate(self.raw_file_red)})
+        # frames are read through the cache, which writes downsampled copies of
+        # the binaries in the background for playback when zoomed out
+        self.cache = FrameCache(sources)
+        self.cache.build_pyramids()
+
 
     def setup_views(self):
         self.p1.clear()
@@ -505,8 +553,7 @@ class BinaryPlayer(QMainWindow):
         self.ichosen = 0
         self.ROIedit.setText("0")
         # get scaling from 100 random frames
-        frames = subsample_frames(self.ops, np.minimum(self.ops["nframes"] - 1, 100),
-                                  self.reg_loc[-1])
+        frames = subsample_frames(self.reg_file[-1], np.minimum(self.ops["nframes"] - 1, 100))
         self.srange = frames.mean() + frames.std() * np.array([-2, 5])
 
         self.movieLabel.setText(self.reg_loc[-1])
@@ -565,9 +612,14 @@ class BinaryPlayer(QMainWindow):
             self.cell_chosen()
 
         self.cframe = -1
+        self.last_frame = -1
         self.loaded = True
         self.next_frame()
 
+    def closeEvent(self, event):
+        if self.cache is not None:
+            self.cache.close()
+
     def keyPressEvent(self, event):
         bid = -1
         if self.playButton.isEnabled():
@@ -808,22 +860,10 @@ class BinaryPlayer(QMainWindow):
         self.p3.setXLink("plot_shift")
 
 
-def subsample_frames(ops, nsamps, reg_loc):
-    nFrames = ops["nframes"]
-    Ly = ops["Ly"]
-    Lx = ops["Lx"]
-    frames = np.zeros((nsamps, Ly, Lx), dtype="int16")
-    nbytesread = 2 * Ly * Lx
-    istart = np.linspace(0, nFrames, 1 + nsamps).astype("int64")
-    reg_file = open(reg_loc, "rb")
-    for j in range(0, nsamps):
-        reg_file.seek(nbytesread * istart[j], 0)
-        buff = reg_file.read(nbytesread)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0)
-        buff = []
-        frames[j, :, :] = np.reshape(data, (Ly, Lx))
-    reg_file.close()
-    return frames
+def subsample_frames(f, nsamps):
+    """ nsamps frames evenly spaced over the BinaryFile f """
+    istart = np.linspace(0, f.shape[0], 1 + nsamps).astype("int64")
+    return np.array(f[istart[:-1]])
 
 
 class PCViewer(QMainWindow):
@@ -32,7 +32,7 @@ DB_KEYS = [  "input_format", "look_one_level_down",
              "h5py_key", "nwb_series", "force_sktiff"
         ]
 FILE_KEYS = ["data_path", "save_path0", "fast_disk"]
-COMBO_KEYS = ["input_format", "algorithm", "img"]
+COMBO_KEYS = ["input_format", "algorithm", "img", "svd_method"]
 
 ### custom QDialog with an editable list 
 class BatchView(QDialog):
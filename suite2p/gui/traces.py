@@ -6,14 +6,62 @@ from qtpy import QtGui, QtCore
 from qtpy.QtWidgets import QLabel, QComboBox, QPushButton, QLineEdit, QCheckBox
 
 
+def _trace_chunks(ncells, nt, chunk_size=2**26):
+    """ slices of ROIs with at most chunk_size bytes of float32 traces """
+    nrows = max(1, chunk_size // max(1, 4 * nt))
+    return [slice(i, min(i + nrows, ncells)) for i in range(0, ncells, nrows)]
+
+
+def activity(Fcell, Fneu, Spks, rows, mode=2):
+    """ activity of the ROIs in rows, copied from the (memory-mapped) traces
+
+    mode = 0 : F, 1 : Fneu, 2 : F - 0.7 * Fneu, 3 : spks
+    """
+    if mode == 0:
+        return np.array(Fcell[rows], np.float32)
+    elif mode == 1:
+        return np.array(Fneu[rows], np.float32)
+    elif mode == 2:
+        return np.asarray(Fcell[rows], np.float32) - 0.7 * np.asarray(
+            Fneu[rows], np.float32)
+    else:
+        return np.array(Spks[rows], np.float32)
+
+
+def trace_snr(Fcell, Fneu):
+    """ signal-to-noise ratio of F - 0.7 * Fneu, computed in chunks of ROIs """
+    snr = np.zeros(Fcell.shape[0], np.float32)
+    for rows in _trace_chunks(*Fcell.shape):
+        dF = activity(Fcell, Fneu, None, rows, mode=2)
+        snr[rows] = 1 - 0.5 * np.diff(dF, axis=1).var(axis=1) / dF.var(axis=1)
+    return snr
+
+
+def binned_activity(Fcell, Fneu, Spks, mode, bin):
+    """ activity binned in time (bin frames) with its mean subtracted, and its std
+
+    computed in chunks of ROIs so that memory-mapped traces are streamed
+    """
+    ncells, nt = Fcell.shape
+    nb = nt // bin
+    Fbin = np.zeros((ncells, nb), np.float32)
+    for rows in _trace_chunks(ncells, nt):
+        f = activity(Fcell, Fneu, Spks, rows, mode)
+        Fbin[rows] = f[:, :nb * bin].reshape((-1, nb, bin)).mean(axis=2)
+    Fbin -= Fbin.mean(axis=1)[:, np.newaxis]
+    Fstd = (Fbin**2).mean(axis=1)**0.5
+    return Fbin, Fstd
+
+
 def plot_trace(parent):
     parent.p3.clear()
     ax = parent.p3.getAxis("left")
     if len(parent.imerge) == 1:
+        # fetch the traces of the selected cell only
         n = parent.imerge[0]
-        f = parent.Fcell[n, :]
-        fneu = parent.Fneu[n, :]
-        sp = parent.Spks[n, :]
+        f = activity(parent.Fcell, parent.Fneu, parent.Spks, n, mode=0)
+        fneu = activity(parent.Fcell, parent.Fneu, parent.Spks, n, mode=1)
+        sp = activity(parent.Fcell, parent.Fneu, parent.Spks, n, mode=3)
         if np.ptp(fneu) == 0:
             fmax = f.max()
             fmin = f.min()
@@ -43,14 +91,7 @@ def plot_trace(parent):
         i = parent.activityMode
         favg = np.zeros((parent.Fcell.shape[1],))
         for n in pmerge[::-1]:
-            if i == 0:
-                f = parent.Fcell[n, :]
-            elif i == 1:
-                f = parent.Fneu[n, :]
-            elif i == 2:
-                f = parent.Fcell[n, :] - 0.7 * parent.Fneu[n, :]
-            else:
-                f = parent.Spks[n, :]
+            f = activity(parent.Fcell, parent.Fneu, parent.Spks, n, mode=i)
             favg += f.flatten()
             fmax = f.max()
             fmin = f.min()
@@ -11,4 +11,7 @@ from .tiff import ome_to_binary, tiff_to_binary
 from .nd2 import nd2_to_binary
 from .dcam import dcimg_to_binary
 from .binary import BinaryFile, BinaryFileCombined
+from .manifest import load_manifest
+from .store import save_results, load_results, load_stat, load_ops, convert_results
 from .server import send_jobs
+from .jobs import run_jobs, LocalBackend, BatchBackend
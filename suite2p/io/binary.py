@@ -14,7 +14,7 @@ import numpy as np
 class BinaryFile:
 
     def __init__(self, Ly, Lx, filename, n_frames=None,
-                 dtype="int16", write=False):
+                 dtype="int16", write=False, tile_size=None):
         """
         Open or create a Suite2p binary file backed by a memory-mapped numpy array.
 
@@ -33,19 +33,31 @@ class BinaryFile:
             Data type of each pixel value.
         write : bool, optional (default False)
             If True, open the file for reading and writing. If False, open read-only.
+        tile_size : int, optional (default None)
+            If given, each frame is stored on disk as square tiles of
+            tile_size x tile_size pixels (padded at the bottom and right
+            edges), so that reading a small spatial crop touches only the
+            tiles it overlaps. If None, frames are stored row by row.
+
+        Notes
+        -----
+        Indexing with a tuple (frames, y, x), e.g. f[t0:t1, y0:y1, x0:x1],
+        reads only the requested pixels: a strided memmap view for the row
+        layout, and only the overlapping tiles for the tiled layout.
         """
         self.Ly = Ly
         self.Lx = Lx
         self.filename = filename
         self.dtype = dtype
         self.write = write
+        self.tile_size = tile_size
 
         if write and n_frames is None and not os.path.exists(self.filename):
             raise ValueError(
                 "need to provide number of frames n_frames when writing file")
-        elif not write:
+        elif not write or n_frames is None:
             n_frames = self.n_frames
-        shape = (n_frames, self.Ly, self.Lx)
+        shape = (n_frames, *self._frame_shape)
         if write:
             mode = "r+" if os.path.exists(self.filename) else "w+"
         else:
@@ -68,10 +80,18 @@ class BinaryFile:
         """
         np.load(from_filename).tofile(to_filename)
 
+    @property
+    def _frame_shape(self):
+        """Shape of one frame on disk, (Ly, Lx) or (n_tiles_y, n_tiles_x, tile_size, tile_size)."""
+        if self.tile_size is None:
+            return (self.Ly, self.Lx)
+        tile = self.tile_size
+        return (-(-self.Ly // tile), -(-self.Lx // tile), tile, tile)
+
     @property
     def nbytesread(self):
         """Number of bytes per frame (fixed for a given file)."""
-        return np.int64(2 * self.Ly * self.Lx)
+        return np.int64(np.dtype(self.dtype).itemsize * np.prod(self._frame_shape))
 
     @property
     def nbytes(self):
@@ -126,13 +146,39 @@ class BinaryFile:
     def __setitem__(self, *items):
         indices, data = items
         if data.dtype != "int16":
-            self.file[indices] = np.minimum(data, 2**15 - 2).astype("int16")
-        else:
+            data = np.minimum(data, 2**15 - 2).astype("int16")
+        if self.tile_size is None:
             self.file[indices] = data
+            return
+        t, y, x = _split_index(indices)
+        if isinstance(y, slice) and y == slice(None) and isinstance(x, slice) and x == slice(None):
+            frames = data
+        else:
+            frames = self[t]
+            frames[..., y, x] = data
+        self.file[t] = _to_tiles(frames, self.tile_size, *self._frame_shape[:2])
 
     def __getitem__(self, *items):
         indices, *crop = items
-        return self.file[indices]
+        if self.tile_size is None:
+            return self.file[indices]
+        t, y, x = _split_index(indices)
+        if np.ndim(t) == 0 and not isinstance(t, slice):
+            t, t_post = slice(t, t + 1 if t != -1 else None), 0
+        elif isinstance(t, slice):
+            t_post = slice(None)
+        else:
+            t_post = np.arange(np.count_nonzero(t) if np.asarray(t).dtype == bool else np.size(t))
+        (ys, y_post), (xs, x_post) = _read_slice(y, self.Ly), _read_slice(x, self.Lx)
+        tile = self.tile_size
+        ty0, ty1 = ys.start // tile, -(-ys.stop // tile)
+        tx0, tx1 = xs.start // tile, -(-xs.stop // tile)
+        tiles = self.file[t, ty0:ty1, tx0:tx1]
+        data = tiles.transpose(0, 1, 3, 2, 4).reshape(tiles.shape[0], (ty1 - ty0) * tile,
+                                                      (tx1 - tx0) * tile)
+        data = data[:, ys.start - ty0 * tile : ys.stop - ty0 * tile,
+                    xs.start - tx0 * tile : xs.stop - tx0 * tile]
+        return data[t_post, y_post, x_post]
 
     def sampled_mean(self):
         """
@@ -146,7 +192,7 @@ class BinaryFile:
         n_frames = self.n_frames
         nsamps = min(n_frames, 1000)
         inds = np.linspace(0, n_frames, 1 + nsamps).astype(np.int64)[:-1]
-        frames = self.file[inds].astype(np.float32)
+        frames = self[inds].astype(np.float32)
         return frames.mean(axis=0)
 
     @property
@@ -159,7 +205,7 @@ class BinaryFile:
         frames : numpy.ndarray
             All frame data as an array of shape (n_frames, Ly, Lx).
         """
-        return self.file[:]
+        return self[:]
 
     def write_tiff(self, fname, range_dict={}):
         """
@@ -187,11 +233,46 @@ class BinaryFile:
                 y_range = range_dict['y_range']
             logger.info('Frame Range: {}, y_range: {}, x_range{}'.format(frame_range, y_range, x_range))
             for i in range(frame_range[0], frame_range[1]):
-                curr_frame = np.floor(self.file[i, y_range[0]:y_range[1], x_range[0]:x_range[1]]).astype(np.int16)
+                curr_frame = np.floor(self[i, y_range[0]:y_range[1], x_range[0]:x_range[1]]).astype(np.int16)
                 f.write(curr_frame, contiguous=True)
         logger.info('Tiff has been saved to {}'.format(fname))
 
 
+def _split_index(indices):
+    """ split an index of a movie into its frame, y and x parts """
+    if not isinstance(indices, tuple):
+        indices = (indices,)
+    if any(index is Ellipsis or index is None for index in indices) or len(indices) > 3:
+        raise IndexError("only (frames, y, x) indices are supported")
+    return tuple(indices) + (slice(None),) * (3 - len(indices))
+
+
+def _read_slice(index, L):
+    """
+    Contiguous range to read along an axis of length L for an index, and the
+    index that selects the requested elements from that range.
+    """
+    if isinstance(index, slice):
+        start, stop, step = index.indices(L)
+        if step > 0:
+            stop = max(start, stop)
+            return slice(start, stop), slice(None, None, step)
+        return slice(0, L), index
+    if np.ndim(index) == 0:
+        index = range(L)[index]
+        return slice(index, index + 1), 0
+    return slice(0, L), np.asarray(index)
+
+
+def _to_tiles(frames, tile, n_tiles_y, n_tiles_x):
+    """ reshape frames (..., Ly, Lx) into zero-padded tiles (..., n_tiles_y, n_tiles_x, tile, tile) """
+    Ly, Lx = frames.shape[-2:]
+    padded = np.zeros((*frames.shape[:-2], n_tiles_y * tile, n_tiles_x * tile), frames.dtype)
+    padded[..., :Ly, :Lx] = frames
+    padded = padded.reshape(*frames.shape[:-2], n_tiles_y, tile, n_tiles_x, tile)
+    return np.swapaxes(padded, -3, -2)
+
+
 @contextmanager
 def temporary_pointer(file):
     """
@@ -209,7 +290,7 @@ def temporary_pointer(file):
 
 class BinaryFileCombined:
 
-    def __init__(self, LY, LX, Ly, Lx, dy, dx, read_filenames):
+    def __init__(self, LY, LX, Ly, Lx, dy, dx, read_filenames, tile_size=None):
         """
         Open multiple Suite2p binary files for combined reading across ROIs/planes.
 
@@ -232,6 +313,13 @@ class BinaryFileCombined:
             Array of x-offsets for placing each ROI in the full frame.
         read_filenames : list of str
             Paths to the binary files to read, one per ROI.
+        tile_size : int, optional (default None)
+            Tile size of the binary files (see BinaryFile).
+
+        Notes
+        -----
+        Indexing with a spatial crop, e.g. f[t0:t1, y0:y1, x0:x1], reads only
+        the part of each ROI file that overlaps the crop.
         """
         self.LY = LY
         self.LX = LX
@@ -242,7 +330,7 @@ class BinaryFileCombined:
         self.read_filenames = read_filenames
 
         self.read_files = [
-            BinaryFile(ly, lx, read_filename)
+            BinaryFile(ly, lx, read_filename, tile_size=tile_size)
             for (ly, lx, read_filename) in zip(self.Ly, self.Lx, self.read_filenames)
         ]
         n_frames = np.zeros(len(self.read_files))
@@ -276,14 +364,30 @@ class BinaryFileCombined:
         """Total number of frames (from the first ROI file)."""
         return self.read_files[0].n_frames
 
+    @property
+    def shape(self):
+        """Dimensions (n_frames, LY, LX) of the combined movie."""
+        return self.n_frames, self.LY, self.LX
+
     def __getitem__(self, *items):
         indices, *crop = items
-        data0 = self.read_files[0][indices]
-        data_all = np.zeros((data0.shape[0], self.LY, self.LX), "int16")
+        t, y, x = _split_index(indices)
+        (ys, y_post), (xs, x_post) = _read_slice(y, self.LY), _read_slice(x, self.LX)
+        if np.ndim(t) == 0 and not isinstance(t, slice):
+            t, t_post = slice(t, t + 1 if t != -1 else None), 0
+        elif isinstance(t, slice):
+            t_post = slice(None)
+        else:
+            t_post = np.arange(np.count_nonzero(t) if np.asarray(t).dtype == bool else np.size(t))
+        n_frames = len(range(self.n_frames)[t]) if isinstance(t, slice) else len(t_post)
+        data_all = np.zeros((n_frames, ys.stop - ys.start, xs.stop - xs.start), "int16")
         for n, read_file in enumerate(self.read_files):
-            if n > 0:
-                data0 = self.read_file[indices]
-            data_all[:, self.dy[n]:self.dy[n] + self.Ly[n],
-                     self.dx[n]:self.dx[n] + self.Lx[n]] = data0
-
-        return data_all
+            # overlap of the crop with the ROI, in ROI coordinates
+            y0, y1 = max(ys.start - self.dy[n], 0), min(ys.stop - self.dy[n], self.Ly[n])
+            x0, x1 = max(xs.start - self.dx[n], 0), min(xs.stop - self.dx[n], self.Lx[n])
+            if y1 <= y0 or x1 <= x0:
+                continue
+            data_all[:, self.dy[n] + y0 - ys.start : self.dy[n] + y1 - ys.start,
+                     self.dx[n] + x0 - xs.start : self.dx[n] + x1 - xs.start] = \
+                read_file[t, y0:y1, x0:x1]
+        return data_all[t_post, y_post, x_post]
@@ -0,0 +1,321 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os, re, sys, time, shlex, subprocess
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# states of a plane job written to its status file
+JOB_STATES = ["queued", "running", "done", "failed"]
+
+# default script of a batch job; the placeholders are filled by BatchBackend.
+# If python crashes without reporting (e.g. killed), the job is marked failed.
+BATCH_TEMPLATE = """#!/bin/bash
+{setup}
+{command} > {log_file} 2>&1 || grep -q '^failed' {status_file} || echo failed > {status_file}
+"""
+
+
+def write_status(status_file, state, message=""):
+    """
+    Write the state of a plane job to its status file.
+
+    The first line of the file is the state, the following lines the message
+    (e.g. the traceback of a failed job). The file is replaced atomically.
+
+    Parameters
+    ----------
+    status_file : str
+        Path to the status file.
+    state : str
+        One of JOB_STATES.
+    message : str, optional (default "")
+        Message stored with the state.
+    """
+    if state not in JOB_STATES:
+        raise ValueError(f"job state must be one of {JOB_STATES}, not {state}")
+    tmp_file = status_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(f"{state}\n{message}")
+    os.replace(tmp_file, status_file)
+
+
+def read_status(status_file):
+    """
+    Read the state of a plane job from its status file.
+
+    Parameters
+    ----------
+    status_file : str
+        Path to the status file.
+
+    Returns
+    -------
+    state : str or None
+        State of the job, None if the status file does not exist.
+    message : str
+        Message stored with the state.
+    """
+    if not os.path.exists(status_file):
+        return None, ""
+    with open(status_file, "r") as f:
+        state, _, message = f.read().partition("\n")
+    return state.strip(), message
+
+
+def plane_command(db_path, settings_path, status_file, python=sys.executable):
+    """
+    Command line running suite2p on one plane and reporting to its status file.
+
+    Returns
+    -------
+    command : list of str
+        Arguments of the command.
+    """
+    return [python, "-m", "suite2p", "--single_plane", "--verbose", "--settings",
+            settings_path, "--db", db_path, "--status", status_file]
+
+
+class JobBackend:
+    """
+    Interface of the backends running the plane jobs of run_jobs.
+
+    Subclasses implement submit, and optionally alive and cancel. The
+    progress of a job is read from its status file, so a backend only needs
+    to start the job.
+
+    Attributes
+    ----------
+    max_jobs : int or None
+        Maximum number of jobs submitted at once, None for no limit (e.g. if
+        the scheduler queues the jobs).
+    """
+    max_jobs = None
+
+    def submit(self, ipl, db_path, settings_path, status_file, log_file):
+        """
+        Start the job of a plane.
+
+        Parameters
+        ----------
+        ipl : int
+            Index of the plane.
+        db_path : str
+            Path to the db.npy of the plane.
+        settings_path : str
+            Path to the settings.npy of the plane.
+        status_file : str
+            Path to the status file the job reports to.
+        log_file : str
+            Path to the file for the output of the job.
+
+        Returns
+        -------
+        job : object
+            Handle of the job, passed to alive and cancel.
+        """
+        raise NotImplementedError
+
+    def alive(self, job):
+        """ True if the job is queued or running, False if it has exited, None if unknown """
+        return None
+
+    def cancel(self, job):
+        """ stop the job if possible """
+        pass
+
+
+class LocalBackend(JobBackend):
+    """
+    Run the plane jobs as subprocesses on this machine.
+
+    Parameters
+    ----------
+    max_jobs : int, optional (default 2)
+        Maximum number of planes processed at once.
+    python : str, optional (default sys.executable)
+        Python executable running suite2p.
+    """
+
+    def __init__(self, max_jobs=2, python=sys.executable):
+        self.max_jobs = max_jobs
+        self.python = python
+
+    def submit(self, ipl, db_path, settings_path, status_file, log_file):
+        command = plane_command(db_path, settings_path, status_file, python=self.python)
+        with open(log_file, "w") as log:
+            return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+    def alive(self, job):
+        return job.poll() is None
+
+    def cancel(self, job):
+        job.terminate()
+
+
+class BatchBackend(JobBackend):
+    """
+    Submit the plane jobs to a batch scheduler (e.g. SLURM, LSF, SGE).
+
+    For each plane a job script is written from template and submitted with
+    submit_command. The planes must be on a file system shared with the
+    compute nodes. The template and the commands are formatted with the
+    placeholders {ipl}, {script}, {log_file}, {status_file}, {n_cores},
+    {setup} and {command} (and {job_id} for status_command and
+    cancel_command), for example::
+
+        BatchBackend(submit_command="sbatch -c {n_cores} -J s2p{ipl} {script}",
+                     status_command="squeue -h -j {job_id}",
+                     cancel_command="scancel {job_id}",
+                     setup="source activate suite2p")
+
+    runs each plane as a SLURM job, and
+    ``submit_command="nohup sh {script} > /dev/null 2>&1 & echo $!"`` runs the
+    scripts in the background on this machine as a stand-in scheduler.
+
+    Parameters
+    ----------
+    submit_command : str, optional (default "sbatch {script}")
+        Shell command submitting a job script; the first integer in its
+        output is used as {job_id}.
+    template : str, optional (default BATCH_TEMPLATE)
+        Template of the job script.
+    status_command : str, optional (default None)
+        Shell command with an empty output (or a non-zero exit code) once the
+        job has left the scheduler. If None, jobs killed by the scheduler
+        are only detected from their status files.
+    cancel_command : str, optional (default None)
+        Shell command cancelling a job.
+    setup : str, optional (default "")
+        Lines of the job script run before suite2p, e.g. to activate the environment.
+    python : str, optional (default "python")
+        Python executable running suite2p on the compute nodes.
+    n_cores : int, optional (default 8)
+        Number of cores requested per job.
+    """
+
+    def __init__(self, submit_command="sbatch {script}", template=BATCH_TEMPLATE,
+                 status_command=None, cancel_command=None, setup="", python="python",
+                 n_cores=8):
+        self.submit_command = submit_command
+        self.template = template
+        self.status_command = status_command
+        self.cancel_command = cancel_command
+        self.setup = setup
+        self.python = python
+        self.n_cores = n_cores
+
+    def submit(self, ipl, db_path, settings_path, status_file, log_file):
+        command = shlex.join(plane_command(db_path, settings_path, status_file,
+                                           python=self.python))
+        script = os.path.join(os.path.dirname(status_file), "job.sh")
+        fields = dict(ipl=ipl, script=shlex.quote(script), log_file=shlex.quote(log_file),
+                      status_file=shlex.quote(status_file), n_cores=self.n_cores,
+                      setup=self.setup, command=command)
+        with open(script, "w", newline="") as f:
+            f.write(self.template.format(**fields))
+        os.chmod(script, 0o755)
+        out = subprocess.run(self.submit_command.format(**fields), shell=True,
+                             capture_output=True, text=True, check=True).stdout
+        job_id = re.search(r"\d+", out)
+        return {**fields, "job_id": job_id.group(0) if job_id else out.strip()}
+
+    def alive(self, job):
+        if self.status_command is None:
+            return None
+        out = subprocess.run(self.status_command.format(**job), shell=True,
+                             capture_output=True, text=True)
+        return out.returncode == 0 and len(out.stdout.strip()) > 0
+
+    def cancel(self, job):
+        if self.cancel_command is not None:
+            subprocess.run(self.cancel_command.format(**job), shell=True)
+
+
+JOB_BACKENDS = {"local": LocalBackend, "batch": BatchBackend}
+
+
+def run_jobs(db_paths, settings, backend="local", max_retries=1, poll_interval=5.,
+             skip=(), **backend_kwargs):
+    """
+    Run each plane as a separate job and wait for the jobs to finish.
+
+    Each job runs ``python -m suite2p --single_plane`` and reports its state
+    to the file job_status.txt in the plane folder (see write_status), with
+    its output in job_log.txt. The status files are polled, and failed jobs
+    are resubmitted up to max_retries times.
+
+    Parameters
+    ----------
+    db_paths : list of str
+        Paths to the db.npy file of each plane.
+    settings : dict
+        Pipeline settings dictionary, saved to settings.npy in each plane folder.
+    backend : str or JobBackend, optional (default "local")
+        Backend running the jobs, an instance or a name of JOB_BACKENDS
+        created with backend_kwargs.
+    max_retries : int, optional (default 1)
+        Number of times a failed plane is resubmitted.
+    poll_interval : float, optional (default 5.)
+        Seconds between checks of the status files.
+    skip : sequence of int, optional (default ())
+        Indices of planes not to process (e.g. flyback planes).
+    **backend_kwargs
+        Arguments of the backend if backend is a name, e.g. max_jobs for
+        "local" or submit_command for "batch".
+
+    Returns
+    -------
+    errors : dict
+        Message of the last failure for each plane index, or None if the
+        plane finished.
+    """
+    if isinstance(backend, str):
+        if backend not in JOB_BACKENDS:
+            raise ValueError(f"job backend must be one of {list(JOB_BACKENDS)}, not {backend}")
+        backend = JOB_BACKENDS[backend](**backend_kwargs)
+    planes = [ipl for ipl in range(len(db_paths)) if ipl not in skip]
+    files = {}
+    for ipl in planes:
+        plane_folder = os.path.dirname(os.path.abspath(db_paths[ipl]))
+        settings_path = os.path.join(plane_folder, "settings.npy")
+        np.save(settings_path, settings)
+        files[ipl] = dict(db_path=os.path.abspath(db_paths[ipl]), settings_path=settings_path,
+                          status_file=os.path.join(plane_folder, "job_status.txt"),
+                          log_file=os.path.join(plane_folder, "job_log.txt"))
+
+    errors, attempts, pending, active = {}, {ipl: 0 for ipl in planes}, list(planes), {}
+    try:
+        while pending or active:
+            while pending and (backend.max_jobs is None or len(active) < backend.max_jobs):
+                ipl = pending.pop(0)
+                attempts[ipl] += 1
+                write_status(files[ipl]["status_file"], "queued")
+                active[ipl] = backend.submit(ipl, **files[ipl])
+                logger.info(f">>>>>>>>>> PLANE {ipl} submitted (attempt {attempts[ipl]}) <<<<<<<<<")
+            time.sleep(poll_interval)
+            for ipl in list(active):
+                # check the job before its status, which is written before it exits
+                alive = backend.alive(active[ipl])
+                state, message = read_status(files[ipl]["status_file"])
+                if alive is False and state not in ["done", "failed"]:
+                    state, message = "failed", f"job exited while {state}, see {files[ipl]['log_file']}"
+                    write_status(files[ipl]["status_file"], state, message)
+                if state == "done":
+                    active.pop(ipl)
+                    errors[ipl] = None
+                    logger.info(f"PLANE {ipl} done")
+                elif state == "failed":
+                    active.pop(ipl)
+                    if attempts[ipl] <= max_retries:
+                        logger.warning(f"PLANE {ipl} failed, resubmitting:\n{message}")
+                        pending.append(ipl)
+                    else:
+                        errors[ipl] = message or "failed"
+                        logger.error(f"PLANE {ipl} failed:\n{message}")
+    except BaseException:
+        for job in active.values():
+            backend.cancel(job)
+        raise
+    return dict(sorted(errors.items()))
@@ -0,0 +1,190 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+# Conversion manifest of a save folder (suite2p/conversion.jsonl), written while
+# the input files are converted to the plane binaries. It is a JSON-lines log:
+#   line 1 : header with the conversion parameters, and Ly, Lx of the pages
+#   then one line per converted file, appended once all of its frames are written:
+#     "path", "size", "mtime" : signature of the input file
+#     "pages" : number of pages of the file
+#     "frames" : frames written per plane folder and channel, (n_planes, 2)
+#     "offsets" : end of the file's frames in the plane binaries in bytes, (n_planes, 2)
+#   last line : {"complete": true} once the binaries and dbs are written.
+# An interrupted line (crash while appending) is ignored when loading.
+MANIFEST_FILE = "conversion.jsonl"
+
+# parameters that determine where each page is written
+HEADER_KEYS = ["input_format", "nplanes", "nchannels", "nrois", "functional_chan",
+               "swap_order", "batch_size", "lines"]
+
+
+def _write_lines(f, lines):
+    f.write("".join(json.dumps(line) + "\n" for line in lines))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def file_signature(path):
+    """
+    Signature of an input file: its path, size and modification time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    signature : dict
+        "path", "size" and "mtime" of the file.
+    """
+    st = os.stat(path)
+    return {"path": str(path), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def manifest_header(dbs, input_format, batch_size):
+    """
+    Header of the conversion manifest, with the parameters of the conversion.
+
+    Parameters
+    ----------
+    dbs : list of dict
+        Database dictionaries of the plane folders.
+    input_format : str
+        Format of the input files, e.g. "tif".
+    batch_size : int
+        Number of pages read at once.
+
+    Returns
+    -------
+    header : dict
+        Conversion parameters (see HEADER_KEYS).
+    """
+    db = dbs[0]
+    return {"input_format": input_format, "nplanes": int(db["nplanes"]),
+            "nchannels": int(db["nchannels"]), "nrois": int(db.get("nrois", 1)),
+            "functional_chan": int(db["functional_chan"]),
+            "swap_order": bool(db.get("swap_order", False)), "batch_size": int(batch_size),
+            "lines": [np.asarray(db["lines"]).tolist() if "lines" in db else None
+                      for db in dbs]}
+
+
+def load_manifest(save_folder):
+    """
+    Load the conversion manifest of a save folder.
+
+    Parameters
+    ----------
+    save_folder : str
+        Folder with the plane folders (e.g. "suite2p/").
+
+    Returns
+    -------
+    manifest : dict or None
+        Header of the manifest with the entries of the converted files in
+        "files" and whether the conversion finished in "complete". None if
+        there is no manifest.
+    """
+    filename = os.path.join(save_folder, MANIFEST_FILE)
+    if not os.path.exists(filename):
+        return None
+    lines = []
+    with open(filename, "r") as f:
+        for line in f:
+            try:
+                lines.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    if len(lines) == 0:
+        return None
+    manifest = {**lines[0], "files": [], "complete": False}
+    for line in lines[1:]:
+        if line.get("complete", False):
+            manifest["complete"] = True
+        else:
+            manifest["files"].append(line)
+    return manifest
+
+
+def start_manifest(save_folder, header, files=()):
+    """
+    Write a new conversion manifest, keeping the entries of files already converted.
+
+    Parameters
+    ----------
+    save_folder : str
+        Folder with the plane folders.
+    header : dict
+        Conversion parameters, and "Ly" and "Lx" of the pages if known.
+    files : list of dict, optional
+        Entries of the files already converted.
+    """
+    filename = os.path.join(save_folder, MANIFEST_FILE)
+    with open(filename + ".tmp", "w") as f:
+        _write_lines(f, [header] + list(files))
+    os.replace(filename + ".tmp", filename)
+
+
+def append_manifest(save_folder, entry):
+    """
+    Record a converted file (or {"complete": True}) in the conversion manifest.
+
+    Parameters
+    ----------
+    save_folder : str
+        Folder with the plane folders.
+    entry : dict
+        Entry of the file, written once its frames are flushed to the binaries.
+    """
+    with open(os.path.join(save_folder, MANIFEST_FILE), "a") as f:
+        _write_lines(f, [entry])
+
+
+def converted_files(manifest, header, fs, binary_sizes, append=False):
+    """
+    Number of leading input files that are already converted to the binaries.
+
+    Files are converted if the manifest has the same conversion parameters,
+    lists the same files (same path, size and modification time) in the
+    same order, and the binaries hold all of their frames. The files of a
+    completed conversion are only kept when appending files to it.
+
+    Parameters
+    ----------
+    manifest : dict or None
+        Conversion manifest from load_manifest.
+    header : dict
+        Parameters of the current conversion.
+    fs : list of str
+        Input files of the current conversion.
+    binary_sizes : numpy.ndarray
+        Current size in bytes of the binary of each plane folder and channel,
+        shape (n_planes, 2).
+    append : bool, optional (default False)
+        Whether the files are appended to a completed conversion.
+
+    Returns
+    -------
+    nfiles : int
+        Number of files whose frames can be kept.
+    """
+    if manifest is None or (manifest["complete"] and not append):
+        return 0
+    if any(manifest.get(key, None) != header[key] for key in HEADER_KEYS):
+        logger.info("conversion parameters changed, not resuming previous conversion")
+        return 0
+    nfiles = 0
+    for file, entry in zip(fs, manifest["files"]):
+        if file_signature(file) != {key: entry[key] for key in ["path", "size", "mtime"]}:
+            break
+        if (np.asarray(entry["offsets"]) > binary_sizes).any():
+            break
+        nfiles += 1
+    return nfiles
@@ -5,8 +5,8 @@ import datetime
 import gc
 import logging
 import os
-import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -16,31 +16,17 @@ from natsort import natsorted
 logger = logging.getLogger(__name__)
 
 
-class _CrossPlatformUnpickler(pickle.Unpickler):
-    """Unpickler that handles PosixPath/WindowsPath across platforms."""
-
-    def find_class(self, module, name):
-        if name == "PosixPath" or name == "WindowsPath":
-            return Path
-        return super().find_class(module, name)
-
-def _load_npy_cross_platform(path):
-    """Load a .npy file that may contain Path objects from a different OS."""
-    with open(path, "rb") as f:
-        major, _ = np.lib.format.read_magic(f)
-        read_header = (np.lib.format.read_array_header_1_0 if major == 1
-                       else np.lib.format.read_array_header_2_0)
-        shape, fortran, dtype = read_header(f)
-        if dtype.hasobject:
-            return _CrossPlatformUnpickler(f).load()
-    return np.load(path, allow_pickle=False)
-
+from ..detection.roitable import ROITable
 from ..detection.stats import roi_stats
 from . import utils
+from .store import load_stat, load_ops
 from .. import default_settings
 
 try:
-    from pynwb import NWBHDF5IO, NWBFile
+    from hdmf.common import VectorData, VectorIndex
+    from hdmf.data_utils import GenericDataChunkIterator
+    from hdmf.utils import get_docval
+    from pynwb import NWBHDF5IO, NWBFile, H5DataIO
     from pynwb.base import Images
     from pynwb.image import GrayscaleImage
     from pynwb.ophys import (
@@ -54,151 +40,240 @@ try:
     NWB = True
 except ModuleNotFoundError:
     NWB = False
+    GenericDataChunkIterator = object
+
+# trace files saved in the NWB file, and the names of their containers
+NWB_TRACES = {"F.npy": "Fluorescence", "Fneu.npy": "Neuropil", "spks.npy": "Deconvolved"}
+NWB_TRACES_CHAN2 = {"F_chan2.npy": "Fluorescence_chan2", "Fneu_chan2.npy": "Neuropil_chan2"}
 
 
-def nwb_to_binary(settings):
-    """convert nwb file to binary (experimental)
+class TraceChunkIterator(GenericDataChunkIterator):
+    """
+    Chunked frames x ROIs view of a ROIs x frames trace file, for NWB export.
 
-    converts single plane single channel nwb file to binary for suite2p processing
+    The traces are memory-mapped and read one buffer at a time while the
+    RoiResponseSeries is written, so they are never fully loaded. Frames
+    after the end of the file (planes with fewer frames) are zero.
 
     Parameters
     ----------
-    settings: dictionary
-        requires "nwb_file" key
-        optional keys "nwb_driver", "nwb_series"
-        uses "nplanes", "save_path", "save_folder", "fast_disk",
-        "nchannels", "keep_movie_raw", "look_one_level_down"
+    fname : str
+        Trace file (e.g. F.npy) of shape (n_rois, n_frames).
+    nframes : int
+        Number of frames of the series (at least n_frames).
+    **kwargs
+        Buffer and chunk options of hdmf's GenericDataChunkIterator
+        (e.g. "buffer_gb", "chunk_mb").
+    """
 
-    Returns
-    -------
-        settings : dictionary of first plane
-            settings["reg_file"] or settings["raw_file"] is created binary
-            assigns keys "Ly", "Lx", "tiffreader", "first_tiffs",
-            "frames_per_folder", "nframes", "meanImg", "meanImg_chan2"
+    def __init__(self, fname, nframes, **kwargs):
+        self.traces = np.load(fname, mmap_mode="r")
+        self.nframes = int(nframes)
+        super().__init__(**kwargs)
 
-    """
+    def _get_data(self, selection):
+        frames, rois = selection
+        t0, t1, _ = frames.indices(self.nframes)
+        r0, r1, _ = rois.indices(self.traces.shape[0])
+        data = np.zeros((t1 - t0, r1 - r0), self.traces.dtype)
+        nt = min(t1, self.traces.shape[1]) - t0
+        if nt > 0:
+            data[:nt] = self.traces[r0:r1, t0 : t0 + nt].T
+        return data
 
-    # force 1 plane 1 chan for now
-    settings["nplanes"] = 1
-    settings["nchannels"] = 1
+    def _get_maxshape(self):
+        return (self.nframes, self.traces.shape[0])
 
-    # initialize settings with reg_file and raw_file paths, etc
-    settings = utils.init_settings(settings)[0]
+    def _get_dtype(self):
+        return self.traces.dtype
 
-    t0 = time.time()
-    nplanes = settings["nplanes"]
-    nchannels = settings["nchannels"]
 
-    batch_size = settings["batch_size"]
-    batch_size = int(nplanes * nchannels * np.ceil(batch_size / (nplanes * nchannels)))
+def nwb_frame_blocks(data, batch_size):
+    """
+    Iterate over blocks of frames of an NWB (HDF5) dataset, read lazily.
 
-    # open reg_file (and when available reg_file_chan2)
-    if "keep_movie_raw" in settings and settings["keep_movie_raw"]:
-        reg_file = open(settings["raw_file"], "wb")
-        if nchannels > 1:
-            reg_file_chan2 = open(settings["raw_file_chan2"], "wb")
-    else:
-        reg_file = open(settings["reg_file"], "wb")
-        if nchannels > 1:
-            reg_file_chan2 = open(settings["reg_file_chan2"], "wb")
+    The blocks are a multiple of the chunk size of the dataset along frames
+    (about batch_size frames), so that each chunk is read and decompressed once.
+
+    Parameters
+    ----------
+    data : h5py.Dataset or numpy.ndarray
+        Movie of shape (n_frames, Ly, Lx).
+    batch_size : int
+        Approximate number of frames per block.
+
+    Yields
+    ------
+    i0 : int
+        Index of the first frame of the block.
+    frames : numpy.ndarray
+        Frames i0 to i0 + len(frames).
+    """
+    chunks = getattr(data, "chunks", None)
+    nchunk = chunks[0] if chunks else 1
+    nblock = nchunk * max(1, int(round(batch_size / nchunk)))
+    for i0 in range(0, data.shape[0], nblock):
+        yield i0, data[i0 : i0 + nblock]
+
+
+def _find_series(nwbfile, series_name):
+    """ TwoPhotonSeries with series_name, or the first TwoPhotonSeries if empty """
+    if series_name:
+        return nwbfile.acquisition[series_name]
+    names = [v.name for v in nwbfile.acquisition.values() if isinstance(v, TwoPhotonSeries)]
+    if len(names) == 0:
+        raise ValueError("no TwoPhotonSeries in NWB file")
+    elif len(names) > 1:
+        logger.warning(f"more than one TwoPhotonSeries in NWB file, choosing {names[0]}")
+    return nwbfile.acquisition[names[0]]
+
+
+def _series_lengths(nwb_list, nwb_driver, series_name):
+    """ number of frames of the TwoPhotonSeries of each NWB file """
+    lengths = []
+    for fname in nwb_list:
+        with NWBHDF5IO(fname, "r", driver=nwb_driver) as fio:
+            lengths.append(_find_series(fio.read(), series_name).data.shape[0])
+    return lengths
+
+
+def nwb_to_binary(dbs, settings, reg_file, reg_file_chan2):
+    """
+    Stream the TwoPhotonSeries of NWB files into the binary files of the planes.
 
-    nwb_driver = None
-    if settings.get("nwb_driver") and isinstance(nwb_driver, str):
-        nwb_driver = settings["nwb_driver"]
+    The series are read lazily in blocks of frames aligned to their HDF5
+    chunks (see nwb_frame_blocks), and frames interleaved across planes and
+    channels (as in h5py_to_binary) are written to the binaries of their
+    plane, which are preallocated to their final size.
 
-    with NWBHDF5IO(settings["nwb_file"], "r", driver=nwb_driver) as fio:
-        nwbfile = fio.read()
+    Parameters
+    ----------
+    dbs : list of dict
+        Database dictionaries for each plane. Must contain keys "file_list",
+        "nplanes", "nchannels", "batch_size" and "functional_chan", optionally
+        "nwb_driver" (e.g. "ros3" for remote files) and "nwb_series" (name of
+        the TwoPhotonSeries, defaults to the first one). Updated in-place with
+        "Ly", "Lx", "nframes", "nframes_per_folder", "meanImg", and
+        "meanImg_chan2".
+    settings : dict
+        Suite2p settings dictionary, saved alongside each plane's database.
+    reg_file : list of file objects
+        Opened binary files for writing each plane's functional channel data.
+    reg_file_chan2 : list of file objects
+        Opened binary files for writing each plane's second channel data
+        (used only when nchannels > 1).
 
-        # get TwoPhotonSeries
-        if not settings.get("nwb_series"):
-            TwoPhotonSeries_names = []
-            for v in nwbfile.acquisition.values():
-                if isinstance(v, TwoPhotonSeries):
-                    TwoPhotonSeries_names.append(v.name)
-            if len(TwoPhotonSeries_names) == 0:
-                raise ValueError("no TwoPhotonSeries in NWB file")
-            elif len(TwoPhotonSeries_names) > 1:
-                raise Warning(
-                    "more than one TwoPhotonSeries in NWB file, choosing first one")
-            settings["nwb_series"] = TwoPhotonSeries_names[0]
-
-        series = nwbfile.acquisition[settings["nwb_series"]]
-        series_shape = nwbfile.acquisition[settings["nwb_series"]].data.shape
-        settings["nframes"] = series_shape[0]
-        settings["frames_per_file"] = np.array([settings["nframes"]])
-        settings["frames_per_folder"] = np.array([settings["nframes"]])
-        settings["meanImg"] = np.zeros((series_shape[1], series_shape[2]), np.float32)
-        for ik in np.arange(0, settings["nframes"], batch_size):
-            ikend = min(ik + batch_size, settings["nframes"])
-            im = series.data[ik:ikend]
-
-            # check if uint16
-            if im.dtype.type == np.uint16:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type == np.int32:
-                im = (im // 2).astype(np.int16)
-            elif im.dtype.type != np.int16:
-                im = im.astype(np.int16)
-
-            reg_file.write(bytearray(im))
-            settings["meanImg"] += im.astype(np.float32).sum(axis=0)
-
-            if ikend % (batch_size * 4) == 0:
-                logger.info("%d frames of binary, time %0.2f sec." %
-                      (ikend, time.time() - t0))
+    Returns
+    -------
+    dbs : list of dict
+        Updated database dictionaries with image dimensions, frame counts, and
+        mean images populated.
+    """
+    if not NWB:
+        raise ImportError("pynwb is required for this file type, please 'pip install pynwb'")
+
+    nplanes = dbs[0]["nplanes"]
+    nchannels = dbs[0]["nchannels"]
+    ncp = nplanes * nchannels
+    nfunc = dbs[0]["functional_chan"] - 1 if nchannels > 1 else 0
+    batch_size = ncp * int(np.ceil(dbs[0]["batch_size"] / ncp))
+    nwb_driver = dbs[0].get("nwb_driver", None) or None
+    nwb_list = dbs[0]["file_list"]
+    # index of the first frame of the functional (and second) channel of each
+    # plane within each cycle of ncp frames
+    ifunc = [nchannels * j + nfunc for j in range(nplanes)]
+    ichan2 = [nchannels * j + 1 - nfunc for j in range(nplanes)]
+
+    t0 = time.time()
+    nbytes = 0
+    lengths = _series_lengths(nwb_list, nwb_driver, dbs[0].get("nwb_series", ""))
+    for db in dbs:
+        db["nframes"] = 0
+        db["nframes_per_folder"] = np.zeros(len(nwb_list), np.int32)
+    for ifile, fname in enumerate(nwb_list):
+        with NWBHDF5IO(fname, "r", driver=nwb_driver) as fio:
+            series = _find_series(fio.read(), dbs[0].get("nwb_series", ""))
+            data = series.data
+            if data.ndim != 3:
+                raise ValueError(f"TwoPhotonSeries {series.name} in {fname} has shape "
+                                 f"{data.shape}, expected (n_frames, Ly, Lx)")
+            nframes_all, Ly, Lx = data.shape
+            logger.info(f"streaming TwoPhotonSeries {series.name} of {fname}: {data.shape}, "
+                        f"chunks {getattr(data, 'chunks', None)}")
+            if ifile == 0:
+                for j, db in enumerate(dbs):
+                    db["Ly"], db["Lx"] = Ly, Lx
+                    db["meanImg"] = np.zeros((Ly, Lx), np.float32)
+                    if nchannels > 1:
+                        db["meanImg_chan2"] = np.zeros((Ly, Lx), np.float32)
+                    # preallocate the binaries to the frames of all files
+                    nframes_plane = sum(len(range(ifunc[j], n, ncp)) for n in lengths)
+                    reg_file[j].truncate(nframes_plane * Ly * Lx * 2)
+                    if nchannels > 1:
+                        reg_file_chan2[j].truncate(nframes_plane * Ly * Lx * 2)
+            tlog = time.time()
+            for i0, im in nwb_frame_blocks(data, batch_size):
+                # check if uint16
+                if im.dtype.type == np.uint16 or im.dtype.type == np.int32:
+                    im = (im // 2).astype(np.int16)
+                elif im.dtype.type != np.int16:
+                    im = im.astype(np.int16)
+                for j, db in enumerate(dbs):
+                    im2write = im[(ifunc[j] - i0) % ncp::ncp]
+                    reg_file[j].write(bytearray(im2write))
+                    db["meanImg"] += im2write.astype(np.float32).sum(axis=0)
+                    if nchannels > 1:
+                        im2 = im[(ichan2[j] - i0) % ncp::ncp]
+                        reg_file_chan2[j].write(bytearray(im2))
+                        db["meanImg_chan2"] += im2.astype(np.float32).sum(axis=0)
+                    db["nframes"] += im2write.shape[0]
+                    db["nframes_per_folder"][ifile] += im2write.shape[0]
+                nbytes += im.nbytes
+                if time.time() - tlog > 10 or i0 + len(im) == nframes_all:
+                    tlog = time.time()
+                    logger.info("%d/%d frames of %s, %0.1f MB/s, time %0.2f sec." %
+                                (i0 + len(im), nframes_all, os.path.basename(fname),
+                                 nbytes / 2**20 / (tlog - t0), tlog - t0))
         gc.collect()
 
-    # write settings files
-    settings["Ly"], settings["Lx"] = settings["meanImg"].shape
-    settings["yrange"] = np.array([0, settings["Ly"]])
-    settings["xrange"] = np.array([0, settings["Lx"]])
-    settings["meanImg"] /= settings["nframes"]
-    if nchannels > 1:
-        settings["meanImg_chan2"] /= settings["nframes"]
-    # close all binary files and write settings files
-    np.save(settings["settings_path"], settings)
-    reg_file.close()
-    if nchannels > 1:
-        reg_file_chan2.close()
+    # update dbs with image dimensions and mean images
+    do_registration = settings["run"]["do_registration"]
+    for db in dbs:
+        if not do_registration:
+            db["yrange"] = np.array([0, db["Ly"]])
+            db["xrange"] = np.array([0, db["Lx"]])
+        db["meanImg"] /= db["nframes"]
+        if nchannels > 1:
+            db["meanImg_chan2"] /= db["nframes"]
+        # Save db and settings to each plane folder
+        np.save(db["db_path"], db)
+        np.save(db["settings_path"], settings)
 
-    return settings
+    return dbs
 
 
 def read_nwb(fpath):
-    """read NWB file for use in the GUI"""
+    """read NWB file for use in the GUI
+
+    The masks, traces and iscell are read with one read per dataset
+    (and per plane for the traces).
+    """
     with NWBHDF5IO(fpath, "r") as fio:
         nwbfile = fio.read()
 
-        # ROIs
-        try:
-            rois = nwbfile.processing["ophys"]["ImageSegmentation"][
-                "PlaneSegmentation"]["pixel_mask"]
-            multiplane = False
-        except Exception:
-            rois = nwbfile.processing["ophys"]["ImageSegmentation"][
-                "PlaneSegmentation"]["voxel_mask"]
-            multiplane = True
-        stat = []
-        for n in range(len(rois)):
-            if isinstance(rois[0], np.ndarray):
-                stat.append({
-                    "ypix":
-                        np.array(
-                            [rois[n][i][0].astype("int") for i in range(len(rois[n]))]),
-                    "xpix":
-                        np.array(
-                            [rois[n][i][1].astype("int") for i in range(len(rois[n]))]),
-                    "lam":
-                        np.array([rois[n][i][-1] for i in range(len(rois[n]))]),
-                })
-            else:
-                stat.append({
-                    "ypix": rois[n]["x"].astype("int"),
-                    "xpix": rois[n]["y"].astype("int"),
-                    "lam": rois[n]["weight"],
-                })
-            if multiplane:
-                stat[-1]["iplane"] = int(rois[n][0][-2])
+        # ROIs, with the masks of all ROIs read at once
+        ps = nwbfile.processing["ophys"]["ImageSegmentation"]["PlaneSegmentation"]
+        multiplane = "pixel_mask" not in ps.colnames
+        rois = ps["voxel_mask" if multiplane else "pixel_mask"]
+        masks = np.asarray(rois.target.data[:])
+        offsets = np.zeros(len(rois) + 1, "int64")
+        offsets[1:] = rois.data[:]
+        # fields are (x, y, [z,] weight) with the y-coordinates saved in x
+        fields = masks.dtype.names
+        columns = ({"iplane": masks[fields[-2]][offsets[:-1]].astype("int")}
+                   if multiplane and len(masks) > 0 else {})
+        stat = ROITable(masks[fields[0]].astype("int"), masks[fields[1]].astype("int"),
+                        masks[fields[-1]], offsets, columns=columns).to_stat()
         settings = default_settings()
 
         if multiplane:
@@ -237,12 +312,16 @@ def read_nwb(fpath):
             if name in roi_response_series.keys():
                 fluo = ophys[name][name].data[:]
             elif "plane0" in roi_response_series.keys():
-                for key, value in roi_response_series.items():
-                    if key == "plane0":
-                        fluo = value.data[:]
-                    else:
-                        fluo = np.concatenate((fluo, value.data[:]), axis=1)
-                fluo = np.transpose(fluo)
+                # read each plane into the preallocated array of all ROIs
+                series = [roi_response_series[key] for key in natsorted(roi_response_series)]
+                nframes = max(value.data.shape[0] for value in series)
+                fluo = np.zeros((sum(value.data.shape[1] for value in series), nframes),
+                                series[0].data.dtype)
+                i0 = 0
+                for value in series:
+                    data = value.data[:]
+                    fluo[i0 : i0 + data.shape[1], :data.shape[0]] = data.T
+                    i0 += data.shape[1]
             else:
                 raise AttributeError(f"Can't find {name} container in {fpath}")
             return fluo
@@ -252,11 +331,7 @@ def read_nwb(fpath):
         spks = get_fluo("Deconvolved")
 
         # cell probabilities
-        iscell = [
-            ophys["ImageSegmentation"]["PlaneSegmentation"]["iscell"][n]
-            for n in range(len(stat))
-        ]
-        iscell = np.array(iscell)
+        iscell = np.asarray(ps["iscell"].data[:])
         probcell = iscell[:, 1]
         iscell_bool = iscell[:, 0].astype("bool")
         # Create redcell as 2-column array for consistency with iscell format
@@ -315,39 +390,56 @@ def read_nwb(fpath):
     return stat, settings, F, Fneu, spks, iscell, probcell, redcell, probredcell
 
 
-def save_nwb(save_folder):
-    """convert folder with plane folders to NWB format"""
+def _load_plane_masks(plane_folder, iplane, multiplane):
+    """
+    Pixel masks (voxel masks if multiplane) of the ROIs of a plane as one
+    compound array, built from the columnar ROI data, with the ROI offsets
+    and iscell of the plane.
+    """
+    stat = load_stat(plane_folder)
+    fields = [("x", "uint32"), ("y", "uint32")]
+    fields += [("z", "uint32")] if multiplane else []
+    masks = np.zeros(len(stat.ypix), dtype=fields + [("weight", "float32")])
+    # ypix is saved as "x" and xpix as "y" (as read by read_nwb)
+    masks["x"], masks["y"], masks["weight"] = stat.ypix, stat.xpix, stat.lam
+    if multiplane:
+        masks["z"] = iplane
+    iscell = np.load(os.path.join(plane_folder, "iscell.npy"))
+    return masks, stat.offsets, iscell
+
+
+def save_nwb(save_folder, compression="gzip", compression_opts=4, n_workers=4):
+    """
+    Convert a folder with plane folders to NWB format (ophys.nwb).
+
+    The pixel masks are built from the columnar ROI data of the planes,
+    which are loaded in parallel, and the traces are streamed from their
+    files into chunked, compressed datasets.
+
+    Parameters
+    ----------
+    save_folder : str
+        Suite2p output folder with the plane folders.
+    compression : str or None, optional (default "gzip")
+        HDF5 compression filter of the traces and masks, None for no compression.
+    compression_opts : int or None, optional (default 4)
+        Options of the compression filter (gzip level).
+    n_workers : int, optional (default 4)
+        Number of threads loading the planes.
+    """
 
     plane_folders = natsorted([
         Path(f.path)
         for f in os.scandir(save_folder)
         if f.is_dir() and f.name[:5] == "plane"
     ])
-    settings1 = [
-        np.load(f.joinpath("settings.npy"), allow_pickle=True).item() for f in plane_folders
-    ]
-    dbs = [
-        _load_npy_cross_platform(f.joinpath("db.npy")).item() for f in plane_folders
-    ]
-
-    # Load reg_outputs and detect_outputs for background images
-    for i, f in enumerate(plane_folders):
-        # Merge reg_outputs (contains meanImg, yrange, xrange, etc.)
-        reg_path = f.joinpath("reg_outputs.npy")
-        if reg_path.exists():
-            reg_outputs = np.load(reg_path, allow_pickle=True).item()
-            settings1[i] = {**settings1[i], **reg_outputs}
-
-        # Merge detect_outputs (contains Vcorr, max_proj, etc.)
-        detect_path = f.joinpath("detect_outputs.npy")
-        if detect_path.exists():
-            detect_outputs = np.load(detect_path, allow_pickle=True).item()
-            settings1[i] = {**settings1[i], **detect_outputs}
-
-        # Add db keys that might be needed (Ly, Lx)
-        for key in ["Ly", "Lx"]:
-            if key in dbs[i] and key not in settings1[i]:
-                settings1[i][key] = dbs[i][key]
+    # metadata from the results store, or from db.npy, settings.npy,
+    # reg_outputs.npy (meanImg, yrange, ...) and detect_outputs.npy (Vcorr, max_proj, ...)
+    dbs, settings1 = [], []
+    for f in plane_folders:
+        db, settings = load_ops(f)
+        dbs.append(db)
+        settings1.append({**settings, **db})
 
     # Get nchannels from the main db or from plane dbs
     nchannels = dbs[0].get("nchannels", 1)
@@ -357,6 +449,9 @@ def save_nwb(save_folder):
             multiplane = True
         else:
             multiplane = False
+        compress = (lambda data: H5DataIO(data, compression=compression,
+                                          compression_opts=compression_opts)
+                    if compression is not None else data)
 
         settings = settings1[0]
         if "date_proc" in settings:
@@ -397,8 +492,13 @@ def save_nwb(save_folder):
             grid_spacing=([2.0, 2.0, 30.0] if multiplane else [2.0, 2.0]),
             grid_spacing_unit="microns",
         )
+        Nfr = np.array([db["nframes"] for db in dbs]).max()
         # link to external data
         external_data = settings["filelist"] if "filelist" in settings else [""]
+        # newer pynwb versions need the number of frames of external data
+        num_samples = ({"num_samples": int(Nfr * dbs[0]["nplanes"])}
+                       if any(arg["name"] == "num_samples"
+                              for arg in get_docval(TwoPhotonSeries.__init__)) else {})
         image_series = TwoPhotonSeries(
             name="TwoPhotonSeries",
             dimension=[dbs[0]["Ly"], dbs[0]["Lx"]],
@@ -408,9 +508,31 @@ def save_nwb(save_folder):
             format="external",
             starting_time=0.0,
             rate=settings["fs"] * dbs[0]["nplanes"],
+            **num_samples,
         )
         nwbfile.add_acquisition(image_series)
 
+        # ROI masks of all planes, loaded in parallel
+        with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(plane_folders)))) as pool:
+            planes = list(pool.map(_load_plane_masks, plane_folders,
+                                   range(len(plane_folders)),
+                                   [multiplane] * len(plane_folders)))
+        ncells = np.array([len(offsets) - 1 for _, offsets, _ in planes], dtype=np.int_)
+        mask_starts = np.cumsum([0] + [len(masks) for masks, _, _ in planes])
+        mask_name = "voxel_mask" if multiplane else "pixel_mask"
+        mask_column = VectorData(
+            name=mask_name,
+            description=f"{mask_name.split('_')[0].capitalize()} masks for each ROI",
+            data=compress(np.concatenate([masks for masks, _, _ in planes])),
+        )
+        mask_index = VectorIndex(
+            name=f"{mask_name}_index",
+            data=np.concatenate([offsets[1:] + start
+                                 for (_, offsets, _), start in zip(planes, mask_starts)]),
+            target=mask_column,
+        )
+        iscell = np.concatenate([iscell for _, _, iscell in planes], axis=0)
+
         # processing
         img_seg = ImageSegmentation()
         ps = img_seg.create_plane_segmentation(
@@ -418,124 +540,42 @@ def save_nwb(save_folder):
             description="suite2p output",
             imaging_plane=imaging_plane,
             reference_images=image_series,
+            id=list(range(int(ncells.sum()))),
+            columns=[mask_index, mask_column],
         )
         ophys_module = nwbfile.create_processing_module(
             name="ophys", description="optical physiology processed data")
         ophys_module.add(img_seg)
 
-        file_strs = ["F.npy", "Fneu.npy", "spks.npy"]
-        file_strs_chan2 = ["F_chan2.npy", "Fneu_chan2.npy"]
-        traces, traces_chan2 = [], []
-        ncells = np.zeros(len(settings1), dtype=np.int_)
-        Nfr = np.array([db["nframes"] for db in dbs]).max()
-        for iplane, (settings, db) in enumerate(zip(settings1, dbs)):
-            if iplane == 0:
-                iscell = np.load(os.path.join(plane_folders[iplane], "iscell.npy"))
-                for fstr in file_strs:
-                    traces.append(np.load(os.path.join(plane_folders[iplane], fstr)))
-                if nchannels > 1:
-                    for fstr in file_strs_chan2:
-                        traces_chan2.append(
-                            np.load(plane_folders[iplane].joinpath(fstr)))
-                PlaneCellsIdx = iplane * np.ones(len(iscell))
-            else:
-                iscell = np.append(
-                    iscell,
-                    np.load(os.path.join(plane_folders[iplane], "iscell.npy")),
-                    axis=0,
-                )
-                for i, fstr in enumerate(file_strs):
-                    trace = np.load(os.path.join(plane_folders[iplane], fstr))
-                    if trace.shape[1] < Nfr:
-                        fcat = np.zeros((trace.shape[0], Nfr - trace.shape[1]),
-                                        "float32")
-                        trace = np.concatenate((trace, fcat), axis=1)
-                    traces[i] = np.append(traces[i], trace, axis=0)
-                if nchannels > 1:
-                    for i, fstr in enumerate(file_strs_chan2):
-                        traces_chan2[i] = np.append(
-                            traces_chan2[i],
-                            np.load(plane_folders[iplane].joinpath(fstr)),
-                            axis=0,
-                        )
-                PlaneCellsIdx = np.append(
-                    PlaneCellsIdx, iplane * np.ones(len(iscell) - len(PlaneCellsIdx)))
-
-            stat = np.load(os.path.join(plane_folders[iplane], "stat.npy"),
-                           allow_pickle=True)
-            ncells[iplane] = len(stat)
-            for n in range(ncells[iplane]):
-                if multiplane:
-                    pixel_mask = np.array([
-                        stat[n]["ypix"],
-                        stat[n]["xpix"],
-                        iplane * np.ones(stat[n]["npix"]),
-                        stat[n]["lam"],
-                    ])
-                    ps.add_roi(voxel_mask=pixel_mask.T)
-                else:
-                    pixel_mask = np.array(
-                        [stat[n]["ypix"], stat[n]["xpix"], stat[n]["lam"]])
-                    ps.add_roi(pixel_mask=pixel_mask.T)
-
         ps.add_column("iscell", "two columns - iscell & probcell", iscell)
 
         rt_region = []
-        for iplane, settings in enumerate(settings1):
-            if iplane == 0:
-                rt_region.append(
-                    ps.create_roi_table_region(
-                        region=list(np.arange(0, ncells[iplane]),),
-                        description=f"ROIs for plane{int(iplane)}",
-                    ))
-            else:
-                rt_region.append(
-                    ps.create_roi_table_region(
-                        region=list(
-                            np.arange(
-                                np.sum(ncells[:iplane]),
-                                ncells[iplane] + np.sum(ncells[:iplane]),
-                            )),
-                        description=f"ROIs for plane{int(iplane)}",
-                    ))
-
-        # FLUORESCENCE (all are required)
-        name_strs = ["Fluorescence", "Neuropil", "Deconvolved"]
-        name_strs_chan2 = ["Fluorescence_chan2", "Neuropil_chan2"]
-
-        for i, (fstr, nstr) in enumerate(zip(file_strs, name_strs)):
+        for iplane in range(len(settings1)):
+            rt_region.append(
+                ps.create_roi_table_region(
+                    region=list(np.arange(ncells[:iplane].sum(),
+                                          ncells[:iplane + 1].sum())),
+                    description=f"ROIs for plane{int(iplane)}",
+                ))
+
+        # FLUORESCENCE (all are required), streamed from the trace files
+        trace_files = dict(NWB_TRACES, **(NWB_TRACES_CHAN2 if nchannels > 1 else {}))
+        for fstr, nstr in trace_files.items():
+            fl = Fluorescence(name=nstr)
+            ophys_module.add(fl)
             for iplane, settings in enumerate(settings1):
-                roi_resp_series = RoiResponseSeries(
+                if ncells[iplane] > 0:
+                    data = compress(TraceChunkIterator(
+                        os.path.join(plane_folders[iplane], fstr), Nfr))
+                else:
+                    data = np.zeros((Nfr, 0), "float32")
+                fl.add_roi_response_series(roi_response_series=RoiResponseSeries(
                     name=f"plane{int(iplane)}",
-                    data=np.transpose(traces[i][PlaneCellsIdx == iplane]),
+                    data=data,
                     rois=rt_region[iplane],
                     unit="lumens",
                     rate=settings["fs"],
-                )
-                if iplane == 0:
-                    fl = Fluorescence(roi_response_series=roi_resp_series, name=nstr)
-                else:
-                    fl.add_roi_response_series(roi_response_series=roi_resp_series)
-            ophys_module.add(fl)
-
-        if nchannels > 1:
-            for i, (fstr, nstr) in enumerate(zip(file_strs_chan2, name_strs_chan2)):
-                for iplane, settings in enumerate(settings1):
-                    roi_resp_series = RoiResponseSeries(
-                        name=f"plane{int(iplane)}",
-                        data=np.transpose(traces_chan2[i][PlaneCellsIdx == iplane]),
-                        rois=rt_region[iplane],
-                        unit="lumens",
-                        rate=settings["fs"],
-                    )
-
-                    if iplane == 0:
-                        fl = Fluorescence(roi_response_series=roi_resp_series,
-                                          name=nstr)
-                    else:
-                        fl.add_roi_response_series(roi_response_series=roi_resp_series)
-
-                ophys_module.add(fl)
+                ))
 
         # BACKGROUNDS
         # (meanImg, Vcorr and max_proj are REQUIRED)
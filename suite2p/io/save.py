@@ -2,6 +2,7 @@
 Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
 """
 import os
+import tempfile
 from natsort import natsorted
 import numpy as np
 from datetime import datetime
@@ -10,6 +11,12 @@ import pathlib
 import logging 
 logger = logging.getLogger(__name__)
 
+from ..detection.roitable import ROITable
+from .store import load_ops, load_stat, has_store, save_results
+
+# traces concatenated across planes in the combined view
+COMBINED_TRACES = ["F", "Fneu", "spks"]
+
 
 def save_mat(ops, stat, F, Fneu, spks, iscell, redcell,
              F_chan2=None, Fneu_chan2=None):
@@ -153,12 +160,27 @@ def compute_dydx(db1):
     return dy, dx
 
 
+def _copy_rows(dst, src, i0, chunk_size=2**28):
+    """
+    Copy the rows of src into dst[i0 : i0 + len(src), :src.shape[1]], in
+    chunks of rows of at most chunk_size bytes so that memory-mapped inputs
+    and outputs are streamed.
+    """
+    nrows = max(1, chunk_size // max(1, src.shape[1] * src.itemsize))
+    for j in range(0, len(src), nrows):
+        dst[i0 + j : i0 + min(j + nrows, len(src)), :src.shape[1]] = src[j : j + nrows]
+
+
 def combined(save_folder, save=True):
     """
     Combine all plane folders in save_folder into a single result file.
 
     Loads per-plane results (stat, F, Fneu, spks, iscell, redcell), shifts ROI
     coordinates by the tiled offsets, and concatenates them into combined arrays.
+    The traces are copied plane by plane into preallocated arrays, which are
+    memory-mapped files in the "combined" subfolder if save is True (temporary
+    files in that folder, deleted once the arrays are closed, otherwise), so that
+    the combined view of many planes is built with bounded memory.
     Multi-plane recordings are arranged to best tile a square. Multi-ROI
     recordings are arranged by their dx, dy physical localization.
 
@@ -182,7 +204,8 @@ def combined(save_folder, save=True):
     settings : dict
         Suite2p settings dictionary.
     F : numpy.ndarray
-        Combined fluorescence traces of shape (n_cells_total, n_frames).
+        Combined fluorescence traces of shape (n_cells_total, n_frames),
+        memory-mapped (read-only if save is True). Fneu and spks likewise.
     Fneu : numpy.ndarray
         Combined neuropil traces of shape (n_cells_total, n_frames).
     spks : numpy.ndarray
@@ -201,24 +224,12 @@ def combined(save_folder, save=True):
     plane_folders = natsorted([
         f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5] == "plane"
     ])
-    dbs = [
-        np.load(os.path.join(f, "db.npy"), allow_pickle=True).item()
-        for f in plane_folders
-    ]
-    settings = np.load(os.path.join(plane_folders[0], "settings.npy"), allow_pickle=True).item()
-    if os.path.exists(os.path.join(plane_folders[0], "reg_outputs.npy")):
-        dops =  [
-        np.load(os.path.join(f, "reg_outputs.npy"), allow_pickle=True).item()
-        for f in plane_folders
-        ]
-        dbs = [{**db, **dop} for db, dop in zip(dbs, dops)]
-    
-    if os.path.exists(os.path.join(plane_folders[0], "detect_outputs.npy")):
-        dops =  [
-        np.load(os.path.join(f, "detect_outputs.npy"), allow_pickle=True).item()
-        for f in plane_folders
-        ]
-        dbs = [{**db, **dop} for db, dop in zip(dbs, dops)]
+    # db merged with reg_outputs and detect_outputs, from the results store if present
+    dbs, settings = [], None
+    for f in plane_folders:
+        db, settings0 = load_ops(f)
+        dbs.append(db)
+        settings = settings0 if settings is None else settings
     
 
     dy, dx = compute_dydx(dbs)
@@ -237,13 +248,46 @@ def combined(save_folder, save=True):
         max_proj = np.zeros((LY, LX))
 
     Vcorr = np.zeros((LY, LX))
-    Nfr = np.amax(np.array([db["nframes"] for db in dbs]))
-    ii = 0
+
+    # scan the trace shapes of the planes with ROIs, then preallocate the
+    # combined traces (memory-mapped in the combined folder if saving) and
+    # copy each plane's rows in place
+    has_rois = [os.path.exists(os.path.join(f, "stat.npy")) or has_store(f)
+                for f in plane_folders]
+    plane_traces = [{key: np.load(os.path.join(f, f"{key}.npy"), mmap_mode="r")
+                     for key in COMBINED_TRACES} if rois else None
+                    for f, rois in zip(plane_folders, has_rois)]
+    nrois = [0 if tr is None else tr["F"].shape[0] for tr in plane_traces]
+    Nfr = max([db["nframes"] for db in dbs] +
+              [tr["F"].shape[1] for tr in plane_traces if tr is not None])
+    hasred = any(has_rois) and all(os.path.isfile(os.path.join(f, "redcell.npy"))
+                                   for f, rois in zip(plane_folders, has_rois) if rois)
+    fpath = os.path.join(save_folder, "combined")
+    if not os.path.isdir(fpath):
+        os.makedirs(fpath)
+    traces = {}
+    for key in COMBINED_TRACES:
+        dtype = np.result_type(*[tr[key].dtype for tr in plane_traces if tr is not None],
+                               "float32")
+        shape = (int(sum(nrois)), int(Nfr))
+        # frames missing in shorter planes stay zero
+        if save:
+            traces[key] = np.lib.format.open_memmap(os.path.join(fpath, f"{key}.npy"),
+                                                    mode="w+", dtype=dtype, shape=shape)
+        elif shape[0] * shape[1] > 0:
+            # anonymous file, removed when the memory map is closed
+            with tempfile.TemporaryFile(dir=fpath) as tmp:
+                traces[key] = np.memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+        else:
+            traces[key] = np.zeros(shape, dtype)
+
+    tables, iscell, redcell = [], [], []
+    i0 = 0
     for k, db in enumerate(dbs):
-        fpath = plane_folders[k]
-        if not os.path.exists(os.path.join(fpath, "stat.npy")):
+        fpath_plane = plane_folders[k]
+        if not has_rois[k]:
             continue
-        stat0 = np.load(os.path.join(fpath, "stat.npy"), allow_pickle=True)
+        stat0 = load_stat(fpath_plane)
         xrange = np.arange(dx[k], dx[k] + Lx[k])
         yrange = np.arange(dy[k], dy[k] + Ly[k])
         meanImg[np.ix_(yrange, xrange)] = db["meanImg"]
@@ -261,42 +305,30 @@ def combined(save_folder, save=True):
         Vcorr[np.ix_(yrange, xrange)] = db["Vcorr"]
         if "max_proj" in db:
             max_proj[np.ix_(yrange, xrange)] = db["max_proj"]
-        for j in range(len(stat0)):
-            stat0[j]["xpix"] += dx[k]
-            stat0[j]["ypix"] += dy[k]
-            stat0[j]["med"][0] += dy[k]
-            stat0[j]["med"][1] += dx[k]
-            stat0[j]["iplane"] = k
-        F0 = np.load(os.path.join(fpath, "F.npy"))
-        Fneu0 = np.load(os.path.join(fpath, "Fneu.npy"))
-        spks0 = np.load(os.path.join(fpath, "spks.npy"))
-        iscell0 = np.load(os.path.join(fpath, "iscell.npy"))
-        if os.path.isfile(os.path.join(fpath, "redcell.npy")):
-            redcell0 = np.load(os.path.join(fpath, "redcell.npy"))
-            hasred = True
-        else:
-            redcell0 = []
-            hasred = False
-        nn, nt = F0.shape
-        if nt < Nfr:
-            fcat = np.zeros((nn, Nfr - nt), "float32")
-            #logger.info(F0.shape)
-            #logger.info(fcat.shape)
-            F0 = np.concatenate((F0, fcat), axis=1)
-            spks0 = np.concatenate((spks0, fcat), axis=1)
-            Fneu0 = np.concatenate((Fneu0, fcat), axis=1)
-        if ii == 0:
-            F, Fneu, spks, stat, iscell, redcell = F0, Fneu0, spks0, stat0, iscell0, redcell0
-        else:
-            F = np.concatenate((F, F0))
-            Fneu = np.concatenate((Fneu, Fneu0))
-            spks = np.concatenate((spks, spks0))
-            stat = np.concatenate((stat, stat0))
-            iscell = np.concatenate((iscell, iscell0))
-            if hasred:
-                redcell = np.concatenate((redcell, redcell0))
-        ii += 1
+        columns = {**stat0.columns, "iplane": np.full(len(stat0), k)}
+        if "med" in columns:
+            columns["med"] = np.asarray(columns["med"]) + np.array([dy[k], dx[k]])
+        tables.append(ROITable(stat0.ypix + dy[k], stat0.xpix + dx[k], stat0.lam,
+                               stat0.offsets, stat0.pixel_columns, columns,
+                               stat0.list_columns))
+        for key in COMBINED_TRACES:
+            _copy_rows(traces[key], plane_traces[k][key], i0)
+        iscell.append(np.load(os.path.join(fpath_plane, "iscell.npy")))
+        if hasred:
+            redcell.append(np.load(os.path.join(fpath_plane, "redcell.npy")))
+        i0 += nrois[k]
         logger.info("appended plane %d to combined view" % k)
+    del plane_traces
+    if save:
+        # reopen the written traces read-only
+        for key in COMBINED_TRACES:
+            traces[key].flush()
+            traces[key] = np.load(os.path.join(fpath, f"{key}.npy"), mmap_mode="r")
+    F, Fneu, spks = traces["F"], traces["Fneu"], traces["spks"]
+    iscell = np.concatenate(iscell) if len(iscell) > 0 else np.zeros((0, 2))
+    redcell = np.concatenate(redcell) if hasred else []
+    table = ROITable.concatenate(tables)
+    stat = table.to_stat()
     
     db["meanImg"] = meanImg
     db["meanImgE"] = meanImgE
@@ -312,11 +344,6 @@ def combined(save_folder, save=True):
     db["xrange"] = [0, db["Lx"]]
     db["yrange"] = [0, db["Ly"]]
 
-    fpath = os.path.join(save_folder, "combined")
-
-    if not os.path.isdir(fpath):
-        os.makedirs(fpath)
-
     db["save_path"] = fpath
 
     # need to save iscell regardless (required for GUI function)
@@ -327,12 +354,11 @@ def combined(save_folder, save=True):
         redcell = np.zeros_like(iscell)
 
     if save:
-        np.save(os.path.join(fpath, "F.npy"), F)
-        np.save(os.path.join(fpath, "Fneu.npy"), Fneu)
-        np.save(os.path.join(fpath, "spks.npy"), spks)
         np.save(os.path.join(fpath, "db.npy"), db)
         np.save(os.path.join(fpath, "stat.npy"), stat)
         np.save(os.path.join(fpath, "settings.npy"), settings)
+        if settings["io"].get("save_columnar", True):
+            save_results(fpath, stat=table, db=db, settings=settings)
 
         # save as matlab file
         if settings["io"]["save_mat"]:
@@ -0,0 +1,388 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import json
+import glob
+import pickle
+import datetime
+from pathlib import Path, PurePath
+from natsort import natsorted
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+from ..detection.roitable import ROITable
+from ..version import version
+
+# Pickle-free results store of a plane (or combined) folder:
+#   rois/ : columns of the ROITable of stat as .npy files, listed in rois/columns.json
+#   metadata.json : db, settings, reg_outputs and detect_outputs, with the
+#                   arrays saved as .npy files in metadata/
+# The traces (F.npy, Fneu.npy, spks.npy, ...) are already plain arrays and are
+# read with memory mapping.
+ROI_FOLDER = "rois"
+ROI_COLUMNS_FILE = "columns.json"
+METADATA_FILE = "metadata.json"
+METADATA_FOLDER = "metadata"
+METADATA_SECTIONS = ["db", "settings", "reg_outputs", "detect_outputs"]
+TRACE_KEYS = ["F", "Fneu", "spks", "F_chan2", "Fneu_chan2", "iscell", "redcell"]
+
+# arrays with at most this many elements are stored in metadata.json
+MAX_INLINE_SIZE = 64
+
+
+class _CrossPlatformUnpickler(pickle.Unpickler):
+    """Unpickler that handles PosixPath/WindowsPath across platforms."""
+
+    def find_class(self, module, name):
+        if name == "PosixPath" or name == "WindowsPath":
+            return Path
+        return super().find_class(module, name)
+
+def _load_npy_cross_platform(path):
+    """Load a .npy file that may contain Path objects from a different OS."""
+    with open(path, "rb") as f:
+        major, _ = np.lib.format.read_magic(f)
+        read_header = (np.lib.format.read_array_header_1_0 if major == 1
+                       else np.lib.format.read_array_header_2_0)
+        shape, fortran, dtype = read_header(f)
+        if dtype.hasobject:
+            return _CrossPlatformUnpickler(f).load()
+    return np.load(path, allow_pickle=False)
+
+
+def _to_json(obj, name, folder):
+    """ JSON-compatible version of obj, saving large arrays to folder as name.npy """
+    if isinstance(obj, dict):
+        return {str(key): _to_json(val, f"{name}.{key}", folder) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)) or (isinstance(obj, np.ndarray) and obj.dtype == object):
+        return [_to_json(val, f"{name}.{i}", folder) for i, val in enumerate(obj)]
+    elif isinstance(obj, np.ndarray):
+        if obj.size <= MAX_INLINE_SIZE:
+            return {"__ndarray__": obj.tolist(), "dtype": obj.dtype.str, "shape": obj.shape}
+        fname = f"{name}.npy".replace(os.sep, "_")
+        np.save(os.path.join(folder, fname), obj)
+        return {"__npy__": fname}
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    elif isinstance(obj, PurePath):
+        return str(obj)
+    elif obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    logger.warning(f"{name} of type {type(obj).__name__} saved as string in results store")
+    return str(obj)
+
+
+def _from_json(obj, folder, mmap_mode="r"):
+    """ inverse of _to_json, with arrays of .npy files memory-mapped """
+    if isinstance(obj, dict):
+        if "__npy__" in obj:
+            return np.load(os.path.join(folder, obj["__npy__"]), mmap_mode=mmap_mode)
+        elif "__ndarray__" in obj:
+            return np.array(obj["__ndarray__"], dtype=obj["dtype"]).reshape(obj["shape"])
+        elif "__datetime__" in obj:
+            return datetime.datetime.fromisoformat(obj["__datetime__"])
+        return {key: _from_json(val, folder, mmap_mode) for key, val in obj.items()}
+    elif isinstance(obj, list):
+        return [_from_json(val, folder, mmap_mode) for val in obj]
+    return obj
+
+
+def _write_json(fname, obj):
+    """ write obj to fname atomically """
+    with open(fname + ".tmp", "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(fname + ".tmp", fname)
+
+
+def has_store(save_path):
+    """
+    Whether save_path has an up-to-date results store.
+
+    The store is ignored if stat.npy was saved after it (e.g. by a version
+    of suite2p or of the GUI that only saves stat.npy).
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+
+    Returns
+    -------
+    found : bool
+        True if the ROIs and metadata of the store can be used.
+    """
+    columns_file = os.path.join(save_path, ROI_FOLDER, ROI_COLUMNS_FILE)
+    if not (os.path.exists(columns_file) and
+            os.path.exists(os.path.join(save_path, METADATA_FILE))):
+        return False
+    stat_file = os.path.join(save_path, "stat.npy")
+    return (not os.path.exists(stat_file) or
+            os.stat(stat_file).st_mtime_ns <= os.stat(columns_file).st_mtime_ns)
+
+
+def save_rois(save_path, stat):
+    """
+    Save ROIs to the rois/ folder of the results store.
+
+    Each column of the ROITable is saved as a separate .npy file: the flat
+    pixel arrays ("ypix", "xpix", "lam", "offsets" and per-pixel columns),
+    numeric per-ROI columns, and ragged per-ROI columns as flat arrays with
+    offsets. Other values are stored in columns.json.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+    stat : numpy.ndarray or ROITable
+        ROI statistics dictionaries or ROITable.
+    """
+    table = stat if isinstance(stat, ROITable) else ROITable.from_stat(stat)
+    folder = os.path.join(save_path, ROI_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    for fname in [os.path.join(folder, ROI_COLUMNS_FILE)] + glob.glob(os.path.join(folder, "*.npy")):
+        if os.path.exists(fname):
+            os.remove(fname)
+    for key in ["ypix", "xpix", "lam", "offsets"]:
+        np.save(os.path.join(folder, f"{key}.npy"), getattr(table, key))
+    for key, column in table.pixel_columns.items():
+        np.save(os.path.join(folder, f"pixel.{key}.npy"), column)
+
+    columns, ragged_columns, json_columns = [], [], {}
+    for key, column in table.columns.items():
+        if column.dtype != object:
+            np.save(os.path.join(folder, f"column.{key}.npy"), column)
+            columns.append(key)
+            continue
+        values = [None if v is None else np.asarray(v) for v in column]
+        if all(v is not None and v.ndim == 1 and v.dtype.kind in "biuf" for v in values):
+            offsets = np.zeros(len(values) + 1, "int64")
+            offsets[1:] = np.cumsum([v.size for v in values])
+            flat = np.concatenate(values) if len(values) else np.zeros(0)
+            np.save(os.path.join(folder, f"ragged.{key}.npy"), flat)
+            np.save(os.path.join(folder, f"ragged.{key}.offsets.npy"), offsets)
+            ragged_columns.append(key)
+        else:
+            json_columns[key] = _to_json(list(column), f"json.{key}", folder)
+    # written last, so that an interrupted save is not used
+    _write_json(os.path.join(folder, ROI_COLUMNS_FILE), {
+        "version": version, "n_rois": len(table),
+        "pixel_columns": list(table.pixel_columns), "columns": columns,
+        "ragged_columns": ragged_columns, "json_columns": json_columns,
+        "list_columns": sorted(table.list_columns)})
+
+
+def load_rois(save_path, mmap_mode="r"):
+    """
+    Load the ROIs of the results store as an ROITable.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+    mmap_mode : str or None, optional (default "r")
+        Memory-mapping mode of the column arrays (see numpy.load).
+
+    Returns
+    -------
+    table : ROITable
+        ROIs, with memory-mapped columns.
+    """
+    folder = os.path.join(save_path, ROI_FOLDER)
+    with open(os.path.join(folder, ROI_COLUMNS_FILE), "r") as f:
+        info = json.load(f)
+    load = lambda fname: np.load(os.path.join(folder, fname), mmap_mode=mmap_mode)
+    columns = {key: load(f"column.{key}.npy") for key in info["columns"]}
+    for key in info["ragged_columns"]:
+        flat, offsets = load(f"ragged.{key}.npy"), load(f"ragged.{key}.offsets.npy")
+        column = np.empty(info["n_rois"], dtype=object)
+        for k in range(info["n_rois"]):
+            column[k] = np.asarray(flat[offsets[k] : offsets[k + 1]])
+        columns[key] = column
+    for key, values in info["json_columns"].items():
+        column = np.empty(info["n_rois"], dtype=object)
+        for k, value in enumerate(_from_json(values, folder, mmap_mode)):
+            column[k] = value
+        columns[key] = column
+    return ROITable(load("ypix.npy"), load("xpix.npy"), load("lam.npy"), load("offsets.npy"),
+                    pixel_columns={key: load(f"pixel.{key}.npy")
+                                   for key in info["pixel_columns"]},
+                    columns=columns, list_columns=info["list_columns"])
+
+
+def save_metadata(save_path, **sections):
+    """
+    Save metadata dictionaries to metadata.json of the results store.
+
+    Arrays with more than MAX_INLINE_SIZE elements are saved as .npy files
+    in the metadata/ folder, and datetimes and paths as strings.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+    **sections : dict
+        Dictionaries to save, e.g. db=db, settings=settings. Sections not
+        given are kept from a previous save.
+    """
+    folder = os.path.join(save_path, METADATA_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    metadata_file = os.path.join(save_path, METADATA_FILE)
+    metadata = {}
+    if os.path.exists(metadata_file):
+        with open(metadata_file, "r") as f:
+            metadata = json.load(f)
+    for section, values in sections.items():
+        if values is None:
+            continue
+        for fname in glob.glob(os.path.join(folder, f"{section}.*.npy")):
+            os.remove(fname)
+        metadata[section] = _to_json(values, section, folder)
+    metadata["version"] = version
+    _write_json(metadata_file, metadata)
+
+
+def load_metadata(save_path, mmap_mode="r"):
+    """
+    Load metadata.json of the results store.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+    mmap_mode : str or None, optional (default "r")
+        Memory-mapping mode of the arrays saved as .npy files.
+
+    Returns
+    -------
+    metadata : dict
+        Dictionaries "db", "settings", "reg_outputs" and "detect_outputs"
+        (empty if they were not saved).
+    """
+    with open(os.path.join(save_path, METADATA_FILE), "r") as f:
+        metadata = json.load(f)
+    folder = os.path.join(save_path, METADATA_FOLDER)
+    return {section: _from_json(metadata.get(section, {}), folder, mmap_mode)
+            for section in METADATA_SECTIONS}
+
+
+def save_results(save_path, stat=None, db=None, settings=None, reg_outputs=None,
+                 detect_outputs=None):
+    """
+    Save the ROIs and metadata of a plane to the results store.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder.
+    stat : numpy.ndarray or ROITable, optional (default None)
+        ROIs, not saved if None.
+    db, settings, reg_outputs, detect_outputs : dict, optional (default None)
+        Metadata dictionaries, not saved if None.
+    """
+    save_metadata(save_path, db=db, settings=settings, reg_outputs=reg_outputs,
+                  detect_outputs=detect_outputs)
+    if stat is not None:
+        save_rois(save_path, stat)
+
+
+def load_stat(save_path):
+    """
+    ROIs of a plane or combined folder, from the results store if up to date,
+    otherwise from stat.npy.
+
+    Returns
+    -------
+    table : ROITable
+        ROIs of the folder.
+    """
+    if has_store(save_path):
+        return load_rois(save_path)
+    return ROITable.from_stat(_load_npy_cross_platform(os.path.join(save_path, "stat.npy")))
+
+
+def load_ops(save_path):
+    """
+    Metadata of a plane or combined folder, from the results store if up to
+    date, otherwise from db.npy, settings.npy, reg_outputs.npy and
+    detect_outputs.npy.
+
+    Returns
+    -------
+    db : dict
+        Database dictionary merged with the registration and detection outputs.
+    settings : dict
+        Pipeline settings dictionary.
+    """
+    if has_store(save_path):
+        metadata = load_metadata(save_path)
+    else:
+        metadata = {}
+        for section in METADATA_SECTIONS:
+            fname = os.path.join(save_path, f"{section}.npy")
+            metadata[section] = (_load_npy_cross_platform(fname).item()
+                                 if os.path.exists(fname) else {})
+    db = {**metadata["db"], **metadata["reg_outputs"], **metadata["detect_outputs"]}
+    return db, metadata["settings"]
+
+
+def load_results(save_path, mmap_mode="r"):
+    """
+    Load the results of a plane or combined folder lazily.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane or combined folder with a results store.
+    mmap_mode : str or None, optional (default "r")
+        Memory-mapping mode of the ROI columns, metadata arrays and traces.
+
+    Returns
+    -------
+    results : dict
+        "stat" (ROITable), the metadata dictionaries (see load_metadata) and
+        the arrays "F", "Fneu", "spks", "F_chan2", "Fneu_chan2", "iscell"
+        and "redcell" (None if not saved).
+    """
+    results = {"stat": load_rois(save_path, mmap_mode), **load_metadata(save_path, mmap_mode)}
+    for key in TRACE_KEYS:
+        fname = os.path.join(save_path, f"{key}.npy")
+        results[key] = np.load(fname, mmap_mode=mmap_mode) if os.path.exists(fname) else None
+    return results
+
+
+def convert_results(save_folder):
+    """
+    Add a results store to existing result folders.
+
+    Converts stat.npy, db.npy, settings.npy, reg_outputs.npy and
+    detect_outputs.npy (pickled files saved on any OS) of save_folder, or of
+    its planeX and combined folders. The original files are kept.
+
+    Parameters
+    ----------
+    save_folder : str
+        Plane folder, or suite2p folder with planeX (and combined) folders.
+
+    Returns
+    -------
+    folders : list of str
+        Converted folders.
+    """
+    folders = [save_folder] + natsorted([
+        f.path for f in os.scandir(save_folder)
+        if f.is_dir() and (f.name[:5] == "plane" or f.name == "combined")])
+    folders = [f for f in folders if os.path.exists(os.path.join(f, "stat.npy"))]
+    for folder in folders:
+        metadata = {}
+        for section in METADATA_SECTIONS:
+            fname = os.path.join(folder, f"{section}.npy")
+            if os.path.exists(fname):
+                metadata[section] = _load_npy_cross_platform(fname).item()
+        stat = _load_npy_cross_platform(os.path.join(folder, "stat.npy"))
+        save_results(folder, stat=stat, **metadata)
+        logger.info(f"converted {folder} ({len(stat)} ROIs)")
+    return folders
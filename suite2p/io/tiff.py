@@ -14,6 +14,9 @@ import numpy as np
 from tifffile import imread, TiffFile, TiffWriter
 
 from . import utils
+from .binary import BinaryFile
+from .manifest import (manifest_header, load_manifest, start_manifest, append_manifest,
+                       converted_files, file_signature)
 
 try:
     from ScanImageTiffReader import ScanImageTiffReader
@@ -141,13 +144,154 @@ def read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff):
 
     return im
 
-def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2):
+def tiff_page_counts(fs, use_sktiff):
+    """
+    Number of pages of each TIFF file.
+
+    Parameters
+    ----------
+    fs : list of str
+        Paths to the TIFF files.
+    use_sktiff : bool
+        If True, use tifffile (TiffFile). If False, use ScanImageTiffReader.
+
+    Returns
+    -------
+    page_counts : numpy.ndarray
+        Number of pages of each file, shape (len(fs),).
+    """
+    page_counts = np.zeros(len(fs), "int64")
+    for ifile, file in enumerate(fs):
+        tif, page_counts[ifile] = open_tiff(file, use_sktiff)
+        tif.close()
+    return page_counts
+
+
+def tiff_routing_table(page_counts, first_files, nplanes, nchannels, batch_size,
+                       functional_chan=1, swap=False, nrois=1):
+    """
+    Destinations of the pages of interleaved TIFF files in the plane binaries.
+
+    Pages are interleaved across planes and channels (channels first, or
+    planes first if swap), restarting at plane 0 with the first file of
+    each folder. Each page of a plane is written to the binaries of all
+    ROIs of the plane (nrois > 1 for mesoscope recordings). The table is
+    built from the page counts only, for files read in batches of
+    batch_size pages.
+
+    Parameters
+    ----------
+    page_counts : numpy.ndarray
+        Number of pages of each file.
+    first_files : numpy.ndarray
+        Boolean array, True for the first file of each folder.
+    nplanes : int
+        Number of planes.
+    nchannels : int
+        Number of channels.
+    batch_size : int
+        Number of pages read at once, multiple of nplanes * nchannels.
+    functional_chan : int, optional (default 1)
+        Channel (1 or 2) with the functional imaging.
+    swap : bool, optional (default False)
+        Whether planes are interleaved before channels.
+    nrois : int, optional (default 1)
+        Number of ROIs per plane.
+
+    Returns
+    -------
+    routes : dict of numpy.ndarray
+        One entry per page and destination, sorted by page: "page" (global
+        page index across files), "file" (index of the file), "plane" (index
+        of the plane folder, iplane * nrois + iroi), "chan" (0 for the
+        functional channel, 1 for the second channel) and "frame" (frame
+        index in the binary of the plane and channel).
+    """
+    ncp = nplanes * nchannels
+    nfunc = functional_chan - 1 if nchannels > 1 else 0
+    chan_offsets = [nfunc, 1 - nfunc][:nchannels]
+    pages, planes, chans = [], [], []
+    istart = np.concatenate(([0], np.cumsum(page_counts)))
+    for ifile, Ltif in enumerate(page_counts):
+        # keep track of the plane identity of the first page (channel identity is assumed always 0)
+        if first_files[ifile]:
+            iplane = 0
+        for ix in range(0, Ltif, batch_size):
+            nframes = min(batch_size, Ltif - ix)
+            for j in range(nplanes):
+                i0 = (nchannels * ((iplane + j) % nplanes) if not swap else
+                      (iplane + j) % ncp)
+                for chan, c in enumerate(chan_offsets):
+                    ipage = np.arange(int(i0) + (swap + 1) * c, nframes, ncp)
+                    pages.append(istart[ifile] + ix + ipage)
+                    planes.append(np.full(len(ipage), j))
+                    chans.append(np.full(len(ipage), chan))
+            if not swap:
+                iplane = (iplane - nframes / nchannels) % nplanes
+            else:
+                iplane = (iplane - nframes) % ncp
+    page = np.concatenate(pages) if pages else np.zeros(0, "int64")
+    plane = np.concatenate(planes) if planes else np.zeros(0, "int64")
+    chan = np.concatenate(chans) if chans else np.zeros(0, "int64")
+    isort = np.argsort(page, kind="stable")
+    page, plane, chan = page[isort], plane[isort], chan[isort]
+    # frames are written in page order to the binary of each plane and channel
+    frame = np.zeros(len(page), "int64")
+    for key in np.unique(plane * 2 + chan):
+        iroute = np.nonzero(plane * 2 + chan == key)[0]
+        frame[iroute] = np.arange(len(iroute))
+    # each page of a plane goes to all of its ROIs
+    routes = {"page": page, "file": np.searchsorted(istart, page, side="right") - 1,
+              "plane": plane, "chan": chan, "frame": frame}
+    routes = {key: np.repeat(value, nrois) for key, value in routes.items()}
+    routes["plane"] = routes["plane"] * nrois + np.tile(np.arange(nrois), len(page))
+    return routes
+
+
+def route_pages(im, ipage, routes, reg_file, reg_file_chan2, line_slices, mean_imgs):
+    """
+    Write a batch of pages to their destinations in the plane binaries.
+
+    Parameters
+    ----------
+    im : numpy.ndarray
+        Pages ipage to ipage + len(im), int16 array of shape (n_pages, Ly, Lx).
+    ipage : int
+        Global index of the first page of im.
+    routes : dict of numpy.ndarray
+        Routing table from tiff_routing_table.
+    reg_file : list of file objects
+        Binary files of the functional channel of each plane.
+    reg_file_chan2 : list of file objects
+        Binary files of the second channel of each plane.
+    line_slices : list of slice
+        Lines of the pages in each plane (ROI of mesoscope recordings).
+    mean_imgs : numpy.ndarray
+        Sums of the frames of each plane and channel, shape (n_planes, 2, ...),
+        updated in-place.
+    """
+    r0, r1 = np.searchsorted(routes["page"], [ipage, ipage + len(im)])
+    dest = routes["plane"][r0:r1] * 2 + routes["chan"][r0:r1]
+    isort = np.argsort(dest, kind="stable")
+    keys, starts = np.unique(dest[isort], return_index=True)
+    for key, iroute in zip(keys, np.split(isort + r0, starts[1:])):
+        jk, chan = divmod(int(key), 2)
+        imk = im[routes["page"][iroute] - ipage, line_slices[jk]]
+        # frames of a plane and channel are consecutive within a batch
+        f = reg_file[jk] if chan == 0 else reg_file_chan2[jk]
+        f.seek(int(routes["frame"][iroute[0]]) * imk[0].nbytes)
+        f.write(bytearray(imk))
+        mean_imgs[jk][chan] += imk.sum(axis=0).astype("float64")
+
+
+def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2, append=False):
     """
     Read TIFF files and write interleaved plane/channel data to binary files.
 
-    Iterates over all TIFF files listed in `dbs[0]["file_list"]`, de-interleaves
-    planes and channels, and writes each plane's frames to the corresponding binary
-    file. Also computes per-plane mean images and frame counts.
+    Iterates over all TIFF files listed in `dbs[0]["file_list"]` and writes
+    each page to the binaries of its plane, channel and ROI, looked up in a
+    routing table built from the page counts of all files (see
+    tiff_routing_table). Also computes per-plane mean images and frame counts.
 
     Parameters
     ----------
@@ -164,6 +308,10 @@ def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2):
     reg_file_chan2 : list of file objects
         Opened binary files for writing each plane's second channel data
         (used only when nchannels > 1).
+    append : bool, optional (default False)
+        Whether to append the files that are not in the conversion manifest
+        to the binaries of a completed conversion. The dbs are then the
+        dbs of the plane folders, with the new "file_list" and "first_files".
 
     Returns
     -------
@@ -175,7 +323,7 @@ def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2):
     t0 = time.time()
         
     fs = dbs[0]["file_list"]
-    first_files = dbs[0]["first_files"]
+    first_files = np.asarray(dbs[0]["first_files"], "bool")
 
     # try tiff readers
     batch_size = dbs[0]["batch_size"]
@@ -186,90 +334,111 @@ def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2):
     nrois = dbs[0].get("nrois", 1)
     batch_size = nplanes * nchannels * math.ceil(batch_size / (nplanes * nchannels))
 
+    # files converted before an interruption are kept (see manifest.py)
+    save_folder = os.path.dirname(dbs[0]["save_path"])
+    header = manifest_header(dbs, "tif", batch_size)
+    binaries = [[reg_file[jk], reg_file_chan2[jk] if nchannels > 1 else None]
+                for jk in range(len(dbs))]
+    binary_sizes = np.array([[os.fstat(f.fileno()).st_size if f is not None else 0
+                              for f in fb] for fb in binaries])
+    manifest = load_manifest(save_folder)
+    ndone = converted_files(manifest, header, fs, binary_sizes, append=append)
+    if append and (manifest is None or ndone < len(manifest["files"])):
+        raise ValueError("cannot append files: the converted files were modified or removed, "
+                         "or the conversion parameters changed")
+    done = manifest["files"][:ndone] if ndone > 0 else []
+
+    page_counts = np.concatenate(([entry["pages"] for entry in done],
+                                  tiff_page_counts(fs[ndone:], use_sktiff))).astype("int64")
+    routes = tiff_routing_table(page_counts, first_files, nplanes, nchannels, batch_size,
+                                functional_chan=dbs[0]["functional_chan"],
+                                swap=dbs[0].get("swap_order", False), nrois=nrois)
+    line_slices = [slice(db["lines"][0], db["lines"][-1] + 1) if nrois > 1 else slice(None)
+                   for db in dbs]
+
+    # frame counts of the functional channel from the routing table
+    prev_nframes = [db.get("nframes", 0) for db in dbs]
+    func = routes["chan"] == 0
+    which_folder = np.cumsum(first_files) - 1
+    for jk, db in enumerate(dbs):
+        iroute = func & (routes["plane"] == jk)
+        db["nframes"] = int(iroute.sum())
+        db["frames_per_file"] = np.bincount(routes["file"][iroute], minlength=len(fs))
+        db["frames_per_folder"] = np.bincount(which_folder[routes["file"][iroute]],
+                                              minlength=first_files.sum())
+    file_frames = np.zeros((len(fs), len(dbs), 2), "int64")
+    np.add.at(file_frames, (routes["file"], routes["plane"], routes["chan"]), 1)
+
+    def set_shape(Ly, Lx):
+        header["Ly"], header["Lx"] = Ly, Lx
+        for db in dbs:
+            db["Ly"] = (db["lines"][-1] + 1 - db["lines"][0]) if nrois > 1 else Ly
+            db["Lx"] = Lx
+        frame_nbytes = np.array([[2 * db["Ly"] * db["Lx"]] for db in dbs])
+        return frame_nbytes * np.cumsum(file_frames, axis=0)
+
+    # keep the frames of the converted files, and their sums for the mean images
+    offsets = np.zeros_like(file_frames)
+    if ndone > 0:
+        logger.info(f"appending {len(fs) - ndone} files to {ndone} converted files" if append
+                    else f"resuming conversion after {ndone} / {len(fs)} files")
+        offsets = set_shape(manifest["Ly"], manifest["Lx"])
+        mean_imgs = [np.zeros((2, db["Ly"], db["Lx"]), "float64") for db in dbs]
+    for jk, fb in enumerate(binaries):
+        for chan, f in enumerate(fb):
+            nbytes = offsets[ndone - 1, jk, chan] if ndone > 0 else 0
+            if f is None:
+                continue
+            f.truncate(nbytes)
+            # mean images of the previous conversion (its frames may be registered since)
+            nkept = file_frames[:ndone, jk, 0].sum()
+            mean_key = "meanImg" if chan == 0 else "meanImg_chan2"
+            if append and nkept > 0 and prev_nframes[jk] == nkept and mean_key in dbs[jk]:
+                mean_imgs[jk][chan] = dbs[jk][mean_key] * nkept
+            elif nbytes > 0:
+                f.flush()
+                with BinaryFile(dbs[jk]["Ly"], dbs[jk]["Lx"], f.name) as f_bin:
+                    for i in range(0, f_bin.shape[0], batch_size):
+                        mean_imgs[jk][chan] += f_bin[i : i + batch_size].sum(axis=0,
+                                                                             dtype="float64")
+    start_manifest(save_folder, header, done)
+
     # loop over all tiffs
-    which_folder = -1
-    ntotal = 0
-    swap = dbs[0].get("swap_order", False)
-    for ifile, file in enumerate(fs):
+    ntotal = int(page_counts[:ndone].sum())
+    for ifile in range(ndone, len(fs)):
+        file = fs[ifile]
         # open tiff
         tif, Ltif = open_tiff(file, use_sktiff)
-        # keep track of the plane identity of the first frame (channel identity is assumed always 0)
-        if first_files[ifile]:
-            which_folder += 1
-            iplane = 0
         ix = 0
         while 1:
             im = read_tiff(file, tif, Ltif, ix, batch_size, use_sktiff)
             if im is None:
                 break          
-            nframes = im.shape[0]
-            for j in range(0, nplanes):
-                if ifile == 0 and ix == 0:
-                    Ly, Lx = im.shape[1], im.shape[2]
-                    for k in range(nrois):
-                        jk = j*nrois + k
-                        Ly = (dbs[jk]["lines"][-1] + 1 - dbs[jk]["lines"][0] 
-                              if nrois > 1 else Ly)
-                        dbs[jk]["Ly"], dbs[jk]["Lx"] = Ly, Lx
-                        dbs[jk]["nframes"] = 0
-                        dbs[jk]["frames_per_file"] = np.zeros(len(fs), "int")
-                        dbs[jk]["frames_per_folder"] = np.zeros(first_files.sum(), "int")
-                        dbs[jk]["meanImg"] = np.zeros((Ly, Lx), "float64")
-                        if nchannels > 1:
-                            dbs[jk]["meanImg_chan2"] = np.zeros((Ly, Lx), "float64")
-
-                if not swap:
-                    i0 = nchannels * ((iplane + j) % nplanes)
-                else:
-                    i0 = (iplane + j) % (nplanes*nchannels)
-
-                if nchannels > 1:
-                    nfunc = dbs[jk]["functional_chan"] - 1
-                else:
-                    nfunc = 0
-
-                #print(i0, int(i0) + (swap+1)*nfunc)
-
-                im2write = im[int(i0) + (swap+1)*nfunc:nframes:nplanes * nchannels]
-                
-                for k in range(nrois):
-                    jk = j*nrois + k
-                    if nrois > 1:
-                        imk = im2write[:, dbs[jk]["lines"][0] : dbs[jk]["lines"][-1] + 1]
-                    else:
-                        imk = im2write
-                    reg_file[jk].write(bytearray(imk))
-                    dbs[jk]["meanImg"] += imk.sum(axis=0).astype("float64")
-                    dbs[jk]["nframes"] += imk.shape[0]
-                    dbs[jk]["frames_per_file"][ifile] += imk.shape[0]
-                    dbs[jk]["frames_per_folder"][which_folder] += imk.shape[0]
-                    
-                if nchannels > 1:
-                    #print(int(i0) + (swap+1)*(1 - nfunc))
-                    im2write = im[int(i0) + (swap+1)*(1 - nfunc):nframes:nplanes * nchannels]
-                    for k in range(nrois):
-                        jk = j*nrois + k
-                        if nrois > 1:
-                            imk = im2write[:, dbs[jk]["lines"][0] : dbs[jk]["lines"][-1] + 1]
-                        else:
-                            imk = im2write
-                        reg_file_chan2[jk].write(bytearray(imk))
-                        dbs[jk]["meanImg_chan2"] += imk.sum(axis=0).astype("float64")
-            if not swap:
-                iplane = (iplane - nframes / nchannels) % nplanes
-            else:
-                iplane = (iplane - nframes) % (nchannels * nplanes)
-            ix += nframes
-            ntotal += nframes
+            if "Ly" not in header:
+                offsets = set_shape(im.shape[1], im.shape[2])
+                mean_imgs = [np.zeros((2, db["Ly"], db["Lx"]), "float64") for db in dbs]
+                start_manifest(save_folder, header)
+            route_pages(im, ntotal, routes, reg_file, reg_file_chan2, line_slices, mean_imgs)
+            ix += im.shape[0]
+            ntotal += im.shape[0]
             if ntotal % (batch_size * 4) == 0:
                 logger.info("%d frames of binary, time %0.2f sec." %
                       (ntotal, time.time() - t0))
+        tif.close()
+        # record the file once its frames are on disk
+        for f in sum(binaries, []):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+        append_manifest(save_folder, {**file_signature(file), "pages": int(Ltif),
+                                      "frames": file_frames[ifile].tolist(),
+                                      "offsets": offsets[ifile].tolist()})
         gc.collect()
     # write dbs and settings files
-    for db in dbs:
-        db["meanImg"] /= db["nframes"]
+    for db, mean_img in zip(dbs, mean_imgs):
+        db["meanImg"] = mean_img[0] / db["nframes"]
         if nchannels > 1:
-            db["meanImg_chan2"] /= db["nframes"]
+            db["meanImg_chan2"] = mean_img[1] / db["nframes"]
         np.save(db["db_path"], db)
         np.save(db["settings_path"], settings)
     
@@ -278,6 +447,7 @@ def tiff_to_binary(dbs, settings, reg_file, reg_file_chan2):
         reg_file[jk].close()
         if nchannels > 1:
             reg_file_chan2[jk].close()
+    append_manifest(save_folder, {"complete": True})
     return dbs
 
 def ome_to_binary(dbs, settings, reg_file, reg_file_chan2):
@@ -14,6 +14,7 @@ from natsort import natsorted
 
 EXTS = {"tif": ["*.tif", "*.tiff", "*.TIF", "*.TIFF"],
         "h5": ["*.h5", "*.hdf5", "*.mesc"],
+        "nwb": ["*.nwb"],
         "sbx": ["*.sbx"],
         "nd2": ["*.nd2"],
         "dcimg": ["*.dcimg"],
@@ -0,0 +1,283 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import torch
+import logging
+import logging.handlers
+logger = logging.getLogger(__name__)
+
+from .extraction.traces import TRACES_PER_ROI
+
+# environment variables limiting the threads of OpenMP and BLAS libraries
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# number of times a plane is rerun after its worker process died
+PLANE_RETRIES = 1
+
+
+def available_memory():
+    """
+    Available RAM in GB.
+
+    Returns
+    -------
+    memory : float
+        Available RAM in GB, or inf if it cannot be determined.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 2**30
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**30
+    except (ValueError, OSError, AttributeError):
+        return np.inf
+
+
+def plane_memory(db, settings):
+    """
+    Estimate of the peak RAM used to process a plane, in GB.
+
+    Counts the binned movie used for detection (and its copies during
+    detection), the registration batches, and the traces of the ROIs (up to
+    the memory budget of the trace post-processing).
+
+    Parameters
+    ----------
+    db : dict
+        Database dictionary of the plane, with "Ly", "Lx" and "nframes".
+    settings : dict
+        Pipeline settings dictionary.
+
+    Returns
+    -------
+    memory : float
+        Estimated memory in GB.
+    """
+    npix = db["Ly"] * db["Lx"]
+    bin_size = settings["detection"].get("bin_size", None)
+    bin_size = bin_size or max(1, int(settings["tau"] * settings["fs"]))
+    nbinned = min(settings["detection"].get("nbins", 5000), db["nframes"] // bin_size)
+    nbatch = settings["registration"].get("batch_size", 100)
+    nbytes = 4 * npix * (3 * nbinned + 6 * nbatch)
+    # traces of at most one ROI per 100 pixels, up to the post-processing budget
+    traces = min(TRACES_PER_ROI * 4 * db["nframes"] * npix / 100 / 2**30,
+                 settings["extraction"].get("memory_budget", 4.))
+    return nbytes / 2**30 + traces
+
+
+def worker_devices(torch_device):
+    """
+    Torch devices the planes are distributed over.
+
+    Parameters
+    ----------
+    torch_device : str
+        Device of the pipeline settings, e.g. "cuda", "cuda:1" or "cpu".
+
+    Returns
+    -------
+    devices : list of str
+        All visible GPUs if torch_device is "cuda", otherwise [torch_device].
+    """
+    if torch_device == "cuda" and torch.cuda.is_available() and torch.cuda.device_count() > 1:
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return [torch_device]
+
+
+def limit_threads(n_threads):
+    """
+    Limit the threads used by torch, numba and the OpenMP / BLAS libraries of this process.
+
+    Parameters
+    ----------
+    n_threads : int
+        Maximum number of threads.
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    torch.set_num_threads(n_threads)
+    try:
+        import numba
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    except (ImportError, ValueError):
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+
+
+class _PlaneFilter(logging.Filter):
+    """ prefix log messages with the plane index """
+
+    def __init__(self, ipl):
+        super().__init__()
+        self.ipl = ipl
+
+    def filter(self, record):
+        record.msg = f"[plane {self.ipl}] {record.getMessage()}"
+        record.args = None
+        return True
+
+
+class _LogForwarder(logging.Handler):
+    """ handle records sent by the workers with the loggers of the main process """
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _run_plane_worker(ipl, db_path, settings, device, n_threads, log_queue):
+    """
+    Run run_plane for one plane in a worker process.
+
+    Returns
+    -------
+    plane_times : dict or None
+        Timings of the plane, None if it failed.
+    error : str or None
+        Traceback of the error if the plane failed.
+    """
+    limit_threads(n_threads)
+    # send the records of the suite2p loggers to the main process
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(_PlaneFilter(ipl))
+    s2p_logger = logging.getLogger("suite2p")
+    s2p_logger.handlers = [handler]
+    s2p_logger.setLevel(logging.DEBUG)
+    s2p_logger.propagate = False
+    try:
+        from .run_s2p import run_plane
+        db = np.load(db_path, allow_pickle=True).item()
+        outputs = run_plane(db=db, settings={**settings, "torch_device": device},
+                            db_path=db_path)
+        return outputs[-1], None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def run_planes_parallel(db_paths, settings, n_workers=2, threads_per_worker=0,
+                        memory_limit=0., skip=()):
+    """
+    Run run_plane on several planes concurrently in a local process pool.
+
+    Planes are started in order whenever a worker is free and the estimated
+    memory of the running planes (see plane_memory) plus the next plane fits
+    in memory_limit; a plane is always started if no other plane is running.
+    Each plane runs on the least used device of worker_devices, with its
+    threads limited to threads_per_worker. The log records of the workers are
+    handled by the suite2p loggers of this process, prefixed with the plane.
+    A failing plane is reported and does not stop the other planes. If a
+    worker process dies (e.g. out of memory), the pool is restarted and the
+    planes that were running are rerun one at a time, so that only the plane
+    that crashed is reported as failed (after PLANE_RETRIES reruns).
+
+    Parameters
+    ----------
+    db_paths : list of str
+        Paths to the db.npy file of each plane.
+    settings : dict
+        Pipeline settings dictionary.
+    n_workers : int, optional (default 2)
+        Maximum number of planes processed at once.
+    threads_per_worker : int, optional (default 0)
+        Threads per worker; if 0, the CPU cores are split between the workers.
+    memory_limit : float, optional (default 0.)
+        RAM in GB for the planes running at once; if 0, the available RAM.
+    skip : sequence of int, optional (default ())
+        Indices of planes not to process (e.g. flyback planes).
+
+    Returns
+    -------
+    errors : dict
+        Traceback of the error for each plane index, or None if the plane
+        finished.
+    """
+    planes = [ipl for ipl in range(len(db_paths)) if ipl not in skip]
+    n_workers = int(max(1, min(n_workers, len(planes))))
+    n_threads = int(threads_per_worker or max(1, (os.cpu_count() or 1) // n_workers))
+    memory_limit = memory_limit or available_memory()
+    devices = worker_devices(settings["torch_device"])
+    memory = {ipl: plane_memory(np.load(db_paths[ipl], allow_pickle=True).item(), settings)
+              for ipl in planes}
+    logger.info(f"Running {len(planes)} planes with {n_workers} workers, {n_threads} threads "
+                f"per worker, on {devices}, memory limit {memory_limit:.1f} GB")
+
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager()
+    log_queue = manager.Queue()
+    listener = logging.handlers.QueueListener(log_queue, _LogForwarder())
+    listener.start()
+    errors, pending, running = {}, list(planes), {}
+    retries = {ipl: 0 for ipl in planes}
+    device_load = {device: 0 for device in devices}
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+    try:
+        while pending or running:
+            # admit planes while workers are free and memory allows
+            while pending and len(running) < n_workers:
+                ipl = pending[0]
+                # planes rerun after a worker died run alone
+                if running and (retries[ipl] > 0 or
+                                any(retries[running[future][0]] > 0 for future in running)):
+                    break
+                used = sum(memory[running[future][0]] for future in running)
+                if running and used + memory[ipl] > memory_limit:
+                    break
+                device = min(device_load, key=device_load.get)
+                future = executor.submit(_run_plane_worker, ipl, db_paths[ipl], settings,
+                                         device, n_threads, log_queue)
+                running[future] = (ipl, device)
+                device_load[device] += 1
+                pending.pop(0)
+                logger.info(f">>>>>>>>>>>>>>>>>>>>> PLANE {ipl} started on {device} "
+                            f"({memory[ipl]:.1f} GB estimated) <<<<<<<<<<<<<<<<<<<<<<")
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            crashed = []
+            for future in done:
+                ipl, device = running.pop(future)
+                device_load[device] -= 1
+                try:
+                    plane_times, errors[ipl] = future.result()
+                except BrokenProcessPool:
+                    crashed.append(ipl)
+                    continue
+                if errors[ipl] is None:
+                    logger.info(f"PLANE {ipl} finished in "
+                                f"{plane_times.get('total_plane_runtime', 0):0.2f} sec.")
+                else:
+                    logger.error(f"PLANE {ipl} failed:\n{errors[ipl]}")
+            if crashed:
+                # a worker died (e.g. out of memory), which breaks the pool and
+                # all the planes running in it: restart the pool and rerun them
+                executor.shutdown(wait=True)
+                crashed += [ipl for ipl, device in running.values()]
+                running, device_load = {}, {device: 0 for device in devices}
+                executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+                rerun = []
+                for ipl in sorted(crashed):
+                    if retries[ipl] < PLANE_RETRIES:
+                        retries[ipl] += 1
+                        rerun.append(ipl)
+                        logger.warning(f"PLANE {ipl} interrupted by a worker process that "
+                                       f"terminated abruptly, running it again")
+                    else:
+                        errors[ipl] = "worker process terminated abruptly"
+                        logger.error(f"PLANE {ipl} failed: {errors[ipl]}")
+                pending = rerun + pending
+    finally:
+        executor.shutdown(wait=True)
+        listener.stop()
+        manager.shutdown()
+    return dict(sorted(errors.items()))
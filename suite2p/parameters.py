@@ -289,7 +289,39 @@ SETTINGS = {
             "min": None,
             "max": None,
             "default": False,
-            "description": "Whether or not to run each plane as a server job.",
+            "description": "Whether or not to run each plane as a separate job (ssh server, local or batch scheduler, see the server argument of run_s2p).",
+        },
+        "n_workers": {
+            "gui_name": "Parallel planes",
+            "type": int,
+            "min": 1,
+            "max": np.inf,
+            "default": 1,
+            "description": "Number of planes processed at once on this machine (in separate processes).",
+        },
+        "threads_per_worker": {
+            "gui_name": "Threads per plane",
+            "type": int,
+            "min": 0,
+            "max": np.inf,
+            "default": 0,
+            "description": "Threads used by each parallel plane (0 splits the CPU cores between the planes).",
+        },
+        "memory_limit": {
+            "gui_name": "Memory limit (GB)",
+            "type": float,
+            "min": 0.,
+            "max": np.inf,
+            "default": 0.,
+            "description": "RAM (in GB) for the planes running at once; a plane only starts if its estimated memory fits (0 uses the available RAM).",
+        },
+        "stage_cache": {
+            "gui_name": "Reuse unchanged stages",
+            "type": bool,
+            "min": None,
+            "max": None,
+            "default": True,
+            "description": "Whether to keep the outputs of previous runs and only re-run the stages (registration with raw binary, detection, extraction, deconvolution, classification) whose inputs or settings changed.",
         },
     },
     "io": {
@@ -325,6 +357,14 @@ SETTINGS = {
             "default": True,
             "description": "Whether to save db, settings, reg_outputs, detection_outputs into ops.npy.",
         },
+        "save_columnar": {
+            "gui_name": "Save columnar results",
+            "type": bool,
+            "min": None,
+            "max": None,
+            "default": True,
+            "description": "Whether to also save the ROIs and metadata in a pickle-free results store (rois/ folder and metadata.json), which is memory-mapped when loading.",
+        },
         "delete_bin": {
             "gui_name": "Delete binary",
             "type": bool,
@@ -522,6 +562,14 @@ SETTINGS = {
             "default": (64, 64),
             "description": "Block size for denoising.",
         },
+        "svd_method": {
+            "gui_name": "SVD method",
+            "type": str,
+            "min": None,
+            "max": None,
+            "default": "full",
+            "description": "Method for the SVD in sourcery and PCA denoising ['full', 'randomized'] ('randomized' runs a batched randomized SVD on the torch device).",
+        },
         "nbins": {
             "gui_name": "Max binned frames",
             "type": int,
@@ -844,6 +892,14 @@ SETTINGS = {
             "default": False,
             "description": "Force neuropil_masks to be circular instead of square (slow).",
         },
+        "memory_budget": {
+            "gui_name": "Trace memory (GB)",
+            "type": float,
+            "min": 0.,
+            "max": np.inf,
+            "default": 4.,
+            "description": "Memory (in GB) for the traces processed at once after extraction (SNR, statistics, deconvolution); traces are read from F.npy and Fneu.npy in chunks of ROIs.",
+        },
     },
     "dcnv_preprocess": {
         "baseline": {
@@ -10,23 +10,26 @@ from getpass import getpass
 import pathlib
 import contextlib
 import numpy as np
-from scipy.stats import skew
 import torch
 import logging 
 logger = logging.getLogger(__name__)
 
 
 from . import extraction, registration, detection, classification, default_settings, default_db
+from . import stage_cache
 from .registration import zalign
 
 def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
              run_registration=True, settings=default_settings(), badframes=None, stat=None,
-             device=torch.device("cuda"), Zstack=None):
+             device=torch.device("cuda"), Zstack=None, cache=False):
     """
     Run suite2p processing pipeline on an array or BinaryFile.
 
     Runs registration, ROI detection, signal extraction, spike deconvolution,
-    and classification sequentially on a single plane.
+    and classification sequentially on a single plane. With cache, the
+    hash of the inputs of each stage is saved in stage_cache.npy, and stages
+    whose inputs (data, upstream stages and settings section) are unchanged
+    load their outputs from save_path instead of running again.
 
     Parameters
     ----------
@@ -57,6 +60,8 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     Zstack : list, optional (default None)
         Dense Z-stack used for Z-position estimation, via 
         correlation with f_reg per frame.
+    cache : bool, optional (default False)
+        Whether to skip the stages with unchanged inputs (see stage_cache).
 
     Returns
     -------
@@ -98,10 +103,26 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     else:
         classfile, ctype = classification.user_classfile, "default"
     logger.info(f"NOTE: applying {ctype} classifier: {classfile}")
-    
+
+    # hashes of the inputs of the stages completed by previous runs
+    if cache:
+        hashes = stage_cache.load_stage_hashes(save_path)
+        reg_key = stage_cache.stage_hash(settings["registration"], badframes,
+                                         stage_cache.data_signature(f_raw),
+                                         stage_cache.data_signature(f_raw_chan2))
+        if (not run_registration and f_raw is not None and settings["run"]["do_registration"]
+                and hashes.get("registration", reg_key) != reg_key):
+            logger.info("registration settings changed, re-running registration from raw binary")
+            run_registration = True
+    else:
+        hashes, reg_key = {}, None
+        if os.path.exists(os.path.join(save_path, stage_cache.CACHE_FILE)):
+            os.remove(os.path.join(save_path, stage_cache.CACHE_FILE))
+
     if run_registration:
         t11 = time.time()
         logger.info("----------- REGISTRATION")
+        stage_cache.start_stage(save_path, hashes, "registration")
         align_by_chan2 = settings["registration"]["align_by_chan2"]
         reg_outputs = registration.registration_wrapper(
             f_reg, f_raw=f_raw, f_reg_chan2=f_reg_chan2, f_raw_chan2=f_raw_chan2,
@@ -122,6 +143,7 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
             logger.info("Registration metrics, %0.2f sec." %
                   plane_times["registration_metrics"])
             np.save(os.path.join(save_path, "reg_outputs.npy"), reg_outputs)
+        stage_cache.finish_stage(save_path, hashes, "registration", reg_key)
     else:
         try:
             reg_outputs = np.load(os.path.join(save_path, "reg_outputs.npy"), allow_pickle=True).item()
@@ -139,6 +161,10 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     
     yrange, xrange = reg_outputs["yrange"], reg_outputs["xrange"]
     meanImg_chan2 = reg_outputs.get("meanImg_chan2", None)
+    # the registered movie is identified by the signature of its file
+    movie_key = stage_cache.stage_hash(
+        stage_cache.data_signature(f_reg), stage_cache.data_signature(f_reg_chan2),
+        badframes, yrange, xrange, reg_outputs["badframes"]) if cache else None
     
     logger.info("----------- ROI DETECTION")
     t11 = time.time()
@@ -152,20 +178,40 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
             settings["diameter"] = np.array(settings["diameter"])
         if settings["diameter"].size == 1:
             settings["diameter"] = np.array([settings["diameter"], settings["diameter"]])
-        detect_outputs, stat, redcell = detection.detection_wrapper(f_reg, 
-                                                                    meanImg_chan2=meanImg_chan2,
-                                                    yrange=yrange, xrange=xrange,
-                                                    tau=settings["tau"], fs=settings["fs"],
-                                                    diameter=settings["diameter"],
-                                                settings=settings["detection"], 
-                                                classifier_path=classfile,
-                                                badframes=bad_frames,
-                                                preclassify=settings["classification"]["preclassify"],
-                                                device=device)
-        np.save(os.path.join(save_path, "stat.npy"), stat)
-        np.save(os.path.join(save_path, "detect_outputs.npy"), detect_outputs)
-        if redcell is not None:
-            np.save(os.path.join(save_path, "redcell.npy"), redcell)
+        detect_key = stage_cache.stage_hash(
+            movie_key, settings["detection"], settings["diameter"], settings["tau"],
+            settings["fs"], settings["classification"]["preclassify"],
+            stage_cache.data_signature(classfile)) if cache else None
+        if stage_cache.is_cached(save_path, hashes, "detection", detect_key,
+                                 ["detect_outputs.npy", "stat_detection.npy"]):
+            detect_outputs = np.load(os.path.join(save_path, "detect_outputs.npy"),
+                                     allow_pickle=True).item()
+            detected = np.load(os.path.join(save_path, "stat_detection.npy"),
+                               allow_pickle=True).item()
+            stat, redcell = detected["stat"], detected["redcell"]
+        else:
+            stage_cache.start_stage(save_path, hashes, "detection")
+            detect_outputs, stat, redcell = detection.detection_wrapper(f_reg, 
+                                                                        meanImg_chan2=meanImg_chan2,
+                                                        yrange=yrange, xrange=xrange,
+                                                        tau=settings["tau"], fs=settings["fs"],
+                                                        diameter=settings["diameter"],
+                                                    settings=settings["detection"], 
+                                                    classifier_path=classfile,
+                                                    badframes=bad_frames,
+                                                    preclassify=settings["classification"]["preclassify"],
+                                                    device=device)
+            np.save(os.path.join(save_path, "stat.npy"), stat)
+            np.save(os.path.join(save_path, "detect_outputs.npy"), detect_outputs)
+            if redcell is not None:
+                np.save(os.path.join(save_path, "redcell.npy"), redcell)
+            if cache:
+                # ROIs before SNR removal, for re-running extraction only
+                np.save(os.path.join(save_path, "stat_detection.npy"),
+                        {"stat": stat, "redcell": redcell})
+            stage_cache.finish_stage(save_path, hashes, "detection", detect_key)
+    else:
+        detect_key = stage_cache.stage_hash(movie_key, stat) if cache else None
         
     plane_times["detection"] = time.time() - t11
     logger.info("----------- Total %0.2f sec." % plane_times["detection"])
@@ -178,66 +224,108 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     logger.info("----------- EXTRACTION")
     t11 = time.time()
     snr_threshold = settings["extraction"]["snr_threshold"]
-    for step in range(1 + (snr_threshold > 0)):
+    neuropil_coefficient = settings["extraction"]["neuropil_coefficient"]
+    memory_budget = settings["extraction"]["memory_budget"]
+    trace_keys = ["F", "Fneu"] + (["F_chan2", "Fneu_chan2"] if f_reg_chan2 is not None else [])
+    extract_key = stage_cache.stage_hash(detect_key, {key: val for key, val in
+        settings["extraction"].items() if key != "memory_budget"}) if cache else None
+    if stage_cache.is_cached(save_path, hashes, "extraction", extract_key,
+                             ["stat.npy"] + [f"{key}.npy" for key in trace_keys]):
+        stat = np.load(os.path.join(save_path, "stat.npy"), allow_pickle=True)
+        if redcell is not None:
+            redcell = np.load(os.path.join(save_path, "redcell.npy"))
+        traces = {key: np.load(os.path.join(save_path, f"{key}.npy"), mmap_mode="r")
+                  for key in trace_keys}
+        F, Fneu = traces["F"], traces["Fneu"]
+        F_chan2, Fneu_chan2 = traces.get("F_chan2", None), traces.get("Fneu_chan2", None)
+        del traces
+    else:
+        stage_cache.start_stage(save_path, hashes, "extraction")
+        Ly, Lx = f_reg.shape[-2:]
+        cell_masks, neuropil_masks = extraction.create_mask_matrices(
+            stat, Ly, Lx, **{key: settings["extraction"][key] for key in extraction.MASK_SETTINGS})
         F, Fneu, F_chan2, Fneu_chan2 = extraction.extraction_wrapper(
-            stat, f_reg, f_reg_chan2=f_reg_chan2, settings=settings["extraction"],
-            device=device)
-        # subtract neuropil
-        dF = F.copy() - settings["extraction"]["neuropil_coefficient"] * Fneu
-        # remove ROIs with low SNR and recompute overlapping pixels
-        snr = 1 - 0.5 * np.diff(dF, axis=1).var(axis=1) / dF.var(axis=1)
-        keep_rois = snr > snr_threshold
-        nremove = (~keep_rois).sum()
-        if step==0 and snr_threshold > 0 and nremove > 0:
-            logger.info(f"Removing {nremove} ROIs with snr < {snr_threshold}")
-            stat = stat[keep_rois]
-            redcell = redcell[keep_rois] if redcell is not None else None
-            if redcell is not None:
-                np.save(os.path.join(save_path, "redcell.npy"), redcell)
-            Ly, Lx = f_reg.shape[-2:]
-            stat = detection.assign_overlaps(stat, Ly, Lx)
-            logger.info("Running second extraction with updated overlap pixels")
-        else:
-            # do not run second extraction step
-            break
-    # compute activity statistics for classifier
-    sk, sd = skew(dF, axis=1), np.std(dF, axis=1)
-    for k, s in enumerate(stat):
-        s["snr"], s["skew"], s["std"] = snr[k], sk[k], sd[k]
-    np.save(os.path.join(save_path, "stat.npy"), stat)
+            stat, f_reg, f_reg_chan2=f_reg_chan2, cell_masks=cell_masks,
+            neuropil_masks=neuropil_masks, settings=settings["extraction"], device=device)
+        if snr_threshold > 0:
+            # remove ROIs with low SNR and recompute overlapping pixels
+            snr = extraction.trace_statistics(F, Fneu, neuropil_coefficient, memory_budget)[0]
+            keep_rois = snr > snr_threshold
+            nremove = (~keep_rois).sum()
+            if nremove > 0:
+                logger.info(f"Removing {nremove} ROIs with snr < {snr_threshold}")
+                stat = stat[keep_rois]
+                redcell = redcell[keep_rois] if redcell is not None else None
+                if redcell is not None:
+                    np.save(os.path.join(save_path, "redcell.npy"), redcell)
+                stat = detection.assign_overlaps(stat, Ly, Lx)
+                logger.info("Re-extracting ROIs with updated overlap pixels")
+                (F, Fneu, F_chan2, Fneu_chan2,
+                 cell_masks, neuropil_masks) = extraction.reextract_changed_rois(
+                    stat, f_reg, keep_rois, cell_masks, neuropil_masks, F, Fneu,
+                    f_reg_chan2=f_reg_chan2, F_chan2=F_chan2, Fneu_chan2=Fneu_chan2,
+                    settings=settings["extraction"], device=device)
+
+        # save traces, and process them from disk in chunks of ROIs
+        traces = {"F": F, "Fneu": Fneu, "F_chan2": F_chan2, "Fneu_chan2": Fneu_chan2}
+        for key in traces:
+            if traces[key] is not None:
+                np.save(os.path.join(save_path, f"{key}.npy"), traces[key])
+                traces[key] = np.load(os.path.join(save_path, f"{key}.npy"), mmap_mode="r")
+        F, Fneu, F_chan2, Fneu_chan2 = traces.values()
+        del traces
+
+        # compute activity statistics for classifier
+        snr, sk, sd = extraction.trace_statistics(F, Fneu, neuropil_coefficient, memory_budget)
+        for k, s in enumerate(stat):
+            s["snr"], s["skew"], s["std"] = snr[k], sk[k], sd[k]
+        np.save(os.path.join(save_path, "stat.npy"), stat)
+        stage_cache.finish_stage(save_path, hashes, "extraction", extract_key)
     plane_times["extraction"] = time.time() - t11
     logger.info("----------- Total %0.2f sec." % plane_times["extraction"])
 
     if settings["run"]["do_deconvolution"]:
         logger.info("----------- SPIKE DECONVOLUTION")
         t11 = time.time()
-        dF = F.copy() - settings["extraction"]["neuropil_coefficient"] * Fneu
-        dF = extraction.preprocess(F=dF, fs=settings["fs"], batch_size=settings["extraction"]["batch_size"],
-                                   device=device, **settings["dcnv_preprocess"])
-        spks = extraction.oasis(F=dF, batch_size=settings["extraction"]["batch_size"],
-                                tau=settings["tau"], fs=settings["fs"])
+        dcnv_key = stage_cache.stage_hash(
+            extract_key, settings["dcnv_preprocess"], settings["tau"], settings["fs"],
+            settings["extraction"]["batch_size"]) if cache else None
+        if stage_cache.is_cached(save_path, hashes, "deconvolution", dcnv_key, ["spks.npy"]):
+            spks = np.load(os.path.join(save_path, "spks.npy"), mmap_mode="r")
+        else:
+            stage_cache.start_stage(save_path, hashes, "deconvolution")
+            # deconvolve directly into spks.npy
+            spks = np.lib.format.open_memmap(os.path.join(save_path, "spks.npy"), mode="w+",
+                                             dtype=np.float32, shape=F.shape)
+            extraction.deconvolve_traces(F, Fneu, spks, tau=settings["tau"], fs=settings["fs"],
+                                         neuropil_coefficient=neuropil_coefficient,
+                                         batch_size=settings["extraction"]["batch_size"],
+                                         dcnv_settings=settings["dcnv_preprocess"],
+                                         memory_budget=memory_budget, device=device)
+            spks.flush()
+            stage_cache.finish_stage(save_path, hashes, "deconvolution", dcnv_key)
         plane_times["deconvolution"] = time.time() - t11
         logger.info("----------- Total %0.2f sec." % plane_times["deconvolution"])
     else:
         logger.warn("WARNING: skipping spike detection (settings['do_deconvolution']=False)")
-        spks = np.zeros_like(F)
-    
-    # save results
-    np.save(os.path.join(save_path, "stat.npy"), stat)
-    np.save(os.path.join(save_path, "F.npy"), F)
-    np.save(os.path.join(save_path, "Fneu.npy"), Fneu)
-    if F_chan2 is not None:
-        np.save(os.path.join(save_path, "F_chan2.npy"), F_chan2)
-        np.save(os.path.join(save_path, "Fneu_chan2.npy"), Fneu_chan2)
-    np.save(os.path.join(save_path, "spks.npy"), spks)
+        stage_cache.start_stage(save_path, hashes, "deconvolution")
+        spks = np.zeros(F.shape, np.float32)
+        np.save(os.path.join(save_path, "spks.npy"), spks)
 
     logger.info("----------- ROI CLASSIFICATION")
     t11 = time.time()
-    if len(stat):
-        iscell = classification.classify(stat=stat, classfile=classfile)
+    classify_key = stage_cache.stage_hash(extract_key, settings["classification"],
+                                          stage_cache.data_signature(classfile)) if cache else None
+    if stage_cache.is_cached(save_path, hashes, "classification", classify_key, ["iscell.npy"]):
+        iscell = np.load(os.path.join(save_path, "iscell.npy"))
     else:
-        iscell = np.zeros((0, 2))
-    np.save(os.path.join(save_path, "iscell.npy"), iscell)
+        stage_cache.start_stage(save_path, hashes, "classification")
+        if len(stat):
+            iscell = classification.classify(stat=stat, classfile=classfile)
+        else:
+            iscell = np.zeros((0, 2))
+        np.save(os.path.join(save_path, "iscell.npy"), iscell)
+        stage_cache.finish_stage(save_path, hashes, "classification", classify_key)
     plane_times["classification"] = time.time() - t11
 
     plane_runtime = time.time() - t1
@@ -257,3 +345,156 @@ def pipeline(save_path, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     
     return (reg_outputs, detect_outputs, stat, F, Fneu, F_chan2, Fneu_chan2, 
             spks, iscell, redcell, zcorr, plane_times)
+
+
+def _append_columns(filename, new, chunk_size=2**28):
+    """ appends the columns of new to the array in filename, streaming the previous
+    columns in chunks of rows of at most chunk_size bytes into a new file """
+    old = np.load(filename, mmap_mode="r")
+    tmp = filename[:-4] + "_append.npy"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=old.dtype,
+                                    shape=(old.shape[0], old.shape[1] + new.shape[1]))
+    nrows = max(1, chunk_size // max(1, out.shape[1] * out.itemsize))
+    for i in range(0, len(old), nrows):
+        out[i : i + nrows, :old.shape[1]] = old[i : i + nrows]
+        out[i : i + nrows, old.shape[1]:] = new[i : i + nrows]
+    out.flush()
+    del out, old
+    os.replace(tmp, filename)
+    return np.load(filename, mmap_mode="r")
+
+
+def pipeline_append(save_path, f_reg, n_frames0, f_raw=None, f_reg_chan2=None,
+                    f_raw_chan2=None, settings=default_settings(), badframes=None,
+                    device=torch.device("cuda")):
+    """
+    Process frames appended to a plane that was already processed by pipeline.
+
+    The appended frames (after the first n_frames0 frames) are registered
+    against the stored reference image, and the traces of the existing ROIs
+    in stat.npy are extracted from them and concatenated onto F.npy,
+    Fneu.npy (and F_chan2.npy, Fneu_chan2.npy) and spks.npy. The frames
+    that were already processed are not read again, except for the frames
+    deconvolved as context before the appended frames. Detection and
+    classification are not re-run: the ROIs and iscell.npy are kept, and
+    the activity statistics of the ROIs are updated.
+
+    Parameters
+    ----------
+    save_path : str
+        Path to the outputs of the plane.
+    f_reg : numpy.ndarray or BinaryFile
+        Registered frames followed by the appended frames, shape (n_frames, Ly, Lx).
+    n_frames0 : int
+        Number of frames that were already processed.
+    f_raw : numpy.ndarray or BinaryFile, optional (default None)
+        Unregistered frames, shape (n_frames, Ly, Lx).
+    f_reg_chan2 : numpy.ndarray or BinaryFile, optional (default None)
+        Non-functional registered frames followed by the appended frames.
+    f_raw_chan2 : numpy.ndarray or BinaryFile, optional (default None)
+        Non-functional unregistered frames.
+    settings : dict, optional
+        Dictionary of pipeline settings from default_settings().
+    badframes : numpy.ndarray, optional (default None)
+        Boolean array of bad frames (e.g. photostim times), shape (n_frames,).
+    device : torch.device, optional (default torch.device("cuda"))
+        Torch device for performing operations.
+
+    Returns
+    -------
+    outputs : tuple
+        Outputs of the whole plane, as returned by pipeline.
+    """
+    plane_times = {}
+    t1 = time.time()
+    # frames after n_frames0 (memory-mapped views of BinaryFiles)
+    appended = lambda f: getattr(f, "file", f)[n_frames0:] if f is not None else None
+    n_frames, Ly, Lx = f_reg.shape
+    load = lambda fname, **kwargs: (np.load(os.path.join(save_path, fname), **kwargs)
+                                    if os.path.exists(os.path.join(save_path, fname)) else None)
+    reg_outputs = load("reg_outputs.npy", allow_pickle=True).item()
+    logger.info(f"appending {n_frames - n_frames0} frames to {n_frames0} processed frames")
+
+    if "yoff" in reg_outputs:
+        t11 = time.time()
+        logger.info("----------- REGISTRATION")
+        reg_outputs = registration.registration_append(
+            reg_outputs, appended(f_reg), f_raw=appended(f_raw),
+            f_reg_chan2=appended(f_reg_chan2), f_raw_chan2=appended(f_raw_chan2),
+            align_by_chan2=settings["registration"]["align_by_chan2"],
+            badframes=badframes[n_frames0:] if badframes is not None else None,
+            settings=settings["registration"], device=device)
+        plane_times["registration"] = time.time() - t11
+        logger.info("----------- Total %0.2f sec" % plane_times["registration"])
+    else:
+        logger.info("NOTE: not registering appended frames, plane was not registered")
+        reg_outputs["badframes"] = np.concatenate((reg_outputs["badframes"],
+                                                   np.zeros(n_frames - n_frames0, "bool")))
+    np.save(os.path.join(save_path, "reg_outputs.npy"), reg_outputs)
+
+    detect_outputs = load("detect_outputs.npy", allow_pickle=True)
+    detect_outputs = detect_outputs.item() if detect_outputs is not None else None
+    stat = load("stat.npy", allow_pickle=True)
+    if stat is None or len(stat) == 0:
+        logger.info("no ROIs to extract")
+        plane_times["total_plane_runtime"] = time.time() - t1
+        return (reg_outputs, detect_outputs, stat, None, None, None, None, None, None,
+                None, None, plane_times)
+
+    logger.info("----------- EXTRACTION")
+    t11 = time.time()
+    neuropil_coefficient = settings["extraction"]["neuropil_coefficient"]
+    memory_budget = settings["extraction"]["memory_budget"]
+    twoc = f_reg_chan2 is not None and os.path.exists(os.path.join(save_path, "F_chan2.npy"))
+    cell_masks, neuropil_masks = extraction.create_mask_matrices(
+        stat, Ly, Lx, **{key: settings["extraction"][key] for key in extraction.MASK_SETTINGS})
+    F, Fneu, F_chan2, Fneu_chan2 = extraction.extraction_wrapper(
+        stat, appended(f_reg), f_reg_chan2=appended(f_reg_chan2) if twoc else None,
+        cell_masks=cell_masks, neuropil_masks=neuropil_masks,
+        settings=settings["extraction"], device=device)
+    traces = {"F": F, "Fneu": Fneu, "F_chan2": F_chan2, "Fneu_chan2": Fneu_chan2}
+    for key in traces:
+        if traces[key] is not None:
+            traces[key] = _append_columns(os.path.join(save_path, f"{key}.npy"), traces[key])
+    F, Fneu, F_chan2, Fneu_chan2 = traces.values()
+    del traces
+
+    # update activity statistics for the whole recording
+    snr, sk, sd = extraction.trace_statistics(F, Fneu, neuropil_coefficient, memory_budget)
+    for k, s in enumerate(stat):
+        s["snr"], s["skew"], s["std"] = snr[k], sk[k], sd[k]
+    np.save(os.path.join(save_path, "stat.npy"), stat)
+    plane_times["extraction"] = time.time() - t11
+    logger.info("----------- Total %0.2f sec." % plane_times["extraction"])
+
+    spks = load("spks.npy", mmap_mode="r")
+    if settings["run"]["do_deconvolution"] and spks is not None:
+        logger.info("----------- SPIKE DECONVOLUTION")
+        t11 = time.time()
+        # previous frames within the baseline window and the indicator decay
+        # are deconvolved with the appended frames as context
+        dcnv_settings = settings["dcnv_preprocess"]
+        n_context = min(n_frames0, int(dcnv_settings["win_baseline"] * settings["fs"]) +
+                        int(np.ceil(10 * settings["tau"] * settings["fs"])))
+        spks_new = np.zeros((F.shape[0], n_frames - n_frames0 + n_context), np.float32)
+        extraction.deconvolve_traces(F[:, n_frames0 - n_context:],
+                                     Fneu[:, n_frames0 - n_context:], spks_new,
+                                     tau=settings["tau"], fs=settings["fs"],
+                                     neuropil_coefficient=neuropil_coefficient,
+                                     batch_size=settings["extraction"]["batch_size"],
+                                     dcnv_settings=dcnv_settings,
+                                     memory_budget=memory_budget, device=device)
+        spks = _append_columns(os.path.join(save_path, "spks.npy"), spks_new[:, n_context:])
+        plane_times["deconvolution"] = time.time() - t11
+        logger.info("----------- Total %0.2f sec." % plane_times["deconvolution"])
+    else:
+        spks = _append_columns(os.path.join(save_path, "spks.npy"),
+                               np.zeros((F.shape[0], n_frames - n_frames0), np.float32))
+
+    iscell, redcell = load("iscell.npy"), load("redcell.npy")
+    zcorr = np.zeros((0,))
+    plane_runtime = time.time() - t1
+    plane_times["total_plane_runtime"] = plane_runtime
+    logger.info(f"Appended frames processed in {plane_runtime:0.2f} sec.")
+    return (reg_outputs, detect_outputs, stat, F, Fneu, F_chan2, Fneu_chan2,
+            spks, iscell, redcell, zcorr, plane_times)
@@ -944,6 +944,108 @@ def registration_wrapper(f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
     reg_outputs["meanImgE"] = meanImgE
     return reg_outputs
 
+def registration_append(reg_outputs, f_reg, f_raw=None, f_reg_chan2=None, f_raw_chan2=None,
+                        align_by_chan2=False, aspect=1., badframes=None,
+                        settings=default_settings(), device=torch.device("cuda")):
+    """
+    Register frames appended to a registered movie, against its reference image.
+
+    The reference image, intensity clipping and bidiphase offset of the
+    previous registration are reused, so that the appended frames are aligned
+    to the frames that are already registered. Shifts and bad frames are
+    concatenated to the previous ones, and the valid region and mean images
+    are updated for the whole movie.
+
+    Parameters
+    ----------
+    reg_outputs : dict
+        Registration outputs of the previous frames (see registration_wrapper).
+    f_reg : np.ndarray or BinaryFile
+        Appended functional channel frames of shape (n_frames, Ly, Lx),
+        registered in-place if f_raw is None.
+    f_raw : np.ndarray or BinaryFile or None
+        Appended raw functional channel frames, registered into f_reg.
+    f_reg_chan2 : np.ndarray or BinaryFile or None
+        Appended second channel frames.
+    f_raw_chan2 : np.ndarray or BinaryFile or None
+        Appended raw second channel frames.
+    align_by_chan2 : bool
+        If True, use the second channel as the alignment source.
+    aspect : float
+        Pixel aspect ratio used for computing the enhanced mean image.
+    badframes : np.ndarray or None
+        1-D boolean array of pre-existing bad frame labels of the appended
+        frames. If None, initialized to all False.
+    settings : dict
+        Registration settings dictionary from default_settings().
+    device : torch.device
+        Torch device for computation.
+
+    Returns
+    -------
+    reg_outputs : dict
+        Registration outputs of the whole movie.
+    """
+    # raw frames are registered into f_reg, otherwise f_reg is registered in-place
+    chan1 = (f_reg if f_raw is None else f_raw, None if f_raw is None else f_reg)
+    chan2 = (f_reg_chan2 if f_raw_chan2 is None else f_raw_chan2,
+             None if f_raw_chan2 is None else f_reg_chan2)
+    if f_reg_chan2 is None or not align_by_chan2:
+        (f_align_in, f_align_out), (f_alt_in, f_alt_out) = chan1, chan2
+    else:
+        (f_align_in, f_align_out), (f_alt_in, f_alt_out) = chan2, chan1
+    n_frames, Ly, Lx = f_align_in.shape
+    n_frames0 = len(reg_outputs["yoff"])
+    nonrigid = "yoff1" in reg_outputs
+    bidiphase = reg_outputs["bidiphase"]
+    logger.info(f"registering {n_frames} frames appended to {n_frames0} registered frames")
+
+    outputs = register_frames(f_align_in, f_align_out=f_align_out, bidiphase=bidiphase,
+                              refImg=reg_outputs["refImg"], batch_size=settings["batch_size"],
+                              norm_frames=settings["norm_frames"],
+                              smooth_sigma=settings["smooth_sigma"],
+                              spatial_taper=settings["spatial_taper"],
+                              block_size=settings["block_size"], nonrigid=nonrigid,
+                              maxregshift=settings["maxregshift"],
+                              smooth_sigma_time=settings["smooth_sigma_time"],
+                              snr_thresh=settings["snr_thresh"],
+                              maxregshiftNR=settings["maxregshiftNR"], device=device)
+    mean_img, offsets_all, blocks = outputs[2:]
+    yoff, xoff, corrXY, yoff1, xoff1, corrXY1 = offsets_all[:6]
+    if f_alt_in is not None:
+        mean_img_alt = shift_frames_and_write(f_alt_in, f_alt_out, settings["batch_size"],
+                                              yoff, xoff, yoff1, xoff1, blocks=blocks,
+                                              bidiphase=bidiphase, device=device)
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+    reg_outputs = dict(reg_outputs)
+    keys = ["yoff", "xoff", "corrXY"] + (["yoff1", "xoff1", "corrXY1"] if nonrigid else [])
+    for key, offset in zip(keys, [yoff, xoff, corrXY, yoff1, xoff1, corrXY1]):
+        reg_outputs[key] = np.concatenate((reg_outputs[key], offset), axis=0)
+    badframes = np.zeros(n_frames, "bool") if badframes is None else badframes
+    badframes0 = np.concatenate((reg_outputs.get("badframes0", np.zeros(n_frames0, "bool")),
+                                 badframes))
+    reg_outputs["badframes"], reg_outputs["yrange"], reg_outputs["xrange"] = compute_crop(
+        xoff=reg_outputs["xoff"], yoff=reg_outputs["yoff"], corrXY=reg_outputs["corrXY"],
+        th_badframes=settings["th_badframes"], badframes=badframes0.copy(),
+        maxregshift=settings["maxregshift"], Ly=Ly, Lx=Lx)
+    reg_outputs["badframes0"] = badframes0
+
+    # mean images of all frames
+    w0 = n_frames0 / (n_frames0 + n_frames)
+    if f_alt_in is None or not align_by_chan2:
+        mean_img, mean_img_chan2 = mean_img, (mean_img_alt if f_alt_in is not None else None)
+    else:
+        mean_img, mean_img_chan2 = mean_img_alt, mean_img
+    reg_outputs["meanImg"] = w0 * reg_outputs["meanImg"] + (1 - w0) * mean_img
+    if mean_img_chan2 is not None:
+        reg_outputs["meanImg_chan2"] = (w0 * reg_outputs["meanImg_chan2"] +
+                                        (1 - w0) * mean_img_chan2)
+    reg_outputs["meanImgE"] = utils.highpass_mean_image(
+        reg_outputs["meanImg"].astype("float32"), aspect=aspect)
+    return reg_outputs
+
 def registration_outputs_to_dict(refImg, rmin, rmax, meanImg, rigid_offsets,
                                  nonrigid_offsets, zest, meanImg_chan2,
                                  badframes, badframes0, yrange, xrange, bidiphase):
@@ -17,7 +17,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from . import io, default_settings, default_db, pipeline, version_str
+from . import io, default_settings, default_db, pipeline, version_str, parallel
+from .pipeline_s2p import pipeline_append
 
 from functools import partial
 from pathlib import Path
@@ -169,9 +170,76 @@ def _find_existing_binaries(plane_folders):
         os.path.isfile(os.path.join(f, "data_raw.bin")) or
         os.path.isfile(os.path.join(f, "data.bin")) for f in plane_folders
     ])
-    files_found_flag = db_found_flag and settings_found_flag and binaries_found_flag
+    # binaries of an interrupted conversion are incomplete
+    manifest = io.load_manifest(os.path.dirname(plane_folders[0]))
+    conversion_flag = manifest is None or manifest["complete"]
+    files_found_flag = (db_found_flag and settings_found_flag and binaries_found_flag
+                        and conversion_flag)
     return files_found_flag, db_paths, settings_paths
 
+def _load_badframes(db):
+    """ frames to exclude from registration and detection (e.g. photostim frames),
+    from bad_frames.npy in the first data_path or in save_path0 (optional) """
+    badframes_path = os.path.join(db["data_path"][0], "bad_frames.npy")
+    if not os.path.exists(badframes_path):
+        badframes_path = os.path.join(db["save_path0"], "bad_frames.npy")
+    badframes_path = badframes_path if os.path.exists(badframes_path) else None
+    # badframes from file (optional)
+    badframes0 = np.zeros(db["nframes"], "bool")
+    if badframes_path is not None and os.path.exists(badframes_path):
+        bf_indices = np.load(badframes_path).flatten().astype("int")
+        badframes0[bf_indices] = True
+        logger.info(f"badframes file: {badframes_path};\n # of badframes: {badframes0.sum()}")
+    return badframes0
+
+def _save_plane_outputs(db, settings, outputs):
+    """ saves the results store, Fall.mat and ops.npy of a processed plane, and moves
+    or deletes its binaries, as set in settings["io"] """
+    (reg_outputs, detect_outputs, stat, F, Fneu, F_chan2, Fneu_chan2, spks, iscell, redcell,
+     zcorr, plane_times) = outputs
+
+    # save ROIs and metadata in the pickle-free results store
+    if settings["io"]["save_columnar"]:
+        io.save_results(db["save_path"], stat=stat, db=db, settings=settings,
+                        reg_outputs=reg_outputs, detect_outputs=detect_outputs)
+
+    # save as matlab file
+    if settings["io"]["save_mat"]:
+        if reg_outputs is None:
+            logger.info("No registration outputs to save (registration was skipped)")
+        if detect_outputs is None:
+            logger.info("No detection outputs to save (detection was skipped)")
+        ops = {**db, **settings, **(reg_outputs or {}), **(detect_outputs or {}), **plane_times}
+        io.save_mat(ops, stat, F, Fneu, spks, iscell, redcell, F_chan2, Fneu_chan2)
+
+    # save ops orig
+    if settings["io"]["save_ops_orig"]:
+        if reg_outputs is None:
+            logger.info("No registration outputs in ops.npy (registration was skipped)")
+        if detect_outputs is None:
+            logger.info("No detection outputs in ops.npy (detection was skipped)")
+        ops = {**db, **settings, **(reg_outputs or {}), **(detect_outputs or {})}
+        ops["plane_times"] = plane_times
+        np.save(os.path.join(db["save_path"], "ops.npy"), ops)
+    
+    if settings["io"]["move_bin"] and db["save_path"] != db["fast_disk"]:
+        logger.info("moving binary files to save_path")
+        for key in ["reg_file", "reg_file_chan2", "raw_file", "raw_file_chan2"]:
+            if key in db:
+                moved = os.path.join(db["save_path"], os.path.split(db[key])[1])
+                if os.path.abspath(db[key]) != os.path.abspath(moved):
+                    shutil.move(db[key], moved)
+                    db[key] = moved
+        # point db.npy to the moved binaries (e.g. for append_s2p)
+        if db.get("db_path", None) is not None:
+            np.save(db["db_path"], db)
+                
+    elif settings["io"]["delete_bin"]:
+        logger.info("deleting binary files")
+        for key in ["reg_file", "reg_file_chan2", "raw_file", "raw_file_chan2"]:
+            if key in db:
+                os.remove(db[key])
+
 def run_plane(db, settings, db_path=None, stat=None):
     """
     Run suite2p processing on a single plane/ROI.
@@ -244,16 +312,7 @@ def run_plane(db, settings, db_path=None, stat=None):
     n_frames, Ly, Lx = db["nframes"], db["Ly"], db["Lx"]
     
     # get frames to exclude from registration and detection (e.g. photostim frames)
-    badframes_path = os.path.join(db["data_path"][0], "bad_frames.npy")
-    if not os.path.exists(badframes_path):
-        badframes_path = os.path.join(db["save_path0"], "bad_frames.npy")
-    badframes_path = badframes_path if os.path.exists(badframes_path) else None
-    # badframes from file (optional)
-    badframes0 = np.zeros(db["nframes"], "bool")
-    if badframes_path is not None and os.path.exists(badframes_path):
-        bf_indices = np.load(badframes_path).flatten().astype("int")
-        badframes0[bf_indices] = True
-        logger.info(f"badframes file: {badframes_path};\n # of badframes: {badframes0.sum()}")
+    badframes0 = _load_badframes(db)
 
     # check for zstack file to align to
     Zstack = None
@@ -302,41 +361,10 @@ def run_plane(db, settings, db_path=None, stat=None):
 
         outputs = pipeline(db["save_path"], f_reg, f_raw, f_reg_chan2, f_raw_chan2, 
                    run_registration, settings, badframes=badframes0, stat=stat,
-                   device=device, Zstack=Zstack)
+                   device=device, Zstack=Zstack, cache=settings["run"]["stage_cache"])
         (reg_outputs, detect_outputs, stat, F, Fneu, F_chan2, Fneu_chan2, spks, iscell, redcell, zcorr, plane_times) = outputs
 
-    # save as matlab file
-    if settings["io"]["save_mat"]:
-        if reg_outputs is None:
-            logger.info("No registration outputs to save (registration was skipped)")
-        if detect_outputs is None:
-            logger.info("No detection outputs to save (detection was skipped)")
-        ops = {**db, **settings, **(reg_outputs or {}), **(detect_outputs or {}), **plane_times}
-        io.save_mat(ops, stat, F, Fneu, spks, iscell, redcell, F_chan2, Fneu_chan2)
-
-    # save ops orig
-    if settings["io"]["save_ops_orig"]:
-        if reg_outputs is None:
-            logger.info("No registration outputs in ops.npy (registration was skipped)")
-        if detect_outputs is None:
-            logger.info("No detection outputs in ops.npy (detection was skipped)")
-        ops = {**db, **settings, **(reg_outputs or {}), **(detect_outputs or {})}
-        ops["plane_times"] = plane_times
-        np.save(os.path.join(db["save_path"], "ops.npy"), ops)
-    
-    if settings["io"]["move_bin"] and db["save_path"] != db["fast_disk"]:
-        logger.info("moving binary files to save_path")
-        for key in ["reg_file", "reg_file_chan2", "raw_file", "raw_file_chan2"]:
-            if key in db:
-                shutil.move(db[key],
-                        os.path.join(db["save_path"], os.path.split(db[key])[1]))
-                
-    elif settings["io"]["delete_bin"]:
-        logger.info("deleting binary files")
-        for key in ["reg_file", "reg_file_chan2", "raw_file", "raw_file_chan2"]:
-            if key in db:
-                os.remove(db[key])
-
+    _save_plane_outputs(db, settings, outputs)
     return outputs
 
 
@@ -346,8 +374,9 @@ def run_s2p(db={}, settings=default_settings(), server={}):
 
     Converts input files to binary format (if needed), then runs
     registration, detection, extraction, deconvolution, and classification
-    on each plane sequentially (or dispatches to a server for parallel
-    processing).
+    on each plane sequentially, on settings["run"]["n_workers"] planes at
+    once in local processes (see parallel.run_planes_parallel), or as
+    separate jobs (see io.jobs.run_jobs and io.server.send_jobs).
 
     Parameters
     ----------
@@ -357,14 +386,18 @@ def run_s2p(db={}, settings=default_settings(), server={}):
     settings : dict
         Pipeline settings dictionary, e.g. "fs", "tau", "diameter".
     server : dict
-        Server configuration for multiplane_parallel mode. Specify "host",
-        "username", "password", "server_root", "local_root", "n_cores".
+        Job configuration for multiplane_parallel mode. "backend" is "ssh"
+        (default) to send the planes to a server with io.server.send_jobs
+        ("host", "username", "password", "server_root", "local_root",
+        "n_cores"), or "local" / "batch" to run each plane as a job with
+        io.jobs.run_jobs and wait for them (e.g. "max_jobs", "submit_command",
+        "max_retries").
 
     Returns
     -------
     db_paths : list of str or None
         Paths to the per-plane db.npy files. None if running in
-        multiplane_parallel server mode.
+        multiplane_parallel ssh mode.
     """
 
     t0 = time.time()
@@ -391,13 +424,17 @@ def run_s2p(db={}, settings=default_settings(), server={}):
 
     if files_found_flag:
         logger.info(f"FOUND BINARIES AND DBS IN {db_paths}")
-        logger.info("removing previous detection and extraction files, if present")
+        if settings["run"]["stage_cache"]:
+            logger.info("keeping previous outputs, stages with unchanged inputs will not be re-run")
+            files_to_remove = []
+        else:
+            logger.info("removing previous detection and extraction files, if present")
+            files_to_remove = [
+                "detect_outputs.npy", "stat.npy", "stat_detection.npy",
+                "F.npy", "Fneu.npy", "F_chan2.npy", "Fneu_chan2.npy", 
+                "spks.npy", "iscell.npy", "redcell.npy"
+            ]
         logger.info(f"will update settings.npy but not db.npy")
-        files_to_remove = [
-            "detect_outputs.npy", "stat.npy", 
-            "F.npy", "Fneu.npy", "F_chan2.npy", "Fneu_chan2.npy", 
-            "spks.npy", "iscell.npy", "redcell.npy"
-        ]
         for f in plane_folders:
             np.save(os.path.join(f, "settings.npy"), settings)
             for fname in files_to_remove:
@@ -421,14 +458,21 @@ def run_s2p(db={}, settings=default_settings(), server={}):
         np.save(os.path.join(save_folder, "db.npy"), db)
         np.save(os.path.join(save_folder, "settings.npy"), settings)
         
-        # open all binary files for writing
+        # open all binary files for writing, keeping the frames of an interrupted
+        # conversion that can be resumed (the converter truncates the files)
+        manifest = io.load_manifest(save_folder)
+        resume = (manifest is not None and not manifest["complete"]
+                  and manifest["input_format"] == db["input_format"])
+        if manifest is not None and not resume:
+            os.remove(os.path.join(save_folder, io.manifest.MANIFEST_FILE))
+        mode = lambda f: "r+b" if resume and os.path.isfile(f) else "wb"
         with contextlib.ExitStack() as stack:
             raw_str = "raw" if db.get("keep_movie_raw", False) else "reg"
             fnames = [db[f"{raw_str}_file"] for db in dbs]
-            files = [stack.enter_context(open(f, "wb")) for f in fnames]
+            files = [stack.enter_context(open(f, mode(f))) for f in fnames]
             if db["nchannels"] > 1:
                 fnames_chan2 = [db[f"{raw_str}_file_chan2"] for db in dbs]
-                files_chan2 = [stack.enter_context(open(f, "wb")) for f in fnames_chan2]
+                files_chan2 = [stack.enter_context(open(f, mode(f))) for f in fnames_chan2]
             else:
                 files_chan2 = None
             
@@ -437,12 +481,23 @@ def run_s2p(db={}, settings=default_settings(), server={}):
         logger.info("Wrote {} frames per binary, {} folders + {} channels, {:0.2f}sec".format(
                 dbs[0]["nframes"], len(dbs), dbs[0]["nchannels"], time.time() - t0))
         
-    if settings["run"]["multiplane_parallel"]:
+    errors = {}
+    if settings["run"]["multiplane_parallel"] and server.get("backend", "ssh") == "ssh":
+        server = {k: v for k, v in server.items() if k != "backend"}
         if server:  # if user puts in server settings
             io.server.send_jobs(save_folder, **server)
         else: # otherwise use settings modified in io/server.py
             io.server.send_jobs(save_folder)
         return None
+    elif settings["run"]["multiplane_parallel"]:
+        errors = io.jobs.run_jobs(db_paths, settings,
+                                  skip=db.get("ignore_flyback", None) or [], **server)
+    elif settings["run"]["n_workers"] > 1 and len(db_paths) > 1:
+        errors = parallel.run_planes_parallel(
+            db_paths, settings, n_workers=settings["run"]["n_workers"],
+            threads_per_worker=settings["run"]["threads_per_worker"],
+            memory_limit=settings["run"]["memory_limit"],
+            skip=db.get("ignore_flyback", None) or [])
     else:
         for ipl, (settings_path, db_path) in enumerate(zip(settings_paths, db_paths)):
             if db.get("ignore_flyback", None) is not None:
@@ -454,18 +509,158 @@ def run_s2p(db={}, settings=default_settings(), server={}):
             db = np.load(db_path, allow_pickle=True).item()
             logger.info(f">>>>>>>>>>>>>>>>>>>>> PLANE {ipl} <<<<<<<<<<<<<<<<<<<<<<")
             outputs = run_plane(db=db, settings=settings, db_path=db_path)
-        run_time = time.time() - t0
-        logger.info("total = %0.2f sec." % run_time)
+    failed = [ipl for ipl, error in errors.items() if error is not None]
+    if len(failed) > 0:
+        raise RuntimeError(f"processing failed for planes {failed}, see log for errors")
+    run_time = time.time() - t0
+    logger.info("total = %0.2f sec." % run_time)
+
+    #### COMBINE PLANES or FIELDS OF VIEW ####
+    if len(settings_paths) > 1 and settings["io"]["combined"] and settings["run"]["do_detection"]:
+        logger.info("Creating combined view")
+        io.combined(save_folder, save=True)
+
+    # save to NWB
+    if settings["io"]["save_NWB"]:
+        logger.info("Saving in nwb format")
+        io.save_nwb(save_folder)
+
+    logger.info("TOTAL RUNTIME %0.2f sec" % (time.time() - t0))
+    return db_paths
+
+
+def append_plane(db, settings, n_frames0):
+    """
+    Process the frames appended to the binaries of a processed plane.
 
-        #### COMBINE PLANES or FIELDS OF VIEW ####
-        if len(settings_paths) > 1 and settings["io"]["combined"] and settings["run"]["do_detection"]:
-            logger.info("Creating combined view")
-            io.combined(save_folder, save=True)
+    Parameters
+    ----------
+    db : dict
+        Database dictionary of the plane, with "nframes" including the
+        appended frames.
+    settings : dict
+        Pipeline settings dictionary.
+    n_frames0 : int
+        Number of frames that were already processed.
 
-        # save to NWB
-        if settings["io"]["save_NWB"]:
-            logger.info("Saving in nwb format")
-            io.save_nwb(save_folder)
+    Returns
+    -------
+    outputs : tuple
+        Outputs of the whole plane, see pipeline_s2p.pipeline_append.
+    """
+    settings = {**default_settings(), **settings}
+    settings["date_proc"] = datetime.now().astimezone()
+    device = _assign_torch_device(settings["torch_device"])
+
+    n_frames, Ly, Lx = db["nframes"], db["Ly"], db["Lx"]
+    raw = db["keep_movie_raw"] and os.path.isfile(db.get("raw_file", None) or "")
+    twoc = db["nchannels"] > 1
+    badframes0 = _load_badframes(db)
+    with contextlib.ExitStack() as stack:
+        # the registered binaries are extended to n_frames if the raw binaries are kept
+        binary = lambda key, write: stack.enter_context(
+            io.BinaryFile(Ly=Ly, Lx=Lx, filename=db[key], n_frames=n_frames, write=write))
+        f_reg = binary("reg_file", True)
+        f_raw = binary("raw_file", False) if raw else None
+        f_reg_chan2 = binary("reg_file_chan2", True) if twoc else None
+        f_raw_chan2 = binary("raw_file_chan2", False) if raw and twoc else None
+        outputs = pipeline_append(db["save_path"], f_reg, n_frames0, f_raw=f_raw,
+                                  f_reg_chan2=f_reg_chan2, f_raw_chan2=f_raw_chan2,
+                                  settings=settings, badframes=badframes0, device=device)
+    _save_plane_outputs(db, settings, outputs)
+    return outputs
+
+
+def _find_binaries(db):
+    """ update the paths of the binaries of a processed plane that append_s2p
+    writes to, which may have been moved to its save_path (io.move_bin) """
+    keys = ["reg_file"] + (["raw_file"] if db.get("keep_movie_raw", False) else [])
+    if db["nchannels"] > 1:
+        keys += [f"{key}_chan2" for key in keys]
+    for key in keys:
+        if key not in db or os.path.isfile(db[key]):
+            continue
+        moved = os.path.join(db["save_path"], os.path.split(db[key])[1])
+        if not os.path.isfile(moved):
+            raise ValueError(f"binary {db[key]} of {db['save_path']} not found (deleted with "
+                             "io.delete_bin?), appending files requires the binaries")
+        db[key] = moved
+
+
+def append_s2p(db={}, settings=default_settings()):
+    """
+    Append new files of a growing recording to its processed planes.
+
+    The files in db["data_path"] that are not in the conversion manifest
+    of the save folder (see io.manifest) are converted and appended to the
+    plane binaries. The appended frames are registered against the stored
+    reference image, and the traces of the existing ROIs are extracted
+    from them and concatenated onto F.npy, Fneu.npy and spks.npy (see
+    pipeline_s2p.pipeline_append). Detection is not re-run.
+
+    Parameters
+    ----------
+    db : dict
+        Database dictionary used for the first run_s2p, with the same
+        "data_path" (and "save_path0", "save_folder").
+    settings : dict
+        Pipeline settings dictionary.
+
+    Returns
+    -------
+    db_paths : list of str
+        Paths to the per-plane db.npy files.
+    """
+    t0 = time.time()
+    settings = {**default_settings(), **settings}
+    db = {**default_db(), **db}
+
+    save_folder = get_save_folder(db)
+    manifest = io.load_manifest(save_folder)
+    if manifest is None or manifest["input_format"] != "tif":
+        raise ValueError("appending files requires binaries converted from tiffs with a "
+                         f"conversion manifest in {save_folder}")
+    plane_folders = natsorted([
+        f.path for f in os.scandir(save_folder) if f.is_dir() and f.name[:5] == "plane"
+    ])
+    db_paths = [os.path.join(f, "db.npy") for f in plane_folders]
+    dbs = [np.load(db_path, allow_pickle=True).item() for db_path in db_paths]
+    n_frames0 = [d["nframes"] for d in dbs]
+    for d in dbs:
+        _find_binaries(d)
+
+    fs, first_files = io.get_file_list(db)
+    for d in dbs:
+        d["file_list"], d["first_files"] = fs, first_files
+    with contextlib.ExitStack() as stack:
+        raw_str = "raw" if dbs[0].get("keep_movie_raw", False) else "reg"
+        files = [stack.enter_context(open(d[f"{raw_str}_file"], "r+b")) for d in dbs]
+        if dbs[0]["nchannels"] > 1:
+            files_chan2 = [stack.enter_context(open(d[f"{raw_str}_file_chan2"], "r+b"))
+                           for d in dbs]
+        else:
+            files_chan2 = None
+        dbs = io.tiff_to_binary(dbs, settings, files, files_chan2, append=True)
 
-        logger.info("TOTAL RUNTIME %0.2f sec" % (time.time() - t0))
+    if all(d["nframes"] == n0 for d, n0 in zip(dbs, n_frames0)):
+        logger.info("no new frames to append")
         return db_paths
+    logger.info("Appended {} frames per binary, {:0.2f}sec".format(
+        dbs[0]["nframes"] - n_frames0[0], time.time() - t0))
+
+    for ipl, (d, n0) in enumerate(zip(dbs, n_frames0)):
+        if ipl in (db.get("ignore_flyback", None) or []):
+            logger.info(f">>>> skipping flyback PLANE {ipl}")
+            continue
+        logger.info(f">>>>>>>>>>>>>>>>>>>>> PLANE {ipl} <<<<<<<<<<<<<<<<<<<<<<")
+        append_plane(d, settings, n0)
+
+    if len(db_paths) > 1 and settings["io"]["combined"] and settings["run"]["do_detection"]:
+        logger.info("Creating combined view")
+        io.combined(save_folder, save=True)
+    if settings["io"]["save_NWB"]:
+        logger.info("Saving in nwb format")
+        io.save_nwb(save_folder)
+
+    logger.info("TOTAL RUNTIME %0.2f sec" % (time.time() - t0))
+    return db_paths
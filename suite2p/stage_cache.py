@@ -0,0 +1,172 @@
+"""
+Copyright © 2023 Howard Hughes Medical Institute, Authored by Carsen Stringer and Marius Pachitariu.
+"""
+import os
+import hashlib
+import pathlib
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+from .version import version
+
+# stages of the pipeline with cached outputs, in order
+STAGES = ["registration", "detection", "extraction", "deconvolution", "classification"]
+
+# file in the plane folder with the hash of the inputs of each completed stage
+CACHE_FILE = "stage_cache.npy"
+
+
+def _update(h, obj):
+    """ add obj to hash h, recursing into dicts, sequences and object arrays """
+    if isinstance(obj, dict):
+        h.update(b"dict")
+        for key in sorted(obj, key=str):
+            _update(h, str(key))
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"list{len(obj)}".encode())
+        for item in obj:
+            _update(h, item)
+    elif isinstance(obj, np.ndarray) and obj.dtype == object:
+        h.update(f"objects{obj.shape}".encode())
+        for item in obj.flat:
+            _update(h, item)
+    elif isinstance(obj, np.ndarray):
+        h.update(f"array{obj.dtype.str}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, np.generic):
+        _update(h, obj.item())
+    elif isinstance(obj, pathlib.PurePath):
+        _update(h, str(obj))
+    else:
+        h.update(f"{type(obj).__name__}:{obj!r}".encode())
+
+
+def stage_hash(*inputs):
+    """
+    Hash of the inputs of a stage.
+
+    Parameters
+    ----------
+    *inputs
+        Settings dictionaries, arrays (including arrays of stat dictionaries),
+        scalars, strings, file signatures or hashes of previous stages.
+        The suite2p version is always included.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-1 digest.
+    """
+    h = hashlib.sha1(version.encode())
+    for obj in inputs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+def data_signature(data):
+    """
+    Signature of a movie or file used as the input of a stage.
+
+    Files (and BinaryFiles) are identified by their name, size and
+    modification time, so any write to them changes the signature; arrays
+    are identified by their content.
+
+    Parameters
+    ----------
+    data : str, BinaryFile, numpy.ndarray or None
+        Path to a file, BinaryFile, or array.
+
+    Returns
+    -------
+    signature : tuple or str or None
+        Signature of data, None if data is None.
+    """
+    if data is None:
+        return None
+    filename = data if isinstance(data, (str, pathlib.PurePath)) else getattr(data, "filename", None)
+    if filename is not None:
+        st = os.stat(filename)
+        return (os.path.basename(filename), st.st_size, st.st_mtime_ns)
+    return stage_hash(np.asarray(data))
+
+
+def load_stage_hashes(save_path):
+    """
+    Hashes of the completed stages of a plane.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane folder.
+
+    Returns
+    -------
+    hashes : dict
+        Hash of the inputs for each completed stage.
+    """
+    cache_file = os.path.join(save_path, CACHE_FILE)
+    if not os.path.exists(cache_file):
+        return {}
+    return np.load(cache_file, allow_pickle=True).item()
+
+
+def save_stage_hashes(save_path, hashes):
+    """
+    Save the hashes of the completed stages of a plane next to its outputs.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane folder.
+    hashes : dict
+        Hash of the inputs for each completed stage.
+    """
+    np.save(os.path.join(save_path, CACHE_FILE), hashes)
+
+
+def is_cached(save_path, hashes, stage, key, outputs):
+    """
+    Whether the outputs of a stage were computed from the same inputs.
+
+    Parameters
+    ----------
+    save_path : str
+        Plane folder.
+    hashes : dict
+        Hashes of the completed stages, from load_stage_hashes.
+    stage : str
+        Stage in STAGES.
+    key : str
+        Hash of the current inputs of the stage, None if caching is off.
+    outputs : list of str
+        Output files of the stage in save_path, which must all exist.
+
+    Returns
+    -------
+    cached : bool
+        True if the stage can be skipped.
+    """
+    cached = key is not None and hashes.get(stage, None) == key and all(
+        os.path.exists(os.path.join(save_path, fname)) for fname in outputs)
+    if cached:
+        logger.info(f"{stage} inputs unchanged, loading outputs from {save_path}")
+    return cached
+
+
+def start_stage(save_path, hashes, stage):
+    """
+    Remove the hash of a stage before running it, so that outputs of an
+    interrupted run are never reused.
+    """
+    if hashes.pop(stage, None) is not None:
+        save_stage_hashes(save_path, hashes)
+
+
+def finish_stage(save_path, hashes, stage, key):
+    """ record the hash of the inputs of a completed stage (if caching is on) """
+    if key is None:
+        return
+    hashes[stage] = key
+    save_stage_hashes(save_path, hashes)
@@ -0,0 +1,52 @@
+"""
+Tests for the Suite2p Classification module that do not require the test data.
+"""
+import numpy as np
+
+from suite2p.classification import Classifier, classify, builtin_classfile
+from suite2p.classification import classifier
+from suite2p.detection import ROITable
+
+
+def random_stat(n_rois=500, seed=0):
+    rng = np.random.default_rng(seed)
+    stat = np.array([{"ypix": np.zeros(1, "int64"), "xpix": np.zeros(1, "int64"),
+                      "lam": np.ones(1, "float32"), "skew": rng.gamma(2.),
+                      "npix_norm": rng.gamma(1.5), "compact": 1 + rng.gamma(0.3)}
+                     for _ in range(n_rois)])
+    stat[0]["skew"] = np.nan
+    return stat
+
+
+def test_saved_fit_matches_refit(tmp_path):
+    stat = random_stat()
+    model = Classifier(builtin_classfile, keys=["skew", "compact"])
+    # fit from the training data, without the saved and cached fits
+    model_fit = Classifier()
+    model_fit.keys, model_fit.stats, model_fit.iscell = model.keys, model.stats, model.iscell
+    model_fit._fit()
+    logp = model_fit._get_logp(classifier.feature_table(stat, model.keys))
+    probcell = model_fit.model.predict_proba(logp)[:, 1]
+    assert np.array_equal(model.predict_proba(stat), probcell)
+
+    model.save(tmp_path / "classifier.npy")
+    classifier._FIT_CACHE.clear()
+    model = Classifier(tmp_path / "classifier.npy")
+    assert model.keys == ["skew", "compact"] and not hasattr(model, "model")
+    assert np.array_equal(model.predict_proba(stat), probcell)
+    assert np.array_equal(model.predict_proba(ROITable.from_stat(stat)), probcell)
+
+    # a saved fit is not used once the training data changes
+    saved = np.load(tmp_path / "classifier.npy", allow_pickle=True).item()
+    saved["iscell"] = 1 - saved["iscell"]
+    np.save(tmp_path / "classifier_flipped.npy", saved)
+    model = Classifier(tmp_path / "classifier_flipped.npy")
+    assert hasattr(model, "model")
+    assert np.allclose(model.predict_proba(stat), 1 - probcell, atol=1e-2)
+
+
+def test_classify():
+    stat = random_stat()
+    iscell = classify(stat, builtin_classfile)
+    assert iscell.shape == (len(stat), 2)
+    assert np.array_equal(iscell[:, 0], iscell[:, 1] > 0.5)
@@ -0,0 +1,131 @@
+"""
+Tests for the Suite2p Detection module that do not require the test data.
+"""
+import numpy as np
+import torch
+
+from suite2p.detection import sourcery, roi_stats, assign_overlaps, ROITable
+from suite2p.detection.stats import median_pix, soma_crop, fitMVGaus
+from suite2p.detection.denoise import pca_denoise
+from suite2p.detection.svd import randomized_svd
+
+
+def low_rank_movie(nframes=300, Ly=64, Lx=80, rank=5, noise=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    mov = rng.standard_normal((nframes, rank)) @ rng.standard_normal((rank, Ly * Lx))
+    mov += noise * rng.standard_normal((nframes, Ly * Lx))
+    return mov.reshape(nframes, Ly, Lx).astype("float32")
+
+
+def random_rois(n_rois=200, Ly=128, Lx=128, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.meshgrid(np.arange(-10, 11), np.arange(-10, 11), indexing="ij")
+    stats = []
+    for k in range(n_rois):
+        ry, rx = rng.uniform(2, 7, 2)
+        iroi = (yy / ry)**2 + (xx / rx)**2 < 1
+        ypix, xpix = yy[iroi] + rng.integers(10, Ly - 10), xx[iroi] + rng.integers(10, Lx - 10)
+        lam = rng.uniform(0.1, 1, ypix.size).astype("float32")
+        stats.append({"ypix": ypix, "xpix": xpix, "lam": lam})
+    return np.array(stats)
+
+
+def test_roi_table_round_trip():
+    stats = random_rois(20)
+    for k, stat in enumerate(stats):
+        stat["med"] = median_pix(stat["ypix"], stat["xpix"])
+        stat["overlap"] = np.zeros(stat["ypix"].size, "bool")
+        stat["imerge"] = list(range(k % 3))
+        stat["skew"] = np.float32(k)
+    table = ROITable.from_stat(stats)
+    assert len(table) == 20 and table.offsets[-1] == table.ypix.size
+    assert "overlap" in table.pixel_columns and table.columns["med"].shape == (20, 2)
+    for stat, stat0 in zip(table.to_stat(), stats):
+        assert set(stat.keys()) == set(stat0.keys())
+        assert isinstance(stat["med"], list) and stat["imerge"] == stat0["imerge"]
+        for key in ["ypix", "xpix", "lam", "overlap", "med", "skew"]:
+            assert np.array_equal(stat[key], stat0[key])
+    subset = table[np.arange(20) % 2 == 1]
+    assert len(subset) == 10
+    assert np.array_equal(subset.to_stat()[3]["ypix"], stats[7]["ypix"])
+
+
+def test_roi_stats_matches_per_roi_functions():
+    Ly, Lx, d0 = 128, 128, np.array([8., 8.])
+    stats = random_rois(300, Ly, Lx)
+    stats_out = roi_stats(stats, Ly, Lx, diameter=d0, max_overlap=None)
+    assert len(stats_out) == len(stats)
+    for stat in stats_out:
+        ypix, xpix, lam = stat["ypix"], stat["xpix"], stat["lam"]
+        med = median_pix(ypix, xpix)
+        crop = soma_crop(ypix, xpix, lam, med)
+        radii = fitMVGaus(ypix[crop], xpix[crop], lam[crop], d0[0], d0[1], thres=2)[2]
+        assert stat["med"] == med and stat["npix"] == ypix.size
+        assert np.array_equal(stat["soma_crop"], crop) and stat["npix_soma"] == crop.sum()
+        assert np.isclose(stat["radius"], radii[0] * d0.mean(), rtol=1e-4)
+        assert np.isclose(stat["aspect_ratio"],
+                          2 * radii[0] / (.01 + radii[0] + radii[1]), rtol=1e-4)
+        assert stat["compact"] >= 1.0
+
+    # overlapping ROIs are removed in reversed order
+    stats_out = roi_stats(stats, Ly, Lx, diameter=d0, max_overlap=0.75)
+    assert 0 < len(stats_out) < len(stats)
+    overlap = np.zeros((Ly, Lx), "int")
+    for stat in stats_out:
+        overlap[stat["ypix"], stat["xpix"]] += 1
+        assert (stat["overlap"] > 0).mean() <= 0.75
+    stats_out = assign_overlaps(stats_out, Ly, Lx)
+    for stat in stats_out:
+        assert np.array_equal(stat["overlap"], overlap[stat["ypix"], stat["xpix"]] > 1)
+
+
+def test_randomized_svd_matches_full_svd_on_batched_low_rank_matrices():
+    mov = low_rank_movie().reshape(300, -1)
+    X = torch.from_numpy(np.stack((mov, 2 * mov[::-1].copy())))
+    get_rows = lambda tstart, tend: X[:, tstart:tend]
+    U, S, Vh = randomized_svd(get_rows, X.shape[1], X.shape[2], 5, n_batch=2,
+                              batch_size=64, device=torch.device("cpu"))
+    assert U.shape == (2, 300, 5) and S.shape == (2, 5) and Vh.shape == (2, 5, X.shape[2])
+    for b in range(2):
+        s = np.linalg.svd(X[b].numpy(), compute_uv=False)[:5]
+        assert np.allclose(S[b].numpy(), s, rtol=1e-4)
+        Xr = (U[b] * S[b]) @ Vh[b]
+        assert torch.linalg.norm(Xr - X[b]) / torch.linalg.norm(X[b]) < 1e-2
+
+
+def test_randomized_pca_denoise_matches_full_pca_denoise():
+    mov = low_rank_movie()
+    denoised = pca_denoise(mov.copy(), block_size=[32, 32], n_comps_frac=0.5)
+    denoised_rand = pca_denoise(mov.copy(), block_size=[32, 32], n_comps_frac=0.5,
+                                svd_method="randomized", device=torch.device("cpu"))
+    assert denoised_rand.dtype == np.float32
+    assert denoised_rand.shape == mov.shape
+    assert np.allclose(denoised, denoised_rand, atol=5e-2)
+
+
+def test_sparse_sourcery_regression_matches_dense_solve():
+    rng = np.random.default_rng(1)
+    Ly, Lx, nsvd, nbasis = 30, 40, 12, 9
+    ypix, xpix, lam = [], [], []
+    for n in range(25):
+        y0, x0 = rng.integers(0, Ly - 5), rng.integers(0, Lx - 5)
+        yp, xp = np.meshgrid(np.arange(y0, y0 + 5), np.arange(x0, x0 + 5), indexing="ij")
+        ypix.append(yp.flatten()); xpix.append(xp.flatten())
+        lam.append(rng.random(25).astype("float32"))
+    L = sourcery.roi_footprints(ypix, xpix, lam, Ly, Lx)
+    Ld = np.zeros((Ly, Lx, 25), "float32")
+    for n in range(25):
+        Ld[ypix[n], xpix[n], n] = lam[n]
+    Ld = Ld.reshape(-1, 25)
+    assert np.allclose(L.toarray(), Ld)
+
+    U = rng.standard_normal((Ly * Lx, nsvd)).astype("float32")
+    S = rng.standard_normal((Ly * Lx, nbasis)).astype("float32")
+    LtL, LtS, LtU = (L.T @ L).tocsc(), L.T @ S, L.T @ U
+    StS, StU = S.T @ S, S.T @ U
+    codes, neu = sourcery.solve_codes(LtL, LtS, StS, LtU, StU)
+
+    A = np.block([[Ld.T @ Ld, Ld.T @ S], [S.T @ Ld, StS]])
+    x = np.linalg.solve(A + 1e-3 * np.eye(A.shape[0]), np.concatenate((LtU, StU)))
+    assert np.allclose(codes, x[:25], rtol=1e-3, atol=1e-4)
+    assert np.allclose(neu, x[25:], rtol=1e-3, atol=1e-4)
@@ -0,0 +1,256 @@
+"""
+Tests for the Suite2p Extraction module that do not require the test data.
+"""
+import numpy as np
+import torch
+from scipy.ndimage import percentile_filter, minimum_filter1d, maximum_filter1d
+from scipy.stats import skew
+
+from suite2p import default_settings
+from suite2p.detection import assign_overlaps
+from suite2p.detection.sparsedetect import extendROI
+from suite2p.extraction import (masks, extraction_wrapper, reextract_changed_rois,
+                                 update_traces, MASK_SETTINGS)
+from suite2p.extraction.extract import extract_traces
+from suite2p.extraction import traces
+from suite2p.extraction.dcnv import oasis, oasis_matrix, sliding_maximin, preprocess
+
+
+def random_stats(n_rois=150, Ly=120, Lx=100, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.meshgrid(np.arange(-8, 9), np.arange(-8, 9), indexing="ij")
+    stats = []
+    for k in range(n_rois):
+        ry, rx = rng.uniform(2, 6, 2)
+        iroi = (yy / ry)**2 + (xx / rx)**2 < 1
+        ypix, xpix = yy[iroi] + rng.integers(0, Ly), xx[iroi] + rng.integers(0, Lx)
+        inside = (ypix >= 0) & (ypix < Ly) & (xpix >= 0) & (xpix < Lx)
+        ypix, xpix = ypix[inside], xpix[inside]
+        lam = rng.uniform(0.1, 1, ypix.size).astype("float32")
+        stats.append({"ypix": ypix, "xpix": xpix, "lam": lam, "radius": (ry + rx) / 2})
+    return stats
+
+
+def neuropil_masks_by_growing(ypixs, xpixs, cell_pix, inner_neuropil_radius,
+                              min_neuropil_pixels):
+    """ rectangular neuropil masks grown by 5 pixels at a time """
+    Ly, Lx = cell_pix.shape
+    neuropil_ipix = []
+    for ypix, xpix in zip(ypixs, xpixs):
+        ypix, xpix = extendROI(ypix, xpix, Ly, Lx, niter=inner_neuropil_radius)
+        nring = (~cell_pix[ypix, xpix]).sum()
+        ypix1, xpix1 = ypix, xpix
+        for n in range(100):
+            if (~cell_pix[ypix1, xpix1]).sum() - nring > min_neuropil_pixels:
+                break
+            ypix1, xpix1 = np.meshgrid(
+                np.arange(max(0, ypix1.min() - 5), min(Ly, ypix1.max() + 6)),
+                np.arange(max(0, xpix1.min() - 5), min(Lx, xpix1.max() + 6)),
+                indexing="ij")
+        neuropil_mask = np.zeros((Ly, Lx), "bool")
+        neuropil_mask[ypix1, xpix1] = ~cell_pix[ypix1, xpix1]
+        neuropil_mask[ypix, xpix] = False
+        neuropil_ipix.append(np.nonzero(neuropil_mask.flatten())[0])
+    return neuropil_ipix
+
+
+def test_create_cell_pix_matches_percentile_filter():
+    Ly, Lx = 120, 100
+    stats = random_stats(Ly=Ly, Lx=Lx)
+    lammap = np.zeros((Ly, Lx))
+    for stat in stats:
+        lammap[stat["ypix"], stat["xpix"]] = np.maximum(lammap[stat["ypix"], stat["xpix"]],
+                                                        stat["lam"])
+    size = int(np.median([stat["radius"] for stat in stats]) * 5)
+    filt = percentile_filter(lammap, percentile=50., size=size)
+    cell_pix = masks.create_cell_pix(stats, Ly=Ly, Lx=Lx, lam_percentile=50.)
+    assert np.array_equal(cell_pix, ~np.logical_or(lammap < filt, lammap == 0))
+
+
+def test_neuropil_mask_matrix_matches_grown_masks():
+    Ly, Lx = 120, 100
+    stats = random_stats(Ly=Ly, Lx=Lx)
+    ypixs, xpixs = [stat["ypix"] for stat in stats], [stat["xpix"] for stat in stats]
+    cell_pix = masks.create_cell_pix(stats, Ly=Ly, Lx=Lx)
+    for inner_neuropil_radius, min_neuropil_pixels in [(2, 350), (0, 100), (3, 20000)]:
+        neuropil_masks = masks.create_neuropil_mask_matrix(
+            ypixs, xpixs, cell_pix, inner_neuropil_radius=inner_neuropil_radius,
+            min_neuropil_pixels=min_neuropil_pixels)
+        assert neuropil_masks.shape == (len(stats), Ly * Lx)
+        neuropil_ipix = neuropil_masks_by_growing(ypixs, xpixs, cell_pix,
+                                                  inner_neuropil_radius,
+                                                  min_neuropil_pixels)
+        for k, ipix in enumerate(neuropil_ipix):
+            assert np.array_equal(neuropil_masks[k].indices, ipix)
+
+
+def test_mask_matrices_match_mask_lists_and_are_cached():
+    Ly, Lx = 120, 100
+    stats = random_stats(Ly=Ly, Lx=Lx)
+    for stat in stats:
+        stat["overlap"] = np.zeros(stat["ypix"].size, "bool")
+        stat["overlap"][::3] = True
+    cell_masks, neuropil_masks = masks.create_masks(stats, Ly, Lx)
+    cell_matrix, neuropil_matrix = masks.create_mask_matrices(stats, Ly, Lx)
+    assert cell_matrix.shape == neuropil_matrix.shape == (Ly * Lx, len(stats))
+    for k, (ipix, lam) in enumerate(cell_masks):
+        cell_mask = np.zeros(Ly * Lx, "float32")
+        cell_mask[ipix] = lam
+        assert np.allclose(cell_matrix[:, k].toarray().flatten(), cell_mask)
+        assert np.array_equal(neuropil_matrix[:, k].indices, neuropil_masks[k])
+    assert masks.create_mask_matrices(stats, Ly, Lx)[0] is cell_matrix
+    assert masks.create_mask_matrices(stats, Ly, Lx, allow_overlap=True)[0] is not cell_matrix
+    # the same pixels split differently between ROIs are not a cache hit
+    moved = [dict(stat) for stat in stats]
+    for key in ["ypix", "xpix", "lam", "overlap"]:
+        moved[0][key], moved[1][key] = stats[0][key][:-1], np.concatenate(
+            (stats[0][key][-1:], stats[1][key]))
+    assert masks.create_mask_matrices(moved, Ly, Lx)[0] is not cell_matrix
+
+
+def test_extract_traces_with_mask_matrices():
+    Ly, Lx = 120, 100
+    stats = random_stats(Ly=Ly, Lx=Lx)
+    for stat in stats:
+        stat["overlap"] = np.zeros(stat["ypix"].size, "bool")
+    mov = np.random.default_rng(0).integers(0, 1000, (50, Ly, Lx)).astype("int16")
+    cell_masks, neuropil_masks = masks.create_masks(stats, Ly, Lx)
+    cell_matrix, neuropil_matrix = masks.create_mask_matrices(stats, Ly, Lx)
+    F, Fneu = extract_traces(mov, cell_matrix, neuropil_matrix, batch_size=16,
+                             device=torch.device("cpu"))
+    F0, Fneu0 = extract_traces(mov, cell_masks, neuropil_masks, batch_size=16,
+                               device=torch.device("cpu"))
+    mov = mov.reshape(50, -1).astype("float64")
+    Fneu_dense = np.stack([mov[:, ipix].mean(axis=1) for ipix in neuropil_masks])
+    F_dense = np.stack([mov[:, ipix] @ lam for ipix, lam in cell_masks])
+    assert np.allclose(F, F_dense, rtol=1e-5) and np.allclose(Fneu, Fneu_dense, rtol=1e-5)
+    assert np.allclose(F, F0, rtol=1e-6) and np.array_equal(Fneu, Fneu0)
+
+
+def test_reextract_changed_rois_matches_full_extraction():
+    Ly, Lx = 120, 100
+    stats = assign_overlaps(np.array(random_stats(Ly=Ly, Lx=Lx)), Ly, Lx)
+    rng = np.random.default_rng(0)
+    mov = rng.integers(0, 1000, (40, Ly, Lx)).astype("int16")
+    mov_chan2 = rng.integers(0, 1000, (40, Ly, Lx)).astype("int16")
+    settings = default_settings()["extraction"]
+    cell_masks, neuropil_masks = masks.create_mask_matrices(
+        stats, Ly, Lx, **{key: settings[key] for key in MASK_SETTINGS})
+    outputs = extraction_wrapper(stats, mov, f_reg_chan2=mov_chan2, cell_masks=cell_masks,
+                                 neuropil_masks=neuropil_masks, settings=settings,
+                                 device=torch.device("cpu"))
+    assert np.array_equal(outputs[2], extract_traces(mov_chan2, cell_masks, neuropil_masks,
+                                                     device=torch.device("cpu"))[0])
+
+    keep_rois = rng.random(len(stats)) > 0.1
+    stats = assign_overlaps(stats[keep_rois], Ly, Lx)
+    outputs = reextract_changed_rois(stats, mov, keep_rois, cell_masks, neuropil_masks,
+                                     outputs[0], outputs[1], f_reg_chan2=mov_chan2,
+                                     F_chan2=outputs[2], Fneu_chan2=outputs[3],
+                                     settings=settings, device=torch.device("cpu"))
+    outputs_full = extraction_wrapper(stats, mov, f_reg_chan2=mov_chan2, settings=settings,
+                                      device=torch.device("cpu"))
+    for X, X_full in zip(outputs[:4], outputs_full):
+        assert X.shape == (len(stats), 40) and np.array_equal(X, X_full)
+
+
+def test_update_traces_matches_full_extraction(tmp_path):
+    Ly, Lx = 120, 100
+    stats = assign_overlaps(np.array(random_stats(Ly=Ly, Lx=Lx)), Ly, Lx)
+    mov = np.random.default_rng(0).integers(0, 1000, (40, Ly, Lx)).astype("int16")
+    settings = default_settings()
+    settings["fs"] = 10.
+    device = torch.device("cpu")
+    F_full, Fneu_full = extraction_wrapper(stats, mov, settings=settings["extraction"],
+                                           device=device)[:2]
+    for fname in ["F.npy", "Fneu.npy", "spks.npy"]:
+        np.save(tmp_path / fname, np.zeros((len(stats), 40), "float32"))
+
+    # edit in place
+    irois = np.array([3, 10, 57])
+    F, Fneu, spks = update_traces(str(tmp_path), stats, irois, mov, settings=settings,
+                                  device=device)
+    assert np.array_equal(F, F_full[irois]) and np.array_equal(Fneu, Fneu_full[irois])
+    assert np.array_equal(np.load(tmp_path / "F.npy")[irois], F_full[irois])
+    assert np.array_equal(np.load(tmp_path / "spks.npy")[irois], spks)
+
+    # remove two ROIs and add one at the end
+    keep = np.ones(len(stats), "bool")
+    keep[[0, 5]] = False
+    stats = assign_overlaps(np.concatenate((stats[keep], stats[:1])), Ly, Lx)
+    F, Fneu, spks = update_traces(str(tmp_path), stats, np.array([len(stats) - 1]), mov,
+                                  iremove=np.array([0, 5]), settings=settings,
+                                  device=device)
+    F_saved = np.load(tmp_path / "F.npy")
+    assert F_saved.shape == (len(stats), 40)
+    # rows of the edited ROIs 3, 10, 57 moved up past the removed rows 0 and 5
+    assert np.array_equal(F_saved[[2, 8, 55]], F_full[irois])
+    assert np.array_equal(F_saved[-1], F[0])
+    F_full = extraction_wrapper(stats, mov, settings=settings["extraction"],
+                                device=device)[0]
+    assert np.allclose(F[0], F_full[-1], rtol=1e-6)
+
+
+def test_oasis_matches_reference_and_writes_into_memmap(tmp_path):
+    rng = np.random.default_rng(0)
+    F = (rng.standard_normal((70, 3000)) +
+         3 * np.maximum(0, rng.standard_normal((70, 3000)))).astype("float32")
+    # reference: one fresh workspace per neuron
+    S0 = np.zeros_like(F)
+    v, w, l = np.zeros_like(F), np.zeros_like(F), np.zeros_like(F)
+    t = np.zeros(F.shape, "int64")
+    oasis_matrix(F, v, w, t, l, S0, 1.3, 13.)
+    assert np.array_equal(oasis(F, batch_size=32, tau=1.3, fs=13.), S0)
+
+    spks = np.lib.format.open_memmap(str(tmp_path / "spks.npy"), mode="w+",
+                                     dtype="float32", shape=F.shape)
+    spks[:] = 1
+    assert oasis(F, batch_size=32, tau=1.3, fs=13., out=spks) is spks
+    spks.flush()
+    assert np.array_equal(np.load(tmp_path / "spks.npy"), S0)
+
+
+def test_sliding_maximin_matches_min_max_filters():
+    rng = np.random.default_rng(0)
+    F = rng.standard_normal((7, 500)).astype("float32")
+    F[:, 100:120] = 0.5
+    for h in [0, 1, 12, 300, 600]:
+        Flow = np.zeros_like(F)
+        sliding_maximin(F, Flow, h)
+        Flow0 = maximum_filter1d(minimum_filter1d(F, 2 * h + 1, mode="nearest"), 2 * h + 1,
+                                 mode="nearest")
+        assert np.array_equal(Flow, Flow0)
+    # a single neuron is also filtered (up to the rounding of the gaussian smoothing)
+    F1 = preprocess(F[:1].copy(), "maximin", win_baseline=6., sig_baseline=2., fs=10.,
+                    device=torch.device("cpu"))
+    assert np.allclose(F1, preprocess(F.copy(), "maximin", win_baseline=6.,
+                                      sig_baseline=2., fs=10.,
+                                      device=torch.device("cpu"))[:1], atol=1e-6)
+
+
+def test_chunked_trace_processing_matches_in_memory(tmp_path):
+    rng = np.random.default_rng(0)
+    F = (rng.standard_normal((130, 2000)) + 5).astype("float32")
+    Fneu = (rng.standard_normal((130, 2000)) + 2).astype("float32")
+    np.save(tmp_path / "F.npy", F)
+    np.save(tmp_path / "Fneu.npy", Fneu)
+    F, Fneu = np.load(tmp_path / "F.npy", mmap_mode="r"), np.load(tmp_path / "Fneu.npy", mmap_mode="r")
+    # budget for 13 ROIs per chunk
+    memory_budget = 13 * traces.TRACES_PER_ROI * 4 * 2000 / 2**30
+    assert traces.chunk_size(2000, memory_budget) == 13
+
+    dF = np.array(F) - 0.7 * np.array(Fneu)
+    snr, sk, sd = traces.trace_statistics(F, Fneu, 0.7, memory_budget=memory_budget)
+    assert np.array_equal(snr, 1 - 0.5 * np.diff(dF, axis=1).var(axis=1) / dF.var(axis=1))
+    assert np.array_equal(sk, skew(dF, axis=1)) and np.array_equal(sd, dF.std(axis=1))
+
+    dcnv_settings = default_settings()["dcnv_preprocess"]
+    for baseline in ["maximin", "constant", "prctile"]:
+        dcnv_settings["baseline"] = baseline
+        spks0 = oasis(preprocess(F=dF.copy(), fs=10., batch_size=10, device=torch.device("cpu"),
+                                 **dcnv_settings), batch_size=10, tau=1., fs=10.)
+        spks = np.zeros(F.shape, "float32")
+        traces.deconvolve_traces(F, Fneu, spks, tau=1., fs=10., batch_size=10,
+                                 dcnv_settings=dcnv_settings, memory_budget=memory_budget,
+                                 device=torch.device("cpu"))
+        assert np.array_equal(spks, spks0)
@@ -258,3 +258,336 @@ def test_get_suite2p_path(input_path, expected_path, success):
     else:
         with pytest.raises(FileNotFoundError):
             get_suite2p_path(Path(input_path))
+
+
+def test_binary_file_cropped_reads_match_full_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    mov = rng.integers(-1000, 1000, (20, 37, 51)).astype("int16")
+    for tile_size in [None, 8, 64]:
+        filename = str(tmp_path / f"data_{tile_size}.bin")
+        with io.BinaryFile(37, 51, filename, n_frames=20, write=True,
+                           tile_size=tile_size) as f:
+            f[:] = mov
+            f[4, 3:20, 10:40] = np.zeros((17, 30), "int16")
+        mov[4, 3:20, 10:40] = 0
+        with io.BinaryFile(37, 51, filename, tile_size=tile_size) as f:
+            assert f.shape == mov.shape
+            for indices in [np.s_[:], np.s_[2:9, 5:30, 7:12], np.s_[3, ::3, 20:],
+                            np.s_[[1, 4], 10, :], np.s_[-1, 30:5:-2, [0, 50]]]:
+                assert np.array_equal(f[indices], mov[indices])
+
+
+def test_binary_file_combined_cropped_reads(tmp_path):
+    rng = np.random.default_rng(0)
+    Ly, Lx, dy, dx = [20, 15], [30, 25], [0, 22], [0, 10]
+    mov = np.zeros((12, 37, 40), "int16")
+    filenames = []
+    for n in range(2):
+        mov[:, dy[n]:dy[n] + Ly[n], dx[n]:dx[n] + Lx[n]] = rng.integers(
+            -100, 100, (12, Ly[n], Lx[n]))
+        filenames.append(str(tmp_path / f"data{n}.bin"))
+        with io.BinaryFile(Ly[n], Lx[n], filenames[-1], n_frames=12, write=True) as f:
+            f[:] = mov[:, dy[n]:dy[n] + Ly[n], dx[n]:dx[n] + Lx[n]]
+    with io.BinaryFileCombined(37, 40, Ly, Lx, dy, dx, filenames) as f:
+        assert f.shape == mov.shape
+        for indices in [np.s_[:], np.s_[2:5], np.s_[3, 25:37, 12:30], np.s_[:, 5:30, ::2]]:
+            assert np.array_equal(f[indices], mov[indices])
+
+
+def test_results_store_matches_pickled_outputs(tmp_path):
+    import datetime
+    from suite2p import default_settings
+    rng = np.random.default_rng(0)
+    Ly, Lx, nframes = 30, 40, 50
+    for ipl in range(2):
+        plane = tmp_path / f"plane{ipl}"
+        plane.mkdir()
+        stat = []
+        for k in range(5 + ipl):
+            npix = rng.integers(5, 20)
+            ypix, xpix = rng.integers(0, Ly, npix), rng.integers(0, Lx, npix)
+            stat.append({"ypix": ypix, "xpix": xpix, "lam": rng.random(npix).astype("float32"),
+                         "med": [int(np.median(ypix)), int(np.median(xpix))], "npix": npix,
+                         "overlap": rng.random(npix) > 0.8, "radius": rng.random(),
+                         "neighbors": rng.integers(0, 5, rng.integers(1, 4))})
+        np.save(plane / "stat.npy", np.array(stat, dtype=object))
+        np.save(plane / "db.npy", {"Ly": Ly, "Lx": Lx, "nframes": nframes, "nchannels": 1,
+                                   "nplanes": 2, "iplane": ipl, "data_path": [Path("/data")],
+                                   "dx": 0, "dy": 0})
+        np.save(plane / "settings.npy", {**default_settings(),
+                                         "date_proc": datetime.datetime.now().astimezone()})
+        np.save(plane / "reg_outputs.npy", {"meanImg": rng.random((Ly, Lx)), "yrange": [0, Ly],
+                                            "xrange": [0, Lx], "yoff": rng.random(nframes)})
+        np.save(plane / "detect_outputs.npy", {"Vcorr": rng.random((Ly, Lx)), "diameter": [8, 8]})
+        for key in ["F", "Fneu", "spks"]:
+            np.save(plane / f"{key}.npy", rng.random((len(stat), nframes)).astype("float32"))
+        np.save(plane / "iscell.npy", rng.random((len(stat), 2)))
+    legacy = io.combined(str(tmp_path), save=False)
+
+    assert io.convert_results(str(tmp_path)) == [str(tmp_path / "plane0"), str(tmp_path / "plane1")]
+    results = io.load_results(str(tmp_path / "plane1"))
+    stat = np.load(tmp_path / "plane1" / "stat.npy", allow_pickle=True)
+    assert isinstance(results["F"], np.memmap)
+    for s0, s1 in zip(stat, results["stat"].to_stat()):
+        assert s0.keys() == s1.keys()
+        for key in s0:
+            assert np.array_equal(s0[key], s1[key])
+            if isinstance(s0[key], np.ndarray):
+                assert type(s1[key]) is np.ndarray
+        assert isinstance(s1["med"], list)
+    assert results["settings"]["date_proc"] == np.load(
+        tmp_path / "plane1" / "settings.npy", allow_pickle=True).item()["date_proc"]
+    assert np.array_equal(results["reg_outputs"]["meanImg"],
+                          np.load(tmp_path / "plane1" / "reg_outputs.npy",
+                                  allow_pickle=True).item()["meanImg"])
+
+    columnar = io.combined(str(tmp_path), save=False)
+    for s0, s1 in zip(legacy[0], columnar[0]):
+        for key in s0:
+            assert np.array_equal(s0[key], s1[key])
+    for x0, x1 in zip(legacy[3:], columnar[3:]):
+        assert np.array_equal(x0, x1)
+
+    # a stat.npy saved after the store (e.g. by an older GUI) is used instead
+    np.save(tmp_path / "plane0" / "stat.npy", np.array(stat, dtype=object))
+    assert not io.store.has_store(str(tmp_path / "plane0"))
+    assert len(io.load_stat(str(tmp_path / "plane0"))) == len(stat)
+
+
+def make_plane_folders(save_folder, shapes, seed=1):
+    """ plane folders with random ROIs and traces of shapes [(n_rois, n_frames), ...] """
+    from suite2p import default_settings
+    rng = np.random.default_rng(seed)
+    traces, stats = [], []
+    for ipl, (nrois, nframes) in enumerate(shapes):
+        plane = save_folder / f"plane{ipl}"
+        plane.mkdir()
+        stat = []
+        for k in range(nrois):
+            ipix = rng.choice(400, 6, replace=False)
+            stat.append({"ypix": ipix // 20, "xpix": ipix % 20, "lam": rng.random(6).astype("float32"),
+                         "med": [10, 10], "npix": 6})
+        np.save(plane / "stat.npy", np.array(stat, dtype=object))
+        np.save(plane / "db.npy", {"Ly": 20, "Lx": 20, "nframes": nframes, "nchannels": 1,
+                                   "nplanes": len(shapes), "dx": 0, "dy": 0,
+                                   "data_path": [str(save_folder)]})
+        np.save(plane / "settings.npy", default_settings())
+        np.save(plane / "reg_outputs.npy", {"meanImg": np.ones((20, 20)), "yrange": [0, 20],
+                                            "xrange": [0, 20]})
+        np.save(plane / "detect_outputs.npy", {"Vcorr": np.ones((20, 20)),
+                                               "max_proj": np.ones((20, 20))})
+        F = {key: rng.random((nrois, nframes)).astype("float32")
+             for key in ["F", "Fneu", "spks"]}
+        for key in F:
+            np.save(plane / f"{key}.npy", F[key])
+        np.save(plane / "iscell.npy", rng.random((nrois, 2)))
+        traces.append(F)
+        stats.append(stat)
+    return traces, stats
+
+
+def test_combined_streams_traces_of_planes_with_different_lengths(tmp_path):
+    traces, _ = make_plane_folders(tmp_path, [(4, 60), (0, 60), (3, 50)])
+
+    out = io.combined(str(tmp_path), save=True)
+    assert isinstance(out[3], np.memmap)
+    for i, key in enumerate(["F", "Fneu", "spks"]):
+        expected = np.zeros((7, 60), "float32")
+        expected[:4] = traces[0][key]
+        expected[4:, :50] = traces[2][key]
+        assert np.array_equal(out[3 + i], expected)
+        assert np.array_equal(np.load(tmp_path / "combined" / f"{key}.npy"), expected)
+    assert [s["iplane"] for s in out[0]] == [0] * 4 + [2] * 3
+    assert len(out[6]) == 7
+
+    # without saving, the traces are backed by temporary files that leave no trace
+    files = sorted((tmp_path / "combined").iterdir())
+    out = io.combined(str(tmp_path), save=False)
+    assert isinstance(out[3], np.memmap)
+    assert np.array_equal(out[3][:4], traces[0]["F"])
+    assert sorted((tmp_path / "combined").iterdir()) == files
+
+
+@pytest.mark.parametrize("compression", ["gzip", None])
+def test_nwb_export_streams_compressed_traces(tmp_path, compression):
+    traces, stats = make_plane_folders(tmp_path, [(4, 60), (3, 50)])
+    save_nwb(tmp_path, compression=compression, n_workers=2)
+
+    with NWBHDF5IO(str(tmp_path / "ophys.nwb"), "r") as fio:
+        ophys = fio.read().processing["ophys"]
+        masks = ophys["ImageSegmentation"]["PlaneSegmentation"]["voxel_mask"]
+        for n, (iplane, k) in enumerate([(0, k) for k in range(4)] + [(1, k) for k in range(3)]):
+            mask = masks[n]
+            assert np.array_equal(mask["x"], stats[iplane][k]["ypix"])
+            assert np.array_equal(mask["y"], stats[iplane][k]["xpix"])
+            assert np.all(mask["z"] == iplane)
+            assert np.allclose(mask["weight"], stats[iplane][k]["lam"])
+        data = ophys["Fluorescence"]["plane1"].data
+        assert data.shape == (60, 3)
+        assert data.compression == compression and data.chunks is not None
+
+    _, _, F, Fneu, spks, iscell, *_ = read_nwb(tmp_path / "ophys.nwb")
+    for key, x in zip(["F", "Fneu", "spks"], [F, Fneu, spks]):
+        expected = np.zeros((7, 60), "float32")
+        expected[:4] = traces[0][key]
+        expected[4:, :50] = traces[1][key]
+        assert np.array_equal(x, expected)
+    assert np.array_equal(iscell, np.concatenate([np.load(tmp_path / f"plane{i}" / "iscell.npy")
+                                                  for i in range(2)]))
+
+
+def test_nwb_to_binary_streams_interleaved_planes(tmp_path):
+    import datetime
+    from pynwb import NWBFile, H5DataIO
+    from pynwb.ophys import OpticalChannel, TwoPhotonSeries
+    from suite2p import default_db, default_settings
+
+    rng = np.random.default_rng(0)
+    mov = rng.integers(0, 2**12, (101, 16, 24)).astype("uint16")
+    nwbfile = NWBFile(session_description="test", identifier="test",
+                      session_start_time=datetime.datetime.now().astimezone())
+    device = nwbfile.create_device(name="Microscope")
+    imaging_plane = nwbfile.create_imaging_plane(
+        name="ImagingPlane", optical_channel=OpticalChannel(
+            name="OpticalChannel", description="channel", emission_lambda=500.),
+        imaging_rate=10., description="test", device=device, excitation_lambda=600.,
+        indicator="GCaMP", location="V1")
+    nwbfile.add_acquisition(TwoPhotonSeries(
+        name="TwoPhotonSeries", imaging_plane=imaging_plane, rate=10., unit="a.u.",
+        data=H5DataIO(mov, chunks=(7, 16, 24), compression="gzip")))
+    (tmp_path / "data").mkdir()
+    with NWBHDF5IO(str(tmp_path / "data" / "movie.nwb"), "w") as fio:
+        fio.write(nwbfile)
+
+    db = {**default_db(), "data_path": [str(tmp_path / "data")], "input_format": "nwb",
+          "nplanes": 2, "save_path0": str(tmp_path), "batch_size": 20}
+    db["file_list"], db["first_files"] = io.utils.get_file_list(db)
+    dbs = io.utils.init_dbs(db)
+    with open(dbs[0]["reg_file"], "wb") as f0, open(dbs[1]["reg_file"], "wb") as f1:
+        dbs = io.nwb_to_binary(dbs, default_settings(), [f0, f1], None)
+
+    for j, db in enumerate(dbs):
+        expected = (mov[j::2] // 2).astype("int16")
+        assert db["nframes"] == len(expected) and (db["Ly"], db["Lx"]) == (16, 24)
+        with io.BinaryFile(16, 24, db["reg_file"]) as f:
+            assert np.array_equal(f.data, expected)
+        assert np.allclose(db["meanImg"], expected.mean(axis=0))
+
+
+def make_tiff_folders(tmp_path, counts=([12, 8], [10]), seed=0):
+    """ writes tiffs with counts[i] pages per file in folders f0, f1, ..., returns
+    the db and the pages of each folder """
+    import tifffile
+    from suite2p import default_db
+
+    rng = np.random.default_rng(seed)
+    pages, data_path = [], []
+    for ifolder, folder_counts in enumerate(counts):
+        folder = tmp_path / f"f{ifolder}"
+        folder.mkdir()
+        movs = [rng.integers(0, 4000, (n, 12, 10)).astype("uint16") for n in folder_counts]
+        for k, mov in enumerate(movs):
+            tifffile.imwrite(folder / f"m{k}.tif", mov)
+        pages.append(np.concatenate(movs))
+        data_path.append(str(folder))
+    db = {**default_db(), "data_path": data_path, "save_path0": str(tmp_path),
+          "nplanes": 2, "nchannels": 2, "functional_chan": 2, "batch_size": 4,
+          "force_sktiff": True}
+    db["file_list"], db["first_files"] = io.get_file_list(db)
+    return db, pages
+
+
+def convert_tiffs(db, mode="wb"):
+    import contextlib
+    from suite2p import default_settings
+
+    dbs = io.init_dbs(db)
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(d["reg_file"], mode)) for d in dbs]
+        files_chan2 = [stack.enter_context(open(d["reg_file_chan2"], mode)) for d in dbs]
+        return io.tiff_to_binary(dbs, default_settings(), files, files_chan2)
+
+
+def test_tiff_to_binary_routes_pages_to_planes_and_channels(tmp_path):
+    db, pages = make_tiff_folders(tmp_path)
+    dbs = convert_tiffs(db)
+
+    # pages cycle through (plane 0, chan 1), (plane 0, chan 2), (plane 1, chan 1), ...
+    # from the first page of each folder
+    for j, d in enumerate(dbs):
+        func = np.concatenate([(p[2 * j + 1::4] // 2) for p in pages]).astype("int16")
+        chan2 = np.concatenate([(p[2 * j::4] // 2) for p in pages]).astype("int16")
+        for fname, expected in [(d["reg_file"], func), (d["reg_file_chan2"], chan2)]:
+            assert np.array_equal(np.fromfile(fname, "int16").reshape(-1, 12, 10), expected)
+        assert d["nframes"] == len(func)
+        assert list(d["frames_per_folder"]) == [len(p[2 * j + 1::4]) for p in pages]
+        assert np.allclose(d["meanImg"], func.mean(axis=0))
+
+
+def test_tiff_to_binary_resumes_interrupted_conversion(tmp_path, monkeypatch):
+    from suite2p.io import tiff
+
+    db, pages = make_tiff_folders(tmp_path, counts=([12, 8, 6], [10, 7]))
+    expected = convert_tiffs(db)
+    expected_data = {d[f]: np.fromfile(d[f], "int16") for d in expected
+                     for f in ["reg_file", "reg_file_chan2"]}
+    assert io.load_manifest(str(tmp_path / "suite2p"))["complete"]
+
+    # interrupt the conversion in the middle of the fourth file
+    read_tiff, opened = tiff.read_tiff, []
+    def interrupted_read_tiff(file, tif, Ltif, ix, *args):
+        if file == db["file_list"][3] and ix > 0:
+            raise KeyboardInterrupt
+        return read_tiff(file, tif, Ltif, ix, *args)
+    monkeypatch.setattr(tiff, "read_tiff", interrupted_read_tiff)
+    with pytest.raises(KeyboardInterrupt):
+        convert_tiffs(db)
+    manifest = io.load_manifest(str(tmp_path / "suite2p"))
+    assert not manifest["complete"] and len(manifest["files"]) == 3
+
+    # only the remaining files are read, after truncating the partial frames
+    monkeypatch.setattr(tiff, "read_tiff", lambda file, *args: (opened.append(file),
+                                                                read_tiff(file, *args))[1])
+    dbs = convert_tiffs(db, mode="r+b")
+    assert set(opened) == set(db["file_list"][3:])
+    assert io.load_manifest(str(tmp_path / "suite2p"))["complete"]
+    for d, d0 in zip(dbs, expected):
+        for f in ["reg_file", "reg_file_chan2"]:
+            assert np.array_equal(np.fromfile(d[f], "int16"), expected_data[d[f]])
+        for key in ["nframes", "meanImg", "meanImg_chan2"]:
+            assert np.array_equal(d[key], d0[key])
+        assert np.array_equal(d["frames_per_file"], d0["frames_per_file"])
+
+
+def test_tiff_to_binary_appends_new_files(tmp_path):
+    import contextlib
+    import shutil
+    from suite2p import default_settings
+
+    (tmp_path / "full").mkdir()
+    db, pages = make_tiff_folders(tmp_path / "full", counts=([12, 8, 6],))
+    expected = convert_tiffs(db)
+
+    # convert the first two files, then append the third one
+    (tmp_path / "f0").mkdir()
+    for fname in ["m0.tif", "m1.tif"]:
+        shutil.copy(tmp_path / "full" / "f0" / fname, tmp_path / "f0" / fname)
+    db = {**db, "data_path": [str(tmp_path / "f0")], "save_path0": str(tmp_path)}
+    db["file_list"], db["first_files"] = io.get_file_list(db)
+    convert_tiffs(db)
+    shutil.copy(tmp_path / "full" / "f0" / "m2.tif", tmp_path / "f0" / "m2.tif")
+    dbs = [np.load(tmp_path / "suite2p" / f"plane{j}" / "db.npy", allow_pickle=True).item()
+           for j in range(2)]
+    for d in dbs:
+        d["file_list"], d["first_files"] = io.get_file_list(db)
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(d["reg_file"], "r+b")) for d in dbs]
+        files_chan2 = [stack.enter_context(open(d["reg_file_chan2"], "r+b")) for d in dbs]
+        dbs = io.tiff_to_binary(dbs, default_settings(), files, files_chan2, append=True)
+
+    assert len(io.load_manifest(str(tmp_path / "suite2p"))["files"]) == 3
+    for d, d0 in zip(dbs, expected):
+        for f in ["reg_file", "reg_file_chan2"]:
+            assert np.array_equal(np.fromfile(d[f], "int16"), np.fromfile(d0[f], "int16"))
+        assert d["nframes"] == d0["nframes"]
+        assert np.allclose(d["meanImg"], d0["meanImg"])
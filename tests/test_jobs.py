@@ -0,0 +1,48 @@
+"""
+Tests for the plane job backends, using stand-ins for the suite2p command and the scheduler.
+"""
+import numpy as np
+
+from suite2p import default_settings, default_db
+from suite2p.io.jobs import run_jobs, read_status, write_status, LocalBackend
+
+
+def plane_folders(tmp_path, nplanes=2):
+    db_paths = []
+    for ipl in range(nplanes):
+        save_path = tmp_path / f"plane{ipl}"
+        save_path.mkdir()
+        np.save(save_path / "db.npy", {**default_db(), "save_path": str(save_path)})
+        db_paths.append(str(save_path / "db.npy"))
+    return db_paths
+
+
+def test_status_file_roundtrip(tmp_path):
+    status_file = str(tmp_path / "job_status.txt")
+    assert read_status(status_file) == (None, "")
+    write_status(status_file, "failed", "Traceback\nValueError")
+    assert read_status(status_file) == ("failed", "Traceback\nValueError")
+
+
+def test_local_jobs_exiting_without_status_are_resubmitted(tmp_path):
+    db_paths = plane_folders(tmp_path)
+    # "true" exits without reporting to the status file
+    errors = run_jobs(db_paths, default_settings(), backend=LocalBackend(python="true"),
+                      max_retries=1, poll_interval=0.2)
+    assert list(errors) == [0, 1]
+    for db_path in db_paths:
+        state, message = read_status(db_path.replace("db.npy", "job_status.txt"))
+        assert state == "failed" and "exited" in message
+
+
+def test_batch_jobs_with_local_scheduler(tmp_path):
+    db_paths = plane_folders(tmp_path, nplanes=3)
+    # scripts run in the background, "false" fails and the job script reports it
+    errors = run_jobs(db_paths, default_settings(), backend="batch", python="false",
+                      submit_command="nohup sh {script} > /dev/null 2>&1 & echo $!",
+                      status_command="ps -p {job_id} -o pid=", max_retries=2,
+                      poll_interval=0.2, skip=[1])
+    assert list(errors) == [0, 2]
+    assert all(error == "failed" for error in errors.values())
+    assert (tmp_path / "plane0" / "job.sh").exists()
+    assert not (tmp_path / "plane1" / "job.sh").exists()
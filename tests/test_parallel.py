@@ -0,0 +1,61 @@
+"""
+Tests for the plane-level parallel scheduler that do not require the test data.
+"""
+import os
+import time
+import numpy as np
+
+from suite2p import default_settings, default_db, parallel
+from suite2p.parallel import plane_memory, worker_devices, run_planes_parallel
+
+
+def test_plane_memory_scales_with_plane_size():
+    settings = default_settings()
+    small = plane_memory({"Ly": 128, "Lx": 128, "nframes": 1000}, settings)
+    large = plane_memory({"Ly": 512, "Lx": 512, "nframes": 1000}, settings)
+    assert 0 < small < large
+    # the trace memory is capped by the post-processing budget
+    settings["extraction"]["memory_budget"] = 0.
+    assert plane_memory({"Ly": 512, "Lx": 512, "nframes": 1000}, settings) < large
+    assert worker_devices("cpu") == ["cpu"]
+
+
+def test_failing_planes_are_reported(tmp_path):
+    settings = default_settings()
+    settings["torch_device"] = "cpu"
+    db_paths = []
+    for ipl in range(3):
+        save_path = tmp_path / f"plane{ipl}"
+        save_path.mkdir()
+        # no binary file, so run_plane fails
+        db = {**default_db(), "save_path": str(save_path), "Ly": 32, "Lx": 32,
+              "nframes": 100, "iplane": ipl}
+        np.save(save_path / "db.npy", db)
+        db_paths.append(str(save_path / "db.npy"))
+    errors = run_planes_parallel(db_paths, settings, n_workers=2, threads_per_worker=1,
+                                 skip=[1])
+    assert list(errors) == [0, 2]
+    assert all(error is not None for error in errors.values())
+
+
+def _crashing_worker(ipl, db_path, settings, device, n_threads, log_queue):
+    """ worker of plane 0 dies, the other planes finish after a while """
+    if ipl == 0:
+        os._exit(1)
+    time.sleep(2)
+    return {"total_plane_runtime": 2.}, None
+
+
+def test_crashing_worker_does_not_fail_other_planes(tmp_path, monkeypatch):
+    settings = default_settings()
+    settings["torch_device"] = "cpu"
+    db_paths = []
+    for ipl in range(2):
+        db = {**default_db(), "Ly": 32, "Lx": 32, "nframes": 100, "iplane": ipl}
+        np.save(tmp_path / f"db{ipl}.npy", db)
+        db_paths.append(str(tmp_path / f"db{ipl}.npy"))
+    # the workers are spawned, so they import the worker from this module
+    monkeypatch.setattr(parallel, "_run_plane_worker", _crashing_worker)
+    errors = run_planes_parallel(db_paths, settings, n_workers=2, threads_per_worker=1)
+    assert errors[0] == "worker process terminated abruptly"
+    assert errors[1] is None
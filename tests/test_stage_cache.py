@@ -0,0 +1,106 @@
+"""
+Tests for the stage cache of the pipeline, and for appending frames to a
+processed plane, that do not require the test data.
+"""
+import os
+import numpy as np
+import torch
+
+from suite2p import default_settings
+from suite2p import extraction
+from suite2p.pipeline_s2p import pipeline, pipeline_append
+from suite2p.stage_cache import stage_hash, load_stage_hashes
+
+
+def synthetic_movie(nframes=400, Ly=96, Lx=96, n_cells=20, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.meshgrid(np.arange(Ly), np.arange(Lx), indexing="ij")
+    mov = 100 + rng.normal(0, 10, (nframes, Ly, Lx))
+    for k in range(n_cells):
+        cy, cx = rng.uniform(8, [Ly - 8, Lx - 8])
+        spikes = (rng.random(nframes) < 0.03).astype("float32")
+        trace = 200 * np.convolve(spikes, np.exp(-np.arange(30) / 8.))[:nframes]
+        mov += trace[:, None, None] * np.exp(-((yy - cy)**2 + (xx - cx)**2) / 18.)[None]
+    return mov.astype("int16")
+
+
+def test_stage_hash_is_deterministic():
+    settings = default_settings()
+    assert stage_hash(settings["detection"]) == stage_hash(default_settings()["detection"])
+    assert stage_hash(np.float32(0.5)) == stage_hash(0.5)
+    settings["detection"]["threshold_scaling"] = 2.
+    assert stage_hash(settings["detection"]) != stage_hash(default_settings()["detection"])
+
+
+def test_only_changed_stages_are_rerun(tmp_path):
+    mov = synthetic_movie()
+    settings = default_settings()
+    settings["detection"]["algorithm"] = "sourcery"
+    settings["diameter"], settings["fs"] = [8, 8], 10.
+    settings["extraction"]["snr_threshold"] = 0.2
+    outputs = ["stat_detection.npy", "F.npy", "spks.npy", "iscell.npy"]
+
+    def run():
+        out = pipeline(str(tmp_path), mov, run_registration=False, settings=settings,
+                       badframes=np.zeros(len(mov), "bool"), device=torch.device("cpu"),
+                       cache=True)
+        mtimes = [os.stat(tmp_path / fname).st_mtime_ns for fname in outputs]
+        return out, mtimes
+
+    out0, mtimes0 = run()
+    assert set(load_stage_hashes(str(tmp_path))) == {"detection", "extraction",
+                                                     "deconvolution", "classification"}
+    out1, mtimes1 = run()
+    assert mtimes1 == mtimes0
+    assert np.array_equal(out0[7], out1[7])
+
+    # deconvolution settings only change spks
+    settings["dcnv_preprocess"]["win_baseline"] = 30.
+    out2, mtimes2 = run()
+    assert [m2 == m1 for m1, m2 in zip(mtimes1, mtimes2)] == [True, True, False, True]
+
+    # extraction settings keep the detected ROIs
+    settings["extraction"]["neuropil_coefficient"] = 0.5
+    out3, mtimes3 = run()
+    assert [m3 == m2 for m2, m3 in zip(mtimes2, mtimes3)] == [True, False, False, False]
+
+    (tmp_path / "fresh").mkdir()
+    fresh = pipeline(str(tmp_path / "fresh"), mov, run_registration=False, settings=settings,
+                     badframes=np.zeros(len(mov), "bool"), device=torch.device("cpu"))
+    assert len(fresh[2]) == len(out3[2])
+    for cached, full in zip(out3[3:9], fresh[3:9]):
+        if full is not None:
+            assert np.allclose(cached, full)
+
+
+def test_pipeline_append_extends_traces_of_existing_rois(tmp_path):
+    mov = synthetic_movie(nframes=500)
+    n0 = 400
+    settings = default_settings()
+    settings["detection"]["algorithm"] = "sourcery"
+    settings["diameter"], settings["fs"] = [8, 8], 10.
+    settings["registration"]["nonrigid"] = False
+    settings["run"]["do_regmetrics"] = False
+    device = torch.device("cpu")
+
+    f_reg = mov.copy()
+    out0 = pipeline(str(tmp_path), f_reg[:n0], settings=settings,
+                    badframes=np.zeros(n0, "bool"), device=device)
+    reg0, stat0, F0, spks0 = out0[0], out0[2], np.array(out0[3]), np.array(out0[7])
+    registered0 = f_reg[:n0].copy()
+
+    out = pipeline_append(str(tmp_path), f_reg, n0, settings=settings, device=device)
+    reg_outputs, stat, F, spks = out[0], out[2], out[3], out[7]
+    assert F.shape == spks.shape == (len(stat0), len(mov))
+    assert np.array_equal(F[:, :n0], F0) and np.array_equal(spks[:, :n0], spks0)
+    assert np.array_equal(np.load(tmp_path / "F.npy"), F)
+
+    # appended frames are registered to the same reference image, then extracted
+    assert np.array_equal(reg_outputs["refImg"], reg0["refImg"])
+    assert len(reg_outputs["yoff"]) == len(reg_outputs["badframes"]) == len(mov)
+    assert np.array_equal(f_reg[:n0], registered0)
+    F1 = extraction.extraction_wrapper(stat, f_reg[n0:], settings=settings["extraction"],
+                                       device=device)[0]
+    assert np.allclose(F[:, n0:], F1)
+    assert np.allclose(reg_outputs["meanImg"], (n0 * reg0["meanImg"] + 100 * f_reg[n0:].mean(axis=0))
+                       / len(mov), atol=1e-2)